@@ -19,36 +19,72 @@
 This module represents a backup.
 """
 
+import bisect
 import datetime
+import errno
 import logging
 import os
+import pickle
 import shutil
+import time
 from glob import glob
+from multiprocessing.pool import ThreadPool
 
 import dateutil.parser
 import dateutil.tz
 
 from barman import output, xlog
-from barman.backup_executor import PostgresBackupExecutor, RsyncBackupExecutor
 from barman.compression import CompressionManager
 from barman.config import BackupOptions
+from barman.dedup import ObjectStore
 from barman.exceptions import (AbortedRetryHookScript,
                                CompressionIncompatibility, SshCommandException,
                                UnknownBackupIdException)
 from barman.hooks import HookScriptRunner, RetryHookScriptRunner
 from barman.infofile import BackupInfo, WalFileInfo
-from barman.recovery_executor import RecoveryExecutor
 from barman.remote_status import RemoteStatusMixin
+from barman.trash import Trash
 from barman.utils import fsync_dir, human_readable_timedelta, pretty_size
 
 _logger = logging.getLogger(__name__)
 
+#: Format version of the backup catalog snapshot
+CATALOG_SNAPSHOT_VERSION = 1
+
+#: Seconds within which the modification time of a file is not trusted
+#: to detect further changes (see the filesystem timestamp granularity)
+CATALOG_SNAPSHOT_RACY_TIME = 2
+
+
+def _delete_files(paths):
+    """
+    Delete a list of files, ignoring the ones already removed
+
+    :param list[str] paths: the files to delete
+    :return list[tuple[str,OSError]]: the files which could not
+        be deleted, with the error
+    """
+    errors = []
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                errors.append((path, e))
+    return errors
+
 
 class BackupManager(RemoteStatusMixin):
     """Manager of the backup archive for a server"""
 
     DEFAULT_STATUS_FILTER = (BackupInfo.DONE,)
 
+    #: Number of threads removing the obsolete WAL files
+    WAL_DELETION_JOBS = 4
+
+    #: Number of WAL files removed by a thread at a time
+    WAL_DELETION_BATCH_SIZE = 100
+
     def __init__(self, server):
         """
         Constructor
@@ -56,9 +92,16 @@ class BackupManager(RemoteStatusMixin):
         super(BackupManager, self).__init__()
         self.server = server
         self.config = server.config
+        #: Counter incremented at every change of the backup catalog,
+        #: used to invalidate the information derived from it
+        self.catalog_generation = 0
         self._backup_cache = None
         self.compression_manager = CompressionManager(self.config, server.path)
         self.executor = None
+        # The executors are imported here, as they are not needed by
+        # the commands working only on the WAL archive
+        from barman.backup_executor import (PostgresBackupExecutor,
+                                            RsyncBackupExecutor)
         try:
             if self.config.backup_method == "postgres":
                 self.executor = PostgresBackupExecutor(self)
@@ -77,6 +120,51 @@ class BackupManager(RemoteStatusMixin):
             return self.executor.mode
         return None
 
+    @property
+    def trash(self):
+        """
+        The trash area of the server, used by the `trash` deletion mode
+
+        :rtype: barman.trash.Trash
+        """
+        return Trash(self.config.trash_directory,
+                     ObjectStore(self.config.deduplication_directory))
+
+    @property
+    def _backup_cache(self):
+        """
+        The cache of the available backups, as a dictionary indexed by
+        backup id, or None if not loaded yet.
+
+        The ids of the cached backups are also kept in the sorted list
+        ``_backup_ids``, which is rebuilt when the cache is replaced and
+        updated by backup_cache_add and backup_cache_remove.
+        """
+        return self._backups
+
+    @_backup_cache.setter
+    def _backup_cache(self, value):
+        self._backups = value
+        self._backup_ids = None if value is None else sorted(value)
+        self.catalog_changed()
+
+    def reload_catalog(self):
+        """
+        Discard the cache of the available backups, which is read again
+        from disk when needed.
+
+        A long running process must call it to see the backups added or
+        removed by other processes.
+        """
+        self._backup_cache = None
+
+    def catalog_changed(self):
+        """
+        Notify a change of the backup catalog, like the addition or the
+        removal of a backup or a change of its status
+        """
+        self.catalog_generation += 1
+
     def get_available_backups(self, status_filter=DEFAULT_STATUS_FILTER):
         """
         Get a list of available backups
@@ -97,17 +185,127 @@ class BackupManager(RemoteStatusMixin):
                 backups[key] = value
         return backups
 
+    @property
+    def catalog_snapshot_path(self):
+        """
+        Path of the snapshot of the backup catalog
+        """
+        return os.path.join(self.config.backup_directory,
+                            'backup_catalog.cache')
+
     def _load_backup_cache(self):
         """
         Populate the cache of the available backups, reading information
         from disk.
+
+        The content of the backup.info files is taken from the catalog
+        snapshot, which is valid as long as the modification time of the
+        base backups directory and the modification time and size of
+        every backup.info file are unchanged. Only the files which
+        changed are parsed, and the snapshot is then rewritten.
+        """
+        snapshot = self._read_catalog_snapshot()
+        base_dir = self.config.basebackups_directory
+        try:
+            directory_mtime = os.stat(base_dir).st_mtime
+        except OSError:
+            directory_mtime = None
+        entries = snapshot.get('backups', {})
+        if directory_mtime is not None and \
+                directory_mtime == snapshot.get('directory_mtime'):
+            # No backup has been added or removed
+            filenames = [os.path.join(base_dir, backup_id, 'backup.info')
+                         for backup_id in entries]
+            changed = False
+        else:
+            filenames = glob("%s/*/backup.info" % base_dir)
+            changed = True
+        backups = {}
+        new_entries = {}
+        for filename in filenames:
+            backup_id = os.path.basename(os.path.dirname(filename))
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                # The backup has been removed
+                changed = True
+                continue
+            key = (stat.st_mtime, stat.st_size)
+            entry = entries.get(backup_id)
+            if entry is not None and entry[0] == key:
+                backup = BackupInfo.from_fields(self.server, filename,
+                                                entry[1], entry[2])
+            else:
+                # Load the backup from disk reading the backup.info file
+                backup = BackupInfo(self.server, filename)
+                changed = True
+            backups[backup.backup_id] = backup
+            new_entries[backup.backup_id] = (
+                key, backup.fields(), backup.backup_version)
+        self._backup_cache = backups
+        if changed and directory_mtime is not None:
+            self._write_catalog_snapshot(directory_mtime, new_entries)
+
+    def _read_catalog_snapshot(self):
+        """
+        Read the snapshot of the backup catalog.
+
+        An empty dictionary is returned if the snapshot is missing
+        or invalid.
+
+        :rtype: dict
+        """
+        try:
+            with open(self.catalog_snapshot_path, 'rb') as snapshot_file:
+                snapshot = pickle.load(snapshot_file)
+            if isinstance(snapshot, dict) and \
+                    snapshot.get('version') == CATALOG_SNAPSHOT_VERSION:
+                return snapshot
+        except (IOError, OSError):
+            pass
+        except Exception as e:
+            _logger.debug("Ignoring invalid backup catalog snapshot %s: %s",
+                          self.catalog_snapshot_path, e)
+        return {}
+
+    def _write_catalog_snapshot(self, directory_mtime, entries):
         """
-        self._backup_cache = {}
-        # Load all the backups from disk reading the backup.info files
-        for filename in glob("%s/*/backup.info" %
-                             self.config.basebackups_directory):
-            backup = BackupInfo(self.server, filename)
-            self._backup_cache[backup.backup_id] = backup
+        Atomically replace the snapshot of the backup catalog.
+
+        Files modified in the last CATALOG_SNAPSHOT_RACY_TIME seconds
+        could change again without a visible change of their modification
+        time, so they are left out of the snapshot, and the directory
+        is listed again at the next load.
+
+        :param float directory_mtime: modification time of the
+            base backups directory
+        :param dict entries: the snapshot entries, indexed by backup id
+        """
+        limit = time.time() - CATALOG_SNAPSHOT_RACY_TIME
+        if directory_mtime >= limit:
+            directory_mtime = None
+        for backup_id in list(entries):
+            if entries[backup_id][0][0] >= limit:
+                del entries[backup_id]
+                directory_mtime = None
+        snapshot = {
+            'version': CATALOG_SNAPSHOT_VERSION,
+            'directory_mtime': directory_mtime,
+            'backups': entries,
+        }
+        path = self.catalog_snapshot_path
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as snapshot_file:
+                pickle.dump(snapshot, snapshot_file, 2)
+            os.rename(tmp_path, path)
+        except Exception as e:
+            _logger.debug("Unable to write backup catalog snapshot %s: %s",
+                          path, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
 
     def backup_cache_add(self, backup_info):
         """
@@ -121,8 +319,12 @@ class BackupManager(RemoteStatusMixin):
         # Load the cache if needed
         if self._backup_cache is None:
             self._load_backup_cache()
-        # Insert the BackupInfo object into the cache
+        # Insert the BackupInfo object into the cache, keeping the
+        # list of ids sorted
+        if backup_info.backup_id not in self._backup_cache:
+            bisect.insort(self._backup_ids, backup_info.backup_id)
         self._backup_cache[backup_info.backup_id] = backup_info
+        self.catalog_changed()
 
     def backup_cache_remove(self, backup_info):
         """
@@ -138,6 +340,9 @@ class BackupManager(RemoteStatusMixin):
             return
         # Remove the BackupInfo object from the backups cache
         del self._backup_cache[backup_info.backup_id]
+        del self._backup_ids[bisect.bisect_left(self._backup_ids,
+                                                backup_info.backup_id)]
+        self.catalog_changed()
 
     def get_backup(self, backup_id):
         """
@@ -150,13 +355,52 @@ class BackupManager(RemoteStatusMixin):
         :rtype: BackupInfo|None
         """
         if backup_id is not None:
-            # Get all the available backups from the cache
-            available_backups = self.get_available_backups(
-                BackupInfo.STATUS_ALL)
+            # Load the cache if necessary
+            if self._backup_cache is None:
+                self._load_backup_cache()
             # Return the BackupInfo if present, or None
-            return available_backups.get(backup_id)
+            return self._backup_cache.get(backup_id)
         return None
 
+    def _find_backup(self, position, step, status_filter):
+        """
+        Walk the sorted list of backup ids, starting from the given
+        position, and return the first backup matching the status filter.
+
+        The status is checked on the cached BackupInfo objects, because
+        it changes while a backup is running.
+
+        :param int position: the first position to check
+        :param int step: 1 to walk forward, -1 to walk backward
+        :param tuple status_filter: the status of the backup to return
+        :rtype: BackupInfo|None
+        """
+        ids = self._backup_ids
+        while 0 <= position < len(ids):
+            backup = self._backup_cache[ids[position]]
+            if backup.status in status_filter:
+                return backup
+            position += step
+        return None
+
+    def _get_backup_position(self, backup_id):
+        """
+        Return the position of a backup id inside the sorted list of
+        backup ids, loading the cache if necessary
+
+        :param str backup_id: the ID of the backup
+        :rtype: int
+        :raise UnknownBackupIdException: if the backup is not in the catalog
+        """
+        if self._backup_cache is None:
+            self._load_backup_cache()
+        position = bisect.bisect_left(self._backup_ids, backup_id)
+        if position == len(self._backup_ids) or \
+                self._backup_ids[position] != backup_id:
+            raise UnknownBackupIdException('Could not find backup_id %s' %
+                                           backup_id)
+        return position
+
     def get_previous_backup(self, backup_id,
                             status_filter=DEFAULT_STATUS_FILTER):
         """
@@ -167,21 +411,8 @@ class BackupManager(RemoteStatusMixin):
         """
         if not isinstance(status_filter, tuple):
             status_filter = tuple(status_filter)
-        backup = BackupInfo(self.server, backup_id=backup_id)
-        available_backups = self.get_available_backups(status_filter +
-                                                       (backup.status,))
-        ids = sorted(available_backups.keys())
-        try:
-            current = ids.index(backup_id)
-            while current > 0:
-                res = available_backups[ids[current - 1]]
-                if res.status in status_filter:
-                    return res
-                current -= 1
-            return None
-        except ValueError:
-            raise UnknownBackupIdException('Could not find backup_id %s' %
-                                           backup_id)
+        position = self._get_backup_position(backup_id)
+        return self._find_backup(position - 1, -1, status_filter)
 
     def get_next_backup(self, backup_id, status_filter=DEFAULT_STATUS_FILTER):
         """
@@ -192,21 +423,8 @@ class BackupManager(RemoteStatusMixin):
         """
         if not isinstance(status_filter, tuple):
             status_filter = tuple(status_filter)
-        backup = BackupInfo(self.server, backup_id=backup_id)
-        available_backups = self.get_available_backups(status_filter +
-                                                       (backup.status,))
-        ids = sorted(available_backups.keys())
-        try:
-            current = ids.index(backup_id)
-            while current < (len(ids) - 1):
-                res = available_backups[ids[current + 1]]
-                if res.status in status_filter:
-                    return res
-                current += 1
-            return None
-        except ValueError:
-            raise UnknownBackupIdException('Could not find backup_id %s' %
-                                           backup_id)
+        position = self._get_backup_position(backup_id)
+        return self._find_backup(position + 1, 1, status_filter)
 
     def get_last_backup_id(self, status_filter=DEFAULT_STATUS_FILTER):
         """
@@ -216,12 +434,13 @@ class BackupManager(RemoteStatusMixin):
             default to DEFAULT_STATUS_FILTER.
         :return string|None: ID of the backup
         """
-        available_backups = self.get_available_backups(status_filter)
-        if len(available_backups) == 0:
-            return None
-
-        ids = sorted(available_backups.keys())
-        return ids[-1]
+        if not isinstance(status_filter, tuple):
+            status_filter = tuple(status_filter)
+        if self._backup_cache is None:
+            self._load_backup_cache()
+        backup = self._find_backup(len(self._backup_ids) - 1, -1,
+                                   status_filter)
+        return backup and backup.backup_id
 
     def get_first_backup_id(self, status_filter=DEFAULT_STATUS_FILTER):
         """
@@ -231,12 +450,12 @@ class BackupManager(RemoteStatusMixin):
             default to DEFAULT_STATUS_FILTER.
         :return string|None: ID of the backup
         """
-        available_backups = self.get_available_backups(status_filter)
-        if len(available_backups) == 0:
-            return None
-
-        ids = sorted(available_backups.keys())
-        return ids[0]
+        if not isinstance(status_filter, tuple):
+            status_filter = tuple(status_filter)
+        if self._backup_cache is None:
+            self._load_backup_cache()
+        backup = self._find_backup(0, 1, status_filter)
+        return backup and backup.backup_id
 
     def delete_backup(self, backup):
         """
@@ -244,85 +463,189 @@ class BackupManager(RemoteStatusMixin):
 
         :param backup: the backup to delete
         """
-        available_backups = self.get_available_backups()
+        self.delete_backups([backup])
+
+    def delete_backups(self, backups):
+        """
+        Delete a set of backups
+
+        The data of every backup is deleted first, then the WAL files
+        which are not needed anymore are removed with a single pass on
+        the xlogdb, and finally the backup directories are removed.
+
+        :param list[barman.infofile.BackupInfo] backups: the backups
+            to delete
+        """
+        available_backups = len(self.get_available_backups())
         minimum_redundancy = self.server.config.minimum_redundancy
-        # Honour minimum required redundancy
-        if backup.status == BackupInfo.DONE and \
-                minimum_redundancy >= len(available_backups):
-            output.warning("Skipping delete of backup %s for server %s "
-                           "due to minimum redundancy requirements "
-                           "(minimum redundancy = %s, "
-                           "current redundancy = %s)",
-                           backup.backup_id,
-                           self.config.name,
-                           len(available_backups),
-                           minimum_redundancy)
+        deleted = []
+        for backup in sorted(backups, key=lambda b: b.backup_id):
+            # Honour minimum required redundancy
+            if backup.status == BackupInfo.DONE and \
+                    minimum_redundancy >= available_backups:
+                output.warning("Skipping delete of backup %s for server %s "
+                               "due to minimum redundancy requirements "
+                               "(minimum redundancy = %s, "
+                               "current redundancy = %s)",
+                               backup.backup_id,
+                               self.config.name,
+                               available_backups,
+                               minimum_redundancy)
+                continue
+            # Keep track of when the delete operation started.
+            delete_start_time = datetime.datetime.now()
+            output.info("Deleting backup %s for server %s",
+                        backup.backup_id, self.config.name)
+            # Move the whole backup in the trash, or
+            # delete all the data contained in the backup
+            trashed = self._move_backup_to_trash(backup)
+            if not trashed:
+                try:
+                    self.delete_backup_data(backup)
+                except OSError as e:
+                    output.error("Failure deleting backup %s for server %s."
+                                 "\n%s", backup.backup_id, self.config.name,
+                                 e)
+                    continue
+            if backup.status == BackupInfo.DONE:
+                available_backups -= 1
+            deleted.append((backup, trashed, delete_start_time))
+        if not deleted:
             return
-        # Keep track of when the delete operation started.
-        delete_start_time = datetime.datetime.now()
-        output.info("Deleting backup %s for server %s",
-                    backup.backup_id, self.config.name)
-        previous_backup = self.get_previous_backup(backup.backup_id)
-        next_backup = self.get_next_backup(backup.backup_id)
-        # Delete all the data contained in the backup
+        self._remove_wal_of_deleted_backups([b for b, _, _ in deleted])
+        for backup, trashed, delete_start_time in deleted:
+            # As last action, remove the backup directory,
+            # ending the delete operation
+            try:
+                if not trashed:
+                    self.delete_basebackup(backup)
+            except OSError as e:
+                output.error("Failure deleting backup %s for server %s.\n%s\n"
+                             "Please manually remove the '%s' directory",
+                             backup.backup_id, self.config.name, e,
+                             backup.get_basebackup_directory())
+                continue
+            self.backup_cache_remove(backup)
+            # Save the time of the complete removal of the backup
+            delete_end_time = datetime.datetime.now()
+            output.info("Deleted backup %s (start time: %s, elapsed time: %s)",
+                        backup.backup_id,
+                        delete_start_time.ctime(),
+                        human_readable_timedelta(
+                            delete_end_time - delete_start_time))
+
+    def _move_backup_to_trash(self, backup):
+        """
+        Move the directory of a backup in the trash, if the `trash`
+        deletion mode is enabled
+
+        :param barman.infofile.BackupInfo backup: the backup to delete
+        :return bool: True if the backup has been moved in the trash
+        """
+        if self.config.deletion_mode != 'trash':
+            return False
         try:
-            self.delete_backup_data(backup)
+            self.trash.put_directory(backup.get_basebackup_directory(),
+                                     'backup-%s' % backup.backup_id)
         except OSError as e:
-            output.error("Failure deleting backup %s for server %s.\n%s",
-                         backup.backup_id, self.config.name, e)
-            return
-        # Check if we are deleting the first available backup
-        if not previous_backup:
-            # In the case of exclusive backup (default), removes any WAL
-            # files associated to the backup being deleted.
-            # In the case of concurrent backup, removes only WAL files
-            # prior to the start of the backup being deleted, as they
-            # might be useful to any concurrent backup started immediately
-            # after.
-            remove_until = None  # means to remove all WAL files
-            if next_backup:
-                remove_until = next_backup
-            elif BackupOptions.CONCURRENT_BACKUP in self.config.backup_options:
-                remove_until = backup
-
-            timelines_to_protect = set()
-            # If remove_until is not set there are no backup left
-            if remove_until:
-                # Retrieve the list of extra timelines that contains at least
-                # a backup. On such timelines we don't want to delete any WAL
-                for value in self.get_available_backups(
-                        BackupInfo.STATUS_ARCHIVING).values():
-                    # Ignore the backup that is being deleted
-                    if value == backup:
-                        continue
-                    timelines_to_protect.add(value.timeline)
-                # Remove the timeline of `remove_until` from the list.
-                # We have enough information to safely delete unused WAL files
-                # on it.
-                timelines_to_protect -= set([remove_until.timeline])
-
-            output.info("Delete associated WAL segments:")
-            for name in self.remove_wal_before_backup(remove_until,
-                                                      timelines_to_protect):
-                output.info("\t%s", name)
-        # As last action, remove the backup directory,
-        # ending the delete operation
+            output.warning("Unable to move backup %s for server %s "
+                           "in the trash, deleting it immediately: %s",
+                           backup.backup_id, self.config.name, e)
+            return False
+        return True
+
+    def _move_wal_to_trash(self, wal_infos):
+        """
+        Move a list of WAL files in the trash, deleting them immediately
+        if this is not possible
+
+        :param list[barman.infofile.WalFileInfo] wal_infos: the WAL files
+        """
+        paths = [wal_info.fullpath(self.server) for wal_info in wal_infos]
         try:
-            self.delete_basebackup(backup)
+            self.trash.put_files(paths, 'wals')
         except OSError as e:
-            output.error("Failure deleting backup %s for server %s.\n%s\n"
-                         "Please manually remove the '%s' directory",
-                         backup.backup_id, self.config.name, e,
-                         backup.get_basebackup_directory())
+            output.warning("Unable to move WAL files for server %s "
+                           "in the trash, deleting them immediately: %s",
+                           self.config.name, e)
+            self.delete_wals(wal_infos)
+            return
+        self._remove_empty_hash_dirs(paths)
+
+    @staticmethod
+    def _remove_empty_hash_dirs(paths):
+        """
+        Remove the hash directories of the WAL archive left empty
+        after the removal of some WAL files
+
+        :param list[str] paths: the removed WAL files
+        """
+        for directory in sorted(set(os.path.dirname(p) for p in paths)):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                # The directory is not empty
+                pass
+
+    def _remove_wal_of_deleted_backups(self, backups):
+        """
+        Remove the WAL files which are not needed anymore after the
+        deletion of a set of backups
+
+        WAL files are removed only if at least one of the deleted backups
+        was older than every remaining DONE backup. The horizon and the
+        timelines to protect are computed on the final catalog, so the
+        xlogdb is rewritten only once.
+
+        :param list[barman.infofile.BackupInfo] backups: the deleted
+            backups, sorted by id
+        """
+        deleted_ids = set(backup.backup_id for backup in backups)
+        first_backup_id = None
+        for backup_id in self._backup_ids:
+            if backup_id not in deleted_ids and \
+                    self._backup_cache[backup_id].status == BackupInfo.DONE:
+                first_backup_id = backup_id
+                break
+        # The deleted backups which were the first available one
+        # after the deletion of the previous ones
+        first_deleted = [backup for backup in backups
+                         if first_backup_id is None or
+                         backup.backup_id < first_backup_id]
+        if not first_deleted:
             return
-        self.backup_cache_remove(backup)
-        # Save the time of the complete removal of the backup
-        delete_end_time = datetime.datetime.now()
-        output.info("Deleted backup %s (start time: %s, elapsed time: %s)",
-                    backup.backup_id,
-                    delete_start_time.ctime(),
-                    human_readable_timedelta(
-                        delete_end_time - delete_start_time))
+        # In the case of exclusive backup (default), removes any WAL
+        # files associated to the backups being deleted.
+        # In the case of concurrent backup, removes only WAL files
+        # prior to the start of the last backup being deleted, as they
+        # might be useful to any concurrent backup started immediately
+        # after.
+        remove_until = None  # means to remove all WAL files
+        if first_backup_id:
+            remove_until = self._backup_cache[first_backup_id]
+        elif BackupOptions.CONCURRENT_BACKUP in self.config.backup_options:
+            remove_until = first_deleted[-1]
+
+        timelines_to_protect = set()
+        # If remove_until is not set there are no backup left
+        if remove_until:
+            # Retrieve the list of extra timelines that contains at least
+            # a backup. On such timelines we don't want to delete any WAL
+            for value in self.get_available_backups(
+                    BackupInfo.STATUS_ARCHIVING).values():
+                # Ignore the backups that are being deleted
+                if value.backup_id in deleted_ids:
+                    continue
+                timelines_to_protect.add(value.timeline)
+            # Remove the timeline of `remove_until` from the list.
+            # We have enough information to safely delete unused WAL files
+            # on it.
+            timelines_to_protect -= set([remove_until.timeline])
+
+        output.info("Delete associated WAL segments:")
+        for name in self.remove_wal_before_backup(remove_until,
+                                                  timelines_to_protect):
+            output.info("\t%s", name)
 
     def backup(self):
         """
@@ -358,6 +681,10 @@ class BackupManager(RemoteStatusMixin):
             # Do the backup using the BackupExecutor
             self.executor.backup(backup_info)
 
+            # Move the backup files in the deduplication store
+            if self.config.deduplication:
+                self.deduplicate_backup(backup_info)
+
             # Compute backup size and fsync it on disk
             self.backup_fsync_and_set_sizes(backup_info)
 
@@ -450,6 +777,7 @@ class BackupManager(RemoteStatusMixin):
         # Archive every WAL files in the incoming directory of the server
         self.server.archive_wal(verbose=False)
         # Delegate the recovery operation to a RecoveryExecutor object
+        from barman.recovery_executor import RecoveryExecutor
         executor = RecoveryExecutor(self)
         recovery_info = executor.recover(backup_info,
                                          dest, tablespaces,
@@ -482,12 +810,16 @@ class BackupManager(RemoteStatusMixin):
             available_backups = self.get_available_backups(
                 BackupInfo.STATUS_ALL)
             retention_status = self.config.retention_policy.report()
+            obsolete_backups = []
             for bid in sorted(retention_status.keys()):
                 if retention_status[bid] == BackupInfo.OBSOLETE:
                     output.info(
                         "Enforcing retention policy: removing backup %s for "
                         "server %s" % (bid, self.config.name))
-                    self.delete_backup(available_backups[bid])
+                    obsolete_backups.append(available_backups[bid])
+            # Delete all the obsolete backups at once
+            if obsolete_backups:
+                self.delete_backups(obsolete_backups)
 
     def delete_basebackup(self, backup):
         """
@@ -523,6 +855,11 @@ class BackupManager(RemoteStatusMixin):
             _logger.debug("Deleting PGDATA directory: %s" % pg_data)
             shutil.rmtree(pg_data)
 
+        # Remove the deduplicated objects which are not used anymore.
+        # This is a no-op if the backup has not been deduplicated.
+        store = ObjectStore(self.config.deduplication_directory)
+        store.release(backup.get_basebackup_directory())
+
     def delete_wal(self, wal_info):
         """
         Delete a WAL segment, with the given WalFileInfo
@@ -544,6 +881,33 @@ class BackupManager(RemoteStatusMixin):
                            'for server %s: %s',
                            wal_info.name, self.config.name, e)
 
+    def delete_wals(self, wal_infos):
+        """
+        Delete a list of WAL segments, in parallel batches
+
+        :param list[barman.infofile.WalFileInfo] wal_infos: the WAL files
+            to delete
+        """
+        paths = [wal_info.fullpath(self.server) for wal_info in wal_infos]
+        size = self.WAL_DELETION_BATCH_SIZE
+        batches = [paths[i:i + size] for i in range(0, len(paths), size)]
+        if len(batches) > 1:
+            pool = ThreadPool(processes=self.WAL_DELETION_JOBS)
+            try:
+                results = list(pool.imap_unordered(_delete_files, batches))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_delete_files(batch) for batch in batches]
+        # The errors are reported by the main thread
+        for errors in results:
+            for path, e in errors:
+                output.warning('Ignoring deletion of WAL file %s '
+                               'for server %s: %s',
+                               os.path.basename(path), self.config.name, e)
+        self._remove_empty_hash_dirs(paths)
+
     def check(self, check_strategy):
         """
         This function does some checks on the server.
@@ -772,12 +1136,16 @@ class BackupManager(RemoteStatusMixin):
         If timelines_to_protect list is passed, never remove a wal in one of
         these timelines.
 
+        The xlogdb is rewritten first, and the files are removed after
+        the release of its lock, so the WAL archiving is not blocked.
+
         :param BackupInfo|None backup_info: the backup information structure
         :param set timelines_to_protect: optional list of timelines
             to protect
         :return list: a list of removed WAL files
         """
         removed = []
+        obsolete = []
         with self.server.xlogdb() as fxlogdb:
             xlogdb_new = fxlogdb.name + ".new"
             with open(xlogdb_new, 'w') as fxlogdb_new:
@@ -810,12 +1178,18 @@ class BackupManager(RemoteStatusMixin):
                     if keep:
                         fxlogdb_new.write(wal_info.to_xlogdb_line())
                     else:
-                        self.delete_wal(wal_info)
+                        obsolete.append(wal_info)
                         removed.append(wal_info.name)
                 fxlogdb_new.flush()
                 os.fsync(fxlogdb_new.fileno())
             shutil.move(xlogdb_new, fxlogdb.name)
             fsync_dir(os.path.dirname(fxlogdb.name))
+        # The obsolete files are not in the catalog anymore
+        if obsolete:
+            if self.config.deletion_mode == 'trash':
+                self._move_wal_to_trash(obsolete)
+            else:
+                self.delete_wals(obsolete)
         return removed
 
     def validate_last_backup_maximum_age(self, last_backup_maximum_age):
@@ -851,6 +1225,27 @@ class BackupManager(RemoteStatusMixin):
             # If no backup is available return false
             return False, "No available backups"
 
+    def deduplicate_backup(self, backup_info):
+        """
+        Store the files of a backup in the deduplication object store,
+        replacing them with hard links to the stored objects.
+
+        :param barman.infofile.BackupInfo backup_info: the backup to update
+        """
+        self.executor.current_action = "deduplicating backup files"
+        _logger.debug(self.executor.current_action)
+        store = ObjectStore(self.config.deduplication_directory)
+        # The files linked to the previous backup (reuse_backup = link)
+        # don't need to be hashed again
+        reference_dir = None
+        previous_backup = self.get_previous_backup(backup_info.backup_id)
+        if previous_backup:
+            reference_dir = previous_backup.get_basebackup_directory()
+        shared_files, shared_size = store.deduplicate(
+            backup_info.get_basebackup_directory(), reference_dir)
+        output.info("Deduplication: %s files (%s) shared with other backups",
+                    shared_files, pretty_size(shared_size))
+
     def backup_fsync_and_set_sizes(self, backup_info):
         """
         Fsync all files in a backup and set the actual size on disk
@@ -866,6 +1261,8 @@ class BackupManager(RemoteStatusMixin):
         _logger.debug(self.executor.current_action)
         backup_size = 0
         deduplicated_size = 0
+        # Every file in the deduplication store has an additional link
+        max_links = 2 if self.config.deduplication else 1
         backup_dest = backup_info.get_basebackup_directory()
         for dir_path, _, file_names in os.walk(backup_dest):
             # execute fsync() on the containing directory
@@ -877,7 +1274,7 @@ class BackupManager(RemoteStatusMixin):
                 file_stat = os.fstat(file_fd)
                 backup_size += file_stat.st_size
                 # Excludes hard links from real backup size
-                if file_stat.st_nlink == 1:
+                if file_stat.st_nlink <= max_links:
                     deduplicated_size += file_stat.st_size
                 os.fsync(file_fd)
                 os.close(file_fd)
@@ -890,7 +1287,7 @@ class BackupManager(RemoteStatusMixin):
         else:
             deduplication_ratio = 0
 
-        if self.config.reuse_backup == 'link':
+        if self.config.reuse_backup == 'link' or self.config.deduplication:
             output.info(
                 "Backup size: %s. Actual size on disk: %s"
                 " (-%s deduplication ratio)." % (
@@ -27,28 +27,33 @@ A BackupExecutor is invoked by the BackupManager for backup operations.
 """
 
 import datetime
+import errno
+import json
 import logging
 import os
 import re
 import shutil
+import tarfile
+import tempfile
 from abc import ABCMeta, abstractmethod
+from contextlib import closing, contextmanager
 from functools import partial
 
 import dateutil.parser
 from distutils.version import LooseVersion as Version
 
 from barman import output, xlog
-from barman.command_wrappers import PgBaseBackup
+from barman.command_wrappers import PgBaseBackup, SshControlMaster
 from barman.config import BackupOptions
-from barman.copy_controller import RsyncCopyController
+from barman.copy_controller import PostgresCopyController, RsyncCopyController
 from barman.exceptions import (CommandFailedException, DataTransferFailure,
                                FsOperationFailed, PostgresConnectionError,
                                PostgresIsInRecovery, SshCommandException)
 from barman.fs import UnixRemoteCommand
 from barman.infofile import BackupInfo
-from barman.remote_status import RemoteStatusMixin
-from barman.utils import (human_readable_timedelta, mkpath, total_seconds,
-                          with_metaclass)
+from barman.remote_status import VOLATILE_STATUS_TTL, RemoteStatusMixin
+from barman.utils import (human_readable_timedelta, mkpath, pretty_size,
+                          total_seconds, with_metaclass)
 
 _logger = logging.getLogger(__name__)
 
@@ -121,6 +126,17 @@ class BackupExecutor(with_metaclass(ABCMeta, RemoteStatusMixin)):
         Set additional status info - invoked by BackupManager.status()
         """
 
+    def _update_action_from_strategy(self):
+        """
+        Update the executor's current action with the one of the strategy.
+        This is used during exception handling to let the caller know
+        where the failure occurred.
+        """
+
+        action = getattr(self.strategy, 'current_action', None)
+        if action:
+            self.current_action = action
+
     def fetch_remote_status(self):
         """
         Get additional remote status info - invoked by
@@ -206,6 +222,10 @@ class PostgresBackupExecutor(BackupExecutor):
 
     Relies on pg_basebackup command to copy data files from the PostgreSQL
     cluster using replication protocol.
+
+    When postgres_backup_jobs is greater than one, the data files are
+    instead read through a pool of standard database connections, using
+    the concurrent backup API to start and stop the backup.
     """
 
     def __init__(self, backup_manager):
@@ -218,7 +238,10 @@ class PostgresBackupExecutor(BackupExecutor):
         super(PostgresBackupExecutor, self).__init__(backup_manager,
                                                      'postgres')
         self.validate_configuration()
-        self.strategy = PostgresBackupStrategy(self)
+        if self.config.postgres_backup_jobs > 1:
+            self.strategy = ConcurrentBackupStrategy(self)
+        else:
+            self.strategy = PostgresBackupStrategy(self)
 
     def validate_configuration(self):
         """
@@ -271,6 +294,16 @@ class PostgresBackupExecutor(BackupExecutor):
                 'network_compression option is not supported by '
                 'postgres backup_method')
 
+        # Forbid backup_compression option with a parallel copy.
+        # It works only with pg_basebackup.
+        if self.config.backup_compression and \
+                self.config.postgres_backup_jobs > 1:
+            self.server.config.disabled = True
+            # Report the error in the configuration errors message list
+            self.server.config.msg_list.append(
+                'backup_compression option is not supported by '
+                'a parallel postgres backup (postgres_backup_jobs > 1)')
+
         # bandwidth_limit option is supported by pg_basebackup executable
         # starting from Postgres 9.4
         if self.server.config.bandwidth_limit:
@@ -304,9 +337,18 @@ class PostgresBackupExecutor(BackupExecutor):
 
         :param barman.infofile.BackupInfo backup_info: backup information
         """
+        # Set data directory and server version. With a parallel copy,
+        # this starts the backup through the concurrent backup API, so
+        # all the subsequent code must be wrapped in a try except block
+        # which finally issues a stop_backup command
         try:
-            # Set data directory and server version
             self.strategy.start_backup(backup_info)
+        except BaseException:
+            self._update_action_from_strategy()
+            raise
+
+        copied = False
+        try:
             backup_info.save()
 
             if backup_info.begin_wal is not None:
@@ -323,13 +365,27 @@ class PostgresBackupExecutor(BackupExecutor):
             self._start_backup_copy_message(backup_info)
             self.backup_copy(backup_info)
             self._stop_backup_copy_message(backup_info)
-            self.strategy.stop_backup(backup_info)
-
-            # If this is the first backup, purge eventually unused WAL files
-            self._purge_unused_wal_files(backup_info)
-        except CommandFailedException as e:
-            _logger.exception(e)
+            copied = True
+        except BaseException as e:
+            if isinstance(e, CommandFailedException):
+                _logger.exception(e)
+            output.error("The backup has failed %s", self.current_action)
             raise
+        else:
+            self.current_action = "issuing stop of the backup"
+        finally:
+            # pg_basebackup stops the backup by itself, and the
+            # backup_label is available only if the copy succeeded,
+            # while a backup started by Barman must always be stopped
+            if copied or self.config.postgres_backup_jobs > 1:
+                try:
+                    self.strategy.stop_backup(backup_info)
+                except BaseException:
+                    self._update_action_from_strategy()
+                    raise
+
+        # If this is the first backup, purge eventually unused WAL files
+        self._purge_unused_wal_files(backup_info)
 
     def check(self, check_strategy):
         """
@@ -379,8 +435,11 @@ class PostgresBackupExecutor(BackupExecutor):
         tablespaces_list = postgres.get_tablespaces()
 
         # pg_basebackup supports the tablespace-mapping option,
-        # so there are no problems in this case
-        if remote_status['pg_basebackup_tbls_mapping']:
+        # so there are no problems in this case.
+        # Compressed backups use the tar format, which stores every
+        # tablespace in its own archive without any mapping.
+        if remote_status['pg_basebackup_tbls_mapping'] or \
+                self.config.backup_compression:
             hint = None
             check_result = True
 
@@ -415,6 +474,28 @@ class PostgresBackupExecutor(BackupExecutor):
             hint=hint
         )
 
+        # Reading files through database connections requires
+        # a superuser and PostgreSQL 9.5 or higher
+        if self.config.postgres_backup_jobs > 1:
+            check_strategy.init_check('parallel backup')
+            hint = None
+            check_result = True
+            if postgres.server_version < 90500:
+                check_result = False
+                hint = "PostgreSQL 9.5 or higher is required " \
+                       "(current: %s)" % postgres.server_txt_version
+            elif not postgres.is_superuser:
+                check_result = False
+                hint = "superuser privileges are required"
+            check_strategy.result(
+                self.config.name,
+                check_result,
+                hint=hint
+            )
+
+        # Invoke specific checks for the backup strategy
+        self.strategy.check(check_strategy)
+
     def fetch_remote_status(self):
         """
         Gather info from the remote server.
@@ -488,6 +569,17 @@ class PostgresBackupExecutor(BackupExecutor):
 
         return remote_status
 
+    def is_remote_status_cacheable(self, status):
+        """
+        Don't cache a status collected while the version of PostgreSQL
+        was unknown, because the streaming connection failed
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return status.get('pg_basebackup_installed') is False or \
+            status.get('pg_basebackup_compatible') is not None
+
     def backup_copy(self, backup_info):
         """
         Perform the actual copy of the backup using pg_basebackup.
@@ -500,6 +592,10 @@ class PostgresBackupExecutor(BackupExecutor):
 
         :param barman.infofile.BackupInfo backup_info: backup information
         """
+        if self.config.postgres_backup_jobs > 1:
+            self._parallel_backup_copy(backup_info)
+            return
+
         # Make sure the destination directory exists, ensure the
         # right permissions to the destination dir
         backup_dest = backup_info.get_data_directory()
@@ -508,11 +604,16 @@ class PostgresBackupExecutor(BackupExecutor):
         # Store the start time
         self.copy_start_time = datetime.datetime.now()
 
+        # A compressed backup is stored as a set of tar archives, one for
+        # each tablespace, inside the data directory
+        compression = self.config.backup_compression
+        backup_info.set_attribute('compression', compression)
+
         # Manage tablespaces, we need to handle them now in order to
         # be able to relocate them inside the
         # destination directory of the basebackup
         tbs_map = {}
-        if backup_info.tablespaces:
+        if backup_info.tablespaces and not compression:
             for tablespace in backup_info.tablespaces:
                 source = tablespace.location
                 destination = backup_info.get_data_directory(tablespace.oid)
@@ -543,6 +644,7 @@ class PostgresBackupExecutor(BackupExecutor):
             tbs_mapping=tbs_map,
             bwlimit=bandwidth_limit,
             immediate=self.config.immediate_checkpoint,
+            compression=compression,
             path=self.server.path,
             retry_times=self.config.basebackup_retry_times,
             retry_sleep=self.config.basebackup_retry_sleep,
@@ -583,6 +685,113 @@ class PostgresBackupExecutor(BackupExecutor):
             else:
                 _logger.debug(msg)
 
+    def _parallel_backup_copy(self, backup_info):
+        """
+        Perform the actual copy of the backup through several concurrent
+        database connections, each one reading a share of the files.
+
+        The backup must have been started with the concurrent backup API,
+        which keeps using the main PostgreSQL connection until the backup
+        is stopped.
+
+        :param barman.infofile.BackupInfo backup_info: backup information
+        """
+        # Store the start time
+        self.copy_start_time = datetime.datetime.now()
+
+        controller = PostgresCopyController(
+            conninfo=self.server.postgres.get_connection_string(
+                self.config.streaming_backup_name),
+            workers=self.config.postgres_backup_jobs,
+        )
+
+        # List of paths to be excluded by the PGDATA copy
+        exclude_and_protect = []
+
+        # Process every tablespace, the same way as the rsync method
+        backup_dest = backup_info.get_data_directory()
+        dest_dirs = [backup_dest]
+        if backup_info.tablespaces:
+            for tablespace in backup_info.tablespaces:
+                if tablespace.location.startswith(backup_info.pgdata):
+                    exclude_and_protect += [
+                        tablespace.location[len(backup_info.pgdata):]]
+                exclude_and_protect += ["pg_tblspc/%s" % tablespace.oid]
+                tablespace_dest = backup_info.get_data_directory(
+                    tablespace.oid)
+                dest_dirs.append(tablespace_dest)
+                controller.add_directory(
+                    label=tablespace.name,
+                    src=tablespace.location,
+                    dst=tablespace_dest,
+                    exclude=['/*'] + RsyncBackupExecutor.EXCLUDE_LIST,
+                    include=['/PG_%s_*' %
+                             self.server.postgres.server_major_version],
+                    item_class=controller.TABLESPACE_CLASS,
+                )
+
+        # Prepare the destination directories for pgdata and tablespaces
+        self._prepare_backup_destination(dest_dirs)
+
+        controller.add_directory(
+            label='pgdata',
+            src=backup_info.pgdata,
+            dst=backup_dest,
+            exclude=(RsyncBackupExecutor.PGDATA_EXCLUDE_LIST +
+                     RsyncBackupExecutor.EXCLUDE_LIST),
+            exclude_and_protect=exclude_and_protect,
+            item_class=controller.PGDATA_CLASS,
+        )
+
+        # At last copy pg_control
+        controller.add_file(
+            label='pg_control',
+            src='%s/global/pg_control' % backup_info.pgdata,
+            dst='%s/global/pg_control' % backup_dest,
+            item_class=controller.PGCONTROL_CLASS,
+        )
+
+        # Copy configuration files (if not inside PGDATA)
+        included_config_files = []
+        for config_file in backup_info.get_external_config_files():
+            # Add included files to a list, they will be handled later
+            if config_file.file_type == 'include':
+                included_config_files.append(config_file)
+                continue
+            # If the ident file is missing, it isn't an error condition
+            # for PostgreSQL.
+            controller.add_file(
+                label=config_file.file_type,
+                src=config_file.path,
+                dst=os.path.join(backup_dest,
+                                 os.path.basename(config_file.path)),
+                optional=config_file.file_type == 'ident_file',
+                item_class=controller.CONFIG_CLASS,
+            )
+
+        # Execute the copy
+        controller.copy()
+
+        # Store the end time
+        self.copy_end_time = datetime.datetime.now()
+
+        # Store statistics about the copy
+        backup_info.copy_stats = controller.statistics()
+
+        if any(included_config_files):
+            msg = ("The usage of include directives is not supported "
+                   "for files that reside outside PGDATA.\n"
+                   "Please manually backup the following files:\n"
+                   "\t%s\n" %
+                   "\n\t".join(icf.path for icf in included_config_files))
+            # Show the warning only if the EXTERNAL_CONFIGURATION option
+            # is not specified in the backup_options.
+            if (BackupOptions.EXTERNAL_CONFIGURATION
+                    not in self.config.backup_options):
+                output.warning(msg)
+            else:
+                _logger.debug(msg)
+
     def _retry_handler(self, dest_dirs, command, args, kwargs,
                        attempt, exc):
         """
@@ -627,8 +836,14 @@ class PostgresBackupExecutor(BackupExecutor):
             os.chmod(dest_dir, 448)
 
     def _start_backup_copy_message(self, backup_info):
-        output.info("Starting backup copy via pg_basebackup for %s",
-                    backup_info.backup_id)
+        number_of_workers = self.config.postgres_backup_jobs
+        if number_of_workers > 1:
+            output.info("Starting backup copy via %s PostgreSQL "
+                        "connections for %s",
+                        number_of_workers, backup_info.backup_id)
+        else:
+            output.info("Starting backup copy via pg_basebackup for %s",
+                        backup_info.backup_id)
 
 
 class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
@@ -640,6 +855,9 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
     Raises a SshCommandException if 'ssh_command' is not set.
     """
 
+    #: The values of the status changing frequently
+    REMOTE_STATUS_TTLS = {'last_archived_wal': VOLATILE_STATUS_TTL}
+
     def __init__(self, backup_manager, mode):
         """
         Constructor of the abstract class for backups via Ssh
@@ -649,6 +867,13 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
         """
         super(SshBackupExecutor, self).__init__(backup_manager, mode)
 
+        # Whether the last fetch_remote_status() failed
+        self._remote_status_failed = False
+
+        # The SSH connection shared by the remote commands and the copy,
+        # see shared_ssh_connection()
+        self.ssh_master = None
+
         # Retrieve the ssh command and the options necessary for the
         # remote ssh access.
         self.ssh_command, self.ssh_options = _parse_ssh_command(
@@ -660,6 +885,15 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
                 'Missing or invalid ssh_command in barman configuration '
                 'for server %s' % backup_manager.config.name)
 
+        # Forbid backup_compression option.
+        # It works only with postgres based backups.
+        if self.config.backup_compression:
+            self.server.config.disabled = True
+            # Report the error in the configuration errors message list
+            self.server.config.msg_list.append(
+                'backup_compression option is not supported by '
+                '%s backup_method' % self.config.backup_method)
+
         # Apply the default backup strategy
         if (BackupOptions.CONCURRENT_BACKUP not in
                 self.config.backup_options and
@@ -678,16 +912,45 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
             # Exclusive backup strategy
             self.strategy = ExclusiveBackupStrategy(self)
 
-    def _update_action_from_strategy(self):
+    @contextmanager
+    def shared_ssh_connection(self):
         """
-        Update the executor's current action with the one of the strategy.
-        This is used during exception handling to let the caller know
-        where the failure occurred.
+        Share a single SSH connection among all the remote commands
+        and the rsync processes executed inside this context.
+
+        The control socket of the connection is stored in a temporary
+        directory, removed when the outermost context exits.
+
+        :rtype: barman.command_wrappers.SshControlMaster
         """
+        if self.ssh_master is not None:
+            # Nested context, the connection is already shared
+            yield self.ssh_master
+            return
+        temp_dir = tempfile.mkdtemp(suffix='', prefix='barman-')
+        self.ssh_master = SshControlMaster(
+            self.ssh_command, self.ssh_options,
+            control_path=os.path.join(temp_dir, 'ssh'),
+            path=self.server.path)
+        try:
+            yield self.ssh_master
+        finally:
+            self.ssh_master.close()
+            self.ssh_master = None
+            shutil.rmtree(temp_dir, ignore_errors=True)
 
-        action = getattr(self.strategy, 'current_action', None)
-        if action:
-            self.current_action = action
+    def _remote_command(self):
+        """
+        Create a UnixRemoteCommand on the PostgreSQL server, using the
+        shared SSH connection if available
+
+        :rtype: UnixRemoteCommand
+        """
+        ssh_options = self.ssh_options
+        if self.ssh_master is not None:
+            ssh_options = self.ssh_master.options
+        return UnixRemoteCommand(self.ssh_command, ssh_options,
+                                 path=self.server.path)
 
     @abstractmethod
     def backup_copy(self, backup_info):
@@ -737,7 +1000,10 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
             # Start the copy
             self.current_action = "copying files"
             self._start_backup_copy_message(backup_info)
-            self.backup_copy(backup_info)
+            # The copy and the remote commands it needs share a single
+            # SSH connection
+            with self.shared_ssh_connection():
+                self.backup_copy(backup_info)
             self._stop_backup_copy_message(backup_info)
 
             # Try again to purge eventually unused WAL files. At this point
@@ -765,6 +1031,25 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
         Ssh connection (executing a 'true' command on the remote server)
         and specific checks for the given backup strategy.
 
+        :param CheckStrategy check_strategy: the strategy for the management
+             of the results of the various checks
+        """
+        # The remote commands of the checks share a single SSH connection
+        with self.shared_ssh_connection():
+            self._check_ssh(check_strategy)
+
+        try:
+            # Invoke specific checks for the backup strategy
+            self.strategy.check(check_strategy)
+        except BaseException:
+            self._update_action_from_strategy()
+            raise
+
+    def _check_ssh(self, check_strategy):
+        """
+        Check the Ssh connection and, if PostgreSQL is not responding,
+        the presence of a 'backup_label' file in PGDATA
+
         :param CheckStrategy check_strategy: the strategy for the management
              of the results of the various checks
         """
@@ -773,9 +1058,7 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
         cmd = None
         minimal_ssh_output = None
         try:
-            cmd = UnixRemoteCommand(self.ssh_command,
-                                    self.ssh_options,
-                                    path=self.server.path)
+            cmd = self._remote_command()
             minimal_ssh_output = ''.join(cmd.get_last_output())
         except FsOperationFailed as e:
                 hint = str(e).strip()
@@ -814,13 +1097,6 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
                            "and no 'backup_label' file is in PGDATA."
                     check_strategy.result(self.config.name, False, hint=hint)
 
-        try:
-            # Invoke specific checks for the backup strategy
-            self.strategy.check(check_strategy)
-        except BaseException:
-            self._update_action_from_strategy()
-            raise
-
     def status(self):
         """
         Set additional status info for SshBackupExecutor using remote
@@ -845,6 +1121,7 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
         :rtype: dict[str, None|str]
         """
         remote_status = {}
+        self._remote_status_failed = False
         # Retrieve the last archived WAL using a Ssh connection on
         # the remote server and executing an 'ls' command. Only
         # for pre-9.4 versions of PostgreSQL.
@@ -854,16 +1131,15 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
                 remote_status['last_archived_wal'] = None
                 if self.server.postgres.get_setting('data_directory') and \
                         self.server.postgres.get_setting('archive_command'):
-                    cmd = UnixRemoteCommand(self.ssh_command,
-                                            self.ssh_options,
-                                            path=self.server.path)
                     # Here the name of the PostgreSQL WALs directory is
                     # hardcoded, but that doesn't represent a problem as
                     # this code runs only for PostgreSQL < 9.4
                     archive_dir = os.path.join(
                         self.server.postgres.get_setting('data_directory'),
                         'pg_xlog', 'archive_status')
-                    out = str(cmd.list_dir_content(archive_dir, ['-t']))
+                    with self.shared_ssh_connection():
+                        cmd = self._remote_command()
+                        out = str(cmd.list_dir_content(archive_dir, ['-t']))
                     for line in out.splitlines():
                         if line.endswith('.done'):
                             name = line[:-5]
@@ -872,8 +1148,19 @@ class SshBackupExecutor(with_metaclass(ABCMeta, BackupExecutor)):
                                 break
         except (PostgresConnectionError, FsOperationFailed) as e:
             _logger.warn("Error retrieving PostgreSQL status: %s", e)
+            self._remote_status_failed = True
         return remote_status
 
+    def is_remote_status_cacheable(self, status):
+        """
+        Don't cache a status collected while PostgreSQL or the Ssh
+        connection were unreachable
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return not self._remote_status_failed
+
     def _start_backup_copy_message(self, backup_info):
         number_of_workers = self.config.parallel_jobs
         message = "Starting backup copy via rsync/SSH for %s" % (
@@ -904,6 +1191,14 @@ class RsyncBackupExecutor(SshBackupExecutor):
         '/global/pg_control',
     ]
 
+    #: Name of the file, inside the backup directory, where the copy plan
+    #: is saved when the copy fails
+    COPY_PLAN_FILE = 'copy_plan.json'
+
+    #: Name of the file, inside the backup directory, where the progress
+    #: of the copy is written while the copy is running
+    COPY_PROGRESS_FILE = 'copy_progress.json'
+
     EXCLUDE_LIST = [
         # Files: see excludeFiles const in PostgreSQL source
         'pgsql_tmp*',
@@ -966,12 +1261,16 @@ class RsyncBackupExecutor(SshBackupExecutor):
             path=self.server.path,
             ssh_command=self.ssh_command,
             ssh_options=self.ssh_options,
+            ssh_master=self.ssh_master,
             network_compression=self.config.network_compression,
             reuse_backup=reuse_backup,
             safe_horizon=safe_horizon,
             retry_times=self.config.basebackup_retry_times,
             retry_sleep=self.config.basebackup_retry_sleep,
             workers=self.config.parallel_jobs,
+            progress_file=os.path.join(
+                backup_info.get_basebackup_directory(),
+                self.COPY_PROGRESS_FILE),
         )
 
         # List of paths to be excluded by the PGDATA copy
@@ -1069,14 +1368,23 @@ class RsyncBackupExecutor(SshBackupExecutor):
                 item_class=controller.CONFIG_CLASS,
             )
 
+        # If the last backup failed while copying, reuse the files
+        # it has already transferred
+        self._resume_failed_copy(controller, backup_info)
+
         # Execute the copy
         try:
             controller.copy()
         # TODO: Improve the exception output
         except CommandFailedException as e:
+            # Save the copy plan, letting the next backup resume the copy
+            self._save_copy_plan(controller, backup_info)
             msg = "data transfer failure"
             raise DataTransferFailure.from_command_error(
                 'rsync', e, msg)
+        except KeyboardInterrupt:
+            self._save_copy_plan(controller, backup_info)
+            raise
 
         # Store the end time
         self.copy_end_time = datetime.datetime.now()
@@ -1102,6 +1410,95 @@ class RsyncBackupExecutor(SshBackupExecutor):
             else:
                 _logger.debug(msg)
 
+    def check(self, check_strategy):
+        """
+        Perform additional checks for RsyncBackupExecutor, including
+        the state of a running backup copy.
+
+        :param CheckStrategy check_strategy: the strategy for the management
+             of the results of the various checks
+        """
+        super(RsyncBackupExecutor, self).check(check_strategy)
+        backup_info, progress = self.get_copy_progress()
+        if progress is None:
+            return
+        check_strategy.init_check('backup copy')
+        # The progress file is removed at the end of the copy, so it is
+        # a leftover if the process which wrote it is not running anymore
+        try:
+            os.kill(progress['pid'], 0)
+        except OSError as e:
+            if e.errno == errno.ESRCH:
+                check_strategy.result(
+                    self.config.name, False,
+                    hint="copy of backup %s interrupted (process %s "
+                         "is not running)" % (backup_info.backup_id,
+                                              progress['pid']))
+                return
+        check_strategy.result(
+            self.config.name, True,
+            hint=self._format_copy_progress(backup_info, progress))
+
+    def status(self):
+        """
+        Set additional status info for RsyncBackupExecutor, including
+        the progress of a running backup copy.
+        """
+        super(RsyncBackupExecutor, self).status()
+        backup_info, progress = self.get_copy_progress()
+        if progress is not None:
+            output.result('status', self.config.name,
+                          'copy_progress',
+                          'Backup copy in progress',
+                          self._format_copy_progress(backup_info, progress))
+
+    def get_copy_progress(self):
+        """
+        Read the progress of the copy of the most recent backup which is
+        still running.
+
+        :return tuple[barman.infofile.BackupInfo|None,dict|None]: the backup
+            being copied and the content of its progress file, or
+            (None, None) if no copy is running
+        """
+        backups = self.backup_manager.get_available_backups(
+            status_filter=(BackupInfo.STARTED,))
+        for backup_id in sorted(backups, reverse=True):
+            progress_file = os.path.join(
+                backups[backup_id].get_basebackup_directory(),
+                self.COPY_PROGRESS_FILE)
+            try:
+                with open(progress_file) as f:
+                    return backups[backup_id], json.load(f)
+            except (EnvironmentError, ValueError) as e:
+                _logger.debug("Unable to read the copy progress '%s': %s",
+                              progress_file, e)
+        return None, None
+
+    @staticmethod
+    def _format_copy_progress(backup_info, progress):
+        """
+        Build a human readable summary of the progress of a copy
+
+        :param barman.infofile.BackupInfo backup_info: the backup being copied
+        :param dict progress: the content of the progress file
+        :rtype: str
+        """
+        if not progress['total_size']:
+            return "%s: analysing the source directories" % (
+                backup_info.backup_id)
+        summary = "%s: %.2f%% (%s of %s)" % (
+            backup_info.backup_id,
+            100.0 * progress['processed_size'] / progress['total_size'],
+            pretty_size(progress['processed_size']),
+            pretty_size(progress['total_size']))
+        if progress['throughput']:
+            summary += ", %s/s" % pretty_size(progress['throughput'])
+        if progress['estimated_end_time']:
+            summary += ", estimated end %s" % dateutil.parser.parse(
+                progress['estimated_end_time']).ctime()
+        return summary
+
     def _reuse_path(self, previous_backup_info, tablespace=None):
         """
         If reuse_backup is 'copy' or 'link', builds the path of the directory
@@ -1128,6 +1525,100 @@ class RsyncBackupExecutor(SshBackupExecutor):
             except ValueError:
                 return None
 
+    def _save_copy_plan(self, controller, backup_info):
+        """
+        Save the copy plan of a failed copy inside the backup directory,
+        allowing the next backup to resume it.
+
+        Any error is logged and ignored, to avoid hiding the reason
+        of the copy failure.
+
+        :param RsyncCopyController controller: the failed copy controller
+        :param barman.infofile.BackupInfo backup_info: backup information
+        """
+        plan_file = os.path.join(backup_info.get_basebackup_directory(),
+                                 self.COPY_PLAN_FILE)
+        try:
+            plan = controller.plan()
+            plan['pgdata'] = backup_info.pgdata
+            with open(plan_file, 'w') as f:
+                json.dump(plan, f)
+        except EnvironmentError as e:
+            _logger.warning("Unable to save the copy plan in '%s': %s",
+                            plan_file, e)
+
+    def _resume_failed_copy(self, controller, backup_info):
+        """
+        Resume the copy of the last backup, if it failed during the copy.
+
+        The directories already transferred by the failed backup are moved
+        inside the new backup, so only the missing or changed files will be
+        copied again. As those files have been copied after the beginning
+        of the failed backup, the safe horizon of the copy is moved back
+        accordingly, if required.
+
+        The failed backup is resumable only if it saved its copy plan and it
+        has been taken from the same PGDATA directory.
+
+        :param RsyncCopyController controller: the copy controller,
+            with every item to be copied already added
+        :param barman.infofile.BackupInfo backup_info: backup information
+        """
+        failed_backup = self.backup_manager.get_previous_backup(
+            backup_info.backup_id, status_filter=BackupInfo.STATUS_ALL)
+        if not failed_backup or failed_backup.status != BackupInfo.FAILED:
+            return
+        failed_dir = failed_backup.get_basebackup_directory()
+        plan_file = os.path.join(failed_dir, self.COPY_PLAN_FILE)
+        if not os.path.exists(plan_file):
+            return
+        try:
+            with open(plan_file) as f:
+                plan = json.load(f)
+        except (EnvironmentError, ValueError) as e:
+            _logger.warning("Unable to read the copy plan '%s': %s",
+                            plan_file, e)
+            return
+        if plan.get('pgdata') != backup_info.pgdata or \
+                failed_backup.begin_time is None:
+            _logger.info("Not resuming backup %s: incompatible copy plan",
+                         failed_backup.backup_id)
+            return
+
+        output.info("Resuming the copy of the failed backup %s "
+                    "(%s jobs had been completed)",
+                    failed_backup.backup_id, plan['jobs_done'])
+        backup_dir = backup_info.get_basebackup_directory()
+        planned_items = set(item['dst'] for item in plan['items']
+                            if item['is_directory'])
+        for item in controller.item_list:
+            if not item.is_directory or not item.dst.startswith(backup_dir):
+                continue
+            # Look for the same directory inside the failed backup
+            failed_dst = failed_dir + item.dst[len(backup_dir):]
+            if failed_dst not in planned_items or \
+                    not os.path.isdir(failed_dst):
+                continue
+            # The destination has been just created, and it is still empty
+            os.rmdir(item.dst)
+            os.rename(failed_dst, item.dst)
+            _logger.debug("Resuming '%s' from '%s'", item.dst, failed_dst)
+            # Files hard linked to another backup (reuse_backup = link)
+            # must be removed, as rsync updates the files in place.
+            # They will be linked again if they are still unchanged.
+            for dir_path, _, file_names in os.walk(item.dst):
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    if os.lstat(file_path).st_nlink > 1:
+                        os.unlink(file_path)
+
+        # The plan cannot be resumed twice
+        os.unlink(plan_file)
+
+        if controller.safe_horizon is None or \
+                failed_backup.begin_time < controller.safe_horizon:
+            controller.safe_horizon = failed_backup.begin_time
+
 
 class BackupStrategy(with_metaclass(ABCMeta, object)):
     """
@@ -1305,6 +1796,11 @@ class BackupStrategy(with_metaclass(ABCMeta, object)):
         # If backup_label is present in backup_info use it...
         if backup_info.backup_label:
             backup_label_data = backup_info.backup_label
+        # ... or read it from the archive of a compressed backup...
+        elif backup_info.compression:
+            backup_label_data = self._read_archive_member(
+                backup_info.get_archive_file(), 'backup_label')
+            backup_info.set_attribute('backup_label', backup_label_data)
         # ... otherwise load backup info from backup_label file
         else:
             backup_label_path = os.path.join(backup_info.get_data_directory(),
@@ -1328,6 +1824,28 @@ class BackupStrategy(with_metaclass(ABCMeta, object)):
         backup_info.set_attribute('begin_time', dateutil.parser.parse(
             start_time.group(1)))
 
+    @staticmethod
+    def _read_archive_member(archive_file, name):
+        """
+        Read the content of a file stored in a compressed tar archive
+
+        The archive is read sequentially and the read stops as soon as
+        the file is found, so reading the backup_label, which is the
+        first file written by PostgreSQL, is cheap.
+
+        :param str archive_file: the path of the archive
+        :param str name: the name of the member to read
+        :rtype: str
+        :raises ValueError: if the member is not in the archive
+        """
+        with closing(tarfile.open(archive_file, 'r|*')) as archive:
+            for member in archive:
+                if member.name in (name, './' + name):
+                    return archive.extractfile(member).read().decode(
+                        'utf-8', 'replace')
+        raise ValueError("File %s not found in archive %s" %
+                         (name, archive_file))
+
 
 class PostgresBackupStrategy(BackupStrategy):
     """
@@ -1479,9 +1997,10 @@ class ConcurrentBackupStrategy(BackupStrategy):
     """
     Concrete class for concurrent backup strategy.
 
-    This strategy is for SshBackupExecutor only and is responsible for
-    coordinating Barman with PostgreSQL on concurrent physical backup
-    operations through the pgespresso extension.
+    This strategy is for SshBackupExecutor and for the parallel copy of
+    PostgresBackupExecutor, and is responsible for coordinating Barman
+    with PostgreSQL on concurrent physical backup operations through the
+    native API or the pgespresso extension.
     """
 
     def __init__(self, executor):
@@ -1492,8 +2011,10 @@ class ConcurrentBackupStrategy(BackupStrategy):
             to the strategy
         """
         super(ConcurrentBackupStrategy, self).__init__(executor, 'concurrent')
-        # Make sure that executor is of type SshBackupExecutor
-        assert isinstance(executor, SshBackupExecutor)
+        # Make sure that executor is of type SshBackupExecutor or
+        # PostgresBackupExecutor
+        assert isinstance(executor, (SshBackupExecutor,
+                                     PostgresBackupExecutor))
         # Make sure that backup_options contains 'concurrent'
         assert (BackupOptions.CONCURRENT_BACKUP in
                 self.executor.config.backup_options)
@@ -21,24 +21,34 @@ This module implements the interface with the command line and the logger.
 
 import logging
 import os
+import signal
 import sys
 from argparse import SUPPRESS, ArgumentTypeError
 from contextlib import closing
 from functools import wraps
+from multiprocessing import Pool
 
 from argh import ArghParser, arg, expects_obj, named
 
 import barman.config
-import barman.diagnose
 from barman import output
 from barman.config import RecoveryOptions
-from barman.exceptions import BadXlogSegmentName
+from barman.exceptions import BadXlogSegmentName, WalServerException
 from barman.infofile import BackupInfo
-from barman.server import Server
 from barman.utils import configure_logging, drop_privileges, parse_log_level
 
 _logger = logging.getLogger(__name__)
 
+#: Number of servers processed at the same time by check and status
+DEFAULT_SERVER_JOBS = 10
+
+_worker_context = None
+"""
+Global variable containing the (function, servers) tuple used by the
+worker processes of `for_each_server`. It is set before the creation
+of the pool, so the workers inherit it.
+"""
+
 
 def check_non_negative(value):
     """
@@ -106,21 +116,36 @@ def list_server(minimal=False):
     output.close_and_exit()
 
 
-def cron():
+@arg('--daemon',
+     help='keep running, executing the maintenance tasks of all the '
+          'servers concurrently and restarting the receive-wal processes',
+     action='store_true')
+@arg('--interval',
+     help='seconds between two maintenance runs in daemon mode',
+     type=check_positive)
+@arg('--jobs', '-j',
+     help='number of servers processed at the same time in daemon mode',
+     type=check_positive)
+def cron(daemon=False, interval=60, jobs=10):
     """
     Run maintenance tasks (global command)
     """
     # Skip inactive and temporarily disabled servers
     servers = get_server_list(skip_inactive=True, skip_disabled=True)
-    for name in sorted(servers):
-        server = servers[name]
+    if daemon:
+        from barman.supervisor import CronSupervisor
+        # Keep the servers in memory and process them concurrently
+        CronSupervisor(servers, interval=interval, workers=jobs).run()
+    else:
+        for name in sorted(servers):
+            server = servers[name]
 
-        # Exception: manage_server_command is not invoked here
-        # Normally you would call manage_server_command to check if the
-        # server is None and to report inactive and disabled servers,
-        # but here we have only active and well configured servers.
+            # Exception: manage_server_command is not invoked here
+            # Normally you would call manage_server_command to check if the
+            # server is None and to report inactive and disabled servers,
+            # but here we have only active and well configured servers.
 
-        server.cron()
+            server.cron()
 
     output.close_and_exit()
 
@@ -244,23 +269,34 @@ def list_backup(args):
 @arg('server_name', nargs='+',
      completer=server_completer_all,
      help='specifies the server name for the command')
+@arg('--jobs', '-j',
+     help='number of servers processed at the same time',
+     dest='jobs', default=DEFAULT_SERVER_JOBS,
+     type=check_positive)
 @expects_obj
 def status(args):
     """
     Shows live information and status of the PostgreSQL server
     """
     servers = get_server_list(args, skip_inactive=True)
-    for name in sorted(servers):
-        server = servers[name]
+    for_each_server(_status_server, servers, args.jobs)
+    output.close_and_exit()
 
-        # Skip the server (apply general rule)
-        if not manage_server_command(server, name):
-            continue
 
-        output.init('status', name)
-        with closing(server):
-            server.status()
-    output.close_and_exit()
+def _status_server(server, name):
+    """
+    Execute the status command on a single server
+
+    :param barman.server.Server|None server: the server
+    :param str name: the server name
+    """
+    # Skip the server (apply general rule)
+    if not manage_server_command(server, name):
+        return
+
+    output.init('status', name)
+    with closing(server):
+        server.status()
 
 
 @named('replication-status')
@@ -567,6 +603,10 @@ def switch_xlog(args):
      help="specifies the server names to check "
           "('all' will check all available servers)")
 @arg('--nagios', help='Nagios plugin compatible output', action='store_true')
+@arg('--jobs', '-j',
+     help='number of servers checked at the same time',
+     dest='jobs', default=DEFAULT_SERVER_JOBS,
+     type=check_positive)
 @expects_obj
 def check(args):
     """
@@ -578,31 +618,104 @@ def check(args):
     if args.nagios:
         output.set_output_writer(output.NagiosOutputWriter())
     servers = get_server_list(args)
-    for name in sorted(servers):
-        server = servers[name]
+    for_each_server(_check_server, servers, args.jobs)
+    output.close_and_exit()
 
-        # Validate the returned server
-        if not manage_server_command(
-                server, name, skip_inactive=False,
-                skip_disabled=False, disabled_is_error=False):
-            continue
 
-        # If the server has been manually disabled
-        if not server.config.active:
-            name += " (inactive)"
-        # If server has configuration errors
-        elif server.config.disabled:
-            name += " (WARNING: disabled)"
-        output.init('check', name, server.config.active)
-        with closing(server):
-            server.check()
-    output.close_and_exit()
+def _check_server(server, name):
+    """
+    Execute the check command on a single server
+
+    :param barman.server.Server|None server: the server
+    :param str name: the server name
+    """
+    # Validate the returned server
+    if not manage_server_command(
+            server, name, skip_inactive=False,
+            skip_disabled=False, disabled_is_error=False):
+        return
+
+    # If the server has been manually disabled
+    if not server.config.active:
+        name += " (inactive)"
+    # If server has configuration errors
+    elif server.config.disabled:
+        name += " (WARNING: disabled)"
+    output.init('check', name, server.config.active)
+    with closing(server):
+        server.check()
+
+
+def for_each_server(function, servers, jobs=None):
+    """
+    Execute a function on every server, in the order of their names.
+
+    When more than one server is requested, the function is executed
+    concurrently by up to `jobs` worker processes. The output produced by
+    every server is recorded by the worker and replayed by the main
+    process in the order of the server names, so it is the same as with
+    a sequential execution.
+
+    :param callable function: the function to execute, receiving the
+        server object and its name as arguments
+    :param dict[str,barman.server.Server|None] servers: the servers
+    :param int|None jobs: maximum number of worker processes
+    """
+    global _worker_context
+    if jobs is None:
+        jobs = DEFAULT_SERVER_JOBS
+    names = sorted(servers)
+    if jobs < 2 or len(names) < 2:
+        for name in names:
+            function(servers[name], name)
+        return
+
+    _worker_context = (function, servers)
+    pool = Pool(processes=min(jobs, len(names)),
+                initializer=_init_server_worker)
+    try:
+        # imap returns the results in the order of the names
+        for calls in pool.imap(_run_server_worker, names):
+            output.replay(calls)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+        _worker_context = None
+
+
+def _init_server_worker():
+    """
+    Initialize a worker process of `for_each_server`
+    """
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_server_worker(name):
+    """
+    Execute the function of `for_each_server` on a single server,
+    recording its output
+
+    :param str name: the server name
+    :return list[tuple]: the recorded output calls
+    """
+    function, servers = _worker_context
+    output.start_recording()
+    try:
+        function(servers[name], name)
+    except Exception as e:
+        output.exception("%s\nSee log file for more details.", e)
+    finally:
+        calls = output.stop_recording()
+    return calls
 
 
 def diagnose():
     """
     Diagnostic command (for support and problems detection purpose)
     """
+    import barman.diagnose
     # Get every server (both inactive and temporarily disabled)
     servers = get_server_list(on_error_stop=False, suppress_error=True)
     # errors list with duplicate paths between servers
@@ -719,7 +832,9 @@ def get_wal(args):
     The content will be streamed on standard output unless
     the --output-directory option is specified.
     """
-    server = get_server(args, inactive_is_error=True)
+    # Only the WAL archive is needed: the connections to PostgreSQL,
+    # the archivers and the backup manager are not built
+    server = get_server(args, inactive_is_error=True, lazy=True)
 
     # Retrieve optional arguments. If an argument is not specified,
     # the namespace doesn't contain it due to SUPPRESS default.
@@ -754,6 +869,65 @@ def archive_wal(args):
     output.close_and_exit()
 
 
+@named('reclaim-trash')
+@arg('server_name',
+     completer=server_completer,
+     help='specifies the server name for the command')
+@expects_obj
+def reclaim_trash(args):
+    """
+    Remove the backups and the WAL files moved in the trash of a server
+    by the `trash` deletion mode.
+    """
+    server = get_server(args)
+    with closing(server):
+        server.reclaim_trash()
+    output.close_and_exit()
+
+
+@named('serve-wal')
+@arg('server_name', nargs='+',
+     completer=server_completer_all,
+     help="specifies the server names whose WAL files are served "
+          "('all' will serve all available servers)")
+@arg('--listen', '-l',
+     help="the path of the Unix socket, or HOST:PORT for a TCP socket "
+          "(default: 'wal-server.sock' in barman_home)",
+     default=SUPPRESS)
+@arg('--allow-remote',
+     help="accept to listen on a TCP address reachable from other hosts",
+     action='store_true',
+     default=False)
+@expects_obj
+def serve_wal(args):
+    """
+    Start a WAL server, serving the archived WAL files of the servers
+    to barman-wal-client until terminated.
+    """
+    import socket
+    from barman.wal_server import WalServer
+    # Only the WAL archive is needed, as for get-wal
+    servers = get_server_list(args, skip_inactive=True, skip_disabled=True,
+                              lazy=True)
+    for name in sorted(servers):
+        if not manage_server_command(servers[name], name):
+            del servers[name]
+    address = getattr(args, 'listen', None) or os.path.join(
+        barman.__config__.barman_home, 'wal-server.sock')
+    try:
+        wal_server = WalServer(servers, address,
+                               allow_remote=args.allow_remote)
+        wal_server.bind()
+    except (socket.error, WalServerException) as e:
+        output.error("Unable to start the WAL server on '%s': %s",
+                     address, e)
+        output.close_and_exit()
+    output.info("Serving the WAL files of %s servers on '%s'",
+                len(servers), address)
+    wal_server.run()
+    output.close_and_exit()
+
+
 @named('receive-wal')
 @arg('--stop', help='stop the receive-wal subprocess for the server',
      action='store_true')
@@ -862,7 +1036,7 @@ def global_config(args):
 
 def get_server(args, skip_inactive=True, skip_disabled=False,
                inactive_is_error=False,
-               on_error_stop=True, suppress_error=False):
+               on_error_stop=True, suppress_error=False, lazy=False):
     """
     Get a single server retrieving its configuration (wraps get_server_list())
 
@@ -879,6 +1053,8 @@ def get_server(args, skip_inactive=True, skip_disabled=False,
     :param bool inactive_is_error: treat inactive server as error
     :param bool on_error_stop: stop if an error is found
     :param bool suppress_error: suppress display of errors (e.g. diagnose)
+    :param bool lazy: build the components of the server on first use,
+        for the commands which don't need them
     :rtype: barman.server.Server|None
     """
     # This function must to be called with in a single-server context
@@ -902,7 +1078,7 @@ def get_server(args, skip_inactive=True, skip_disabled=False,
 
     # Retrieve the requested server
     servers = get_server_list(args, skip_inactive, skip_disabled,
-                              on_error_stop, suppress_error)
+                              on_error_stop, suppress_error, lazy)
 
     # The requested server has been excluded from get_server_list result
     if len(servers) == 0:
@@ -930,7 +1106,7 @@ def get_server(args, skip_inactive=True, skip_disabled=False,
 
 
 def get_server_list(args=None, skip_inactive=False, skip_disabled=False,
-                    on_error_stop=True, suppress_error=False):
+                    on_error_stop=True, suppress_error=False, lazy=False):
     """
     Get the server list from the configuration
 
@@ -942,15 +1118,28 @@ def get_server_list(args=None, skip_inactive=False, skip_disabled=False,
     :param bool skip_disabled: skip disabled servers when 'all' is required
     :param bool on_error_stop: stop if an error is found
     :param bool suppress_error: suppress display of errors (e.g. diagnose)
+    :param bool lazy: build the components of the servers on first use
     :rtype: dict(str,barman.server.Server|None)
     """
+    # Imported here, to keep the parsing of the command line
+    # (and the shell completion) light
+    from barman.server import Server
+
     server_dict = {}
 
     # This function must to be called with in a multiple-server context
     assert not args or isinstance(args.server_name, list)
 
-    # Generate the list of servers (required for global errors)
-    available_servers = barman.__config__.server_names()
+    # Generate the list of servers (required for global errors).
+    # When all the servers are requested, every server configuration is
+    # built and checked for conflicting paths, refreshing the
+    # configuration cache.
+    all_servers = not args or 'all' in args.server_name
+    if all_servers:
+        available_servers = [conf.name for conf in
+                             barman.__config__.servers()]
+    else:
+        available_servers = barman.__config__.server_names()
 
     # Get a list of configuration errors from all the servers
     global_error_list = barman.__config__.servers_msg_list
@@ -972,7 +1161,7 @@ def get_server_list(args=None, skip_inactive=False, skip_disabled=False,
     # Handle special 'all' server cases
     # - args is None
     # - 'all' special name
-    if not args or 'all' in args.server_name:
+    if all_servers:
         # When 'all' is used, it must be the only specified argument
         if args and len(args.server_name) != 1:
             output.error("You cannot use 'all' with other server names")
@@ -987,7 +1176,7 @@ def get_server_list(args=None, skip_inactive=False, skip_disabled=False,
             # Unknown server
             server_dict[server] = None
         else:
-            server_object = Server(conf)
+            server_object = Server(conf, lazy=lazy)
             # Skip inactive servers, if requested
             if skip_inactive and not server_object.config.active:
                 output.info("Skipping inactive server '%s'"
@@ -1109,7 +1298,9 @@ def main():
             list_server,
             rebuild_xlogdb,
             receive_wal,
+            reclaim_trash,
             recover,
+            serve_wal,
             show_backup,
             show_server,
             replication_status,
@@ -317,6 +317,9 @@ class Command(object):
         against the `allowed_retval` list, raising a CommandFailedException if
         not in the list.
 
+        If the `out_handler` argument is passed to this method, it is invoked
+        for every line of the output while it is being collected.
+
         Every keyword argument can be specified both in the class constructor
         and during the method call. If specified in both places,
         the method arguments will take the precedence over
@@ -330,7 +333,14 @@ class Command(object):
         # If check is true, it must be handled here
         check = kwargs.pop('check', self.check)
         allowed_retval = kwargs.pop('allowed_retval', self.allowed_retval)
-        self.execute(out_handler=out.append, err_handler=err.append,
+        out_handler = out.append
+        # Let the caller watch the output while the command is running
+        watcher = kwargs.pop('out_handler', None)
+        if watcher:
+            def out_handler(line):
+                out.append(line)
+                watcher(line)
+        self.execute(out_handler=out_handler, err_handler=err.append,
                      check=False, *args, **kwargs)
         self.out = '\n'.join(out)
         self.err = '\n'.join(err)
@@ -360,7 +370,9 @@ class Command(object):
         Execute the command and pass the output to the configured handlers
 
         If `stdin` argument is specified, its content will be passed to the
-        executed command through the standard input descriptor.
+        executed command through the standard input descriptor. If it is
+        a file object, it is used directly as the standard input of the
+        command.
 
         The subprocess output and error stream will be processed through
         the output and error handler, respectively defined through the
@@ -398,15 +410,23 @@ class Command(object):
         self.out = None
         self.err = None
 
+        # A file object is connected directly to the standard input of the
+        # subprocess, so its content is never loaded in memory
+        stdin_file = None
+        if hasattr(stdin, 'fileno'):
+            stdin_file = stdin
+            stdin = None
+
         # Create the subprocess and save it in the current object to be usable
         # by signal handlers
-        pipe = self._build_pipe(args, close_fds)
+        pipe = self._build_pipe(args, close_fds, stdin_file)
         self.pipe = pipe
 
         # Send the provided input and close the stdin descriptor
         if stdin:
             pipe.stdin.write(stdin)
-        pipe.stdin.close()
+        if pipe.stdin is not None:
+            pipe.stdin.close()
         # Prepare the list of processors
         processors = [
             StreamLineProcessor(
@@ -430,7 +450,7 @@ class Command(object):
             self.check_return_value(allowed_retval)
         return self.ret
 
-    def _build_pipe(self, args, close_fds):
+    def _build_pipe(self, args, close_fds, stdin_file=None):
         """
         Build the Pipe object used by the Command
 
@@ -440,6 +460,8 @@ class Command(object):
         :param args: extra arguments for the subprocess
         :param close_fds: if True all file descriptors except 0, 1 and 2
             will be closed before the child process is executed.
+        :param file stdin_file: if provided, the file to be used as the
+            standard input of the subprocess, instead of a pipe
         :rtype: subprocess.Popen
         """
         # Append the argument provided to this method ot the base argument list
@@ -453,7 +475,7 @@ class Command(object):
         # Log the command we are about to execute
         _logger.debug("Command: %r", cmd)
         return subprocess.Popen(cmd, shell=self.shell, env=self.env,
-                                stdin=subprocess.PIPE,
+                                stdin=stdin_file or subprocess.PIPE,
                                 stdout=subprocess.PIPE,
                                 stderr=subprocess.PIPE,
                                 preexec_fn=self._restore_sigpipe,
@@ -674,6 +696,86 @@ class RsyncPgData(Rsync):
         Rsync.__init__(self, rsync, args=options, **kwargs)
 
 
+class SshControlMaster(object):
+    """
+    This class manages a shared SSH connection, using the OpenSSH
+    ControlMaster feature.
+
+    Every ssh process (including the ones spawned by rsync) started with
+    the options returned by this object reuses the same connection, which
+    is opened by the first one of them and kept alive until the
+    :meth:`close` method is invoked.
+
+    If the ssh command already contains a ControlPath option, this object
+    doesn't alter it, leaving the connection management to its owner.
+    """
+
+    def __init__(self, ssh_command, ssh_options=None, control_path=None,
+                 persist=60, path=None):
+        """
+        Constructor
+
+        :param str ssh_command: the ssh command
+        :param list[str]|None ssh_options: the ssh options
+        :param str control_path: the path of the control socket. It must be
+            short enough to be used as a Unix socket path
+        :param int persist: the number of seconds an idle master connection
+            is kept open. It makes sure that the connection will be
+            eventually closed even if :meth:`close` is never invoked
+        :param str path: PATH to be used while searching for `ssh_command`
+        """
+        self.ssh_command = ssh_command
+        self.ssh_options = list(ssh_options or [])
+        self.control_path = control_path
+        self.persist = persist
+        self.path = path
+        self.enabled = (
+            control_path is not None and
+            'controlpath' not in full_command_quote(
+                ssh_command, self.ssh_options).lower())
+
+    @property
+    def options(self):
+        """
+        The ssh options to be used to share the connection
+
+        :rtype: list[str]
+        """
+        if not self.enabled:
+            return list(self.ssh_options)
+        return self.ssh_options + [
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s' % self.control_path,
+            '-o', 'ControlPersist=%s' % self.persist,
+        ]
+
+    @property
+    def command(self):
+        """
+        The complete ssh command line to be used to share the connection,
+        suitable to be passed as the remote shell of rsync
+
+        :rtype: str
+        """
+        return full_command_quote(self.ssh_command, self.options)
+
+    def close(self):
+        """
+        Close the shared connection, if it has been opened.
+
+        Any error is logged and ignored, as the master connection will
+        terminate anyway after `persist` seconds of inactivity.
+        """
+        if not self.enabled or not os.path.exists(self.control_path):
+            return
+        cmd = Command(self.ssh_command,
+                      args=self.options + ['-O', 'exit'],
+                      shell=True, path=self.path)
+        if cmd() != 0:
+            _logger.warning("Error closing the shared ssh connection "
+                            "(%s): %s", self.control_path, cmd.err.strip())
+
+
 class PostgreSQLClient(Command):
     """
     Superclass of all the PostgreSQL client commands.
@@ -852,6 +954,7 @@ class PgBaseBackup(PostgreSQLClient):
                  bwlimit=None,
                  tbs_mapping=None,
                  immediate=False,
+                 compression=None,
                  check=True,
                  args=None,
                  **kwargs):
@@ -867,6 +970,9 @@ class PgBaseBackup(PostgreSQLClient):
         :param str bwlimit: bandwidth limit for pg_basebackup
         :param Dict[str, str] tbs_mapping: used for tablespace
         :param bool immediate: fast checkpoint identifier for pg_basebackup
+        :param str compression: if set, the backup is written in tar
+          format, compressed with the given algorithm (only 'gzip' is
+          supported by pg_basebackup)
         :param bool check: check if the return value is in the list of
           allowed values of the Command obj
         :param List[str] args: additional arguments
@@ -903,6 +1009,12 @@ class PgBaseBackup(PostgreSQLClient):
         if immediate:
             self.args.append("--checkpoint=fast")
 
+        # Write one compressed tar file for every tablespace. The
+        # compression is done by pg_basebackup itself while receiving
+        # the data.
+        if compression == 'gzip':
+            self.args += ['--format=tar', '--gzip']
+
         # Manage additional args
         if args:
             self.args += args
@@ -1005,6 +1117,8 @@ class BarmanSubProcess(object):
     def execute(self):
         """
         Execute the command and pass the output to the configured handlers
+
+        :return subprocess.Popen: the started process
         """
         _logger.debug("BarmanSubProcess: %r", self.command)
         # Redirect all descriptors to /dev/null
@@ -1015,6 +1129,7 @@ class BarmanSubProcess(object):
             stdin=devnull, stdout=devnull, stderr=devnull)
         _logger.debug("BarmanSubProcess: subprocess started. pid: %s",
                       proc.pid)
+        return proc
 
 
 def shell_quote(arg):
@@ -25,11 +25,13 @@ import datetime
 import inspect
 import logging.handlers
 import os
+import pickle
 import re
 import sys
+import time
 from glob import iglob
 
-from barman import output
+from barman import output, version
 
 try:
     from ConfigParser import ConfigParser, NoOptionError
@@ -57,11 +59,24 @@ _TIME_INTERVAL_RE = re.compile(r"""
       \s*$
       """, re.IGNORECASE | re.VERBOSE)
 
+#: Version of the format of the configuration cache
+CONFIG_CACHE_VERSION = 1
+
+#: A configuration file modified less than this number of seconds ago is
+#: not cached, as a further change in the same second could leave its
+#: mtime and size unchanged
+CONFIG_CACHE_RACY_TIME = 2
+
 REUSE_BACKUP_VALUES = ('copy', 'link', 'off')
 
 # Possible copy methods for backups (must be all lowercase)
 BACKUP_METHOD_VALUES = ['rsync', 'postgres']
 
+BACKUP_COMPRESSION_VALUES = ['gzip']
+
+# Possible ways to delete backups and WAL files (must be all lowercase)
+DELETION_MODE_VALUES = ['immediate', 'trash']
+
 
 class CsvOption(set):
 
@@ -247,6 +262,42 @@ def parse_backup_method(value):
             "', '".join(BACKUP_METHOD_VALUES)))
 
 
+def parse_backup_compression(value):
+    """
+    Parse a string to a valid backup_compression value.
+
+    Valid values are contained in BACKUP_COMPRESSION_VALUES list
+
+    :param str value: backup_compression value
+    :raises ValueError: if the value is invalid
+    """
+    if value is None:
+        return None
+    if value.lower() in BACKUP_COMPRESSION_VALUES:
+        return value.lower()
+    raise ValueError(
+        "Invalid value (must be one in: '%s')" % (
+            "', '".join(BACKUP_COMPRESSION_VALUES)))
+
+
+def parse_deletion_mode(value):
+    """
+    Parse a string to a valid deletion_mode value.
+
+    Valid values are contained in DELETION_MODE_VALUES list
+
+    :param str value: deletion_mode value
+    :raises ValueError: if the value is invalid
+    """
+    if value is None:
+        return None
+    if value.lower() in DELETION_MODE_VALUES:
+        return value.lower()
+    raise ValueError(
+        "Invalid value (must be one in: '%s')" % (
+            "', '".join(DELETION_MODE_VALUES)))
+
+
 class ServerConfig(object):
     """
     This class represents the configuration for a specific Server instance.
@@ -256,6 +307,7 @@ class ServerConfig(object):
         'active',
         'archiver',
         'archiver_batch_size',
+        'backup_compression',
         'backup_directory',
         'backup_method',
         'backup_options',
@@ -268,6 +320,9 @@ class ServerConfig(object):
         'conninfo',
         'custom_compression_filter',
         'custom_decompression_filter',
+        'deduplication',
+        'deduplication_directory',
+        'deletion_mode',
         'description',
         'disabled',
         'errors_directory',
@@ -283,11 +338,13 @@ class ServerConfig(object):
         'post_archive_script',
         'post_backup_retry_script',
         'post_backup_script',
+        'postgres_backup_jobs',
         'pre_archive_retry_script',
         'pre_archive_script',
         'pre_backup_retry_script',
         'pre_backup_script',
         'recovery_options',
+        'remote_status_cache_ttl',
         'retention_policy',
         'retention_policy_mode',
         'reuse_backup',
@@ -295,11 +352,17 @@ class ServerConfig(object):
         'ssh_command',
         'streaming_archiver',
         'streaming_archiver_batch_size',
+        'streaming_archiver_inline',
         'streaming_archiver_name',
         'streaming_backup_name',
         'streaming_conninfo',
         'streaming_wals_directory',
         'tablespace_bandwidth_limit',
+        'trash_directory',
+        'trash_reclaim_jobs',
+        'trash_reclaim_rate',
+        'wal_index',
+        'wal_integrity_check',
         'wal_retention_policy',
         'wals_directory'
     ]
@@ -307,6 +370,7 @@ class ServerConfig(object):
     BARMAN_KEYS = [
         'archiver',
         'archiver_batch_size',
+        'backup_compression',
         'backup_method',
         'backup_options',
         'bandwidth_limit',
@@ -317,6 +381,9 @@ class ServerConfig(object):
         'configuration_files_directory',
         'custom_compression_filter',
         'custom_decompression_filter',
+        'deduplication',
+        'deduplication_directory',
+        'deletion_mode',
         'immediate_checkpoint',
         'last_backup_maximum_age',
         'max_incoming_wals_queue',
@@ -328,20 +395,27 @@ class ServerConfig(object):
         'post_archive_script',
         'post_backup_retry_script',
         'post_backup_script',
+        'postgres_backup_jobs',
         'pre_archive_retry_script',
         'pre_archive_script',
         'pre_backup_retry_script',
         'pre_backup_script',
         'recovery_options',
+        'remote_status_cache_ttl',
         'retention_policy',
         'retention_policy_mode',
         'reuse_backup',
         'slot_name',
         'streaming_archiver',
         'streaming_archiver_batch_size',
+        'streaming_archiver_inline',
         'streaming_archiver_name',
         'streaming_backup_name',
         'tablespace_bandwidth_limit',
+        'trash_reclaim_jobs',
+        'trash_reclaim_rate',
+        'wal_index',
+        'wal_integrity_check',
         'wal_retention_policy'
     ]
 
@@ -356,6 +430,9 @@ class ServerConfig(object):
         'basebackup_retry_times': '0',
         'basebackups_directory': '%(backup_directory)s/base',
         'check_timeout': '30',
+        'deduplication': 'false',
+        'deduplication_directory': '%(backup_directory)s/objects',
+        'deletion_mode': 'immediate',
         'disabled': 'false',
         'errors_directory': '%(backup_directory)s/errors',
         'immediate_checkpoint': 'false',
@@ -363,14 +440,22 @@ class ServerConfig(object):
         'minimum_redundancy': '0',
         'network_compression': 'false',
         'parallel_jobs': '1',
+        'postgres_backup_jobs': '1',
         'recovery_options': '',
+        'remote_status_cache_ttl': '0',
         'retention_policy_mode': 'auto',
         'streaming_archiver': 'off',
         'streaming_archiver_batch_size': '0',
+        'streaming_archiver_inline': 'false',
         'streaming_archiver_name': 'barman_receive_wal',
         'streaming_backup_name': 'barman_streaming_backup',
         'streaming_conninfo': '%(conninfo)s',
         'streaming_wals_directory': '%(backup_directory)s/streaming',
+        'trash_directory': '%(backup_directory)s/trash',
+        'trash_reclaim_jobs': '1',
+        'trash_reclaim_rate': '0',
+        'wal_index': 'false',
+        'wal_integrity_check': 'false',
         'wal_retention_policy': 'main',
         'wals_directory': '%(backup_directory)s/wals'
     }
@@ -383,21 +468,31 @@ class ServerConfig(object):
         'active': parse_boolean,
         'archiver': parse_boolean,
         'archiver_batch_size': int,
+        'backup_compression': parse_backup_compression,
         'backup_method': parse_backup_method,
         'backup_options': BackupOptions,
         'basebackup_retry_sleep': int,
         'basebackup_retry_times': int,
         'check_timeout': int,
+        'deduplication': parse_boolean,
+        'deletion_mode': parse_deletion_mode,
         'disabled': parse_boolean,
         'immediate_checkpoint': parse_boolean,
         'last_backup_maximum_age': parse_time_interval,
         'max_incoming_wals_queue': int,
         'network_compression': parse_boolean,
         'parallel_jobs': int,
+        'postgres_backup_jobs': int,
         'recovery_options': RecoveryOptions,
+        'remote_status_cache_ttl': int,
         'reuse_backup': parse_reuse_backup,
         'streaming_archiver': parse_boolean,
         'streaming_archiver_batch_size': int,
+        'streaming_archiver_inline': parse_boolean,
+        'trash_reclaim_jobs': int,
+        'trash_reclaim_rate': int,
+        'wal_index': parse_boolean,
+        'wal_integrity_check': parse_boolean,
     }
 
     def invoke_parser(self, key, source, value, new_value):
@@ -524,10 +619,15 @@ class Config(object):
         '/etc/barman/barman.conf',
     ]
 
+    #: Name of the configuration cache file, inside barman_home
+    CONFIG_CACHE_FILE = '.config.cache'
+
     _QUOTE_RE = re.compile(r"""^(["'])(.*)\1$""")
 
     def __init__(self, filename=None):
         self._config = ConfigParser()
+        # The path of the main configuration file, if read from disk
+        self._config_path = None
         if filename:
             if hasattr(filename, 'read'):
                 self._config.readfp(filename)
@@ -536,7 +636,8 @@ class Config(object):
                 if not os.path.exists(filename):
                     sys.exit("Configuration file '%s' does not exist" %
                              filename)
-                self._config.read(os.path.expanduser(filename))
+                self._config_path = os.path.expanduser(filename)
+                self._config.read(self._config_path)
         else:
             # Check for the presence of configuration files
             # inside default directories
@@ -545,6 +646,7 @@ class Config(object):
                 if os.path.exists(full_path) \
                         and full_path in self._config.read(full_path):
                     filename = full_path
+                    self._config_path = full_path
                     break
             else:
                 sys.exit("Could not find any configuration file at "
@@ -553,6 +655,15 @@ class Config(object):
         self.config_file = filename
         self._servers = None
         self.servers_msg_list = []
+        # The mtime and size of the configuration files, which validate
+        # the configuration cache. None if the cache is not used.
+        self._cache_signature = None
+        # The result of the paths conflict check, taken from a valid
+        # cache. When present, the servers are built one by one
+        # when requested, instead of all together.
+        self._cached_conflicts = None
+        self._cached_servers_msg_list = None
+        self._cached_servers = {}
         self._parse_global_config()
 
     def get(self, section, option, defaults=None, none_value=None):
@@ -595,38 +706,159 @@ class Config(object):
         """
         Read the "configuration_files_directory" option and load all the
         configuration files with the .conf suffix that lie in that folder
+
+        If the configuration cache is valid, the content of the files is
+        taken from it instead.
         """
 
         config_files_directory = self.get('barman',
                                           'configuration_files_directory')
 
+        config_files = []
         if not config_files_directory:
-            return
-
-        if not os.path.isdir(os.path.expanduser(config_files_directory)):
+            pass
+        elif not os.path.isdir(os.path.expanduser(config_files_directory)):
             _logger.warn(
                 'Ignoring the "configuration_files_directory" option as "%s" '
                 'is not a directory',
                 config_files_directory)
+        else:
+            for cfile in sorted(iglob(
+                    os.path.join(os.path.expanduser(config_files_directory),
+                                 '*.conf'))):
+                if os.path.isfile(cfile):
+                    config_files.append(cfile)
+                else:
+                    # Add an info that a file has been discarded
+                    _logger.warn('Discarding configuration file: %s '
+                                 '(not a file)', os.path.basename(cfile))
+
+        signature = self._get_cache_signature(config_files)
+        if signature is not None and self._load_cache(signature):
             return
 
-        for cfile in sorted(iglob(
-                os.path.join(os.path.expanduser(config_files_directory),
-                             '*.conf'))):
+        for cfile in config_files:
             filename = os.path.basename(cfile)
-            if os.path.isfile(cfile):
-                # Load a file
-                _logger.debug('Including configuration file: %s', filename)
-                self._config.read(cfile)
-                if self._is_global_config_changed():
-                    msg = "the configuration file %s contains a not empty [" \
-                          "barman] section" % filename
-                    _logger.fatal(msg)
-                    raise SystemExit("FATAL: %s" % msg)
-            else:
-                # Add an info that a file has been discarded
-                _logger.warn('Discarding configuration file: %s (not a file)',
-                             filename)
+            # Load a file
+            _logger.debug('Including configuration file: %s', filename)
+            self._config.read(cfile)
+            if self._is_global_config_changed():
+                msg = "the configuration file %s contains a not empty [" \
+                      "barman] section" % filename
+                _logger.fatal(msg)
+                raise SystemExit("FATAL: %s" % msg)
+        # The cache is written once the servers have been checked
+        self._cache_signature = signature
+
+    @property
+    def config_cache_path(self):
+        """
+        The path of the configuration cache, or None if the barman_home
+        is not set
+
+        :rtype: str|None
+        """
+        if not self.barman_home:
+            return None
+        return os.path.join(os.path.expanduser(self.barman_home),
+                            self.CONFIG_CACHE_FILE)
+
+    def _get_cache_signature(self, config_files):
+        """
+        Build the key validating the configuration cache, from the mtime
+        and the size of the main configuration file and of the included
+        ones
+
+        :param list[str] config_files: the included configuration files
+        :return tuple|None: None if the cache can't be used
+        """
+        if self._config_path is None or self.config_cache_path is None:
+            return None
+        signature = []
+        for path in [self._config_path] + config_files:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            signature.append((path, stat.st_mtime, stat.st_size))
+        return version.__version__, tuple(signature)
+
+    def _load_cache(self, signature):
+        """
+        Replace the parsed configuration with the content of the cache,
+        if valid for the given signature
+
+        :param tuple signature: the signature of the configuration files
+        :return bool: True if the cache has been used
+        """
+        try:
+            with open(self.config_cache_path, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['version'] != CONFIG_CACHE_VERSION or \
+                    cache['signature'] != signature:
+                return False
+            config = ConfigParser()
+            for section, items in cache['sections']:
+                config.add_section(section)
+                for key, value in items:
+                    config.set(section, key, value)
+        except Exception as e:
+            # A missing or broken cache is ignored, and rebuilt later
+            _logger.debug("Ignoring the configuration cache %s: %s",
+                          self.config_cache_path, e)
+            return False
+        _logger.debug("Using the configuration cache %s",
+                      self.config_cache_path)
+        self._config = config
+        self._cache_signature = signature
+        self._cached_conflicts = cache['conflicts']
+        self._cached_servers_msg_list = cache['servers_msg_list']
+        self.servers_msg_list = list(cache['servers_msg_list'])
+        return True
+
+    def _save_cache(self):
+        """
+        Write the configuration cache, with the parsed configuration files
+        and the result of the paths conflict check
+        """
+        if self._cache_signature is None:
+            return
+        # Don't cache files which could be modified again without
+        # changing their mtime
+        racy_time = time.time() - CONFIG_CACHE_RACY_TIME
+        if any(mtime >= racy_time
+               for _, mtime, _ in self._cache_signature[1]):
+            return
+        # The servers with conflicting paths, which are disabled
+        conflicts = dict((name, list(server.msg_list))
+                         for name, server in self._servers.items()
+                         if server.msg_list)
+        if self._cached_conflicts is not None and \
+                conflicts == self._cached_conflicts and \
+                self.servers_msg_list == self._cached_servers_msg_list:
+            # The cache in use is still valid
+            return
+        cache = {
+            'version': CONFIG_CACHE_VERSION,
+            'signature': self._cache_signature,
+            'sections': [(section, self._config.items(section, raw=True))
+                         for section in self._config.sections()],
+            'conflicts': conflicts,
+            'servers_msg_list': self.servers_msg_list,
+        }
+        path = self.config_cache_path
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(cache, f, 2)
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as e:
+            _logger.debug("Unable to write the configuration cache %s: %s",
+                          path, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
 
     def _populate_servers(self):
         """
@@ -659,6 +891,7 @@ class Config(object):
 
         # Check for conflicting paths in Barman configuration
         self._check_conflicting_paths()
+        self._save_cache()
 
     def _check_conflicting_paths(self):
         """
@@ -689,6 +922,8 @@ class Config(object):
                     section_conf.incoming_wals_directory,
                 'streaming_wals_directory':
                     section_conf.streaming_wals_directory,
+                'trash_directory':
+                    section_conf.trash_directory,
                 'wals_directory':
                     section_conf.wals_directory,
             }
@@ -744,6 +979,10 @@ class Config(object):
 
     def server_names(self):
         """This method returns a list of server names"""
+        if self._servers is None and self._cached_conflicts is not None:
+            # The sections have been validated when the cache was written
+            return [section for section in self._config.sections()
+                    if section != 'barman']
         self._populate_servers()
         return self._servers.keys()
 
@@ -758,6 +997,18 @@ class Config(object):
 
         :param str name: the server name
         """
+        if self._servers is None and self._cached_conflicts is not None:
+            # Build only the requested server, using the result of the
+            # paths check stored in the cache
+            if name not in self._cached_servers:
+                server = None
+                if name != 'barman' and self._config.has_section(name):
+                    server = ServerConfig(self, name)
+                    if name in self._cached_conflicts:
+                        server.msg_list.extend(self._cached_conflicts[name])
+                        server.disabled = True
+                self._cached_servers[name] = server
+            return self._cached_servers[name]
         self._populate_servers()
         return self._servers.get(name, None)
 
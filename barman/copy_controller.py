@@ -24,21 +24,36 @@ and their final destination.
 
 import collections
 import datetime
+import errno
+import fcntl
+import fnmatch
+import json
 import logging
+import multiprocessing
 import os.path
 import re
 import shutil
 import signal
 import tempfile
+import time
 from functools import partial
 from multiprocessing import Lock, Pool
 
 import dateutil.parser
 import dateutil.tz
+import psycopg2
 
-from barman.command_wrappers import RsyncPgData
-from barman.exceptions import CommandFailedException, RsyncListFilesFailure
-from barman.utils import human_readable_timedelta, total_seconds
+from barman.command_wrappers import (Command, RsyncPgData, SshControlMaster,
+                                     full_command_quote)
+from barman.exceptions import (CommandFailedException, DataTransferFailure,
+                               RsyncListFilesFailure)
+from barman.utils import (human_readable_timedelta, mkpath, pretty_size,
+                          total_seconds)
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
 _logger = logging.getLogger(__name__)
 _logger_lock = Lock()
@@ -53,6 +68,9 @@ This variable must be None outside a multiprocessing worker Process.
 # Parallel copy bucket size (10GB)
 BUCKET_SIZE = (1024 * 1024 * 1024 * 10)
 
+# Interval in seconds between two updates of the copy progress
+PROGRESS_INTERVAL = 5
+
 
 def _init_worker(func):
     """
@@ -83,6 +101,19 @@ def _run_worker(job):
     return _worker_callable(job)
 
 
+def _is_non_empty_dir(path):
+    """
+    Return True if the path is a local directory containing something
+
+    :param str path: the path to check. Remote paths (starting with ':')
+        are never considered
+    :rtype: bool
+    """
+    if path.startswith(':') or not os.path.isdir(path):
+        return False
+    return len(os.listdir(path)) > 0
+
+
 class _RsyncJob(object):
     """
     A job to be executed by a worker Process
@@ -107,6 +138,35 @@ class _RsyncJob(object):
         self.copy_start_time = None
         self.copy_end_time = None
 
+        # Progress counters, updated by the worker process
+        self.total_size = sum(entry.size for entry in file_list or [])
+        self.processed_files = 0
+        self.processed_size = 0
+        self.copied_files = 0
+        self.copied_size = 0
+        # Bytes sent and received by rsync
+        self.transferred_size = 0
+
+    def progress(self):
+        """
+        Return the progress of the job, as reported by the worker
+        executing it
+
+        :rtype: dict
+        """
+        return {
+            'pid': os.getpid(),
+            'item_idx': self.item_idx,
+            'id': self.id,
+            'checksum': self.checksum,
+            'copy_start_time': self.copy_start_time,
+            'processed_files': self.processed_files,
+            'processed_size': self.processed_size,
+            'copied_files': self.copied_files,
+            'copied_size': self.copied_size,
+            'transferred_size': self.transferred_size,
+        }
+
 
 class _FileItem(collections.namedtuple('_FileItem', 'mode size date path')):
     """
@@ -271,10 +331,44 @@ class RsyncCopyController(object):
         $ # end of the line
     """)
 
+    # This regular expression is used to parse the lines printed by
+    # the '--itemize-changes' option, to follow the progress of the copy
+    ITEMIZE_RE = re.compile("""
+        (?x) # Enable verbose mode
+
+        ^ # start of the line
+
+        # the update type ('<' and '>' mean that the file is transferred)
+        (?P<update>[<>ch.*])
+
+        # the file type
+        (?P<type>[fdLDS])
+
+        # the attributes, which are all blanks for unchanged files
+        [^\ ]*
+        \ +
+
+        # the name of the file, followed by the target for links
+        (?P<path>.+?)
+        (\ (=>|->)\ .*)?
+
+        $ # end of the line
+    """)
+
+    # This regular expression is used to parse the summary printed
+    # by the '--stats' option
+    STATS_RE = re.compile("""
+        (?x) # Enable verbose mode
+
+        ^ # start of the line
+        Total\ bytes\ (sent|received):\ (?P<size>[\d,]+)
+    """)
+
     def __init__(self, path=None, ssh_command=None, ssh_options=None,
                  network_compression=False,
                  reuse_backup=None, safe_horizon=None,
-                 exclude=None, retry_times=0, retry_sleep=0, workers=1):
+                 exclude=None, retry_times=0, retry_sleep=0, workers=1,
+                 progress_file=None, ssh_master=None):
         """
         :param str|None path: the PATH where rsync executable will be searched
         :param str|None ssh_command: the ssh executable to be used
@@ -292,6 +386,11 @@ class RsyncCopyController(object):
         :param int retry_times: The number of times to retry a failed operation
         :param int retry_sleep: Sleep time between two retry
         :param int workers: The number of parallel copy workers
+        :param str|None progress_file: if set, the file where the progress
+            of the copy is periodically written
+        :param barman.command_wrappers.SshControlMaster|None ssh_master:
+            a shared SSH connection managed by the caller. If not set,
+            a new one is opened for the duration of the copy
         """
 
         super(RsyncCopyController, self).__init__()
@@ -305,6 +404,7 @@ class RsyncCopyController(object):
         self.retry_times = retry_times
         self.retry_sleep = retry_sleep
         self.workers = workers
+        self.progress_file = progress_file
 
         self.item_list = []
         """List of items to be copied"""
@@ -323,6 +423,18 @@ class RsyncCopyController(object):
         self.temp_dir = None
         """Temp dir used to store the status during the copy"""
 
+        self.ssh_master = ssh_master
+        """Shared SSH connection used by every rsync during the copy"""
+
+        self.progress_queue = None
+        """Queue used by the workers to report the progress of their jobs"""
+
+        self.running_jobs = {}
+        """Last progress reported for every running job"""
+
+        self.progress_update_time = None
+        """Time of the last progress update"""
+
         # Statistics
 
         self.jobs_done = None
@@ -421,18 +533,23 @@ class RsyncCopyController(object):
         else:
             exclude = self.exclude or item.exclude
 
-        # TODO: remove debug output or use it to progress tracking
         # By adding a double '--itemize-changes' option, the rsync
         # output will contain the full list of files that have been
-        # touched, even those that have not changed
+        # touched, even those that have not changed. It is used to
+        # follow the progress of the copy.
         args.append('--itemize-changes')
         args.append('--itemize-changes')
 
         # Build the rsync object that will execute the copy
+        # Use the shared SSH connection, if available
+        ssh_options = self.ssh_options
+        if self.ssh_master:
+            ssh_options = self.ssh_master.options
+
         rsync = RsyncPgData(
             path=self.path,
             ssh=self.ssh_command,
-            ssh_options=self.ssh_options,
+            ssh_options=ssh_options,
             args=args,
             bwlimit=item.bwlimit,
             network_compression=self.network_compression,
@@ -455,6 +572,17 @@ class RsyncCopyController(object):
 
         # Create a temporary directory to hold the file lists.
         self.temp_dir = tempfile.mkdtemp(suffix='', prefix='barman-')
+        # Every rsync process spawned during the copy (including the ones
+        # executed by the workers) shares a single SSH connection,
+        # whose control socket is stored inside the temporary directory,
+        # unless the caller already provided one
+        own_ssh_master = False
+        if self.ssh_command and self.ssh_master is None:
+            own_ssh_master = True
+            self.ssh_master = SshControlMaster(
+                self.ssh_command, self.ssh_options,
+                control_path=os.path.join(self.temp_dir, 'ssh'),
+                path=self.path)
         # The following try block is to make sure the temporary directory
         # will be removed on exit and all the pool workers
         # have been terminated.
@@ -473,6 +601,7 @@ class RsyncCopyController(object):
 
                 # Store the analysis start time
                 item.analysis_start_time = datetime.datetime.now()
+                self._write_progress()
 
                 # Analyze the source and destination directory content
                 _logger.info(self._progress_message(
@@ -493,6 +622,10 @@ class RsyncCopyController(object):
             # about the copy process.
             self.jobs_done = []
 
+            # The workers report the progress of their jobs through this
+            # queue. It must be created before the workers.
+            self.progress_queue = multiprocessing.Queue()
+
             # The jobs are executed using a parallel processes pool
             # Each job is generated by `self._job_generator`, it is executed by
             # `_run_worker` using `self._execute_job`, which has been set
@@ -500,16 +633,12 @@ class RsyncCopyController(object):
             pool = Pool(processes=self.workers,
                         initializer=_init_worker,
                         initargs=(self._execute_job,))
-            for job in pool.imap_unordered(_run_worker, self._job_generator(
-                    exclude_classes=[self.PGCONTROL_CLASS])):
-                # Store the finished job for further analysis
-                self.jobs_done.append(job)
+            self._run_jobs(pool, self._job_generator(
+                exclude_classes=[self.PGCONTROL_CLASS]))
 
             # The PGCONTROL_CLASS items must always be copied last
-            for job in pool.imap_unordered(_run_worker, self._job_generator(
-                    include_classes=[self.PGCONTROL_CLASS])):
-                # Store the finished job for further analysis
-                self.jobs_done.append(job)
+            self._run_jobs(pool, self._job_generator(
+                include_classes=[self.PGCONTROL_CLASS]))
 
         except KeyboardInterrupt:
             _logger.info("Copy interrupted by the user (safe before %s)",
@@ -529,6 +658,22 @@ class RsyncCopyController(object):
             if pool:
                 pool.terminate()
                 pool.join()
+            if self.progress_queue:
+                self.progress_queue.close()
+                self.progress_queue = None
+            self.running_jobs = {}
+            # The progress file is meaningful only while copying
+            if self.progress_file and os.path.exists(self.progress_file):
+                try:
+                    os.unlink(self.progress_file)
+                except EnvironmentError as e:
+                    _logger.error("Error removing '%s' (%s)",
+                                  self.progress_file, e)
+            # Close the shared SSH connection before removing the
+            # directory containing its control socket
+            if own_ssh_master:
+                self.ssh_master.close()
+                self.ssh_master = None
             # Clean up the temp dir, any exception raised here is logged
             # and discarded to not clobber an eventual exception being handled.
             try:
@@ -540,6 +685,214 @@ class RsyncCopyController(object):
             # Store the end time
             self.copy_end_time = datetime.datetime.now()
 
+    def _run_jobs(self, pool, jobs):
+        """
+        Execute the jobs using the pool of workers, storing them in
+        the `jobs_done` list once they are finished.
+
+        While waiting for the jobs, the progress of the copy is periodically
+        collected and written in the progress file.
+
+        :param multiprocessing.Pool pool: the pool of workers
+        :param iter[_RsyncJob] jobs: the jobs to execute
+        """
+        results = pool.imap_unordered(_run_worker, jobs)
+        while True:
+            try:
+                job = results.next(PROGRESS_INTERVAL)
+            except multiprocessing.TimeoutError:
+                self._collect_progress()
+                self._write_progress()
+                continue
+            except StopIteration:
+                break
+            # Store the finished job for further analysis
+            self._collect_progress()
+            self.jobs_done.append(job)
+            self.running_jobs.pop((job.item_idx, job.id, job.checksum), None)
+            self._write_progress()
+
+    def _collect_progress(self):
+        """
+        Receive the progress reported by the workers for the running jobs
+        """
+        if self.progress_queue is None:
+            return
+        while True:
+            try:
+                job_progress = self.progress_queue.get_nowait()
+            except Empty:
+                break
+            key = (job_progress['item_idx'], job_progress['id'],
+                   job_progress['checksum'])
+            self.running_jobs[key] = job_progress
+
+    def _report_progress(self, job, force=False):
+        """
+        Send the progress of a job to the main process.
+        It is executed by a worker process.
+
+        The progress is sent at most once every PROGRESS_INTERVAL seconds,
+        unless `force` is True.
+
+        :param _RsyncJob job: the running job
+        :param bool force: whether to ignore the time elapsed since the
+            last report
+        """
+        if self.progress_queue is None:
+            return
+        now = time.time()
+        if not force and self.progress_update_time and \
+                now - self.progress_update_time < PROGRESS_INTERVAL:
+            return
+        self.progress_update_time = now
+        self.progress_queue.put(job.progress())
+
+    def _progress_handler(self, job):
+        """
+        Build a handler for the output of rsync which updates the progress
+        counters of a job, parsing the lines printed by the
+        '--itemize-changes' option.
+
+        :param _RsyncJob job: the job being executed
+        :rtype: callable
+        """
+        sizes = dict((entry.path, entry.size) for entry in job.file_list)
+
+        def handler(line):
+            match = self.ITEMIZE_RE.match(line)
+            if not match or match.group('type') != 'f':
+                return
+            size = sizes.get(match.group('path'), 0)
+            job.processed_files += 1
+            job.processed_size += size
+            # The file content has been transferred
+            if match.group('update') in '<>':
+                job.copied_files += 1
+                job.copied_size += size
+            self._report_progress(job)
+        return handler
+
+    @classmethod
+    def _parse_stats(cls, output):
+        """
+        Get the number of bytes sent and received by rsync from the summary
+        printed by the '--stats' option
+
+        :param str output: the output of rsync
+        :rtype: int
+        """
+        transferred_size = 0
+        for line in (output or '').splitlines():
+            match = cls.STATS_RE.match(line.strip())
+            if match:
+                transferred_size += int(match.group('size').replace(',', ''))
+        return transferred_size
+
+    def progress(self):
+        """
+        Return the progress of the copy: the amount of data processed for
+        every item and by every worker, the current throughput and the
+        estimated end time.
+
+        The result can be serialised as JSON.
+
+        :rtype: dict
+        """
+        now = datetime.datetime.now()
+        items = []
+        for item in self.item_list:
+            items.append({
+                'label': item.label,
+                'total_files': 0,
+                'total_size': 0,
+                'processed_files': 0,
+                'processed_size': 0,
+                'copied_files': 0,
+                'copied_size': 0,
+                'transferred_size': 0,
+            })
+            # The size of a directory is known after the analysis
+            for entry in (item.safe_list or []) + (item.check_list or []):
+                items[-1]['total_files'] += 1
+                items[-1]['total_size'] += entry.size
+        # The completed jobs
+        copy_start = None
+        for job in self.jobs_done or []:
+            data = items[job.item_idx]
+            if job.file_list is not None:
+                data['processed_files'] += len(job.file_list)
+            data['processed_size'] += job.total_size
+            data['copied_files'] += job.copied_files
+            data['copied_size'] += job.copied_size
+            data['transferred_size'] += job.transferred_size
+            if copy_start is None or job.copy_start_time < copy_start:
+                copy_start = job.copy_start_time
+        # The running jobs
+        workers = []
+        for job_progress in self.running_jobs.values():
+            data = items[job_progress['item_idx']]
+            for key in ('processed_files', 'processed_size',
+                        'copied_files', 'copied_size'):
+                data[key] += job_progress[key]
+            job_start = job_progress['copy_start_time']
+            if copy_start is None or job_start < copy_start:
+                copy_start = job_start
+            elapsed = total_seconds(now - job_start)
+            workers.append({
+                'pid': job_progress['pid'],
+                'item': data['label'],
+                'bucket': job_progress['id'],
+                'checksum': job_progress['checksum'],
+                'processed_files': job_progress['processed_files'],
+                'processed_size': job_progress['processed_size'],
+                'throughput': (job_progress['processed_size'] / elapsed
+                               if elapsed > 0 else None),
+            })
+        result = {
+            'pid': os.getpid(),
+            'update_time': now.isoformat(),
+            'copy_start_time': (self.copy_start_time.isoformat()
+                                if self.copy_start_time else None),
+            'items': items,
+            'workers': sorted(workers, key=lambda worker: worker['pid']),
+        }
+        for key in ('total_files', 'total_size', 'processed_files',
+                    'processed_size', 'copied_files', 'copied_size',
+                    'transferred_size'):
+            result[key] = sum(data[key] for data in items)
+        # The throughput is calculated from the start of the first job
+        result['throughput'] = None
+        result['estimated_end_time'] = None
+        if copy_start is not None:
+            elapsed = total_seconds(now - copy_start)
+            if elapsed > 0 and result['processed_size'] > 0:
+                throughput = result['processed_size'] / elapsed
+                remaining = max(
+                    result['total_size'] - result['processed_size'], 0)
+                result['throughput'] = throughput
+                result['estimated_end_time'] = (
+                    now + datetime.timedelta(seconds=remaining / throughput)
+                ).isoformat()
+        return result
+
+    def _write_progress(self):
+        """
+        Write the progress of the copy in the progress file, if required.
+
+        Any error is logged and ignored, as it must not stop the copy.
+        """
+        if not self.progress_file:
+            return
+        tmp_file = self.progress_file + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(self.progress(), f)
+            os.rename(tmp_file, self.progress_file)
+        except EnvironmentError as e:
+            _logger.warning("Unable to write the copy progress in '%s': %s",
+                            self.progress_file, e)
+
     def _job_generator(self, include_classes=None, exclude_classes=None):
         """
         Generate the jobs to be executed by the workers
@@ -683,7 +1036,13 @@ class RsyncCopyController(object):
                        item.src,
                        item.dst,
                        file_list=file_list_path,
-                       checksum=job.checksum)
+                       checksum=job.checksum,
+                       out_handler=self._progress_handler(job))
+            # The files which have not been reported are either vanished
+            # or filtered out
+            job.processed_files = len(job.file_list)
+            job.processed_size = job.total_size
+            job.transferred_size = self._parse_stats(rsync.out)
         else:
             # A file must never have checksum and file_list set
             assert job.file_list is None, \
@@ -700,11 +1059,14 @@ class RsyncCopyController(object):
                         ret=rsync.ret, out=rsync.out, err=rsync.err))
         # Store the stop time
         job.copy_end_time = datetime.datetime.now()
+        self._report_progress(job, force=True)
         # Write in the log that the job is finished
         with _logger_lock:
             _logger.info(job.description, bucket,
-                         'finished (duration: %s)' % human_readable_timedelta(
-                             job.copy_end_time - job.copy_start_time))
+                         'finished (duration: %s, copied %s files, %s)' % (
+                             human_readable_timedelta(
+                                 job.copy_end_time - job.copy_start_time),
+                             job.copied_files, pretty_size(job.copied_size)))
         # Return the job to the caller, for statistics purpose
         return job
 
@@ -810,6 +1172,18 @@ class RsyncCopyController(object):
                 (item.path, item)
                 for item in self._list_files(rsync, ref)
                 if item.mode[0] != 'd'))
+            # When resuming a failed copy, the destination directory
+            # already contains files. Rsync compares them with the source
+            # instead of the ones in the reference directory, so they
+            # take precedence.
+            if item.reuse is not None and _is_non_empty_dir(item.dst):
+                dst = item.dst
+                if dst[-1] != '/':
+                    dst += '/'
+                ref_hash.update(
+                    (entry.path, entry)
+                    for entry in self._list_files(rsync, dst)
+                    if entry.mode[0] != 'd')
         except (CommandFailedException, RsyncListFilesFailure) as e:
             # Here we set ref_hash to None, thus disable the code that marks as
             # "safe matching" those destination files with different time or
@@ -899,12 +1273,15 @@ class RsyncCopyController(object):
             item.src, item.dst,
             check=True)
 
-    def _copy(self, rsync, src, dst, file_list, checksum=False):
+    def _copy(self, rsync, src, dst, file_list, checksum=False,
+              out_handler=None):
         """
         The method execute the call to rsync, using as source a
         a list of files, and adding the the checksum option if required by the
         caller.
 
+        The summary of the transfer is added to the output of rsync.
+
         :param Rsync rsync: the Rsync object used to retrieve the list of files
             inside the directories
             for copy purposes
@@ -912,13 +1289,19 @@ class RsyncCopyController(object):
         :param str dst: destination directory
         :param str file_list: path to the file containing the sources for rsync
         :param bool checksum: if checksum argument for rsync is required
+        :param callable|None out_handler: if set, it is invoked for every
+            line of the rsync output, while the copy is running
         """
         # Build the rsync call args
-        args = ['--files-from=%s' % file_list]
+        args = ['--files-from=%s' % file_list,
+                '--stats', '--no-human-readable']
         if checksum:
             # Add checksum option if needed
             args.append('--checksum')
-        self._rsync_ignore_vanished_files(rsync, src, dst, *args, check=True)
+        kwargs = {'check': True}
+        if out_handler:
+            kwargs['out_handler'] = out_handler
+        self._rsync_ignore_vanished_files(rsync, src, dst, *args, **kwargs)
 
     def _list_files(self, rsync, path):
         """
@@ -987,6 +1370,24 @@ class RsyncCopyController(object):
                         ret=rsync.ret, out=rsync.out, err=rsync.err))
         return rsync.out, rsync.err
 
+    def plan(self):
+        """
+        Return the copy plan: the destination of every item to be copied,
+        and the number of jobs already completed.
+
+        The result can be serialised as JSON. It is meant to be saved when
+        a copy fails, to let a following copy resume it, reusing the
+        directories already transferred.
+
+        :rtype: dict
+        """
+        items = [{'dst': item.dst, 'is_directory': item.is_directory}
+                 for item in self.item_list]
+        return {
+            'items': items,
+            'jobs_done': len(self.jobs_done or []),
+        }
+
     def statistics(self):
         """
         Return statistics about the copy object.
@@ -1006,6 +1407,9 @@ class RsyncCopyController(object):
             'analysis_time_per_item': {},
             'copy_time_per_item': {},
             'serialized_copy_time_per_item': {},
+            'copied_size_per_item': {},
+            'transferred_size_per_item': {},
+            'throughput_per_item': {},
         }
 
         # Calculate the time spent during the analysis of the items
@@ -1044,7 +1448,10 @@ class RsyncCopyController(object):
                 item_data[ident] = {
                     'start': job.copy_start_time,
                     'end': job.copy_end_time,
-                    'total_time': job.copy_end_time - job.copy_start_time
+                    'total_time': job.copy_end_time - job.copy_start_time,
+                    'size': job.total_size,
+                    'copied_size': job.copied_size,
+                    'transferred_size': job.transferred_size,
                 }
             else:
                 data = item_data[ident]
@@ -1053,6 +1460,9 @@ class RsyncCopyController(object):
                 if data['end'] < job.copy_end_time:
                     data['end'] = job.copy_end_time
                 data['total_time'] += job.copy_end_time - job.copy_start_time
+                data['size'] += job.total_size
+                data['copied_size'] += job.copied_size
+                data['transferred_size'] += job.transferred_size
 
         # Calculate the time spent copying
         copy_start = None
@@ -1069,8 +1479,720 @@ class RsyncCopyController(object):
             stat['serialized_copy_time_per_item'][ident] = total_seconds(
                 data['total_time'])
             serialized_time += data['total_time']
+            # Amount of data copied, and the throughput in bytes per second
+            # (useful to identify slow tablespaces)
+            stat['copied_size_per_item'][ident] = data['copied_size']
+            stat['transferred_size_per_item'][ident] = \
+                data['transferred_size']
+            copy_time = stat['copy_time_per_item'][ident]
+            if data['size'] and copy_time > 0:
+                stat['throughput_per_item'][ident] = data['size'] / copy_time
         # Store the total time spent by copying
         stat['copy_time'] = total_seconds(copy_end - copy_start)
         stat['serialized_copy_time'] = total_seconds(serialized_time)
+        stat['copied_size'] = sum(stat['copied_size_per_item'].values())
+        stat['transferred_size'] = sum(
+            stat['transferred_size_per_item'].values())
 
         return stat
+
+
+#: The FICLONE ioctl request (from linux/fs.h), used to create a reflink
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """
+    Copy the content of the src file into dst, using the most efficient
+    method available.
+
+    It tries, in order:
+
+    * a reflink (FICLONE ioctl), which shares the data blocks between the
+      two files on file systems supporting it (e.g. btrfs, XFS)
+    * the copy_file_range system call, which copies the data inside the
+      kernel (Python 3.8+)
+    * a plain copy of the content
+
+    Permissions and modification time are copied as well.
+
+    :param str src: the source file
+    :param str dst: the destination file
+    :return str: the method used, one of 'reflink', 'copy_file_range'
+        or 'copy'
+    """
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            method = _clone_content(fsrc, fdst)
+    shutil.copystat(src, dst)
+    return method
+
+
+def _clone_content(fsrc, fdst):
+    """
+    Copy the content of an open file into another one.
+
+    See :func:`clone_file` for the details.
+
+    :param file fsrc: the source file object, open for reading
+    :param file fdst: the destination file object, open for writing
+    :return str: the method used
+    """
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return 'reflink'
+    except (IOError, OSError):
+        pass
+
+    if hasattr(os, 'copy_file_range'):
+        size = os.fstat(fsrc.fileno()).st_size
+        try:
+            copied = 0
+            while copied < size:
+                count = os.copy_file_range(
+                    fsrc.fileno(), fdst.fileno(), size - copied)
+                if count == 0:
+                    break
+                copied += count
+            return 'copy_file_range'
+        except OSError as e:
+            # Cross-device copies are not supported by older kernels
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+
+    shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+    return 'copy'
+
+
+def _clone_files(file_list):
+    """
+    Clone a list of files. It is executed by a worker process.
+
+    :param list[tuple[str,str]] file_list: the (source, destination)
+        pairs to copy
+    :return int: the number of files that have been copied
+    """
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for src, dst in file_list:
+        clone_file(src, dst)
+    return len(file_list)
+
+
+class LocalCopyController(object):
+    """
+    Copy a list of local directories to their final, empty, local
+    destination.
+
+    Unlike RsyncCopyController, it doesn't implement any delta transfer:
+    every file is cloned using :func:`clone_file`, in parallel if more than
+    one worker has been requested. On file systems supporting reflinks,
+    the copy of a directory completes in a fraction of the time required
+    by rsync, without using additional space.
+
+    The supported exclusion patterns are a subset of the rsync ones: a
+    pattern starting with '/' is matched against the path relative to the
+    source directory, otherwise it is matched against the last components
+    of the path. Excluded directories are skipped with their whole content.
+    """
+
+    PGDATA_CLASS = RsyncCopyController.PGDATA_CLASS
+    TABLESPACE_CLASS = RsyncCopyController.TABLESPACE_CLASS
+    PGCONTROL_CLASS = RsyncCopyController.PGCONTROL_CLASS
+    CONFIG_CLASS = RsyncCopyController.CONFIG_CLASS
+
+    def __init__(self, workers=1):
+        """
+        :param int workers: The number of parallel copy workers
+        """
+        self.workers = workers
+        self.item_list = []
+        """List of items to be copied"""
+
+        # Statistics
+        self.copy_start_time = None
+        self.copy_end_time = None
+
+    def add_directory(self, label, src, dst,
+                      exclude=None,
+                      exclude_and_protect=None,
+                      include=None,
+                      bwlimit=None, reuse=None, item_class=None):
+        """
+        Add a directory that we want to copy.
+
+        The signature is the same of :meth:`RsyncCopyController.add_directory`
+        but the `include`, `bwlimit` and `reuse` arguments are ignored,
+        and `exclude_and_protect` is the same as `exclude`, as the
+        destination is supposed to be empty.
+
+        :param str label: symbolic name to be used for error messages
+            and logging.
+        :param str src: source directory.
+        :param str dst: destination directory.
+        :param list[str] exclude: list of patterns to be excluded from the
+            copy.
+        :param list[str] exclude_and_protect: list of patterns to be
+            excluded from the copy.
+        :param list[str] include: ignored
+        :param bwlimit: ignored
+        :param str|None reuse: ignored
+        :param str item_class: If specified carries a meta information about
+            what the object to be copied is.
+        """
+        self.item_list.append(
+            _RsyncCopyItem(
+                label=label,
+                src=src,
+                dst=dst,
+                exclude=(exclude or []) + (exclude_and_protect or []),
+                is_directory=True,
+                item_class=item_class))
+
+    @staticmethod
+    def _is_excluded(path, patterns):
+        """
+        Check if the path, relative to the copy root, matches a pattern
+
+        :param str path: the relative path, starting with '/'
+        :param list[str] patterns: the exclusion patterns
+        :rtype: bool
+        """
+        for pattern in patterns:
+            pattern = pattern.rstrip('/')
+            if pattern.startswith('/'):
+                if fnmatch.fnmatchcase(path, pattern):
+                    return True
+            else:
+                # An unanchored pattern matches the trailing components
+                depth = pattern.count('/') + 1
+                tail = '/'.join(path.split('/')[-depth:])
+                if fnmatch.fnmatchcase(tail, pattern):
+                    return True
+        return False
+
+    def _list_item(self, item):
+        """
+        Create the destination directory tree of an item and return
+        the list of files to be copied.
+
+        :param _RsyncCopyItem item: the item to copy
+        :return tuple[list,list]: the list of (source, destination) pairs
+            of files and the list of (source, destination) directories
+        """
+        src_root = item.src.rstrip('/')
+        dst_root = item.dst.rstrip('/')
+        patterns = item.exclude or []
+        files = []
+        dirs = [(src_root, dst_root)]
+        mkpath(dst_root)
+        for dirpath, dirnames, filenames in os.walk(src_root,
+                                                    followlinks=True):
+            rel_dir = dirpath[len(src_root):]
+            # Prune the excluded directories
+            for name in list(dirnames):
+                rel_path = '%s/%s' % (rel_dir, name)
+                if self._is_excluded(rel_path, patterns):
+                    dirnames.remove(name)
+                    continue
+                dst_dir = dst_root + rel_path
+                mkpath(dst_dir)
+                dirs.append((os.path.join(dirpath, name), dst_dir))
+            for name in filenames:
+                rel_path = '%s/%s' % (rel_dir, name)
+                if self._is_excluded(rel_path, patterns):
+                    continue
+                src = os.path.join(dirpath, name)
+                if not os.path.exists(src):
+                    _logger.warning("Skipping dangling symlink %s", src)
+                    continue
+                files.append((src, dst_root + rel_path))
+        return files, dirs
+
+    def copy(self):
+        """
+        Execute the actual copy
+        """
+        self.copy_start_time = datetime.datetime.now()
+        pool = None
+        try:
+            for item in self.item_list:
+                _logger.info("Local copy of %s", item)
+                files, dirs = self._list_item(item)
+                # Split the files in small batches, to balance the load
+                # between workers
+                batches = [files[i:i + 100]
+                           for i in range(0, len(files), 100)]
+                if self.workers > 1:
+                    if pool is None:
+                        pool = Pool(processes=self.workers)
+                    for _ in pool.imap_unordered(_clone_files, batches):
+                        pass
+                else:
+                    for src, dst in files:
+                        clone_file(src, dst)
+                # Set permissions and times of the directories after their
+                # content has been written
+                for src, dst in reversed(dirs):
+                    shutil.copystat(src, dst)
+                _logger.info("Local copy of %s finished (%s files)",
+                             item, len(files))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.copy_end_time = datetime.datetime.now()
+
+
+def _extract_archive(job):
+    """
+    Extract a compressed tar archive. It is executed by a worker process.
+
+    The archive is read locally and passed to the standard input of tar,
+    which is executed on the remote host when an ssh command is given.
+
+    :param tuple job: a (label, archive, destination, exclude,
+        ssh_command, path) tuple
+    :return str: the label of the extracted archive
+    """
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    label, archive, dst, exclude, ssh_command, path = job
+    args = ['--extract', '--gzip', '--file=-', '--preserve-permissions',
+            '--directory=%s' % dst]
+    # Patterns starting with '/' are relative to the archive root,
+    # the other ones match any trailing part of a path
+    args += ['--exclude=%s' % pattern
+             for pattern in exclude if not pattern.startswith('/')]
+    args.append('--anchored')
+    args += ['--exclude=%s' % pattern.lstrip('/')
+             for pattern in exclude if pattern.startswith('/')]
+    if ssh_command:
+        tar = Command(ssh_command, shell=True, path=path, check=True)
+        args = [full_command_quote('tar', args)]
+    else:
+        tar = Command('tar', path=path, check=True)
+    _logger.info("Extracting %s from %s to %s", label, archive, dst)
+    with open(archive, 'rb') as archive_file:
+        tar(stdin=archive_file, *args)
+    return label
+
+
+class TarExtractController(object):
+    """
+    Extract the compressed tar archives of a backup taken with
+    pg_basebackup in tar format to their destination directories.
+
+    Every archive is extracted by a tar process, running on the
+    destination host if an ssh command is given, so the data travels
+    compressed over the network. Archives are extracted in parallel if
+    more than one worker has been requested.
+
+    Files already present in a destination directory are overwritten,
+    but the ones missing from the archive are not removed.
+    """
+
+    PGDATA_CLASS = RsyncCopyController.PGDATA_CLASS
+    TABLESPACE_CLASS = RsyncCopyController.TABLESPACE_CLASS
+
+    def __init__(self, path=None, ssh_command=None, workers=1):
+        """
+        :param str|None path: the PATH environment variable to be used
+        :param str|None ssh_command: the ssh command used to reach the
+            destination host, None for a local extraction
+        :param int workers: The number of parallel extraction workers
+        """
+        self.path = path
+        self.ssh_command = ssh_command
+        self.workers = workers
+        self.item_list = []
+        """List of archives to be extracted"""
+
+        # Statistics
+        self.copy_start_time = None
+        self.copy_end_time = None
+
+    def add_archive(self, label, src, dst, exclude=None, item_class=None):
+        """
+        Add an archive that we want to extract.
+
+        The exclusion patterns follow the same convention of
+        :meth:`RsyncCopyController.add_directory`: a pattern starting with
+        '/' is anchored to the root of the archive.
+
+        :param str label: symbolic name to be used for error messages
+            and logging.
+        :param str src: the local archive file.
+        :param str dst: destination directory.
+        :param list[str] exclude: list of patterns to be excluded from the
+            extraction.
+        :param str item_class: If specified carries a meta information about
+            what the object to be extracted is.
+        """
+        self.item_list.append(
+            _RsyncCopyItem(
+                label=label,
+                src=src,
+                dst=dst,
+                exclude=exclude or [],
+                is_directory=False,
+                item_class=item_class))
+
+    def copy(self):
+        """
+        Execute the actual extraction
+        """
+        self.copy_start_time = datetime.datetime.now()
+        jobs = [(item.label, item.src, item.dst, item.exclude,
+                 self.ssh_command, self.path)
+                for item in self.item_list]
+        pool = None
+        try:
+            if self.workers > 1 and len(jobs) > 1:
+                pool = Pool(processes=min(self.workers, len(jobs)))
+                for label in pool.imap_unordered(_extract_archive, jobs):
+                    _logger.info("Extraction of %s finished", label)
+            else:
+                for job in jobs:
+                    _extract_archive(job)
+                    _logger.info("Extraction of %s finished", job[0])
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.copy_end_time = datetime.datetime.now()
+
+
+def _read_server_files(job):
+    """
+    Copy a list of files from a PostgreSQL server, through a dedicated
+    database connection. It is executed by a worker process.
+
+    :param tuple job: a (conninfo, file_list) tuple, where every element
+        of file_list is a (source, destination, modification time) tuple
+    :return int: the number of bytes that have been copied
+    """
+    # Ctrl-C is handled by the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conninfo, file_list = job
+    copied = 0
+    try:
+        conn = psycopg2.connect(conninfo)
+    except psycopg2.Error as e:
+        raise DataTransferFailure(
+            "cannot connect to PostgreSQL: %s" % str(e).strip())
+    try:
+        conn.autocommit = True
+        cur = conn.cursor()
+        for src, dst, mtime in file_list:
+            try:
+                copied += _read_server_file(cur, src, dst)
+            except psycopg2.Error as e:
+                raise DataTransferFailure(
+                    "error reading %s: %s" % (src, str(e).strip()))
+            if os.path.exists(dst):
+                os.utime(dst, (float(mtime), float(mtime)))
+    finally:
+        conn.close()
+    return copied
+
+
+def _read_server_file(cur, src, dst):
+    """
+    Copy a single file from a PostgreSQL server, reading it in chunks of
+    PostgresCopyController.CHUNK_SIZE bytes.
+
+    The file is read until its end, even if it has grown after being
+    listed. A file removed by PostgreSQL in the meantime is skipped, as
+    the WAL replay will take care of it.
+
+    :param cursor cur: a cursor on a superuser connection
+    :param str src: the absolute path of the file on the server
+    :param str dst: the local destination path
+    :return int: the number of bytes that have been copied
+    """
+    chunk_size = PostgresCopyController.CHUNK_SIZE
+    copied = 0
+    with open(dst, 'wb') as dst_file:
+        while True:
+            cur.execute("SELECT pg_read_binary_file(%s, %s, %s, true)",
+                        (src, copied, chunk_size))
+            data = cur.fetchone()[0]
+            if data is None:
+                break
+            dst_file.write(data)
+            copied += len(data)
+            if len(data) < chunk_size:
+                break
+    if data is None:
+        _logger.debug("Skipping %s, removed during the copy", src)
+        os.unlink(dst)
+        return 0
+    os.chmod(dst, 0o600)
+    return copied
+
+
+class PostgresCopyController(object):
+    """
+    Copy directories and files from a PostgreSQL server through a pool of
+    standard database connections, without accessing the file system of
+    the server.
+
+    The content of the directories is listed by the main process using
+    pg_ls_dir() and pg_stat_file(), then the files are split in batches
+    which are read with pg_read_binary_file() by a pool of workers, each
+    one using its own connection. This way the copy is spread on several
+    concurrent streams.
+
+    It requires PostgreSQL 9.5 or higher and a superuser connection.
+
+    The exclusion patterns follow the same rules of
+    :class:`LocalCopyController`, and the include patterns can select
+    some paths which would be otherwise excluded.
+    """
+
+    PGDATA_CLASS = RsyncCopyController.PGDATA_CLASS
+    TABLESPACE_CLASS = RsyncCopyController.TABLESPACE_CLASS
+    PGCONTROL_CLASS = RsyncCopyController.PGCONTROL_CLASS
+    CONFIG_CLASS = RsyncCopyController.CONFIG_CLASS
+
+    #: Number of bytes read from the server with a single query
+    CHUNK_SIZE = 8 * 1024 * 1024
+
+    #: Maximum number of files and size of a batch of files copied using
+    #: the same connection
+    BATCH_FILES = 1000
+    BATCH_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, conninfo, workers=1):
+        """
+        :param str conninfo: the connection string of a superuser
+            connection to the PostgreSQL server
+        :param int workers: The number of parallel connections
+        """
+        self.conninfo = conninfo
+        self.workers = workers
+        self.item_list = []
+        """List of items to be copied"""
+
+        # Statistics
+        self.copy_start_time = None
+        self.copy_end_time = None
+        self.analysis_time = 0
+        self.copied_size = 0
+
+    def add_directory(self, label, src, dst,
+                      exclude=None,
+                      exclude_and_protect=None,
+                      include=None,
+                      item_class=None):
+        """
+        Add a directory that we want to copy.
+
+        :param str label: symbolic name to be used for error messages
+            and logging.
+        :param str src: the absolute path of the directory on the server.
+        :param str dst: local destination directory.
+        :param list[str] exclude: list of patterns to be excluded from the
+            copy.
+        :param list[str] exclude_and_protect: list of patterns to be
+            excluded from the copy, the same as `exclude`.
+        :param list[str] include: list of patterns to be included in the
+            copy even if excluded.
+        :param str item_class: If specified carries a meta information about
+            what the object to be copied is.
+        """
+        self.item_list.append(
+            _RsyncCopyItem(
+                label=label,
+                src=src,
+                dst=dst,
+                exclude=(exclude or []) + (exclude_and_protect or []),
+                include=include,
+                is_directory=True,
+                item_class=item_class))
+
+    def add_file(self, label, src, dst, item_class=None, optional=False):
+        """
+        Add a file that we want to copy
+
+        :param str label: symbolic name to be used for error messages
+            and logging.
+        :param str src: the absolute path of the file on the server.
+        :param str dst: local destination file.
+        :param str item_class: If specified carries a meta information about
+            what the object to be copied is.
+        :param bool optional: Whether a missing file is not an error
+        """
+        self.item_list.append(
+            _RsyncCopyItem(
+                label=label,
+                src=src,
+                dst=dst,
+                is_directory=False,
+                item_class=item_class,
+                optional=optional))
+
+    def _list_item(self, cur, item):
+        """
+        Create the destination directory tree of an item and return
+        the list of files to be copied.
+
+        :param cursor cur: a cursor on a superuser connection
+        :param _RsyncCopyItem item: the item to copy
+        :return list[tuple]: the (source, destination, size,
+            modification time) tuples of the files to copy
+        """
+        if not item.is_directory:
+            cur.execute("SELECT size, extract(epoch FROM modification) "
+                        "FROM pg_stat_file(%s, true)", (item.src,))
+            size, mtime = cur.fetchone()
+            if size is None:
+                if item.optional:
+                    return []
+                raise DataTransferFailure(
+                    "data transfer failure: %s not found" % item.src)
+            mkpath(os.path.dirname(item.dst))
+            return [(item.src, item.dst, size, mtime)]
+
+        src_root = item.src.rstrip('/')
+        dst_root = item.dst.rstrip('/')
+        exclude = item.exclude or []
+        include = item.include or []
+        files = []
+        dirs = ['']
+        mkpath(dst_root)
+        os.chmod(dst_root, 0o700)
+        while dirs:
+            rel_dir = dirs.pop()
+            cur.execute("SELECT name, stat.size, stat.isdir, "
+                        "extract(epoch FROM stat.modification) "
+                        "FROM pg_ls_dir(%(dir)s, true, false) AS name, "
+                        "pg_stat_file(%(dir)s || '/' || name, true) AS stat",
+                        {'dir': src_root + rel_dir})
+            for name, size, isdir, mtime in cur.fetchall():
+                # Skip the entries removed in the meantime
+                if isdir is None:
+                    continue
+                rel_path = '%s/%s' % (rel_dir, name)
+                if LocalCopyController._is_excluded(rel_path, exclude) and \
+                        not LocalCopyController._is_excluded(rel_path,
+                                                             include):
+                    continue
+                if isdir:
+                    mkpath(dst_root + rel_path)
+                    os.chmod(dst_root + rel_path, 0o700)
+                    dirs.append(rel_path)
+                else:
+                    files.append((src_root + rel_path, dst_root + rel_path,
+                                  size, mtime))
+        return files
+
+    def _make_jobs(self, files):
+        """
+        Split a list of files in batches, each one copied by a worker
+        through its own connection.
+
+        Files are sorted by size, so the biggest ones are copied first.
+
+        :param list[tuple] files: the files to copy, as returned by
+            :meth:`_list_item`
+        :return list[tuple]: the jobs for :func:`_read_server_files`
+        """
+        jobs = []
+        batch = []
+        batch_size = 0
+        for src, dst, size, mtime in sorted(files, key=lambda f: -f[2]):
+            if batch and (len(batch) >= self.BATCH_FILES or
+                          batch_size + size > self.BATCH_SIZE):
+                jobs.append((self.conninfo, batch))
+                batch = []
+                batch_size = 0
+            batch.append((src, dst, mtime))
+            batch_size += size
+        if batch:
+            jobs.append((self.conninfo, batch))
+        return jobs
+
+    def _run_jobs(self, pool, jobs):
+        """
+        Execute a list of jobs, in parallel if a pool is available
+
+        :param multiprocessing.Pool|None pool: the pool of workers
+        :param list[tuple] jobs: the jobs to execute
+        """
+        if pool:
+            results = pool.imap_unordered(_read_server_files, jobs)
+        else:
+            results = (_read_server_files(job) for job in jobs)
+        for copied in results:
+            self.copied_size += copied
+
+    def copy(self):
+        """
+        Execute the actual copy
+        """
+        self.copy_start_time = datetime.datetime.now()
+        self.copied_size = 0
+        pool = None
+        try:
+            # List the content of every item
+            try:
+                conn = psycopg2.connect(self.conninfo)
+            except psycopg2.Error as e:
+                raise DataTransferFailure(
+                    "cannot connect to PostgreSQL: %s" % str(e).strip())
+            files = []
+            last_files = []
+            try:
+                cur = conn.cursor()
+                for item in self.item_list:
+                    _logger.info("Analysing %s", item)
+                    try:
+                        item_files = self._list_item(cur, item)
+                    except psycopg2.Error as e:
+                        raise DataTransferFailure(
+                            "error listing %s: %s" % (item.src,
+                                                      str(e).strip()))
+                    # The PGCONTROL_CLASS items must always be copied last
+                    if item.item_class == self.PGCONTROL_CLASS:
+                        last_files += item_files
+                    else:
+                        files += item_files
+            finally:
+                conn.close()
+            self.analysis_time = total_seconds(
+                datetime.datetime.now() - self.copy_start_time)
+            _logger.info("Copying %s files (%s) with %s connections",
+                         len(files) + len(last_files),
+                         pretty_size(sum(f[2] for f in files + last_files)),
+                         self.workers)
+
+            if self.workers > 1:
+                pool = Pool(processes=self.workers)
+            self._run_jobs(pool, self._make_jobs(files))
+            self._run_jobs(None, self._make_jobs(last_files))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+            self.copy_end_time = datetime.datetime.now()
+
+    def statistics(self):
+        """
+        Return statistics about the copy object.
+
+        :rtype: dict
+        """
+        copy_time = total_seconds(self.copy_end_time - self.copy_start_time)
+        return {
+            'total_time': copy_time,
+            'number_of_workers': self.workers,
+            'analysis_time': self.analysis_time,
+            'copy_time': copy_time - self.analysis_time,
+            'copied_size': self.copied_size,
+        }
@@ -0,0 +1,266 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the content-addressed object store used to
+deduplicate the files of the base backups.
+
+Every file of a backup is stored only once in the object store, named
+after the SHA-256 digest of its content, and the backup contains a hard
+link to the object. Files with the same content are shared regardless
+of their attributes, even among backups of different servers. As the
+hard links share the permissions and the modification time of the
+object, the original ones are saved, together with the list of objects
+referenced by a backup, in its manifest file, and are restored during
+recovery. The number of links of an object is used as its reference
+count: when it drops to one, no backup uses the object anymore and it
+can be removed.
+"""
+
+import collections
+import errno
+import hashlib
+import logging
+import os
+import stat
+
+_logger = logging.getLogger(__name__)
+
+#: An entry of the manifest of a backup: the key of the object storing
+#: a file, with the original permission bits and modification time
+#: of the file
+ManifestEntry = collections.namedtuple('ManifestEntry', 'key mode mtime')
+
+
+class ObjectStore(object):
+    """
+    A content-addressed store of files, shared by hard links
+    """
+
+    #: Name of the manifest file, inside the backup directory
+    MANIFEST_FILE = 'deduplication.manifest'
+
+    #: Size of the blocks read while hashing a file
+    BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, path):
+        """
+        :param str path: the directory containing the objects
+        """
+        self.path = path
+
+    def object_path(self, key):
+        """
+        Get the path of the object with the given key
+
+        :param str key: the key of the object, as returned by object_key
+        :rtype: str
+        """
+        return os.path.join(self.path, key[:2], key[2:])
+
+    @classmethod
+    def file_digest(cls, path):
+        """
+        Calculate the SHA-256 hex digest of the content of a file
+
+        :param str path: the file to hash
+        :rtype: str
+        """
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while True:
+                block = f.read(cls.BLOCK_SIZE)
+                if not block:
+                    break
+                sha.update(block)
+        return sha.hexdigest()
+
+    @classmethod
+    def read_manifest(cls, backup_dir):
+        """
+        Read the manifest of a backup
+
+        :param str backup_dir: the base directory of the backup
+        :return dict[str,ManifestEntry]: a relative path -> entry map,
+            empty if the backup has not been deduplicated
+        """
+        manifest = {}
+        manifest_file = os.path.join(backup_dir, cls.MANIFEST_FILE)
+        if not os.path.exists(manifest_file):
+            return manifest
+        with open(manifest_file) as f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                key, mode, mtime, rel_path = line.split(' ', 3)
+                manifest[rel_path] = ManifestEntry(key, int(mode, 8),
+                                                   float(mtime))
+        return manifest
+
+    @classmethod
+    def changed_attributes(cls, backup_dir):
+        """
+        Get the files of a backup whose original attributes differ from
+        the ones of the shared object they are linked to
+
+        :param str backup_dir: the base directory of the backup
+        :return list[tuple[str,int,float]]: the relative path, the
+            permission bits and the modification time of every file
+            to fix after a copy
+        """
+        changed = []
+        for rel_path, entry in sorted(cls.read_manifest(backup_dir).items()):
+            try:
+                file_stat = os.lstat(os.path.join(backup_dir, rel_path))
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue
+            if stat.S_IMODE(file_stat.st_mode) != entry.mode or \
+                    abs(file_stat.st_mtime - entry.mtime) >= 0.000001:
+                changed.append((rel_path, entry.mode, entry.mtime))
+        return changed
+
+    def deduplicate(self, backup_dir, reference_dir=None):
+        """
+        Move the content of every file of a backup in the object store,
+        replacing the file with a hard link to the stored object.
+
+        Only the files contained in the subdirectories of backup_dir
+        (the data directory and the tablespaces) are deduplicated.
+        Files which are hard links to the same path of the reference
+        backup are not hashed again, if the reference has been
+        deduplicated. The original permissions and modification time of
+        every file are saved in the manifest.
+
+        :param str backup_dir: the base directory of the backup
+        :param str|None reference_dir: the base directory of the
+            previous backup, if any
+        :return tuple[int,int]: the number of files which are now shared
+            with other backups and their total size
+        """
+        reference = {}
+        if reference_dir:
+            reference = self.read_manifest(reference_dir)
+        shared_files = 0
+        shared_size = 0
+        manifest_file = os.path.join(backup_dir, self.MANIFEST_FILE)
+        # The manifest is written while processing the files, so the
+        # objects already linked are released even if this method fails
+        with open(manifest_file, 'w') as manifest:
+            for dir_path, _, file_names in os.walk(backup_dir):
+                if dir_path == backup_dir:
+                    # Skip the metadata files of the backup
+                    continue
+                for file_name in file_names:
+                    file_path = os.path.join(dir_path, file_name)
+                    rel_path = os.path.relpath(file_path, backup_dir)
+                    file_stat = os.lstat(file_path)
+                    # Empty files and links are not worth the effort
+                    if not os.path.isfile(file_path) or \
+                            os.path.islink(file_path) or \
+                            file_stat.st_size == 0:
+                        continue
+                    key = None
+                    if file_stat.st_nlink > 1 and rel_path in reference:
+                        key = reference[rel_path].key
+                        object_path = self.object_path(key)
+                        if not os.path.exists(object_path) or \
+                                not os.path.samefile(object_path, file_path):
+                            key = None
+                    if key is None:
+                        key = self.file_digest(file_path)
+                        if self._store(key, file_path):
+                            shared_files += 1
+                            shared_size += file_stat.st_size
+                    else:
+                        shared_files += 1
+                        shared_size += file_stat.st_size
+                    manifest.write('%s %o %.6f %s\n' % (
+                        key, stat.S_IMODE(file_stat.st_mode),
+                        file_stat.st_mtime, rel_path))
+        return shared_files, shared_size
+
+    def _store(self, key, file_path):
+        """
+        Store a file in the object store.
+
+        If an object with the same key already exists, the file is
+        replaced by a hard link to it, otherwise the file becomes the
+        new object.
+
+        :param str key: the key of the object
+        :param str file_path: the file to store
+        :return bool: True if the file is now shared with an
+            existing object
+        """
+        object_path = self.object_path(key)
+        while True:
+            if os.path.exists(object_path):
+                if os.path.samefile(object_path, file_path):
+                    return False
+                # Replace the file atomically
+                tmp_path = file_path + '.dedup'
+                try:
+                    os.link(object_path, tmp_path)
+                except OSError as e:
+                    # The object has been concurrently removed
+                    if e.errno != errno.ENOENT:
+                        raise
+                    continue
+                os.rename(tmp_path, file_path)
+                return True
+            try:
+                os.makedirs(os.path.dirname(object_path))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            try:
+                os.link(file_path, object_path)
+            except OSError as e:
+                # The object has been concurrently added
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            return False
+
+    def release(self, backup_dir):
+        """
+        Remove the objects referenced by a backup which are no longer
+        used by any other backup.
+
+        It must be called after the removal of the backup data, but
+        before the removal of its manifest.
+
+        :param str backup_dir: the base directory of the backup
+        :return int: the number of removed objects
+        """
+        removed = 0
+        manifest = self.read_manifest(backup_dir)
+        for key in set(entry.key for entry in manifest.values()):
+            object_path = self.object_path(key)
+            try:
+                if os.lstat(object_path).st_nlink == 1:
+                    os.unlink(object_path)
+                    removed += 1
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        _logger.debug("Removed %s unused objects from %s",
+                      removed, self.path)
+        return removed
@@ -276,6 +276,18 @@ class BadXlogSegmentName(WALFileException):
     """
 
 
+class BadWalFile(WALFileException):
+    """
+    Exception for a WAL file with invalid content
+    """
+
+
+class UnsupportedWalFile(BadWalFile):
+    """
+    Exception for a WAL file whose format or compression cannot be decoded
+    """
+
+
 class BadHistoryFileContents(WALFileException):
     """
     Exception for a corrupted history file
@@ -299,3 +311,9 @@ class AbortedRetryHookScript(HookScriptException):
         return ("Abort '%s_%s' retry hook script (%s, exit code: %d)" % (
                 self.hook.phase, self.hook.name,
                 self.hook.script, self.hook.exit_status))
+
+
+class WalServerException(BarmanException):
+    """
+    Exception for an invalid request or response of the WAL server
+    """
@@ -16,8 +16,9 @@
 # along with Barman.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
+import time
 
-from barman.command_wrappers import Command, full_command_quote
+from barman.command_wrappers import Command, full_command_quote, shell_quote
 from barman.exceptions import FsOperationFailed
 
 _logger = logging.getLogger(__name__)
@@ -290,6 +291,36 @@ class UnixLocalCommand(object):
         self.cmd('ls', args=ls_options)
         return self.internal_cmd.out
 
+    def set_file_attributes(self, attributes):
+        """
+        Set the permissions and the modification time of many files,
+        executing a single shell script. Missing files are ignored.
+
+        The modification time is set with a precision of one second.
+
+        :param list[tuple[str,int,float]] attributes: the path, the
+            permission bits and the modification time (as seconds since
+            the epoch) of every file
+        """
+        _logger.debug('set the attributes of %s files', len(attributes))
+        if not attributes:
+            return
+        # touch interprets the time in the local time zone
+        script = ['TZ=UTC0', 'export TZ']
+        for path, mode, mtime in attributes:
+            path = shell_quote(path)
+            script.append(
+                'if [ -f %s ]; then chmod %o %s && touch -m -t %s %s '
+                '|| exit 1; fi' % (
+                    path, mode, path,
+                    time.strftime('%Y%m%d%H%M.%S', time.gmtime(mtime)),
+                    path))
+        script.append('')
+        result = self.internal_cmd('sh',
+                                   stdin='\n'.join(script).encode('utf-8'))
+        if result != 0:
+            raise FsOperationFailed('setting file attributes failed')
+
 
 class UnixRemoteCommand(UnixLocalCommand):
     """
@@ -27,6 +27,7 @@ import dateutil.tz
 from barman import xlog
 from barman.compression import identify_compression
 from barman.exceptions import BackupInfoBadInitialisation
+from barman.wal_reader import dump_wal_index, load_wal_index
 
 # Named tuple representing a Tablespace with 'name' 'oid' and 'location'
 # as property.
@@ -314,6 +315,8 @@ class WalFileInfo(FieldListFile):
     time = Field('time', load=float, doc='WAL file modification time '
                                          '(seconds since epoch)')
     compression = Field('compression', doc='compression type')
+    index = Field('index', dump=dump_wal_index, load=load_wal_index,
+                  doc='transactions and restore points in the WAL file')
 
     @classmethod
     def from_file(cls, filename, default_compression=None, **kwargs):
@@ -343,7 +346,16 @@ class WalFileInfo(FieldListFile):
     def to_xlogdb_line(self):
         """
         Format the content of this object as a xlogdb line.
+
+        The index is appended as a fifth field only when available.
         """
+        if self.index is not None:
+            return "%s\t%s\t%s\t%s\t%s\n" % (
+                self.name,
+                self.size,
+                self.time,
+                self.compression,
+                dump_wal_index(self.index))
         return "%s\t%s\t%s\t%s\n" % (
             self.name,
             self.size,
@@ -358,22 +370,29 @@ class WalFileInfo(FieldListFile):
         :param str line: a line in the wal database to parse
         :rtype: WalFileInfo
         """
+        index = None
         try:
-            name, size, time, compression = line.split()
+            # The index is the last field, and it can contain spaces
+            name, size, time, compression, index = line.split(None, 4)
         except ValueError:
-            # Old format compatibility (no compression)
-            compression = None
             try:
-                name, size, time = line.split()
+                name, size, time, compression = line.split()
             except ValueError:
-                raise ValueError("cannot parse line: %r" % (line,))
+                # Old format compatibility (no compression)
+                compression = None
+                try:
+                    name, size, time = line.split()
+                except ValueError:
+                    raise ValueError("cannot parse line: %r" % (line,))
         # The to_xlogdb_line method writes None values as literal 'None'
         if compression == 'None':
             compression = None
         size = int(size)
         time = float(time)
+        if index is not None:
+            index = load_wal_index(index)
         return cls(name=name, size=size, time=time,
-                   compression=compression)
+                   compression=compression, index=index)
 
     def to_json(self):
         """
@@ -427,6 +446,7 @@ class BackupInfo(FieldListFile):
     begin_wal = Field('begin_wal')
     begin_offset = Field('begin_offset', load=int)
     size = Field('size', load=int)
+    compression = Field('compression')
     deduplicated_size = Field('deduplicated_size', load=int)
     end_time = Field('end_time', load=load_datetime_tz)
     end_xlog = Field('end_xlog')
@@ -501,14 +521,51 @@ class BackupInfo(FieldListFile):
             _logger.warning("Error detecting backup_version, "
                             "use default: 2. Failure reason: %s", e)
 
+    @classmethod
+    def from_fields(cls, server, filename, fields, backup_version):
+        """
+        Build a BackupInfo object from the already parsed content of
+        a backup.info file, without reading it from disk.
+
+        This is used to restore the objects saved in the backup catalog
+        snapshot of the BackupManager.
+
+        :param Server server: the server owning the backup
+        :param str filename: the path of the backup.info file
+        :param dict fields: the values of the fields, as returned by
+            the `fields` method
+        :param int backup_version: the layout version of the backup
+        :rtype: BackupInfo
+        """
+        backup_info = cls.__new__(cls)
+        FieldListFile.__init__(backup_info)
+        backup_info.server = server
+        backup_info.config = server.config
+        backup_info.backup_manager = server.backup_manager
+        backup_info._fields.update(fields)
+        backup_info.filename = filename
+        backup_info.backup_id = backup_info.detect_backup_id()
+        backup_info.backup_version = backup_version
+        return backup_info
+
+    def fields(self):
+        """
+        Return a copy of the values of the fields of this object
+
+        :rtype: dict
+        """
+        return dict(self._fields)
+
     def get_required_wal_segments(self):
         """
         Get the list of required WAL segments for the current backup
+
+        :rtype: barman.xlog.SegmentRange
         """
-        return xlog.generate_segment_names(
+        return xlog.SegmentRange.from_names(
             self.begin_wal, self.end_wal,
-            self.version,
-            self.xlog_segment_size)
+            self.xlog_segment_size,
+            self.version)
 
     def get_list_of_files(self, target):
         """
@@ -582,6 +639,25 @@ class BackupInfo(FieldListFile):
         # Return the built path
         return os.path.join(*path)
 
+    def get_archive_file(self, tablespace_oid=None):
+        """
+        Get path to the compressed tar archive of the data directory,
+        or of a tablespace if tablespace_oid is passed.
+
+        The archives are written by pg_basebackup inside the data
+        directory of a compressed backup.
+
+        :param int tablespace_oid: the oid of a valid tablespace
+        :rtype: str
+        """
+        if tablespace_oid is not None:
+            # Validate the tablespace oid
+            self.get_data_directory(tablespace_oid)
+            name = str(tablespace_oid)
+        else:
+            name = 'base'
+        return os.path.join(self.get_data_directory(), '%s.tar.gz' % name)
+
     def get_external_config_files(self):
         """
         Identify all the configuration files that reside outside the PGDATA.
@@ -624,6 +700,9 @@ class BackupInfo(FieldListFile):
         Set a value for a given key
         """
         setattr(self, key, value)
+        if key == 'status':
+            # The status of the backups is part of the catalog
+            self.backup_manager.catalog_changed()
 
     def save(self, filename=None, file_object=None):
         if not file_object:
@@ -287,3 +287,19 @@ class ServerWalReceiveLock(LockFile):
         super(ServerWalReceiveLock, self).__init__(
             os.path.join(lock_directory, '.%s-receive-wal.lock' % server_name),
             raise_if_fail=True, wait=False)
+
+
+class ServerTrashLock(LockFile):
+    """
+    This lock protects a server from multiple executions of
+    reclaim-trash command
+
+    Creates a '.<SERVER>-reclaim-trash.lock' lock file under
+    the given lock_directory for the named SERVER.
+    """
+
+    def __init__(self, lock_directory, server_name):
+        super(ServerTrashLock, self).__init__(
+            os.path.join(lock_directory,
+                         '.%s-reclaim-trash.lock' % server_name),
+            raise_if_fail=True, wait=False)
@@ -22,7 +22,6 @@ This module control how the output of Barman will be rendered
 from __future__ import print_function
 
 import datetime
-import inspect
 import logging
 import sys
 
@@ -33,8 +32,9 @@ from barman.xlog import diff_lsn
 __all__ = [
     'error_occurred', 'debug', 'info', 'warning', 'error', 'exception',
     'result', 'close_and_exit', 'close', 'set_output_writer',
+    'start_recording', 'stop_recording', 'replay',
     'AVAILABLE_WRITERS', 'DEFAULT_WRITER', 'ConsoleOutputWriter',
-    'NagiosOutputWriter',
+    'NagiosOutputWriter', 'RecordingOutputWriter',
 ]
 
 #: True if error or exception methods have been called
@@ -89,7 +89,8 @@ def _put(level, message, *args, **kwargs):
     is_error = kwargs.pop('is_error', False)
     if len(kwargs):
         raise TypeError('%s() got an unexpected keyword argument %r'
-                        % (inspect.stack()[1][3], kwargs.popitem()[0]))
+                        % (sys._getframe(1).f_code.co_name,
+                           kwargs.popitem()[0]))
     if is_error:
         global error_occurred
         error_occurred = True
@@ -102,9 +103,10 @@ def _put(level, message, *args, **kwargs):
         if level == 'exception':
             level = 'error'
             exc_info = True
-        frm = inspect.stack()[2]
-        mod = inspect.getmodule(frm[0])
-        logger = logging.getLogger(mod.__name__)
+        # inspect.stack() is avoided, as it reads the source code
+        # of every frame
+        frm = sys._getframe(2)
+        logger = logging.getLogger(frm.f_globals['__name__'])
         log_level = logging.getLevelName(level.upper())
         logger.log(log_level, message, *args, **{'exc_info': exc_info})
 
@@ -302,6 +304,106 @@ def set_output_writer(new_writer, *args, **kwargs):
         _writer = new_writer
 
 
+def start_recording():
+    """
+    Temporarily replace the current output writer with a
+    RecordingOutputWriter, without closing it.
+
+    :return RecordingOutputWriter: the new writer
+    """
+    global _writer
+    _writer = RecordingOutputWriter(_writer)
+    return _writer
+
+
+def stop_recording():
+    """
+    Restore the output writer replaced by start_recording()
+
+    :return list[tuple]: the recorded calls
+    """
+    global _writer
+    assert isinstance(_writer, RecordingOutputWriter)
+    recorder = _writer
+    _writer = recorder.writer
+    return recorder.calls
+
+
+def replay(calls):
+    """
+    Send the calls recorded by a RecordingOutputWriter to the current
+    output writer, in the same order.
+
+    :param list[tuple] calls: the recorded calls
+    """
+    for name, args, kwargs in calls:
+        if name == 'error_occurred':
+            global error_occurred
+            error_occurred = True
+        getattr(_writer, name)(*args, **kwargs)
+
+
+class RecordingOutputWriter(object):
+    """
+    Output writer that records every call instead of producing any output.
+
+    It is used to run a command in a worker process, letting the main
+    process replay the output later, through its own writer.
+    """
+
+    def __init__(self, writer):
+        """
+        :param writer: the writer which will receive the calls
+        """
+        self.writer = writer
+        #: List of (method name, args, kwargs) tuples
+        self.calls = []
+
+    def is_quiet(self):
+        return self.writer.is_quiet()
+
+    def is_debug(self):
+        return self.writer.is_debug()
+
+    def close(self):
+        """
+        Nothing to close, the real writer is closed by the main process
+        """
+
+    def __getattr__(self, name):
+        """
+        Return a method recording the call to the given method
+        """
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def record(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+        return record
+
+    def _record_message(self, level, message, args):
+        """
+        Record a message, formatting it immediately, as its arguments
+        could not be transferred to another process
+        """
+        self.calls.append((level, (_format_message(message, args),), {}))
+
+    def debug(self, message, *args):
+        self._record_message('debug', message, args)
+
+    def info(self, message, *args):
+        self._record_message('info', message, args)
+
+    def warning(self, message, *args):
+        self._record_message('warning', message, args)
+
+    def error(self, message, *args):
+        self._record_message('error', message, args)
+
+    def exception(self, message, *args):
+        self._record_message('exception', message, args)
+
+
 class ConsoleOutputWriter(object):
     def __init__(self, debug=False, quiet=False):
         """
@@ -599,6 +701,9 @@ class ConsoleOutputWriter(object):
                           pretty_size(data['deduplicated_size']),
                           '{percent:.2%}'.format(percent=deduplication_ratio)
                           )
+            if data['compression']:
+                self.info("    Compression          : %s (tar format)",
+                          data['compression'])
             self.info("    Timeline             : %s", data['timeline'])
             self.info("    Begin WAL            : %s",
                       data['begin_wal'])
@@ -631,6 +736,14 @@ class ConsoleOutputWriter(object):
                     if number_of_workers > 1:
                         value += " (%s jobs)" % number_of_workers
                     self.info("    Estimated throughput : %s", value)
+                    # Show the throughput of every copied directory
+                    throughput_per_item = copy_stats.get(
+                        'throughput_per_item')
+                    if throughput_per_item and len(throughput_per_item) > 1:
+                        for ident in sorted(throughput_per_item):
+                            self.info(
+                                "      %-19s: %s/s", ident,
+                                pretty_size(throughput_per_item[ident]))
             self.info("    Begin Offset         : %s",
                       data['begin_offset'])
             self.info("    End Offset           : %s",
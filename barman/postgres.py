@@ -20,6 +20,7 @@ This module represents the interface towards a PostgreSQL server.
 """
 
 import atexit
+import collections
 import logging
 from abc import ABCMeta
 
@@ -40,7 +41,7 @@ from barman.exceptions import (ConninfoException, PostgresAppNameError,
                                PostgresSuperuserRequired,
                                PostgresUnsupportedFeature)
 from barman.infofile import Tablespace
-from barman.remote_status import RemoteStatusMixin
+from barman.remote_status import VOLATILE_STATUS_TTL, RemoteStatusMixin
 from barman.utils import simplify_version, with_metaclass
 from barman.xlog import DEFAULT_XLOG_SEG_SIZE
 
@@ -55,6 +56,11 @@ except ImportError:
 
 _logger = logging.getLogger(__name__)
 
+# A physical replication slot, as returned by get_replication_slot.
+# It is defined at module level to be picklable.
+ReplicationSlot = collections.namedtuple(
+    'ReplicationSlot', 'slot_name active restart_lsn')
+
 _live_connections = []
 """
 List of connections to be closed at the interpreter shutdown
@@ -75,6 +81,27 @@ def _atexit():
         conn.close()
 
 
+def _parse_synchronous_standby_names(synchronous_standby_names):
+    """
+    Normalise the list of sync standby names
+
+    On PostgreSQL 9.6 it is possible to specify the number of
+    required synchronous standby using this format:
+    n (name1, name2, ... nameN).
+    We only need the name list, so we discard everything else.
+
+    :param str synchronous_standby_names: the value of the setting
+    :return list: synchronous standby names
+    """
+    # The name list starts after the first parenthesis or at pos 0
+    names_start = synchronous_standby_names.find('(') + 1
+    names_end = synchronous_standby_names.rfind(')')
+    if names_end < 0:
+        names_end = len(synchronous_standby_names)
+    names_list = synchronous_standby_names[names_start:names_end]
+    return [x.strip() for x in names_list.split(',')]
+
+
 class PostgreSQL(with_metaclass(ABCMeta, RemoteStatusMixin)):
     """
     This abstract class represents a generic interface to a PostgreSQL server.
@@ -262,6 +289,9 @@ class StreamingConnection(PostgreSQL):
 
     CHECK_QUERY = 'IDENTIFY_SYSTEM'
 
+    #: The values of the status changing frequently
+    REMOTE_STATUS_TTLS = {'xlogpos': VOLATILE_STATUS_TTL}
+
     def __init__(self, config):
         """
         Streaming connection constructor
@@ -344,6 +374,15 @@ class StreamingConnection(PostgreSQL):
                          str(e).strip())
         return result
 
+    def is_remote_status_cacheable(self, status):
+        """
+        Don't cache the status if the connection failed
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return status.get('connection_error') is None
+
     def create_physical_repslot(self, slot_name):
         """
         Create a physical replication slot using the streaming connection
@@ -402,6 +441,41 @@ class PostgreSQLConnection(PostgreSQL):
     WALSTREAMER = 2
     ANY_STREAMING_CLIENT = (STANDBY, WALSTREAMER)
 
+    #: Select from pg_stat_archiver statistics view,
+    #: retrieving statistics about WAL archiver process activity,
+    #: also evaluating if the server is archiving without issues
+    #: and the archived WALs per second rate.
+    #:
+    #: We are using current_settings to check for archive_mode=always.
+    #: current_setting does normalise its output so we can just
+    #: check for 'always' settings using a direct string
+    #: comparison
+    ARCHIVER_STATS_QUERY = (
+        "SELECT *, "
+        "current_setting('archive_mode') IN ('on', 'always') "
+        "AND (last_failed_wal IS NULL "
+        "OR last_failed_wal LIKE '%.history' "
+        "AND substring(last_failed_wal from 1 for 8) "
+        "<= substring(last_archived_wal from 1 for 8) "
+        "OR last_failed_time <= last_archived_time) "
+        "AS is_archiving, "
+        "CAST (archived_count AS NUMERIC) "
+        "/ EXTRACT (EPOCH FROM age(now(), stats_reset)) "
+        "AS current_archived_wals_per_second "
+        "FROM pg_stat_archiver")
+
+    #: The columns returned by ARCHIVER_STATS_QUERY
+    ARCHIVER_STATS_KEYS = (
+        'archived_count', 'last_archived_wal', 'last_archived_time',
+        'failed_count', 'last_failed_wal', 'last_failed_time',
+        'stats_reset', 'is_archiving', 'current_archived_wals_per_second')
+
+    #: The values of the status changing frequently
+    REMOTE_STATUS_TTLS = dict.fromkeys(
+        ('current_xlog', 'current_size', 'is_in_recovery',
+         'replication_slot') + ARCHIVER_STATS_KEYS,
+        VOLATILE_STATUS_TTL)
+
     def __init__(self, config):
         """
         PostgreSQL connection constructor.
@@ -639,34 +713,192 @@ class PostgreSQLConnection(PostgreSQL):
             if self.server_version < 90400:
                 return None
             cur = self._cursor(cursor_factory=DictCursor)
-            # Select from pg_stat_archiver statistics view,
-            # retrieving statistics about WAL archiver process activity,
-            # also evaluating if the server is archiving without issues
-            # and the archived WALs per second rate.
-            #
-            # We are using current_settings to check for archive_mode=always.
-            # current_setting does normalise its output so we can just
-            # check for 'always' settings using a direct string
-            # comparison
-            cur.execute(
-                "SELECT *, "
-                "current_setting('archive_mode') IN ('on', 'always') "
-                "AND (last_failed_wal IS NULL "
-                "OR last_failed_wal LIKE '%.history' "
-                "AND substring(last_failed_wal from 1 for 8) "
-                "<= substring(last_archived_wal from 1 for 8) "
-                "OR last_failed_time <= last_archived_time) "
-                "AS is_archiving, "
-                "CAST (archived_count AS NUMERIC) "
-                "/ EXTRACT (EPOCH FROM age(now(), stats_reset)) "
-                "AS current_archived_wals_per_second "
-                "FROM pg_stat_archiver")
+            cur.execute(self.ARCHIVER_STATS_QUERY)
             return cur.fetchone()
         except (PostgresConnectionError, psycopg2.Error) as e:
             _logger.debug("Error retrieving pg_stat_archive data: %s",
                           str(e).strip())
             return None
 
+    def _remote_status_query(self, version):
+        """
+        Build the query collecting the remote status of the server
+        in a single round trip, according to the PostgreSQL version.
+
+        The columns requiring superuser privileges evaluate to NULL
+        for a normal user.
+
+        :param int version: the PostgreSQL version
+        :return tuple[str,dict]: the query and its parameters
+        """
+        columns = [
+            "version() AS version",
+            "u.rolsuper AS is_superuser",
+            "CASE WHEN u.rolsuper "
+            "THEN current_setting('data_directory') END "
+            "AS data_directory",
+            "(SELECT setting FROM pg_settings "
+            "WHERE name = 'config_file') AS config_file",
+            "(SELECT setting FROM pg_settings "
+            "WHERE name = 'hba_file') AS hba_file",
+            "(SELECT setting FROM pg_settings "
+            "WHERE name = 'ident_file') AS ident_file",
+            "current_setting('archive_mode') AS archive_mode",
+            "current_setting('archive_command') AS archive_command",
+        ]
+        volatile_columns, joins, params = \
+            self._remote_status_volatile_columns(version)
+        columns += volatile_columns
+        if version >= 90000:
+            columns.append("current_setting('wal_level') AS wal_level")
+        if version >= 80400:
+            columns.append(
+                "ARRAY(SELECT DISTINCT sourcefile FROM pg_settings "
+                "WHERE sourcefile IS NOT NULL "
+                "AND sourcefile NOT IN "
+                "(SELECT setting FROM pg_settings "
+                "WHERE name = 'config_file') "
+                "ORDER BY 1) AS included_files")
+        # pg_extension is only available from Postgres 9.1+
+        if version >= 90100:
+            columns += [
+                "EXISTS (SELECT 1 FROM pg_extension "
+                "WHERE extname = 'pgespresso') AS pgespresso_installed",
+                "current_setting('synchronous_standby_names') "
+                "AS synchronous_standby_names",
+            ]
+        else:
+            columns.append("false AS pgespresso_installed")
+        query = ("SELECT %s FROM pg_roles u%s "
+                 "WHERE u.rolname = CURRENT_USER" % (", ".join(columns),
+                                                     joins))
+        return query, params
+
+    def _remote_status_volatile_columns(self, version):
+        """
+        Build the columns of the remote status query returning the values
+        changing frequently, according to the PostgreSQL version.
+
+        The columns are selected from the ``pg_roles`` row of the current
+        user, aliased as ``u``.
+
+        :param int version: the PostgreSQL version
+        :return tuple[list[str],str,dict]: the columns, the joins and
+            the query parameters
+        """
+        columns = [
+            "CASE WHEN u.rolsuper THEN "
+            "(SELECT sum(pg_tablespace_size(oid)) FROM pg_tablespace) END "
+            "AS current_size",
+        ]
+        joins = ""
+        params = {'slot_name': self.config.slot_name}
+        # pg_is_in_recovery is only available from Postgres 9.0+
+        if version >= 90000:
+            columns += [
+                "pg_is_in_recovery() AS is_in_recovery",
+                "CASE WHEN pg_is_in_recovery() THEN NULL "
+                "ELSE (%s(%s())).file_name END AS current_xlog" % (
+                    ('pg_walfile_name_offset', 'pg_current_wal_lsn')
+                    if version >= 100000 else
+                    ('pg_xlogfile_name_offset', 'pg_current_xlog_location')),
+            ]
+        else:
+            columns += [
+                "false AS is_in_recovery",
+                "(pg_xlogfile_name_offset(pg_current_xlog_location()))"
+                ".file_name AS current_xlog",
+            ]
+        if version >= 90400 and self.config.slot_name is not None:
+            columns += [
+                "(SELECT %s FROM pg_replication_slots "
+                "WHERE slot_type = 'physical' "
+                "AND slot_name = %%(slot_name)s) AS %s" % (column, alias)
+                for column, alias in (('slot_name', 'slot_name'),
+                                      ('active', 'slot_active'),
+                                      ('restart_lsn', 'slot_restart_lsn'))]
+        # pg_stat_archiver is only available from Postgres 9.4+,
+        # and always contains a single row
+        if version >= 90400:
+            columns.append("a.*")
+            # Escape the wildcards, as the query has parameters
+            joins = " CROSS JOIN (%s) a" % (
+                self.ARCHIVER_STATS_QUERY.replace('%', '%%'))
+        return columns, joins, params
+
+    def _remote_status_volatile_values(self, row, version):
+        """
+        Extract the values changing frequently from a row of the
+        remote status query
+
+        :param dict row: the row returned by the query
+        :param int version: the PostgreSQL version
+        :rtype: dict
+        """
+        result = {
+            'is_in_recovery': row['is_in_recovery'],
+            'current_xlog': row['current_xlog'],
+            'current_size': row['current_size'],
+        }
+        if version >= 90400:
+            result['replication_slot'] = None
+            if self.config.slot_name is not None and \
+                    row.get('slot_name') is not None:
+                result['replication_slot'] = ReplicationSlot(
+                    row['slot_name'], row['slot_active'],
+                    row['slot_restart_lsn'])
+            # Add the pg_stat_archiver statistics, used by the
+            # FileWalArchiver
+            for name in self.ARCHIVER_STATS_KEYS:
+                if name in row:
+                    result[name] = row[name]
+        return result
+
+    def _remote_status_fallback(self, version):
+        """
+        Collect the same values of the remote status query with a
+        separate query for every property.
+
+        It is used when the remote status query fails, so that a single
+        failing property evaluates to None without affecting the others.
+
+        :param int version: the PostgreSQL version
+        :rtype: dict
+        """
+        is_superuser = self.is_superuser
+        row = {
+            'server_txt_version': self.server_txt_version,
+            'is_superuser': is_superuser,
+            'data_directory': (self.get_setting('data_directory')
+                               if is_superuser else None),
+            'current_size': self.current_size,
+            'is_in_recovery': self.is_in_recovery,
+            'current_xlog': self.current_xlog_file_name,
+            'pgespresso_installed': self.has_pgespresso,
+            'archive_mode': self.get_setting('archive_mode'),
+            'archive_command': self.get_setting('archive_command'),
+        }
+        if version >= 90000:
+            row['wal_level'] = self.get_setting('wal_level')
+        if version >= 90100:
+            row['synchronous_standby_names'] = self.get_setting(
+                'synchronous_standby_names')
+        # Don't return the configuration files of a previous call
+        self.configuration_files = None
+        row.update(self.get_configuration_files())
+        if version >= 90400:
+            row.update(self.get_archiver_stats() or {})
+            if self.config.slot_name is not None:
+                try:
+                    slot = self.get_replication_slot(self.config.slot_name)
+                except (PostgresConnectionError, psycopg2.Error):
+                    slot = None
+                if slot is not None:
+                    row['slot_name'] = slot.slot_name
+                    row['slot_active'] = slot.active
+                    row['slot_restart_lsn'] = slot.restart_lsn
+        return row
+
     def fetch_remote_status(self):
         """
         Get the status of the PostgreSQL server
@@ -680,7 +912,7 @@ class PostgreSQLConnection(PostgreSQL):
         pg_superuser_settings = [
             'data_directory']
         # PostgreSQL settings to get from the server
-        pg_settings = []
+        pg_settings = ['archive_mode', 'archive_command']
         pg_query_keys = [
             'server_txt_version',
             'is_superuser',
@@ -697,47 +929,108 @@ class PostgreSQLConnection(PostgreSQL):
                                pg_query_keys,
                                None)
         try:
+            # Every connect() call checks the connection with a query,
+            # so the version is read only once
+            conn = self.connect()
+            server_version = conn.server_version
+
             # check for wal_level only if the version is >= 9.0
-            if self.server_version >= 90000:
+            if server_version >= 90000:
                 pg_settings.append('wal_level')
 
+            # Collect everything with a single round trip
+            try:
+                query, params = self._remote_status_query(server_version)
+                cur = conn.cursor(cursor_factory=DictCursor)
+                cur.execute(query, params)
+                row = dict(cur.fetchone())
+                row['server_txt_version'] = row['version'].split()[1]
+            except psycopg2.Error as e:
+                _logger.debug("Error retrieving PostgreSQL status with "
+                              "a single query, retrying property by "
+                              "property: %s", str(e).strip())
+                conn.rollback()
+                row = self._remote_status_fallback(server_version)
+
+            is_superuser = row['is_superuser']
             # retrieves superuser settings
-            if self.is_superuser:
+            if is_superuser:
                 for name in pg_superuser_settings:
-                    result[name] = self.get_setting(name)
+                    result[name] = row[name]
 
             # retrieves standard settings
             for name in pg_settings:
-                result[name] = self.get_setting(name)
-
-            result['is_superuser'] = self.is_superuser
-            result['is_in_recovery'] = self.is_in_recovery
-            result['server_txt_version'] = self.server_txt_version
-            result['pgespresso_installed'] = self.has_pgespresso
-            result['current_xlog'] = self.current_xlog_file_name
-            result['current_size'] = self.current_size
+                result[name] = row[name]
 
-            result.update(self.get_configuration_files())
+            result['is_superuser'] = is_superuser
+            result['server_txt_version'] = row['server_txt_version']
+            result['pgespresso_installed'] = row['pgespresso_installed']
 
-            # Retrieve the replication_slot status
-            result["replication_slot_support"] = False
-            if self.server_version >= 90400:
-                result["replication_slot_support"] = True
-                if self.config.slot_name is not None:
-                    result["replication_slot"] = (
-                        self.get_replication_slot(self.config.slot_name))
+            self.configuration_files = {}
+            for name in ('config_file', 'hba_file', 'ident_file'):
+                if row.get(name) is not None:
+                    self.configuration_files[name] = row[name]
+            if server_version >= 80400 and row.get('included_files'):
+                self.configuration_files['included_files'] = (
+                    row['included_files'])
+            result.update(self.configuration_files)
+
+            # The current WAL file, the replication_slot status and
+            # the archiver statistics
+            result.update(
+                self._remote_status_volatile_values(row, server_version))
+            result["replication_slot_support"] = server_version >= 90400
 
             # Retrieve the list of synchronous standby names
             result["synchronous_standby_names"] = []
-            if self.server_version >= 90100:
+            if server_version >= 90100:
+                names = row.get('synchronous_standby_names')
                 result["synchronous_standby_names"] = (
-                    self.get_synchronous_standby_names())
+                    _parse_synchronous_standby_names(names)
+                    if names is not None else None)
 
         except (PostgresConnectionError, psycopg2.Error) as e:
             _logger.warn("Error retrieving PostgreSQL status: %s",
                          str(e).strip())
         return result
 
+    def is_remote_status_cacheable(self, status):
+        """
+        Don't cache a status collected while PostgreSQL was unreachable
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return status.get('server_txt_version') is not None
+
+    def fetch_volatile_remote_status(self):
+        """
+        Get the values of the status of the PostgreSQL server changing
+        frequently, with a query lighter than the full status one
+
+        :return dict[str, None|str]|None: the values, or None if they
+            can't be collected separately
+        """
+        try:
+            conn = self.connect()
+            server_version = conn.server_version
+            columns, joins, params = \
+                self._remote_status_volatile_columns(server_version)
+            cur = conn.cursor(cursor_factory=DictCursor)
+            try:
+                cur.execute("SELECT %s FROM pg_roles u%s "
+                            "WHERE u.rolname = CURRENT_USER" % (
+                                ", ".join(columns), joins), params)
+                row = dict(cur.fetchone())
+            except psycopg2.Error:
+                conn.rollback()
+                raise
+        except (PostgresConnectionError, psycopg2.Error) as e:
+            _logger.debug("Error retrieving the PostgreSQL volatile "
+                          "status: %s", str(e).strip())
+            return None
+        return self._remote_status_volatile_values(row, server_version)
+
     def get_setting(self, name):
         """
         Get a Postgres setting with a given name
@@ -1328,14 +1621,14 @@ class PostgreSQLConnection(PostgreSQL):
          * restart_lsn
 
         :param str slot_name: the replication slot name
-        :rtype: psycopg2.extras.DictRow
+        :rtype: ReplicationSlot|None
         """
         if self.server_version < 90400:
             # Raise exception if replication slot are not supported
             # by PostgreSQL version
             raise PostgresUnsupportedFeature('9.4')
         else:
-            cur = self._cursor(cursor_factory=NamedTupleCursor)
+            cur = self._cursor()
             try:
                 cur.execute("SELECT slot_name, "
                             "active, "
@@ -1344,7 +1637,10 @@ class PostgreSQLConnection(PostgreSQL):
                             "WHERE slot_type = 'physical' "
                             "AND slot_name = '%s'" % slot_name)
                 # Retrieve the replication slot information
-                return cur.fetchone()
+                row = cur.fetchone()
+                if row is None:
+                    return None
+                return ReplicationSlot(*row)
             except (PostgresConnectionError, psycopg2.Error) as e:
                 _logger.debug("Error retrieving replication_slots: %s",
                               str(e).strip())
@@ -1362,21 +1658,8 @@ class PostgreSQLConnection(PostgreSQL):
             # Raise exception if synchronous replication is not supported
             raise PostgresUnsupportedFeature('9.1')
         else:
-            synchronous_standby_names = (
+            return _parse_synchronous_standby_names(
                 self.get_setting('synchronous_standby_names'))
-            # Normalise the list of sync standby names
-            # On PostgreSQL 9.6 it is possible to specify the number of
-            # required synchronous standby using this format:
-            # n (name1, name2, ... nameN).
-            # We only need the name list, so we discard everything else.
-
-            # The name list starts after the first parenthesis or at pos 0
-            names_start = synchronous_standby_names.find('(') + 1
-            names_end = synchronous_standby_names.rfind(')')
-            if names_end < 0:
-                names_end = len(synchronous_standby_names)
-            names_list = synchronous_standby_names[names_start:names_end]
-            return [x.strip() for x in names_list.split(',')]
 
     @property
     def name_map(self):
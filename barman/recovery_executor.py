@@ -21,23 +21,28 @@ This module contains the methods necessary to perform a recovery
 
 from __future__ import print_function
 
+import calendar
 import collections
 import logging
 import os
 import re
 import shutil
 import socket
+import tarfile
 import tempfile
 import time
+from contextlib import closing
 from io import StringIO
 
 import dateutil.parser
 import dateutil.tz
 
 from barman import output, xlog
-from barman.command_wrappers import RsyncPgData
+from barman.command_wrappers import RsyncPgData, SshControlMaster
 from barman.config import RecoveryOptions
-from barman.copy_controller import RsyncCopyController
+from barman.copy_controller import (LocalCopyController, RsyncCopyController,
+                                    TarExtractController)
+from barman.dedup import ObjectStore
 from barman.exceptions import (BadXlogSegmentName, CommandFailedException,
                                DataTransferFailure, FsOperationFailed)
 from barman.fs import UnixLocalCommand, UnixRemoteCommand
@@ -109,6 +114,10 @@ class RecoveryExecutor(object):
         # Run the cron to be sure the wal catalog is up to date
         # Prepare a map that contains all the objects required for a recovery
         recovery_info = self._setup(backup_info, remote_command, dest)
+        # Every remote command executed from now on shares the same
+        # SSH connection
+        if recovery_info['ssh_master']:
+            remote_command = recovery_info['ssh_master'].command
         output.info("Starting %s restore for server %s using backup %s",
                     recovery_info['recovery_dest'], self.server.config.name,
                     backup_info.backup_id)
@@ -151,6 +160,16 @@ class RecoveryExecutor(object):
             output.error("Failure copying base backup: %s", e)
             output.close_and_exit()
 
+        # The deduplicated files have been copied with the attributes
+        # of the objects they share: restore the original ones
+        try:
+            self._restore_file_attributes(backup_info, dest, tablespaces,
+                                          recovery_info['cmd'])
+        except FsOperationFailed as e:
+            output.error("unable to restore the attributes of the "
+                         "deduplicated files: %s", e)
+            output.close_and_exit()
+
         # Copy the backup.info file in the destination as
         # ".barman-recover.info"
         if remote_command:
@@ -174,7 +193,8 @@ class RecoveryExecutor(object):
                 required_xlog_files = tuple(
                     self.server.get_required_xlog_files(
                         backup_info, target_tli,
-                        recovery_info['target_epoch']))
+                        recovery_info['target_epoch'],
+                        target_xid, target_name))
 
                 # Restore WAL segments into the wal_dest directory
                 self._xlog_copy(required_xlog_files,
@@ -268,6 +288,7 @@ class RecoveryExecutor(object):
             'is_pitr': False,
             'wal_dest': wal_dest,
             'get_wal': RecoveryOptions.GET_WAL in self.config.recovery_options,
+            'ssh_master': None,
         }
         # A map that will keep track of the results of the recovery.
         # Used for output generation
@@ -288,10 +309,18 @@ class RecoveryExecutor(object):
         # Handle remote recovery options
         if remote_command:
             recovery_info['recovery_dest'] = 'remote'
+            # Share a single SSH connection among all the ssh and rsync
+            # processes of the recovery. The control socket is stored
+            # inside the temporary directory.
+            recovery_info['ssh_master'] = SshControlMaster(
+                remote_command,
+                control_path=os.path.join(recovery_info['tempdir'], 'ssh'),
+                path=self.server.path)
+            shared_command = recovery_info['ssh_master'].command
             try:
                 recovery_info['rsync'] = RsyncPgData(
                     path=self.server.path,
-                    ssh=remote_command,
+                    ssh=shared_command,
                     bwlimit=self.config.bandwidth_limit,
                     network_compression=self.config.network_compression)
             except CommandFailedException:
@@ -300,7 +329,7 @@ class RecoveryExecutor(object):
 
             try:
                 # create a UnixRemoteCommand obj if is a remote recovery
-                recovery_info['cmd'] = UnixRemoteCommand(remote_command,
+                recovery_info['cmd'] = UnixRemoteCommand(shared_command,
                                                          path=self.server.path)
             except FsOperationFailed:
                 self._teardown(recovery_info)
@@ -362,9 +391,14 @@ class RecoveryExecutor(object):
                         target_time)
                     output.close_and_exit()
 
+                # A naive target time is in the local timezone
+                if target_datetime.tzinfo is None:
+                    seconds = time.mktime(target_datetime.timetuple())
+                else:
+                    seconds = calendar.timegm(
+                        target_datetime.utctimetuple())
                 target_epoch = (
-                    time.mktime(target_datetime.timetuple()) +
-                    (target_datetime.microsecond / 1000000.))
+                    seconds + (target_datetime.microsecond / 1000000.))
                 targets['time'] = str(target_datetime)
             if target_xid:
                 targets['xid'] = str(target_xid)
@@ -509,23 +543,38 @@ class RecoveryExecutor(object):
             has to be checked with checksum
         """
 
+        # The archives of a compressed backup are extracted, as they
+        # can't be copied incrementally
+        if backup_info.compression:
+            self._backup_extract(backup_info, dest, tablespaces,
+                                 remote_command)
+            return
+
         # Set a ':' prefix to remote destinations
         dest_prefix = ''
         if remote_command:
             dest_prefix = ':'
 
-        # Create the copy controller object, specific for rsync,
-        # which will drive all the copy operations. Items to be
-        # copied are added before executing the copy() method
-        controller = RsyncCopyController(
-            path=self.server.path,
-            ssh_command=remote_command,
-            network_compression=self.config.network_compression,
-            safe_horizon=safe_horizon,
-            retry_times=self.config.basebackup_retry_times,
-            retry_sleep=self.config.basebackup_retry_sleep,
-            workers=self.config.parallel_jobs,
-        )
+        # Create the copy controller object which will drive all the copy
+        # operations. Items to be copied are added before executing the
+        # copy() method.
+        if not remote_command and self._is_empty_destination(
+                backup_info, dest, tablespaces):
+            # A local recovery into empty directories doesn't need the rsync
+            # delta transfer: the files are cloned using reflinks, if
+            # supported by the file system, or copied in parallel
+            controller = LocalCopyController(
+                workers=self.config.parallel_jobs)
+        else:
+            controller = RsyncCopyController(
+                path=self.server.path,
+                ssh_command=remote_command,
+                network_compression=self.config.network_compression,
+                safe_horizon=safe_horizon,
+                retry_times=self.config.basebackup_retry_times,
+                retry_sleep=self.config.basebackup_retry_sleep,
+                workers=self.config.parallel_jobs,
+            )
 
         # Dictionary for paths to be excluded from rsync
         exclude_and_protect = []
@@ -591,6 +640,145 @@ class RecoveryExecutor(object):
             msg = "data transfer failure"
             raise DataTransferFailure.from_command_error(
                 'rsync', e, msg)
+        except EnvironmentError as e:
+            raise DataTransferFailure("data transfer failure: %s" % e)
+
+    def _restore_file_attributes(self, backup_info, dest, tablespaces, cmd):
+        """
+        Restore the original permissions and modification time of the
+        recovered files which have been deduplicated
+
+        :param barman.infofile.BackupInfo backup_info: the backup to recover
+        :param str dest: the destination directory
+        :param dict[str,str]|None tablespaces: a tablespace
+            name -> location map (for relocation)
+        :param barman.fs.UnixLocalCommand cmd: the object used to
+            execute the commands in the destination
+        """
+        # Extracted archives are never deduplicated
+        if backup_info.compression:
+            return
+        base_dir = backup_info.get_basebackup_directory()
+        changed = ObjectStore.changed_attributes(base_dir)
+        if not changed:
+            return
+        # The source directories, relative to the base directory of the
+        # backup, and their destination. Tablespaces come first, as they
+        # may be contained in the data directory.
+        locations = []
+        for tablespace in backup_info.tablespaces or []:
+            location = tablespace.location
+            if tablespaces and tablespace.name in tablespaces:
+                location = tablespaces[tablespace.name]
+            locations.append((os.path.relpath(
+                backup_info.get_data_directory(tablespace.oid), base_dir),
+                location))
+        locations.append((os.path.relpath(
+            backup_info.get_data_directory(), base_dir), dest))
+        attributes = []
+        for rel_path, mode, mtime in changed:
+            for src, dst in locations:
+                if rel_path.startswith(src + os.sep):
+                    attributes.append((
+                        os.path.join(dst, rel_path[len(src) + 1:]),
+                        mode, mtime))
+                    break
+        cmd.set_file_attributes(attributes)
+
+    def _backup_extract(self, backup_info, dest, tablespaces=None,
+                        remote_command=None):
+        """
+        Extract the archives of a compressed base backup for recovery
+        purposes
+
+        The data directory and every tablespace are extracted in parallel,
+        according to the parallel_jobs configuration.
+
+        :param barman.infofile.BackupInfo backup_info: the backup to recover
+        :param str dest: the destination directory
+        :param dict[str,str]|None tablespaces: a tablespace
+            name -> location map (for relocation)
+        :param str|None remote_command: default None. The remote command to
+            recover the base backup, in case of remote backup.
+        """
+        controller = TarExtractController(
+            path=self.server.path,
+            ssh_command=remote_command,
+            workers=self.config.parallel_jobs)
+
+        exclude = [
+            '/pg_log/*',
+            '/pg_xlog/*',
+            '/pg_wal/*',
+            '/postmaster.pid',
+            '/recovery.conf',
+            '/tablespace_map',
+        ]
+
+        # Process every tablespace
+        if backup_info.tablespaces:
+            for tablespace in backup_info.tablespaces:
+                # By default a tablespace goes in the same location where
+                # it was on the source server when the backup was taken
+                location = tablespace.location
+                # If a relocation has been requested for this tablespace
+                # use the user provided target directory
+                if tablespaces and tablespace.name in tablespaces:
+                    location = tablespaces[tablespace.name]
+
+                # The link to the tablespace has been already created,
+                # pointing to the right location
+                exclude.append('/pg_tblspc/%s' % tablespace.oid)
+
+                controller.add_archive(
+                    label=tablespace.name,
+                    src=backup_info.get_archive_file(tablespace.oid),
+                    dst=location,
+                    item_class=controller.TABLESPACE_CLASS)
+
+        controller.add_archive(
+            label='pgdata',
+            src=backup_info.get_archive_file(),
+            dst=dest,
+            exclude=exclude,
+            item_class=controller.PGDATA_CLASS)
+
+        # Execute the extraction
+        try:
+            controller.copy()
+        except CommandFailedException as e:
+            msg = "data transfer failure"
+            raise DataTransferFailure.from_command_error(
+                'tar', e, msg)
+        except EnvironmentError as e:
+            raise DataTransferFailure("data transfer failure: %s" % e)
+
+    def _is_empty_destination(self, backup_info, dest, tablespaces=None):
+        """
+        Check that the destination directories of a local recovery
+        (PGDATA and every tablespace) don't contain any file.
+
+        Directories and symbolic links, like the ones created for the
+        tablespaces, are ignored.
+
+        :param barman.infofile.BackupInfo backup_info: the backup to recover
+        :param str dest: the destination directory
+        :param dict[str,str]|None tablespaces: a tablespace
+            name -> location map (for relocation)
+        :rtype: bool
+        """
+        locations = [dest]
+        for tablespace in backup_info.tablespaces or []:
+            if tablespaces and tablespace.name in tablespaces:
+                locations.append(tablespaces[tablespace.name])
+            else:
+                locations.append(tablespace.location)
+        for location in locations:
+            for dirpath, dirnames, filenames in os.walk(location):
+                for name in filenames:
+                    if not os.path.islink(os.path.join(dirpath, name)):
+                        return False
+        return True
 
     def _xlog_copy(self, required_xlog_files, wal_dest, remote_command):
         """
@@ -858,6 +1046,22 @@ class RecoveryExecutor(object):
         :param str remote_command: ssh command for remote recovery
         """
 
+        # The configuration files of a compressed backup are only
+        # available inside its archive. They have already been extracted
+        # in the destination directory, but a remote destination is not
+        # directly accessible, so they are extracted again locally.
+        source_dir = backup_info.get_data_directory()
+        if backup_info.compression:
+            if remote_command:
+                source_dir = recovery_info['tempdir']
+                self._extract_config_files(
+                    backup_info.get_archive_file(),
+                    recovery_info['configuration_files'] +
+                    ['pg_hba.conf', 'pg_ident.conf'],
+                    source_dir)
+            else:
+                source_dir = recovery_info['destination_path']
+
         # Cycle over postgres configuration files which my be missing.
         # If a file is missing, we will be unable to restore it and
         # we will warn the user.
@@ -867,8 +1071,7 @@ class RecoveryExecutor(object):
         # `pg_ident.conf` which is an optional file.
         for conf_file in (recovery_info['configuration_files'] +
                           ['pg_hba.conf', 'pg_ident.conf']):
-            source_path = os.path.join(
-                backup_info.get_data_directory(), conf_file)
+            source_path = os.path.join(source_dir, conf_file)
             if not os.path.exists(source_path):
                 recovery_info['results']['missing_files'].append(conf_file)
                 # Remove the file from the list of configuration files
@@ -883,9 +1086,9 @@ class RecoveryExecutor(object):
                 # in the destination directory.
                 conf_file_path = os.path.join(
                     recovery_info['tempdir'], conf_file)
-                shutil.copy2(
-                    os.path.join(backup_info.get_data_directory(),
-                                 conf_file), conf_file_path)
+                if source_dir != recovery_info['tempdir']:
+                    shutil.copy2(os.path.join(source_dir, conf_file),
+                                 conf_file_path)
             else:
                 # Otherwise use the local destination path.
                 conf_file_path = os.path.join(
@@ -894,6 +1097,33 @@ class RecoveryExecutor(object):
             recovery_info['temporary_configuration_files'].append(
                 conf_file_path)
 
+    @staticmethod
+    def _extract_config_files(archive_file, names, dest_dir):
+        """
+        Extract some files from the root of a compressed tar archive
+
+        The archive is read sequentially, and the read stops as soon as
+        all the requested files have been found.
+
+        :param str archive_file: the path of the archive
+        :param list[str] names: the names of the files to extract
+        :param str dest_dir: the directory where the files are written
+        """
+        names = set(names)
+        with closing(tarfile.open(archive_file, 'r|*')) as archive:
+            for member in archive:
+                name = member.name
+                if name.startswith('./'):
+                    name = name[2:]
+                if name not in names or not member.isfile():
+                    continue
+                with open(os.path.join(dest_dir, name), 'wb') as dest_file:
+                    shutil.copyfileobj(archive.extractfile(member),
+                                       dest_file)
+                names.remove(name)
+                if not names:
+                    break
+
     def _analyse_temporary_config_files(self, recovery_info):
         """
         Analyse temporary configuration files and identify dangerous options
@@ -952,6 +1182,10 @@ class RecoveryExecutor(object):
         :param dict recovery_info: dictionary holding the basic values
             for a recovery
         """
+        # Close the shared SSH connection, whose control socket
+        # lives inside the temporary directory
+        if recovery_info['ssh_master']:
+            recovery_info['ssh_master'].close()
         # Remove the temporary directory (created in the setup method)
         shutil.rmtree(recovery_info['tempdir'])
 
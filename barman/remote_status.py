@@ -24,10 +24,207 @@ retrieving and caching the results of a remote component
 the Mixin pattern.
 """
 
+import logging
+import os
+import pickle
+import time
 from abc import ABCMeta, abstractmethod
 
 from barman.utils import with_metaclass
 
+_logger = logging.getLogger(__name__)
+
+#: Number of seconds the volatile values of a remote status, like the
+#: current WAL position, are kept in the on-disk cache
+VOLATILE_STATUS_TTL = 5
+
+
+class RemoteStatusCache(object):
+    """
+    On-disk cache of the remote status of the components of a server.
+
+    The cache is a single file shared by all the Barman processes. It
+    contains an entry for every component, valid for the default TTL.
+    Every value of the status can have its own TTL, shorter than the
+    default one, so that the values changing frequently can be collected
+    again while the others are still taken from the cache. A damaged or
+    unreadable cache is treated as empty, and the errors while writing it
+    are ignored, as the cache is only an optimisation.
+
+    When bypass is set, the cache is never read, but it is still updated
+    with the freshly collected status.
+    """
+
+    def __init__(self, path, ttl):
+        """
+        :param str path: the path of the cache file
+        :param int ttl: the default number of seconds an entry is valid
+        """
+        self.path = path
+        self.ttl = ttl
+        self.bypass = False
+
+    def _load(self):
+        """
+        Read the content of the cache file
+
+        Every entry contains its expiration time and the values of the
+        status, each one with its own expiration time.
+
+        :rtype: dict[str,tuple[float,dict[str,tuple[float,object]]]]
+        """
+        try:
+            with open(self.path, 'rb') as cache_file:
+                entries = pickle.load(cache_file)
+            if isinstance(entries, dict):
+                return entries
+        except (IOError, OSError):
+            pass
+        except Exception as e:
+            _logger.debug("Ignoring invalid remote status cache %s: %s",
+                          self.path, e)
+        return {}
+
+    def _save(self, entries):
+        """
+        Atomically replace the content of the cache file
+
+        :param dict[str,tuple[float,dict[str,tuple[float,object]]]] entries:
+            the cache entries
+        """
+        tmp_path = '%s.%s.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as cache_file:
+                pickle.dump(entries, cache_file, 2)
+            os.rename(tmp_path, self.path)
+        except Exception as e:
+            _logger.debug("Unable to write remote status cache %s: %s",
+                          self.path, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    def _store(self, entries, key, expires, status, ttls, now):
+        """
+        Store the values of a status in an entry, purging the expired
+        entries
+
+        :param dict entries: the cache entries
+        :param str key: the component key
+        :param float expires: the expiration time of the entry
+        :param dict status: the values of the remote status
+        :param dict[str,int]|None ttls: the number of seconds some values
+            of the status are valid, if shorter than the cache TTL
+        :param float now: the current time
+        """
+        ttls = ttls or {}
+        values = entries[key][1] if key in entries else {}
+        for name, value in status.items():
+            # The values with a zero TTL are stored already expired,
+            # so that they are always collected again
+            ttl = max(min(self.ttl, ttls.get(name, self.ttl)), 0)
+            values[name] = (now + ttl, value)
+        for name, entry in list(entries.items()):
+            if entry[0] < now:
+                del entries[name]
+        entries[key] = (expires, values)
+        self._save(entries)
+
+    def get_values(self, key):
+        """
+        Get the values of the cached status of a component which have
+        not expired, and the names of the expired ones
+
+        :param str key: the component key
+        :return tuple[dict|None,list[str]]: the valid values, None if the
+            entry is missing or expired, and the names of the expired
+            values
+        """
+        if self.bypass:
+            return None, []
+        entry = self._load().get(key)
+        now = time.time()
+        status = {}
+        expired = []
+        try:
+            if entry is None or entry[0] < now:
+                return None, []
+            for name, (expires, value) in entry[1].items():
+                if expires <= now:
+                    expired.append(name)
+                else:
+                    status[name] = value
+        except (TypeError, ValueError) as e:
+            _logger.debug("Ignoring invalid remote status cache entry "
+                          "%s: %s", key, e)
+            return None, []
+        return status, expired
+
+    def get(self, key):
+        """
+        Get the cached status of a component, if none of its values
+        has expired
+
+        :param str key: the component key
+        :rtype: dict|None
+        """
+        status, expired = self.get_values(key)
+        if expired:
+            return None
+        return status
+
+    def set(self, key, status, ttls=None):
+        """
+        Store the status of a component
+
+        :param str key: the component key
+        :param dict status: the remote status
+        :param dict[str,int]|None ttls: the number of seconds some values
+            of the status are valid, if shorter than the cache TTL
+        """
+        if self.ttl <= 0:
+            return
+        entries = self._load()
+        # Replace the whole entry
+        entries.pop(key, None)
+        now = time.time()
+        self._store(entries, key, now + self.ttl, status, ttls, now)
+
+    def update(self, key, status, ttls=None):
+        """
+        Update some values of the cached status of a component, keeping
+        the expiration time of the entry and of the other values
+
+        Nothing is stored if the entry is missing or expired.
+
+        :param str key: the component key
+        :param dict status: the values of the remote status
+        :param dict[str,int]|None ttls: the number of seconds some values
+            of the status are valid, if shorter than the cache TTL
+        """
+        entries = self._load()
+        now = time.time()
+        if key not in entries or entries[key][0] < now:
+            return
+        self._store(entries, key, entries[key][0], status, ttls, now)
+
+    def invalidate(self, key=None):
+        """
+        Remove an entry from the cache, or all of them if key is None
+
+        :param str|None key: the component key
+        """
+        if key is None:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            return
+        entries = self._load()
+        if entries.pop(key, None) is not None:
+            self._save(entries)
+
 
 class RemoteStatusMixin(with_metaclass(ABCMeta, object)):
     """
@@ -35,13 +232,29 @@ class RemoteStatusMixin(with_metaclass(ABCMeta, object)):
     following the Mixin pattern.
     """
 
+    #: The number of seconds the values of the status changing
+    #: frequently are kept in the on-disk cache
+    REMOTE_STATUS_TTLS = {}
+
     def __init__(self, *args, **kwargs):
         """
         Base constructor (Mixin pattern)
         """
         self._remote_status = None
+        self._remote_status_cache = None
+        self._remote_status_cache_key = None
         super(RemoteStatusMixin, self).__init__(*args, **kwargs)
 
+    def set_remote_status_cache(self, cache, key):
+        """
+        Share the remote status through an on-disk cache
+
+        :param RemoteStatusCache|None cache: the cache, None to disable it
+        :param str key: the key identifying this component in the cache
+        """
+        self._remote_status_cache = cache
+        self._remote_status_cache_key = key
+
     @abstractmethod
     def fetch_remote_status(self):
         """
@@ -64,11 +277,61 @@ class RemoteStatusMixin(with_metaclass(ABCMeta, object)):
         :rtype: dict[str, None|str]
         """
         if self._remote_status is None:
-            self._remote_status = self.fetch_remote_status()
+            cache = self._remote_status_cache
+            key = self._remote_status_cache_key
+            status = None
+            if cache is not None:
+                status, expired = cache.get_values(key)
+                if status is not None and expired:
+                    # Collect again only the values changing frequently,
+                    # if the component supports it
+                    volatile = self.fetch_volatile_remote_status()
+                    if volatile is None:
+                        status = None
+                    else:
+                        status.update(volatile)
+                        if self.is_remote_status_cacheable(status):
+                            cache.update(key, volatile,
+                                         self.REMOTE_STATUS_TTLS)
+            if status is None:
+                status = self.fetch_remote_status()
+                if cache is not None and \
+                        self.is_remote_status_cacheable(status):
+                    cache.set(key, status, self.REMOTE_STATUS_TTLS)
+            self._remote_status = status
         return self._remote_status
 
+    def fetch_volatile_remote_status(self):
+        """
+        Retrieve only the values of the status changing frequently,
+        listed in REMOTE_STATUS_TTLS, from the remote component
+
+        It is used when only those values have expired from the on-disk
+        cache. The default implementation returns None, meaning that the
+        whole status is collected again.
+
+        :rtype: dict[str, None|str]|None
+        """
+        return None
+
+    def is_remote_status_cacheable(self, status):
+        """
+        Whether a remote status can be stored in the on-disk cache.
+
+        Components should return False when the status has been
+        collected while the remote side was unreachable, so that a
+        failure is not remembered after the problem has been fixed.
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return True
+
     def reset_remote_status(self):
         """
-        Reset the cached result
+        Reset the cached result, including the on-disk one
         """
         self._remote_status = None
+        if self._remote_status_cache is not None:
+            self._remote_status_cache.invalidate(
+                self._remote_status_cache_key)
@@ -51,17 +51,19 @@ class RetentionPolicy(with_metaclass(ABCMeta, object)):
         self.server = server
         self._first_backup = None
         self._first_wal = None
+        # The last report on the available backups, with the
+        # information needed to check its validity
+        self._report_cache = None
 
     def report(self, source=None, context=None):
         """Report obsolete/valid objects according to the retention policy"""
         if context is None:
             context = self.context
-        # Overrides the list of available backups
-        if source is None:
-            source = self.server.get_available_backups(
-                BackupInfo.STATUS_NOT_EMPTY)
         if context == 'BASE':
-            return self._backup_report(source)
+            # Overrides the list of available backups
+            if source is not None:
+                return self._backup_report(source)
+            return dict(self._catalog_report())
         elif context == 'WAL':
             return self._wal_report()
         else:
@@ -69,18 +71,71 @@ class RetentionPolicy(with_metaclass(ABCMeta, object)):
 
     def backup_status(self, backup_id):
         """Report the status of a backup according to the retention policy"""
-        source = self.server.get_available_backups(BackupInfo.STATUS_NOT_EMPTY)
         if self.context == 'BASE':
-            return self._backup_report(source)[backup_id]
+            return self._catalog_report()[backup_id]
         else:
             return BackupInfo.NONE
 
     def first_backup(self):
         """Returns the first valid backup according to retention policies"""
-        if not self._first_backup:
-            self.report(context='BASE')
+        self._catalog_report()
         return self._first_backup
 
+    def _catalog_report(self):
+        """
+        Report obsolete/valid backups of the server catalog.
+
+        The report is computed once for every generation of the catalog
+        of the server, and reused until a backup is added or removed,
+        the status of a backup changes, or the report expires.
+
+        :rtype: dict[str,str]
+        """
+        manager = self.server.backup_manager
+        key = self._report_key(manager.catalog_generation)
+        if self._report_cache is not None:
+            cached_key, expiry, report, first_backup = self._report_cache
+            if cached_key == key and (
+                    expiry is None or expiry > self._now()):
+                self._first_backup = first_backup
+                return report
+        source = self.server.get_available_backups(
+            BackupInfo.STATUS_NOT_EMPTY)
+        # Loading the catalog changes its generation
+        key = self._report_key(manager.catalog_generation)
+        # The expiry is computed before the report, so that it is never
+        # later than the real one
+        expiry = self._report_expiry(source)
+        self._first_backup = None
+        report = self._backup_report(source)
+        self._report_cache = (key, expiry, report, self._first_backup)
+        return report
+
+    def _report_key(self, generation):
+        """
+        The values the report on the backup catalog depends on
+
+        :param int generation: the generation of the backup catalog
+        """
+        return generation, self.server.config.minimum_redundancy
+
+    def _report_expiry(self, source):
+        """
+        The time when the report on the given backups becomes invalid,
+        or None if it is valid until the backups change
+
+        :param dict[str,BackupInfo] source: the backups
+        :rtype: datetime.datetime|None
+        """
+        return None
+
+    @staticmethod
+    def _now():
+        """
+        The current time
+        """
+        return datetime.now(tz.tzlocal())
+
     def first_wal(self):
         """Returns the first valid WAL according to retention policies"""
         if not self._first_wal:
@@ -241,7 +296,24 @@ class RecoveryWindowRetentionPolicy(RetentionPolicy):
         of recoverability, which will be then used to define the first
         backup or the first WAL
         """
-        return datetime.now(tz.tzlocal()) - self.timedelta
+        return self._now() - self.timedelta
+
+    def _report_expiry(self, source):
+        """
+        The classification of the backups changes when the point of
+        recoverability moves past the end time of a DONE backup
+
+        :param dict[str,BackupInfo] source: the backups
+        :rtype: datetime.datetime|None
+        """
+        point = self._point_of_recoverability()
+        end_times = [backup.end_time for backup in source.values()
+                     if backup.status == BackupInfo.DONE and
+                     backup.end_time is not None and
+                     backup.end_time >= point]
+        if not end_times:
+            return None
+        return min(end_times) + self.timedelta
 
     def _backup_report(self, source):
         """Report obsolete/valid backups according to the retention policy"""
@@ -20,6 +20,9 @@ This module represents a Server.
 Barman is able to manage multiple servers.
 """
 
+import bisect
+import datetime
+import errno
 import logging
 import os
 import shutil
@@ -34,7 +37,7 @@ import barman
 from barman import output, xlog
 from barman.backup import BackupManager
 from barman.command_wrappers import BarmanSubProcess
-from barman.compression import identify_compression
+from barman.compression import CompressionManager, identify_compression
 from barman.exceptions import (ArchiverFailure, BadXlogSegmentName,
                                ConninfoException, LockFileBusy,
                                LockFilePermissionDenied,
@@ -48,17 +51,14 @@ from barman.exceptions import (ArchiverFailure, BadXlogSegmentName,
                                PostgresUnsupportedFeature, TimeoutError,
                                UnknownBackupIdException)
 from barman.infofile import BackupInfo, WalFileInfo
-from barman.lockfile import (ServerBackupLock, ServerCronLock,
+from barman.lockfile import (ServerBackupLock, ServerCronLock, ServerTrashLock,
                              ServerWalArchiveLock, ServerWalReceiveLock,
                              ServerXLOGDBLock)
-from barman.postgres import PostgreSQLConnection, StreamingConnection
 from barman.process import ProcessManager
-from barman.remote_status import RemoteStatusMixin
+from barman.remote_status import RemoteStatusCache, RemoteStatusMixin
 from barman.retention_policies import RetentionPolicyFactory
 from barman.utils import (human_readable_timedelta, is_power_of_two,
                           pretty_size, timeout)
-from barman.wal_archiver import (FileWalArchiver, StreamingWalArchiver,
-                                 WalArchiver)
 
 _logger = logging.getLogger(__name__)
 
@@ -180,6 +180,27 @@ class CheckOutputStrategy(CheckStrategy):
         output.result('check', server_name, check, status, hint)
 
 
+class _Component(object):
+    """
+    A component of a Server, built on first access if the server is lazy.
+
+    This is a non-data descriptor: once the components have been built,
+    they are ordinary attributes of the instance.
+    """
+
+    def __init__(self, name):
+        """
+        :param str name: the name of the attribute
+        """
+        self.name = name
+
+    def __get__(self, server, owner=None):
+        if server is None:
+            return self
+        server._init_components()
+        return server.__dict__[self.name]
+
+
 class Server(RemoteStatusMixin):
     """
     This class represents the PostgreSQL server to backup.
@@ -190,33 +211,31 @@ class Server(RemoteStatusMixin):
     # the strategy for the management of the results of the various checks
     __default_check_strategy = CheckOutputStrategy()
 
-    def __init__(self, config):
+    # The components of the server, built by _init_components. When the
+    # server is lazy, they are built on first access.
+    process_manager = _Component('process_manager')
+    backup_manager = _Component('backup_manager')
+    postgres = _Component('postgres')
+    streaming = _Component('streaming')
+    archivers = _Component('archivers')
+    enforce_retention_policies = _Component('enforce_retention_policies')
+    remote_status_cache = _Component('remote_status_cache')
+
+    def __init__(self, config, lazy=False):
         """
         Server constructor.
 
         :param barman.config.ServerConfig config: the server configuration
+        :param bool lazy: build the components of the server (connections,
+            archivers, backup manager) only when they are first used.
+            The errors of their configuration are detected at that time.
         """
         super(Server, self).__init__()
         self.config = config
         self.path = self._build_path(self.config.path_prefix)
-        self.process_manager = ProcessManager(self.config)
-
-        self.enforce_retention_policies = False
-        self.postgres = None
-        self.streaming = None
-        self.archivers = []
-
-        # Initialize the backup manager
-        self.backup_manager = BackupManager(self)
-
-        # Initialize the main PostgreSQL connection
-        try:
-            self.postgres = PostgreSQLConnection(config)
-        # If the PostgreSQLConnection creation fails, disable the Server
-        except ConninfoException as e:
-            self.config.disabled = True
-            self.config.msg_list.append("PostgreSQL connection: " +
-                                        str(e).strip())
+        # The sorted content of the xlogdb, with the stat of the file,
+        # kept in memory by the long running processes
+        self._xlogdb_view = None
 
         # ARCHIVER_OFF_BACKCOMPATIBILITY - START OF CODE
         # IMPORTANT: This is a back-compatibility feature that has
@@ -239,45 +258,6 @@ class Server(RemoteStatusMixin):
             self.config.archiver = True
         # ARCHIVER_OFF_BACKCOMPATIBILITY - END OF CODE
 
-        # Initialize the FileWalArchiver
-        # WARNING: Order of items in self.archivers list is important!
-        # The files will be archived in that order.
-        if self.config.archiver:
-            try:
-                self.archivers.append(FileWalArchiver(self.backup_manager))
-            except AttributeError as e:
-                _logger.debug(e)
-                self.config.disabled = True
-                self.config.msg_list.append('Unable to initialise the '
-                                            'file based archiver')
-
-        # Initialize the streaming PostgreSQL connection only when
-        # backup_method is postgres or the streaming_archiver is in use
-        if (self.config.backup_method == 'postgres' or
-                self.config.streaming_archiver):
-            try:
-                self.streaming = StreamingConnection(config)
-            # If the StreamingConnection creation fails, disable the server
-            except ConninfoException as e:
-                self.config.disabled = True
-                self.config.msg_list.append("Streaming connection: " +
-                                            str(e).strip())
-
-        # Initialize the StreamingWalArchiver
-        # WARNING: Order of items in self.archivers list is important!
-        # The files will be archived in that order.
-        if self.config.streaming_archiver:
-            try:
-                self.archivers.append(StreamingWalArchiver(
-                    self.backup_manager))
-            # If the StreamingWalArchiver creation fails,
-            # disable the server
-            except AttributeError as e:
-                _logger.debug(e)
-                self.config.disabled = True
-                self.config.msg_list.append('Unable to initialise the '
-                                            'streaming archiver')
-
         # IMPORTANT: The following lines of code have been
         # temporarily commented in order to make the code
         # back-compatible after the introduction of 'archiver=off'
@@ -348,9 +328,104 @@ class Server(RemoteStatusMixin):
                                 self.config.name))
             self.config.minimum_redundancy = 0
 
+        if not lazy:
+            self._init_components()
+
+    def _init_components(self):
+        """
+        Build the components of the server.
+
+        The modules implementing them are imported here, so that the
+        commands which only need the WAL archive, like get-wal, don't
+        pay for importing them (and psycopg2).
+        """
+        from barman.postgres import PostgreSQLConnection, StreamingConnection
+        from barman.wal_archiver import FileWalArchiver, StreamingWalArchiver
+
+        self.process_manager = ProcessManager(self.config)
+
+        self.enforce_retention_policies = False
+        self.postgres = None
+        self.streaming = None
+        self.archivers = []
+
+        # Initialize the backup manager
+        self.backup_manager = BackupManager(self)
+
+        # Initialize the main PostgreSQL connection
+        try:
+            self.postgres = PostgreSQLConnection(self.config)
+        # If the PostgreSQLConnection creation fails, disable the Server
+        except ConninfoException as e:
+            self.config.disabled = True
+            self.config.msg_list.append("PostgreSQL connection: " +
+                                        str(e).strip())
+
+        # Initialize the FileWalArchiver
+        # WARNING: Order of items in self.archivers list is important!
+        # The files will be archived in that order.
+        if self.config.archiver:
+            try:
+                self.archivers.append(FileWalArchiver(self.backup_manager))
+            except AttributeError as e:
+                _logger.debug(e)
+                self.config.disabled = True
+                self.config.msg_list.append('Unable to initialise the '
+                                            'file based archiver')
+
+        # Initialize the streaming PostgreSQL connection only when
+        # backup_method is postgres or the streaming_archiver is in use
+        if (self.config.backup_method == 'postgres' or
+                self.config.streaming_archiver):
+            try:
+                self.streaming = StreamingConnection(self.config)
+            # If the StreamingConnection creation fails, disable the server
+            except ConninfoException as e:
+                self.config.disabled = True
+                self.config.msg_list.append("Streaming connection: " +
+                                            str(e).strip())
+
+        # Initialize the StreamingWalArchiver
+        # WARNING: Order of items in self.archivers list is important!
+        # The files will be archived in that order.
+        if self.config.streaming_archiver:
+            try:
+                self.archivers.append(StreamingWalArchiver(
+                    self.backup_manager))
+            # If the StreamingWalArchiver creation fails,
+            # disable the server
+            except AttributeError as e:
+                _logger.debug(e)
+                self.config.disabled = True
+                self.config.msg_list.append('Unable to initialise the '
+                                            'streaming archiver')
+
         # Initialise retention policies
         self._init_retention_policies()
 
+        # Share the remote status of the components through an on-disk
+        # cache, so that frequent checks don't hammer the PostgreSQL server
+        self.remote_status_cache = None
+        if self.config.remote_status_cache_ttl > 0:
+            self._init_remote_status_cache()
+
+    def _init_remote_status_cache(self):
+        """
+        Attach the on-disk remote status cache to every component
+        """
+        self.remote_status_cache = RemoteStatusCache(
+            os.path.join(self.config.backup_directory, 'remote_status.cache'),
+            self.config.remote_status_cache_ttl)
+        components = [('postgres', self.postgres),
+                      ('streaming', self.streaming),
+                      ('executor', self.backup_manager.executor)]
+        components.extend(('archiver.%s' % type(archiver).__name__, archiver)
+                          for archiver in self.archivers)
+        for key, component in components:
+            if component is not None:
+                component.set_remote_status_cache(
+                    self.remote_status_cache, key)
+
     def _init_retention_policies(self):
 
         # Set retention policy mode
@@ -410,6 +485,9 @@ class Server(RemoteStatusMixin):
         """
         Close all the open connections to PostgreSQL
         """
+        # A lazy server could have never built its connections
+        if 'postgres' not in self.__dict__:
+            return
         if self.postgres:
             self.postgres.close()
         if self.streaming:
@@ -757,6 +835,7 @@ class Server(RemoteStatusMixin):
         :param CheckStrategy check_strategy: the strategy for the management
              of the results of the check
         """
+        from barman.wal_archiver import WalArchiver
         check_strategy.init_check('archiver errors')
         if os.path.isdir(self.config.errors_directory):
             errors = os.listdir(self.config.errors_directory)
@@ -883,6 +962,33 @@ class Server(RemoteStatusMixin):
         result.update(self.backup_manager.get_remote_status())
         return result
 
+    def bypass_remote_status_cache(self):
+        """
+        Collect the status of the server from the remote components,
+        ignoring the on-disk cache, which is still updated.
+
+        Used by the commands acting on the status, which cannot rely
+        on values collected by a previous command.
+        """
+        if self.remote_status_cache is not None:
+            self.remote_status_cache.bypass = True
+
+    def reset_remote_status(self):
+        """
+        Reset the status of the server and of all its components,
+        including the on-disk cache
+        """
+        # Drop the whole cache first, so the components don't need
+        # to rewrite it
+        if self.remote_status_cache is not None:
+            self.remote_status_cache.invalidate()
+        super(Server, self).reset_remote_status()
+        for component in [self.postgres, self.streaming,
+                          self.backup_manager,
+                          self.backup_manager.executor] + self.archivers:
+            if component is not None:
+                component.reset_remote_status()
+
     def show(self):
         """
         Shows the server configuration
@@ -960,6 +1066,7 @@ class Server(RemoteStatusMixin):
         """
         Performs a backup for the server
         """
+        self.bypass_remote_status_cache()
         try:
             # Default strategy for check in backup is CheckStrategy
             # This strategy does not print any output - it only logs checks
@@ -987,6 +1094,8 @@ class Server(RemoteStatusMixin):
             with ServerBackupLock(self.config.barman_lock_directory,
                                   self.config.name):
                 self.backup_manager.backup()
+            # The status of the server has changed
+            self.reset_remote_status()
             # Archive incoming WALs and update WAL catalogue
             self.archive_wal(verbose=False)
 
@@ -1086,9 +1195,27 @@ class Server(RemoteStatusMixin):
         return self.backup_manager.get_next_backup(backup_id)
 
     def get_required_xlog_files(self, backup, target_tli=None,
-                                target_time=None, target_xid=None):
+                                target_time=None, target_xid=None,
+                                target_name=None):
         """
         Get the xlog files required for a recovery
+
+        The WAL files up to the end of the backup are always required.
+        After that, a WAL file is required if it may contain the recovery
+        target, or if the target has not been found yet. The index of the
+        WAL files (see the wal_index option) tells exactly where a target
+        is. For WAL files without index, only the target time can be
+        located, comparing it with the modification time of the file.
+
+        One more WAL file is always returned after the target, as the
+        record it refers to could continue there.
+
+        :param BackupInfo backup: the backup to recover
+        :param int|None target_tli: the target timeline
+        :param float|None target_time: the target time, as seconds since
+            the epoch
+        :param str|None target_xid: the target transaction id
+        :param str|None target_name: the target restore point name
         """
         begin = backup.begin_wal
         end = backup.end_wal
@@ -1096,6 +1223,19 @@ class Server(RemoteStatusMixin):
         # of the backup
         if not target_tli:
             target_tli, _, _ = xlog.decode_segment_name(end)
+        if target_xid is not None:
+            try:
+                target_xid = int(target_xid)
+            except ValueError:
+                # Not a valid xid: it cannot be located
+                target_xid = None
+        # Without any target, every file is required
+        targeted = bool(target_time or target_name or target_xid is not None)
+        time_found = not target_time
+        name_found = not target_name
+        xid_found = False
+        # Files that are not required, unless the target xid is found later
+        pending = []
         with self.xlogdb() as fxlogdb:
             for line in fxlogdb:
                 wal_info = WalFileInfo.from_xlogdb_line(line)
@@ -1109,11 +1249,47 @@ class Server(RemoteStatusMixin):
                 tli, _, _ = xlog.decode_segment_name(wal_info.name)
                 if tli > target_tli:
                     continue
-                yield wal_info
-                if wal_info.name > end:
-                    end = wal_info.name
+                if wal_info.name <= end:
+                    yield wal_info
+                    continue
+                index = wal_info.index
+                required = not (targeted and time_found and name_found)
+                if index is None:
+                    # Without index, only the target time can be located,
+                    # using the modification time of the file
                     if target_time and target_time < wal_info.time:
-                        break
+                        time_found = True
+                    if target_xid is not None:
+                        required = True
+                        xid_found = True
+                else:
+                    if target_time and index.end_time is not None and \
+                            target_time < index.end_time:
+                        time_found = True
+                    if target_name and target_name in index.restore_points:
+                        name_found = True
+                    if target_xid is not None and \
+                            index.min_xid is not None and \
+                            index.min_xid <= target_xid <= index.max_xid:
+                        required = True
+                        xid_found = True
+                if required:
+                    for pending_info in pending:
+                        yield pending_info
+                    pending = []
+                    yield wal_info
+                    continue
+                pending.append(wal_info)
+                # Stop after the target, unless looking for an xid,
+                # whose last occurrence is unknown
+                if target_xid is None:
+                    break
+            if target_xid is not None and not xid_found:
+                # The target xid has not been found: return everything
+                for pending_info in pending:
+                    yield pending_info
+            elif pending:
+                yield pending[0]
             # return all the remaining history files
             for line in fxlogdb:
                 wal_info = WalFileInfo.from_xlogdb_line(line)
@@ -1301,66 +1477,13 @@ class Server(RemoteStatusMixin):
 
         # If peek is requested we only output a list of files
         if peek:
-            # Get the next ``peek`` files following the provided ``wal_name``.
-            # If ``wal_name`` is not a simple wal file,
-            # we cannot guess the names of the following WAL files.
-            # So ``wal_name`` is the only possible result, if exists.
-            if xlog.is_wal_file(wal_name):
-                # We can't know what was the segment size of PostgreSQL WAL
-                # files at backup time. Because of this, we generate all
-                # the possible names for a WAL segment, and then we check
-                # if the requested one is included.
-                wal_peek_list = xlog.generate_segment_names(wal_name)
-            else:
-                wal_peek_list = iter([wal_name])
-
-            # Output the content of wal_peek_list until we have displayed
-            # enough files or find a missing file
-            count = 0
-            while count < peek:
-                try:
-                    wal_peek_name = next(wal_peek_list)
-                except StopIteration:
-                    # No more item in wal_peek_list
-                    break
-
-                wal_peek_file = self.get_wal_full_path(wal_peek_name)
-
-                # If the next WAL file is found, output the name
-                # and continue to the next one
-                if os.path.exists(wal_peek_file):
-                    count += 1
-                    output.info(wal_peek_name, log=False)
-                    continue
-
-                # If ``wal_peek_file`` doesn't exist, check if we need to
-                # look in the following segment
-                tli, log, seg = xlog.decode_segment_name(wal_peek_name)
-
-                # If `seg` is not a power of two, it is not possible that we
-                # are at the end of a WAL group, so we are done
-                if not is_power_of_two(seg):
-                    break
-
-                # This is a possible WAL group boundary, let's try the
-                # following group
-                seg = 0
-                log += 1
-
-                # Install a new generator from the start of the next segment.
-                # If the file doesn't exists we will terminate because
-                # zero is not a power of two
-                wal_peek_name = xlog.encode_segment_name(tli, log, seg)
-                wal_peek_list = xlog.generate_segment_names(wal_peek_name)
-
+            for wal_peek_info in self.peek_wal(wal_name, peek):
+                output.info(wal_peek_info.name, log=False)
             # Do not output anything else
             return
 
-        # Get the WAL file full path
-        wal_file = self.get_wal_full_path(wal_name)
-
         # Check for file existence
-        if not os.path.exists(wal_file):
+        if not os.path.exists(self.get_wal_full_path(wal_name)):
             output.error("WAL file '%s' not found in server '%s'%s",
                          wal_name, self.config.name, source_suffix)
             return
@@ -1370,7 +1493,7 @@ class Server(RemoteStatusMixin):
         if output_directory is not None:
             destination_path = os.path.join(output_directory, wal_name)
             try:
-                destination = open(destination_path, 'w')
+                destination = open(destination_path, 'wb')
                 output.info(
                     "Writing WAL '%s' for server '%s' into '%s' file%s",
                     wal_name, self.config.name, destination_path,
@@ -1380,21 +1503,241 @@ class Server(RemoteStatusMixin):
                              destination_path, source_suffix, e)
                 return
         else:
-            destination = sys.stdout
+            # The WAL content is binary
+            destination = getattr(sys.stdout, 'buffer', sys.stdout)
             _logger.info(
                 "Writing WAL '%s' for server '%s' to standard output%s",
                 wal_name, self.config.name, source_suffix)
 
-        # Get a decompressor for the file (None if not compressed)
-        wal_compressor = self.backup_manager.compression_manager \
-            .get_compressor(compression=identify_compression(wal_file))
+        try:
+            self.write_wal(wal_name, destination, compression)
+        finally:
+            if output_directory is not None:
+                destination.close()
+
+    def peek_wal(self, wal_name, peek, cached=False):
+        """
+        Get the archived WAL files following a WAL file, starting with
+        the WAL file itself
+
+        The WAL files are taken from the xlogdb, without accessing the
+        archive and without locking the xlogdb. As the xlogdb is appended
+        in order, the requested WAL file is located with a binary search
+        on the file offsets. If the WAL file is in the archive but it is
+        not found that way, the whole xlogdb is read and sorted.
+
+        :param str wal_name: the first WAL file
+        :param int peek: the maximum number of WAL files returned
+        :param bool cached: use a sorted view of the xlogdb kept in
+            memory, read again only when the xlogdb changes. It is meant
+            for long running processes, like the WAL server.
+        :rtype: list[WalFileInfo]
+        """
+        if cached:
+            names, lines = self._get_xlogdb_view()
+            return self._peek_xlogdb_lines(
+                wal_name, peek,
+                lines[bisect.bisect_left(names, wal_name):])
+        try:
+            with open(self.xlogdb_file_name, 'rb') as fxlogdb:
+                wal_infos = self._peek_xlogdb_lines(
+                    wal_name, peek, self._xlogdb_lines_from(fxlogdb,
+                                                            wal_name))
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return []
+        if (not wal_infos or wal_infos[0].name != wal_name) and \
+                os.path.exists(self.get_wal_full_path(wal_name)):
+            # The xlogdb is not sorted around the requested file
+            names, lines = self._read_xlogdb_view()[1:]
+            wal_infos = self._peek_xlogdb_lines(
+                wal_name, peek, lines[bisect.bisect_left(names, wal_name):])
+        return wal_infos
+
+    @staticmethod
+    def _peek_xlogdb_lines(wal_name, peek, lines):
+        """
+        Get the WAL files following a WAL file from the lines of the
+        xlogdb, sorted by name and starting from the first line not
+        preceding the WAL file
+
+        :param str wal_name: the first WAL file
+        :param int peek: the maximum number of WAL files returned
+        :param iterable[str] lines: the lines of the xlogdb
+        :rtype: list[WalFileInfo]
+        """
+        lines = iter(lines)
+        # If ``wal_name`` is not a simple wal file,
+        # we cannot guess the names of the following WAL files.
+        # So ``wal_name`` is the only possible result, if exists.
+        if not xlog.is_wal_file(wal_name):
+            for line in lines:
+                if line.split(None, 1)[0] == wal_name:
+                    return [WalFileInfo.from_xlogdb_line(line)]
+                break
+            return []
+
+        # We can't know what was the segment size of PostgreSQL WAL
+        # files at backup time. Because of this, we walk the segment
+        # numbers of every possible name (see xlog.segment_number),
+        # accepting a gap only when it could be the end of a WAL group.
+        per_file = xlog.segments_per_xlog_file()
+        tli, number = xlog.segment_number(wal_name)
+
+        # Collect the WAL files until we have found
+        # enough files or find a missing file
+        wal_infos = []
+        for line in lines:
+            if len(wal_infos) >= peek:
+                break
+            name = line.split(None, 1)[0]
+            # Skip the history, backup and partial files
+            if not xlog.is_wal_file(name):
+                continue
+            found_tli, found_number = xlog.segment_number(name)
+            if found_tli != tli:
+                break
+            if found_number < number:
+                # Duplicate entry
+                continue
+            if found_number != number:
+                # If `seg` is not a power of two, it is not possible that
+                # we are at the end of a WAL group, so we are done.
+                # The first file of the following group can't be missing,
+                # as zero is not a power of two.
+                log, seg = divmod(number, per_file)
+                if not is_power_of_two(seg) or \
+                        found_number != (log + 1) * per_file:
+                    break
+            wal_infos.append(WalFileInfo.from_xlogdb_line(line))
+            number = found_number + 1
+        return wal_infos
+
+    @staticmethod
+    def _xlogdb_lines_from(fxlogdb, wal_name):
+        """
+        Read the lines of a sorted xlogdb, starting from the first one
+        not preceding a WAL file
+
+        The line is located with a binary search on the file offsets.
+        A last line not terminated by a newline, which is still being
+        appended, is ignored.
+
+        :param fxlogdb: the xlogdb, opened in binary mode
+        :param str wal_name: the name of the WAL file
+        :return: a generator of the lines
+        """
+        def next_line():
+            # Get the next non empty complete line, if any
+            while True:
+                line = fxlogdb.readline()
+                if not line.endswith(b'\n'):
+                    return None
+                line = line.decode('ascii')
+                if line.strip():
+                    return line
+
+        def seek_line(offset):
+            # Move to the start of the first line not before the offset
+            fxlogdb.seek(max(offset - 1, 0))
+            if offset:
+                fxlogdb.readline()
+
+        # Find the first offset whose following line does not precede
+        # the WAL file: the lines are sorted, so the names of the lines
+        # following an offset grow with it
+        low = 0
+        high = os.fstat(fxlogdb.fileno()).st_size
+        while low < high:
+            middle = (low + high) // 2
+            seek_line(middle)
+            line = next_line()
+            if line is None or line.split(None, 1)[0] >= wal_name:
+                high = middle
+            else:
+                low = middle + 1
+        seek_line(low)
+        while True:
+            line = next_line()
+            if line is None:
+                return
+            yield line
+
+    def _read_xlogdb_view(self):
+        """
+        Read the whole content of the xlogdb, sorted by WAL name,
+        without locking it
+
+        The xlogdb is only appended or atomically replaced, so reading
+        it without lock gives a consistent content, except for a last
+        line still being appended, which is ignored.
+
+        :return tuple[tuple,list[str],list[str]]: the inode, size and
+            modification time of the file, the WAL names, and the
+            corresponding xlogdb lines
+        """
+        try:
+            with open(self.xlogdb_file_name) as fxlogdb:
+                stat = os.fstat(fxlogdb.fileno())
+                # The name is the first field, so sorting the lines
+                # sorts the names. The xlogdb is usually already sorted.
+                lines = sorted(line for line in fxlogdb
+                               if line.endswith('\n') and line.strip())
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None, [], []
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        return key, [line.split(None, 1)[0] for line in lines], lines
+
+    def _get_xlogdb_view(self):
+        """
+        Get the content of the xlogdb sorted by WAL name, kept in memory
+
+        The content is read again only when the xlogdb file changes, and
+        the lines are parsed only when requested.
+
+        :return tuple[list[str],list[str]]: the WAL names, and the
+            corresponding xlogdb lines
+        """
+        try:
+            stat = os.stat(self.xlogdb_file_name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return [], []
+        key = (stat.st_ino, stat.st_size, stat.st_mtime)
+        view = self._xlogdb_view
+        if view is None or view[0] != key:
+            view = self._read_xlogdb_view()
+            self._xlogdb_view = view
+        return view[1], view[2]
+
+    def write_wal(self, wal_name, destination, compression=None):
+        """
+        Write the content of an archived WAL file to a binary file object,
+        converting it to the requested compression
+
+        :param str wal_name: the name of the WAL file
+        :param destination: the file object receiving the content
+        :param str|None compression: compression format for the output
+        """
+        wal_file = self.get_wal_full_path(wal_name)
+
+        # Get a decompressor for the file (None if not compressed).
+        # The backup manager is not needed here, and it is not built
+        # for a lazy server.
+        compression_manager = CompressionManager(self.config, self.path)
+        wal_compressor = compression_manager.get_compressor(
+            compression=identify_compression(wal_file))
 
         # Get a compressor for the output (None if not compressed)
         # Here we need to handle explicitly the None value because we don't
         # want it ot fallback to the configured compression
         if compression is not None:
-            out_compressor = self.backup_manager.compression_manager \
-                .get_compressor(compression=compression)
+            out_compressor = compression_manager.get_compressor(
+                compression=compression)
         else:
             out_compressor = None
 
@@ -1404,40 +1747,43 @@ class Server(RemoteStatusMixin):
         uncompressed_file = None
         compressed_file = None
 
-        # If the required compression is different from the source we
-        # decompress/compress it into the required format (getattr is
-        # used here to gracefully handle None objects)
-        if getattr(wal_compressor, 'compression', None) != \
-                getattr(out_compressor, 'compression', None):
-            # If source is compressed, decompress it into a temporary file
-            if wal_compressor is not None:
-                uncompressed_file = NamedTemporaryFile(
-                    dir=self.config.wals_directory,
-                    prefix='.%s.' % wal_name,
-                    suffix='.uncompressed')
-                # decompress wal file
-                wal_compressor.decompress(source_file, uncompressed_file.name)
-                source_file = uncompressed_file.name
-
-            # If output compression is required compress the source
-            # into a temporary file
-            if out_compressor is not None:
-                compressed_file = NamedTemporaryFile(
-                    dir=self.config.wals_directory,
-                    prefix='.%s.' % wal_name,
-                    suffix='.compressed')
-                out_compressor.compress(source_file, compressed_file.name)
-                source_file = compressed_file.name
-
-        # Copy the prepared source file to destination
-        with open(source_file) as input_file:
-            shutil.copyfileobj(input_file, destination)
-
-        # Remove temp files
-        if uncompressed_file is not None:
-            uncompressed_file.close()
-        if compressed_file is not None:
-            compressed_file.close()
+        try:
+            # If the required compression is different from the source we
+            # decompress/compress it into the required format (getattr is
+            # used here to gracefully handle None objects)
+            if getattr(wal_compressor, 'compression', None) != \
+                    getattr(out_compressor, 'compression', None):
+                # If source is compressed, decompress it into a temporary
+                # file
+                if wal_compressor is not None:
+                    uncompressed_file = NamedTemporaryFile(
+                        dir=self.config.wals_directory,
+                        prefix='.%s.' % wal_name,
+                        suffix='.uncompressed')
+                    # decompress wal file
+                    wal_compressor.decompress(source_file,
+                                              uncompressed_file.name)
+                    source_file = uncompressed_file.name
+
+                # If output compression is required compress the source
+                # into a temporary file
+                if out_compressor is not None:
+                    compressed_file = NamedTemporaryFile(
+                        dir=self.config.wals_directory,
+                        prefix='.%s.' % wal_name,
+                        suffix='.compressed')
+                    out_compressor.compress(source_file, compressed_file.name)
+                    source_file = compressed_file.name
+
+            # Copy the prepared source file to destination
+            with open(source_file, 'rb') as input_file:
+                shutil.copyfileobj(input_file, destination)
+        finally:
+            # Remove temp files
+            if uncompressed_file is not None:
+                uncompressed_file.close()
+            if compressed_file is not None:
+                compressed_file.close()
 
     def cron(self, wals=True, retention_policies=True):
         """
@@ -1464,6 +1810,8 @@ class Server(RemoteStatusMixin):
                 # Retention policies execution
                 if retention_policies:
                     self.backup_manager.cron_retention_policy()
+                # Remove the content of the trash in background
+                self.cron_reclaim_trash()
         except LockFileBusy:
             output.info(
                 "Another cron process is already running on server %s. "
@@ -1511,6 +1859,39 @@ class Server(RemoteStatusMixin):
                 "on server %s. Skipping to the next server"
                 % self.config.name)
 
+    def cron_reclaim_trash(self):
+        """
+        Method that handles the start of a 'reclaim-trash' sub-process,
+        if the trash of the server is not empty.
+
+        This method must be run protected by ServerCronLock
+        """
+        if not self.backup_manager.trash.entries():
+            return
+        try:
+            # Try to acquire ServerTrashLock, if the lock is available,
+            # no other 'reclaim-trash' processes are running on this server.
+            with ServerTrashLock(self.config.barman_lock_directory,
+                                 self.config.name):
+                # Output and release the lock immediately
+                output.info("Starting trash reclaimer for server %s",
+                            self.config.name, log=False)
+
+            # Init a Barman sub-process object
+            reclaim_process = BarmanSubProcess(
+                subcommand='reclaim-trash',
+                config=barman.__config__.config_file,
+                args=[self.config.name])
+            # Launch the sub-process
+            reclaim_process.execute()
+
+        except LockFileBusy:
+            # Another reclaim-trash process is running for the server
+            output.info(
+                "Another reclaim-trash process is already running "
+                "on server %s. Skipping to the next server"
+                % self.config.name)
+
     def cron_receive_wal(self):
         """
         Method that handles the start of a 'receive-wal' sub process
@@ -1572,6 +1953,35 @@ class Server(RemoteStatusMixin):
                         "on server %s. Skipping to the next server"
                         % self.config.name)
 
+    def reclaim_trash(self):
+        """
+        Remove the backups and the WAL files moved in the trash.
+
+        Usually run as subprocess of the barman cron command,
+        but can be executed manually using the barman reclaim-trash command
+        """
+        try:
+            # Only one reclaimer per server is admitted
+            with ServerTrashLock(self.config.barman_lock_directory,
+                                 self.config.name):
+                start_time = time.time()
+                removed = self.backup_manager.trash.reclaim(
+                    self.config.trash_reclaim_jobs,
+                    self.config.trash_reclaim_rate)
+                if removed:
+                    output.info(
+                        "Removed %s files from the trash of server %s "
+                        "(elapsed time: %s)",
+                        removed, self.config.name,
+                        human_readable_timedelta(datetime.timedelta(
+                            seconds=time.time() - start_time)))
+        except LockFileBusy:
+            output.info("Another reclaim-trash process is already running "
+                        "on server %s" % self.config.name)
+        except (OSError, IOError) as e:
+            output.error("Failure reclaiming the trash of server %s: %s",
+                         self.config.name, e)
+
     def create_physical_repslot(self):
         """
         Create a physical replication slot using the streaming connection
@@ -1608,6 +2018,7 @@ class Server(RemoteStatusMixin):
         try:
             self.streaming.create_physical_repslot(self.config.slot_name)
             output.info("Replication slot '%s' created", self.config.slot_name)
+            self.reset_remote_status()
         except PostgresDuplicateReplicationSlot:
             output.error("Replication slot '%s' already exists",
                          self.config.slot_name)
@@ -1659,6 +2070,7 @@ class Server(RemoteStatusMixin):
         try:
             self.streaming.drop_repslot(self.config.slot_name)
             output.info("Replication slot '%s' dropped", self.config.slot_name)
+            self.reset_remote_status()
         except PostgresInvalidReplicationSlot:
             output.error("Replication slot '%s' does not exist",
                          self.config.slot_name)
@@ -1693,6 +2105,9 @@ class Server(RemoteStatusMixin):
                          "barman configuration file")
             return
 
+        # The replication slot must not be considered in use by a
+        # receive-wal process which is not running anymore
+        self.bypass_remote_status_cache()
         output.info("Starting receive-wal for server %s", self.config.name)
         try:
             # Take care of the receive-wal lock.
@@ -1916,6 +2331,7 @@ class Server(RemoteStatusMixin):
                              "for server '%s'." % self.config.name)
                 return
             if closed_wal:
+                self.reset_remote_status()
                 # The switch_wal command have been executed successfully
                 output.info(
                     "The WAL file %s has been closed on server '%s'" %
@@ -1959,6 +2375,7 @@ class Server(RemoteStatusMixin):
         """
         Implements the 'replication-status' command.
         """
+        from barman.postgres import PostgreSQLConnection
         if target == 'hot-standby':
             client_type = PostgreSQLConnection.STANDBY
         elif target == 'wal-streamer':
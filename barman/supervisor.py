@@ -0,0 +1,235 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the resident version of the cron command.
+
+The CronSupervisor keeps the configuration and the Server objects in
+memory, periodically executes the maintenance operations of every server
+through a pool of threads, and supervises the receive-wal processes,
+restarting them when they terminate.
+"""
+
+import logging
+import signal
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import barman
+from barman import output
+from barman.command_wrappers import BarmanSubProcess
+from barman.exceptions import LockFileBusy, LockFilePermissionDenied
+from barman.lockfile import ServerCronLock, ServerWalReceiveLock
+
+_logger = logging.getLogger(__name__)
+
+
+class _ReceiverState(object):
+    """
+    State of the receive-wal process of a server
+    """
+
+    def __init__(self):
+        #: The running receive-wal process, if any
+        self.process = None
+        #: When the process has been started
+        self.start_time = None
+        #: Seconds to wait before the next restart
+        self.delay = 0
+        #: Earliest time for the next start
+        self.next_start = 0
+
+
+class CronSupervisor(object):
+    """
+    Execute the cron maintenance of a set of servers until stopped.
+
+    Every `interval` seconds, the WAL archiving and the retention policies
+    of every server are executed in the supervisor process, using a pool
+    of `workers` threads. A server is skipped if its previous run is still
+    in progress.
+
+    The receive-wal processes are checked every second: a process that
+    terminates is restarted, waiting a delay which doubles after every
+    consecutive failure up to MAX_RESTART_DELAY seconds.
+    """
+
+    #: Seconds between two checks of the receive-wal processes
+    TICK = 1
+
+    #: Delay before the first restart of a failed receive-wal process
+    RESTART_DELAY = 1
+
+    #: Maximum delay before the restart of a failed receive-wal process
+    MAX_RESTART_DELAY = 300
+
+    #: A receive-wal process running longer than this number of seconds
+    #: is considered healthy, and the restart delay is reset
+    STABLE_TIME = 60
+
+    def __init__(self, servers, interval=60, workers=10):
+        """
+        :param dict[str,barman.server.Server] servers: the servers to manage
+        :param int interval: seconds between two maintenance runs
+        :param int workers: the number of servers processed at the same time
+        """
+        self.servers = servers
+        self.interval = interval
+        self.workers = workers
+        self.receivers = {}
+        self.running = set()
+        self._running_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def stop(self, *args):
+        """
+        Ask the supervisor to terminate. It can be used as a signal handler.
+        """
+        self._stop.set()
+
+    def run(self):
+        """
+        Execute the main loop until the supervisor is stopped
+        """
+        output.info("Starting cron supervisor for %s servers "
+                    "(interval: %s seconds, jobs: %s)",
+                    len(self.servers), self.interval, self.workers)
+        previous_handler = signal.signal(signal.SIGTERM, self.stop)
+        pool = ThreadPool(processes=self.workers)
+        next_run = 0
+        try:
+            while not self._stop.is_set():
+                now = time.time()
+                if now >= next_run:
+                    next_run = now + self.interval
+                    self.schedule(pool)
+                self.supervise_receivers(now)
+                self._stop.wait(self.TICK)
+        except KeyboardInterrupt:
+            output.info('SIGINT received. Terminate gracefully.')
+        finally:
+            # Let the running tasks complete. The receive-wal processes
+            # are detached, and keep streaming WAL files.
+            pool.close()
+            pool.join()
+            signal.signal(signal.SIGTERM, previous_handler)
+        output.info("Cron supervisor terminated")
+
+    def schedule(self, pool):
+        """
+        Queue the maintenance of every server which is not already running
+
+        :param multiprocessing.pool.ThreadPool pool: the pool of workers
+        """
+        for name in sorted(self.servers):
+            with self._running_lock:
+                if name in self.running:
+                    _logger.debug("Maintenance of server %s still running, "
+                                  "skipping", name)
+                    continue
+                self.running.add(name)
+            pool.apply_async(self.maintain, (self.servers[name],))
+
+    def maintain(self, server):
+        """
+        Execute the maintenance operations of a server, like the cron
+        command does, but archiving the WAL files in this process
+
+        :param barman.server.Server server: the server
+        """
+        name = server.config.name
+        try:
+            with ServerCronLock(server.config.barman_lock_directory, name):
+                # The backups could have been changed by other processes
+                server.backup_manager.reload_catalog()
+                server.archive_wal(verbose=False)
+                if not server.config.streaming_archiver:
+                    # Terminate the receive-wal sub-process if present
+                    server.kill('receive-wal', fail_if_not_present=False)
+                server.backup_manager.cron_retention_policy()
+                # Remove the content of the trash in background
+                server.cron_reclaim_trash()
+        except LockFileBusy:
+            output.info("Another cron process is already running on "
+                        "server %s. Skipping to the next server", name)
+        except LockFilePermissionDenied as e:
+            output.error("Permission denied, unable to access '%s'", e)
+        except Exception as e:
+            # A failure must not stop the supervisor
+            _logger.exception("Maintenance of server %s failed", name)
+            output.error("Maintenance of server %s failed: %s", name, e)
+        finally:
+            server.close()
+            with self._running_lock:
+                self.running.discard(name)
+
+    def supervise_receivers(self, now):
+        """
+        Start the receive-wal process of every server with
+        streaming_archiver enabled, restarting the terminated ones
+
+        :param float now: the current time
+        """
+        for name in sorted(self.servers):
+            server = self.servers[name]
+            if not server.config.streaming_archiver:
+                continue
+            state = self.receivers.setdefault(name, _ReceiverState())
+            if state.process is not None:
+                ret_code = state.process.poll()
+                if ret_code is None:
+                    continue
+                self._receiver_terminated(name, state, ret_code, now)
+            if now < state.next_start:
+                continue
+            try:
+                # The process could have been started by someone else
+                with ServerWalReceiveLock(server.config.barman_lock_directory,
+                                          name):
+                    pass
+            except LockFileBusy:
+                continue
+            except LockFilePermissionDenied as e:
+                output.error("Permission denied, unable to access '%s'", e)
+                continue
+            output.info("Starting streaming archiver for server %s", name)
+            state.process = BarmanSubProcess(
+                subcommand='receive-wal',
+                config=barman.__config__.config_file,
+                args=[name]).execute()
+            state.start_time = now
+
+    def _receiver_terminated(self, name, state, ret_code, now):
+        """
+        Compute the restart delay of a terminated receive-wal process
+
+        :param str name: the server name
+        :param _ReceiverState state: the receive-wal state of the server
+        :param int ret_code: the exit code of the process
+        :param float now: the current time
+        """
+        if now - state.start_time >= self.STABLE_TIME:
+            state.delay = self.RESTART_DELAY
+        else:
+            state.delay = min(max(state.delay * 2, self.RESTART_DELAY),
+                              self.MAX_RESTART_DELAY)
+        state.next_start = now + state.delay
+        state.process = None
+        output.warning("receive-wal process for server %s terminated "
+                       "with code %s, restarting in %s seconds",
+                       name, ret_code, state.delay)
@@ -0,0 +1,256 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the trash area of a server.
+
+When the `trash` deletion mode is enabled, the directories of the deleted
+backups and the obsolete WAL files are moved in the trash with a rename,
+which is immediate, and the catalog is updated. The content of the trash
+is removed later by the reclaimer, with a pool of threads and an optional
+limit on the number of files removed per second.
+
+Every entry of the trash is a directory, named after the time of the
+deletion and the deleted object. Entries being created are hidden
+(their name starts with a dot) and ignored by the reclaimer.
+"""
+
+import datetime
+import errno
+import logging
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+from barman.dedup import ObjectStore
+
+_logger = logging.getLogger(__name__)
+
+
+def _unlink(path):
+    """
+    Remove a file, ignoring files already removed
+
+    :param str path: the file to remove
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class Trash(object):
+    """
+    The area where the deleted files wait to be removed
+    """
+
+    #: Number of files removed by a worker at a time
+    BATCH_SIZE = 100
+
+    def __init__(self, path, object_store=None):
+        """
+        :param str path: the trash directory
+        :param barman.dedup.ObjectStore|None object_store: the store of the
+            deduplicated objects referenced by the backups, which are
+            released when a backup is reclaimed
+        """
+        self.path = path
+        self.object_store = object_store
+
+    def _new_entry_name(self, name):
+        """
+        Build a unique name for a new entry of the trash
+
+        :param str name: the name of the deleted object
+        :rtype: str
+        """
+        return '%s-%s-%s' % (
+            datetime.datetime.now().strftime('%Y%m%dT%H%M%S.%f'),
+            os.getpid(), name)
+
+    def _makedirs(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def put_directory(self, path, name):
+        """
+        Move a directory in the trash
+
+        The directory must be on the same file system as the trash,
+        otherwise an OSError with errno EXDEV is raised.
+
+        :param str path: the directory to move
+        :param str name: the name of the deleted object
+        :return str: the path of the new entry
+        """
+        self._makedirs()
+        entry = os.path.join(self.path, self._new_entry_name(name))
+        os.rename(path, entry)
+        return entry
+
+    def put_files(self, paths, name):
+        """
+        Move a list of files in a new entry of the trash
+
+        The files must be on the same file system as the trash,
+        otherwise an OSError with errno EXDEV is raised, and the files
+        already moved are restored.
+
+        :param list[str] paths: the files to move. Their base names must
+            be unique.
+        :param str name: the name of the deleted objects
+        :return str: the path of the new entry
+        """
+        self._makedirs()
+        entry_name = self._new_entry_name(name)
+        tmp_entry = os.path.join(self.path, '.' + entry_name)
+        os.mkdir(tmp_entry)
+        moved = []
+        try:
+            for path in paths:
+                try:
+                    os.rename(path, os.path.join(tmp_entry,
+                                                 os.path.basename(path)))
+                except OSError as e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                else:
+                    moved.append(path)
+        except OSError:
+            for path in moved:
+                os.rename(os.path.join(tmp_entry, os.path.basename(path)),
+                          path)
+            os.rmdir(tmp_entry)
+            raise
+        entry = os.path.join(self.path, entry_name)
+        os.rename(tmp_entry, entry)
+        return entry
+
+    def entries(self):
+        """
+        Get the completed entries of the trash, oldest first
+
+        :rtype: list[str]
+        """
+        if not os.path.isdir(self.path):
+            return []
+        return [os.path.join(self.path, name)
+                for name in sorted(os.listdir(self.path))
+                if not name.startswith('.')]
+
+    def reclaim(self, jobs=1, rate=0):
+        """
+        Remove the content of the trash
+
+        :param int jobs: the number of threads removing files
+        :param int rate: the maximum number of files removed per second,
+            0 means unlimited
+        :return int: the number of removed files
+        """
+        pool = ThreadPool(processes=jobs) if jobs > 1 else None
+        removed = 0
+        try:
+            for entry in self.entries():
+                _logger.debug("Reclaiming trash entry %s", entry)
+                batches = self._throttle(self._batches(entry), rate)
+                if pool:
+                    results = pool.imap_unordered(self._remove_batch,
+                                                  batches)
+                else:
+                    results = (self._remove_batch(b) for b in batches)
+                for count in results:
+                    removed += count
+                self._remove_entry(entry)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return removed
+
+    @staticmethod
+    def _throttle(batches, rate):
+        """
+        Delay the batches of files, so that no more than `rate` files
+        per second are removed. The workers of the pool take the
+        batches from this generator, so they are throttled too.
+
+        :param collections.Iterable[list[str]] batches: the batches
+        :param int rate: the maximum number of files per second,
+            0 means unlimited
+        :rtype: collections.Iterable[list[str]]
+        """
+        start = time.time()
+        sent = 0
+        for batch in batches:
+            if rate:
+                delay = start + float(sent) / rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            sent += len(batch)
+            yield batch
+
+    def _batches(self, entry):
+        """
+        Generate the files of an entry of the trash, in batches
+
+        The deduplication manifest of a backup is kept, as it is needed
+        to release the objects used by the backup.
+
+        :param str entry: the entry of the trash
+        :rtype: collections.Iterable[list[str]]
+        """
+        batch = []
+        for root, dirs, files in os.walk(entry):
+            for name in files + [d for d in dirs
+                                 if os.path.islink(os.path.join(root, d))]:
+                if root == entry and name == ObjectStore.MANIFEST_FILE:
+                    continue
+                batch.append(os.path.join(root, name))
+                if len(batch) >= self.BATCH_SIZE:
+                    yield batch
+                    batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _remove_batch(batch):
+        """
+        Remove a list of files
+
+        :param list[str] batch: the files to remove
+        :return int: the number of files
+        """
+        for path in batch:
+            _unlink(path)
+        return len(batch)
+
+    def _remove_entry(self, entry):
+        """
+        Remove an entry of the trash once its files have been removed
+
+        :param str entry: the entry of the trash
+        """
+        if self.object_store is not None:
+            self.object_store.release(entry)
+        _unlink(os.path.join(entry, ObjectStore.MANIFEST_FILE))
+        for root, dirs, files in os.walk(entry, topdown=False):
+            for name in files + dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path) or name in files:
+                    _unlink(path)
+            os.rmdir(root)
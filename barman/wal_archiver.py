@@ -22,6 +22,7 @@ import filecmp
 import logging
 import os
 import shutil
+import threading
 from abc import ABCMeta, abstractmethod
 from glob import glob
 
@@ -30,11 +31,14 @@ from distutils.version import LooseVersion as Version
 from barman import output, xlog
 from barman.command_wrappers import CommandFailedException, PgReceiveXlog
 from barman.exceptions import (AbortedRetryHookScript, ArchiverFailure,
-                               DuplicateWalFile, MatchingDuplicateWalFile)
+                               BadWalFile, DuplicateWalFile, LockFileBusy,
+                               MatchingDuplicateWalFile, UnsupportedWalFile)
 from barman.hooks import HookScriptRunner, RetryHookScriptRunner
 from barman.infofile import WalFileInfo
-from barman.remote_status import RemoteStatusMixin
+from barman.lockfile import ServerWalArchiveLock
+from barman.remote_status import VOLATILE_STATUS_TTL, RemoteStatusMixin
 from barman.utils import fsync_dir, mkpath, with_metaclass
+from barman.wal_reader import read_wal_file
 
 _logger = logging.getLogger(__name__)
 
@@ -210,6 +214,16 @@ class WalArchiver(with_metaclass(ABCMeta, RemoteStatusMixin)):
                 # but theoretically possible)
                 shutil.move(wal_info.orig_filename, error_dst)
                 continue
+            except BadWalFile as e:
+                output.info("\tError: %s is not a valid WAL file (%s). "
+                            "File moved to errors directory.",
+                            wal_info.name, e)
+                error_dst = os.path.join(
+                    self.config.errors_directory,
+                    "%s.%s.corrupted" % (wal_info.name,
+                                         stamp))
+                shutil.move(wal_info.orig_filename, error_dst)
+                continue
             except AbortedRetryHookScript as e:
                 _logger.warning("Archiving of %s/%s aborted by "
                                 "pre_archive_retry_script."
@@ -311,6 +325,11 @@ class WalArchiver(with_metaclass(ABCMeta, RemoteStatusMixin)):
                     if dst_uncompressed != dst_file:
                         os.unlink(dst_uncompressed)
 
+            # Validate the WAL file and index the transactions it contains
+            if (self.config.wal_index or self.config.wal_integrity_check) \
+                    and xlog.is_wal_file(wal_info.name):
+                wal_info.index = self._read_wal_file(wal_info)
+
             mkpath(dst_dir)
             # Compress the file only if not already compressed
             if compressor and not wal_info.compression:
@@ -384,6 +403,40 @@ class WalArchiver(with_metaclass(ABCMeta, RemoteStatusMixin)):
             script.env_from_wal_info(wal_info, dst_file)
             script.run()
 
+    def _read_wal_file(self, wal_info):
+        """
+        Read the content of a WAL file to validate it and build its index.
+
+        An invalid WAL file is rejected only when wal_integrity_check is
+        enabled. Otherwise, like a WAL file that cannot be decoded, it is
+        archived without index.
+
+        :param WalFileInfo wal_info: the WAL file to read
+        :return: the index of the WAL file, if wal_index is enabled
+        :rtype: barman.wal_reader.WalIndex|None
+        :raise BadWalFile: if the content of the WAL file is not valid
+        """
+        try:
+            index = read_wal_file(wal_info.orig_filename, wal_info.name,
+                                  wal_info.compression)
+        except UnsupportedWalFile as e:
+            _logger.warning("Unable to read WAL file %s for server %s: %s",
+                            wal_info.name, self.config.name, e)
+            return None
+        except BadWalFile as e:
+            if self.config.wal_integrity_check:
+                raise
+            _logger.warning("Unable to index WAL file %s for server %s: %s",
+                            wal_info.name, self.config.name, e)
+            return None
+        except (IOError, OSError) as e:
+            _logger.warning("Unable to read WAL file %s for server %s: %s",
+                            wal_info.name, self.config.name, e)
+            return None
+        if self.config.wal_index:
+            return index
+        return None
+
     @abstractmethod
     def get_next_batch(self):
         """
@@ -443,6 +496,13 @@ class FileWalArchiver(WalArchiver):
     Manager of file-based WAL archiving operations (aka 'log shipping').
     """
 
+    #: The pg_stat_archiver statistics change frequently
+    REMOTE_STATUS_TTLS = dict.fromkeys(
+        ('archived_count', 'last_archived_wal', 'last_archived_time',
+         'failed_count', 'last_failed_wal', 'last_failed_time',
+         'stats_reset', 'is_archiving', 'current_archived_wals_per_second'),
+        VOLATILE_STATUS_TTL)
+
     def __init__(self, backup_manager):
 
         super(FileWalArchiver, self).__init__(backup_manager, 'file archival')
@@ -462,16 +522,26 @@ class FileWalArchiver(WalArchiver):
         # If Postgres is not available we cannot detect anything
         if not postgres:
             return result
-        # Query the database for 'archive_mode' and 'archive_command'
-        result['archive_mode'] = postgres.get_setting('archive_mode')
-        result['archive_command'] = postgres.get_setting('archive_command')
-
-        # Add pg_stat_archiver statistics if the view is supported
-        pg_stat_archiver = postgres.get_archiver_stats()
-        if pg_stat_archiver is not None:
-            result.update(pg_stat_archiver)
+        # 'archive_mode', 'archive_command' and the pg_stat_archiver
+        # statistics, if the view is supported, are collected along
+        # with the status of PostgreSQL
+        postgres_status = postgres.get_remote_status()
+        for name in result:
+            result[name] = postgres_status.get(name)
+        for name in postgres.ARCHIVER_STATS_KEYS:
+            if name in postgres_status:
+                result[name] = postgres_status[name]
         return result
 
+    def is_remote_status_cacheable(self, status):
+        """
+        Don't cache a status collected while PostgreSQL was unreachable
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return status.get('archive_mode') is not None
+
     def get_next_batch(self):
         """
         Returns the next batch of WAL files that have been archived through
@@ -593,6 +663,10 @@ class StreamingWalArchiver(WalArchiver):
     Object used for the management of streaming WAL archive operation.
     """
 
+    #: Seconds between two scans of the streaming directory made by
+    #: the inline archiver
+    INLINE_ARCHIVE_INTERVAL = 1
+
     def __init__(self, backup_manager):
         super(StreamingWalArchiver, self).__init__(backup_manager, 'streaming')
 
@@ -670,6 +744,17 @@ class StreamingWalArchiver(WalArchiver):
 
         return remote_status
 
+    def is_remote_status_cacheable(self, status):
+        """
+        Don't cache a status collected while the version of PostgreSQL
+        was unknown, because the streaming connection failed
+
+        :param dict[str, None|str] status: the remote status
+        :rtype: bool
+        """
+        return status.get('pg_receivexlog_installed') is False or \
+            status.get('pg_receivexlog_compatible') is not None
+
     def receive_wal(self, reset=False):
         """
         Creates a PgReceiveXlog object and issues the pg_receivexlog command
@@ -731,6 +816,17 @@ class StreamingWalArchiver(WalArchiver):
         # Make sure we are not wasting precious PostgreSQL resources
         self.server.close()
 
+        # Archive the completed segments from a background thread
+        inline_thread = None
+        inline_stop = threading.Event()
+        if self.config.streaming_archiver_inline:
+            inline_thread = threading.Thread(
+                target=self._inline_archive,
+                args=(inline_stop,),
+                name='inline-archiver')
+            inline_thread.daemon = True
+            inline_thread.start()
+
         _logger.info('Activating WAL archiving through streaming protocol')
         try:
             output_handler = PgReceiveXlog.make_output_handler(
@@ -767,6 +863,43 @@ class StreamingWalArchiver(WalArchiver):
             # This is a normal termination, so there is nothing to do beside
             # informing the user.
             output.info('SIGINT received. Terminate gracefully.')
+        finally:
+            if inline_thread:
+                inline_stop.set()
+                inline_thread.join()
+
+    def _inline_archive(self, stop):
+        """
+        Archive the streamed WAL files as soon as pg_receivexlog completes
+        them, until the stop event is set. A last pass is made after
+        the event is set.
+
+        It is executed by a background thread of the receive-wal process,
+        so every segment is compressed into the archive while it is still
+        in the page cache, instead of being read back from the disk by
+        the next archive-wal run.
+
+        :param threading.Event stop: the event terminating the loop
+        """
+        while True:
+            stop.wait(self.INLINE_ARCHIVE_INTERVAL)
+            finished = stop.is_set()
+            try:
+                # Share the lock with the archive-wal command
+                with ServerWalArchiveLock(self.config.barman_lock_directory,
+                                          self.config.name):
+                    self.archive(verbose=False)
+            except LockFileBusy:
+                # An archive-wal process is running, it will do the job
+                _logger.debug("Another archive-wal process is already "
+                              "running on server %s", self.config.name)
+            except Exception as e:
+                # Keep receiving WAL files, the archive-wal command
+                # will take care of this segment
+                _logger.exception("Inline archiving failed for server %s: %s",
+                                  self.config.name, e)
+            if finished:
+                break
 
     def _reset_streaming_status(self):
         """
@@ -0,0 +1,597 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module decodes the content of WAL segments.
+
+The WalReader reads a segment sequentially, validating the page headers
+and the chaining of the records across the pages. It extracts from the
+segment the commit and abort timestamps, the range of the terminated
+transaction ids and the names of the restore points. The resulting
+WalIndex is stored in the WAL catalog at archive time, and used
+during recovery to select exactly the segments needed to reach a target.
+
+Only the WAL format of PostgreSQL 9.3 and newer is supported.
+"""
+
+import bz2
+import collections
+import gzip
+import json
+import os
+import struct
+import zlib
+from contextlib import closing
+
+from barman import xlog
+from barman.exceptions import BadWalFile, UnsupportedWalFile
+
+try:
+    _view = memoryview
+except NameError:  # pragma: no cover
+    # Python 2.6: slicing a string copies the data
+    _view = bytes
+
+# Taken from xlog_internal.h and xlogrecord.h from PostgreSQL sources
+
+#: Flags of the page header
+XLP_FIRST_IS_CONTRECORD = 0x0001
+XLP_LONG_HEADER = 0x0002
+
+#: Page magic of the first WAL format with the new record header (9.5)
+XLOG_PAGE_MAGIC_95 = 0xD087
+
+#: Known page magic numbers, and the corresponding PostgreSQL version
+XLOG_PAGE_MAGIC = {
+    0xD075: 90300,
+    0xD07E: 90400,
+    0xD087: 90500,
+    0xD093: 90600,
+    0xD097: 100000,
+    0xD098: 110000,
+}
+
+#: Resource managers
+RM_XLOG_ID = 0
+RM_XACT_ID = 1
+
+#: Records of the RM_XLOG_ID resource manager
+XLOG_RESTORE_POINT = 0x70
+
+#: Records of the RM_XACT_ID resource manager
+XLOG_XACT_OPMASK = 0x70
+XLOG_XACT_COMMIT = 0x00
+XLOG_XACT_ABORT = 0x20
+XLOG_XACT_COMMIT_PREPARED = 0x30
+XLOG_XACT_ABORT_PREPARED = 0x40
+XLOG_XACT_COMMIT_COMPACT = 0x60
+XLOG_XACT_HAS_INFO = 0x80
+
+#: Flags of the xinfo field of the commit and abort records (9.5+),
+#: each one marking the presence of a section of the record data
+XACT_XINFO_HAS_DBINFO = 1 << 0
+XACT_XINFO_HAS_SUBXACTS = 1 << 1
+XACT_XINFO_HAS_RELFILENODES = 1 << 2
+XACT_XINFO_HAS_INVALS = 1 << 3
+XACT_XINFO_HAS_TWOPHASE = 1 << 4
+
+#: Size of the items of the variable length sections of the commit
+#: and abort records (9.5+)
+SIZE_OF_DBINFO = 8
+SIZE_OF_XID = 4
+SIZE_OF_RELFILENODE = 12
+SIZE_OF_INVAL_MESSAGE = 16
+
+#: Block ids of the record headers (9.5+)
+XLR_BLOCK_ID_DATA_SHORT = 255
+XLR_BLOCK_ID_DATA_LONG = 254
+XLR_BLOCK_ID_ORIGIN = 253
+
+#: Maximum length of a restore point name, including the terminator
+MAXFNAMELEN = 64
+
+#: Seconds between the Unix epoch and the PostgreSQL epoch (2000-01-01)
+POSTGRES_EPOCH = 946684800
+
+MAXIMUM_ALIGNOF = 8
+
+_page_header = struct.Struct('<HHIQI')
+_long_page_header = struct.Struct('<QII')
+_record_header_95 = struct.Struct('<IIQBB2xI')
+_record_header_93 = struct.Struct('<IIIBB2xQI')
+_record_length = struct.Struct('<I')
+_timestamp = struct.Struct('<q')
+_uint32 = struct.Struct('<I')
+_int32 = struct.Struct('<i')
+
+#: Size of the page headers
+SIZE_OF_SHORT_PAGE_HEADER = (_page_header.size + 7) & ~7
+SIZE_OF_LONG_PAGE_HEADER = (
+    SIZE_OF_SHORT_PAGE_HEADER + _long_page_header.size + 7) & ~7
+
+#: Size of the record header (MAXALIGNed on 9.3 and 9.4)
+SIZE_OF_RECORD_HEADER_95 = _record_header_95.size
+SIZE_OF_RECORD_HEADER_93 = 32
+
+#: The header of a WAL page
+PageHeader = collections.namedtuple(
+    'PageHeader', 'magic info tli pageaddr rem_len')
+
+#: This namedtuple contains the information about the transactions
+#: terminated inside a WAL segment. Times are expressed in seconds
+#: since the epoch, and every value is None when not available.
+WalIndex = collections.namedtuple(
+    'WalIndex', 'begin_time end_time min_xid max_xid restore_points')
+
+#: The file objects able to decompress a WAL file on the fly,
+#: for every compression supported by Barman
+_decompressors = {
+    'gzip': gzip.GzipFile,
+    'pigz': gzip.GzipFile,
+    'pygzip': gzip.GzipFile,
+    'bzip2': bz2.BZ2File,
+    'pybzip2': bz2.BZ2File,
+}
+
+
+def dump_wal_index(index):
+    """
+    Represent a WalIndex as a compact JSON string
+
+    :param WalIndex|None index: the index to represent
+    :rtype: str|None
+    """
+    if index is None:
+        return None
+    return json.dumps(list(index), separators=(',', ':'))
+
+
+def load_wal_index(string):
+    """
+    Parse a WalIndex from the representation made by dump_wal_index
+
+    :param str string: the string to parse
+    :rtype: WalIndex
+    """
+    begin_time, end_time, min_xid, max_xid, restore_points = json.loads(
+        string)
+    return WalIndex(begin_time, end_time, min_xid, max_xid,
+                    tuple(restore_points))
+
+
+def _maxalign(size):
+    """
+    Align a size to MAXIMUM_ALIGNOF
+
+    :param int size: the size to align
+    :rtype: int
+    """
+    return (size + MAXIMUM_ALIGNOF - 1) & ~(MAXIMUM_ALIGNOF - 1)
+
+
+def _to_epoch(timestamp):
+    """
+    Convert a PostgreSQL timestamp (microseconds since 2000-01-01)
+    to seconds since the Unix epoch
+
+    :param int timestamp: the PostgreSQL timestamp
+    :rtype: float
+    """
+    return POSTGRES_EPOCH + timestamp / 1000000.0
+
+
+def _is_power_of_2(value):
+    """
+    Check if a number is a power of 2
+
+    :param int value: the number to check
+    :rtype: bool
+    """
+    return value > 0 and value & (value - 1) == 0
+
+
+def open_wal_file(path, compression=None):
+    """
+    Open a WAL file for reading, decompressing it on the fly
+
+    :param str path: the path of the file
+    :param str|None compression: the compression of the file
+    :return: a readable binary file object
+    :raise UnsupportedWalFile: if the compression cannot be read
+        in Python, like with a custom compression
+    """
+    if not compression:
+        return open(path, 'rb')
+    if compression not in _decompressors:
+        raise UnsupportedWalFile(
+            "unable to read %s compressed files" % compression)
+    return _decompressors[compression](path, 'rb')
+
+
+class WalReader(object):
+    """
+    Sequentially read and decode a WAL segment
+
+    The headers of the pages are validated while reading: the page magic
+    must be the same in every page, the page addresses must be contiguous
+    and the timelines must never decrease. When the name of the segment
+    is known, the address of the first page and the timelines are
+    checked against it.
+
+    The reading of the records stops at the end of the WAL data, that is
+    the first page which has never been written or belongs to a recycled
+    segment. After that point, no valid page can be found.
+    """
+
+    #: Number of bytes read from the file at once. It must be a multiple
+    #: of every possible page size.
+    BUFFER_SIZE = 1 << 20
+
+    def __init__(self, wal_file, name=None):
+        """
+        :param wal_file: a readable binary file object, positioned at the
+            beginning of the segment
+        :param str|None name: the name of the segment
+        """
+        self.wal_file = wal_file
+        self.name = name and os.path.basename(name)
+        self.magic = None
+        self.page_size = None
+        self.segment_size = None
+
+    def _read(self, size):
+        """
+        Read a number of bytes from the file, unless the file ends first
+
+        :param int size: the number of bytes to read
+        :rtype: bytes
+        """
+        chunks = []
+        while size > 0:
+            chunk = self.wal_file.read(size)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _read_long_header(self, block):
+        """
+        Validate the long header contained in the first page of the
+        segment, setting the magic, the page size and the segment size
+
+        :param block: the first block read from the file
+        :return: the address of the first byte of the segment
+        :rtype: int
+        """
+        if len(block) < SIZE_OF_LONG_PAGE_HEADER:
+            raise BadWalFile("segment too short")
+        header = PageHeader._make(_page_header.unpack_from(block))
+        if header.magic not in XLOG_PAGE_MAGIC:
+            if header.magic:
+                raise UnsupportedWalFile(
+                    "unknown page magic 0x%04X" % header.magic)
+            raise BadWalFile("empty page header")
+        if not header.info & XLP_LONG_HEADER:
+            raise BadWalFile("missing long page header")
+        sysid, segment_size, page_size = _long_page_header.unpack_from(
+            block, SIZE_OF_SHORT_PAGE_HEADER)
+        if not _is_power_of_2(page_size) or \
+                self.BUFFER_SIZE % page_size:
+            raise BadWalFile("invalid page size %s" % page_size)
+        if not _is_power_of_2(segment_size) or segment_size < page_size:
+            raise BadWalFile("invalid segment size %s" % segment_size)
+        self.magic = header.magic
+        self.page_size = page_size
+        self.segment_size = segment_size
+        if self.name is None:
+            return header.pageaddr
+        tli, log, seg = xlog.decode_segment_name(self.name)
+        start = (log << 32) + seg * segment_size
+        if header.pageaddr != start:
+            raise BadWalFile("segment address %X/%X does not match the "
+                             "file name" % (header.pageaddr >> 32,
+                                            header.pageaddr & 0xFFFFFFFF))
+        return start
+
+    def pages(self):
+        """
+        Iterate over the pages containing WAL data, validating the
+        whole segment
+
+        :return: a generator of (offset, PageHeader, payload) tuples,
+            where payload is a memoryview of the page content after
+            the header
+        :raise BadWalFile: if the segment is not valid
+        """
+        if self.name is not None:
+            max_tli = xlog.decode_segment_name(self.name)[0]
+        else:
+            max_tli = None
+        tli = 0
+        size = 0
+        offset = 0
+        start = None
+        end = None
+        while True:
+            block = self._read(self.BUFFER_SIZE)
+            if not block:
+                break
+            size += len(block)
+            if start is None:
+                start = self._read_long_header(block)
+            if size > self.segment_size or len(block) % self.page_size:
+                # Wrong size: keep counting the bytes, to report it
+                continue
+            block = _view(block)
+            for page_offset in range(0, len(block), self.page_size):
+                header = PageHeader._make(
+                    _page_header.unpack_from(block, page_offset))
+                if header.magic != self.magic or \
+                        header.pageaddr != start + offset:
+                    # Never written, or belonging to a recycled segment
+                    if end is None:
+                        end = offset
+                elif end is not None:
+                    raise BadWalFile("missing WAL data before offset "
+                                     "%X" % offset)
+                else:
+                    if header.tli < tli or \
+                            max_tli is not None and header.tli > max_tli:
+                        raise BadWalFile("unexpected timeline %s in page "
+                                         "at offset %X" %
+                                         (header.tli, offset))
+                    tli = header.tli
+                    if header.info & XLP_LONG_HEADER:
+                        header_size = SIZE_OF_LONG_PAGE_HEADER
+                    else:
+                        header_size = SIZE_OF_SHORT_PAGE_HEADER
+                    yield offset, header, block[
+                        page_offset + header_size:
+                        page_offset + self.page_size]
+                offset += self.page_size
+        if start is None:
+            raise BadWalFile("segment too short")
+        if size != self.segment_size:
+            raise BadWalFile("segment size is %s bytes, expected %s" %
+                             (size, self.segment_size))
+
+    def records(self):
+        """
+        Iterate over the records starting in the segment
+
+        A record continuing in the next segment is not returned.
+        The whole segment is validated.
+
+        :return: a generator of (xid, info, rmid, data) tuples, where data
+            is the main data of the record, or None if not available
+        :raise BadWalFile: if the segment is not valid
+        """
+        # Bytes of the segment not decoded yet
+        stream = bytearray()
+        # Bytes of the current record continuing in the next page
+        rem_len = 0
+        # Bytes of the record started in the previous segment, to skip
+        skip = 0
+        finished = False
+        for offset, header, payload in self.pages():
+            if header.info & XLP_FIRST_IS_CONTRECORD:
+                page_rem_len = header.rem_len
+            else:
+                page_rem_len = 0
+            if offset == 0:
+                skip = rem_len = page_rem_len
+            elif finished:
+                continue
+            elif page_rem_len != rem_len:
+                raise BadWalFile("broken continuation record in page "
+                                 "at offset %X" % offset)
+            if skip:
+                skipped = min(skip, len(payload))
+                skip -= skipped
+                rem_len = skip
+                if skip:
+                    continue
+                payload = payload[_maxalign(skipped):]
+            stream += payload
+            pos = 0
+            for pos, record in self._decode(stream):
+                if record is None:
+                    finished = True
+                    break
+                yield record
+            del stream[:pos]
+            if stream and not finished:
+                rem_len = _record_length.unpack_from(stream)[0] - len(stream)
+            else:
+                rem_len = 0
+        if rem_len and (offset + self.page_size) != self.segment_size:
+            # The WAL data ends in the middle of a record
+            raise BadWalFile("incomplete record in page at offset "
+                             "%X" % offset)
+
+    def _decode(self, stream):
+        """
+        Decode the complete records at the beginning of a stream
+
+        :param bytearray stream: the WAL data, starting at the beginning
+            of a record
+        :return: a generator of (position, record) tuples, where position
+            is the offset of the first byte after the record, and record
+            is None at the end of the WAL data
+        """
+        new_format = self.magic >= XLOG_PAGE_MAGIC_95
+        if new_format:
+            header = _record_header_95
+            header_size = SIZE_OF_RECORD_HEADER_95
+        else:
+            header = _record_header_93
+            header_size = SIZE_OF_RECORD_HEADER_93
+        pos = 0
+        end = len(stream)
+        while pos < end:
+            tot_len = _record_length.unpack_from(stream, pos)[0]
+            if tot_len < header_size:
+                # End of the WAL data
+                yield pos, None
+                return
+            if pos + tot_len > end:
+                # The record continues in the next page
+                return
+            fields = header.unpack_from(stream, pos)
+            if new_format:
+                xid, info, rmid = fields[1], fields[3], fields[4]
+                data = self._main_data_95(stream, pos + header_size,
+                                          pos + tot_len)
+            else:
+                xid, data_len, info, rmid = fields[1:5]
+                data_start = pos + header_size
+                data = bytes(stream[data_start:data_start + data_len])
+            pos += _maxalign(tot_len)
+            yield pos, (xid, info, rmid, data)
+
+    @staticmethod
+    def _main_data_95(stream, pos, end):
+        """
+        Return the main data of a record without block references
+
+        :param bytearray stream: the stream of records
+        :param int pos: the position after the record header
+        :param int end: the end of the record
+        :rtype: bytes|None
+        """
+        while pos < end:
+            block_id = stream[pos]
+            if block_id == XLR_BLOCK_ID_DATA_SHORT:
+                length = stream[pos + 1]
+                pos += 2
+                return bytes(stream[pos:pos + length])
+            elif block_id == XLR_BLOCK_ID_DATA_LONG:
+                length = struct.unpack_from('<I', stream, pos + 1)[0]
+                pos += 5
+                return bytes(stream[pos:pos + length])
+            elif block_id == XLR_BLOCK_ID_ORIGIN:
+                pos += 3
+            else:
+                # A block reference: not used by the records we decode
+                return None
+        return None
+
+    def _prepared_xid(self, info, data):
+        """
+        Extract the xid of the prepared transaction from the data of a
+        COMMIT PREPARED or ABORT PREPARED record
+
+        :param int info: the info flags of the record
+        :param bytes data: the main data of the record
+        :rtype: int|None
+        """
+        if self.magic < XLOG_PAGE_MAGIC_95:
+            # The prepared xid precedes the commit or abort data
+            if len(data) < SIZE_OF_XID:
+                return None
+            return _uint32.unpack_from(data)[0]
+        # The timestamp is followed by the xinfo flags, and by the
+        # sections they mark, in this order
+        if not info & XLOG_XACT_HAS_INFO:
+            return None
+        pos = _timestamp.size
+        if len(data) < pos + _uint32.size:
+            return None
+        xinfo = _uint32.unpack_from(data, pos)[0]
+        pos += _uint32.size
+        if xinfo & XACT_XINFO_HAS_DBINFO:
+            pos += SIZE_OF_DBINFO
+        for flag, item_size in (
+                (XACT_XINFO_HAS_SUBXACTS, SIZE_OF_XID),
+                (XACT_XINFO_HAS_RELFILENODES, SIZE_OF_RELFILENODE),
+                (XACT_XINFO_HAS_INVALS, SIZE_OF_INVAL_MESSAGE)):
+            if xinfo & flag:
+                if len(data) < pos + _int32.size:
+                    return None
+                count = _int32.unpack_from(data, pos)[0]
+                pos += _int32.size + count * item_size
+        if not xinfo & XACT_XINFO_HAS_TWOPHASE or \
+                len(data) < pos + SIZE_OF_XID:
+            return None
+        return _uint32.unpack_from(data, pos)[0]
+
+    def index(self):
+        """
+        Build the WalIndex of the segment
+
+        :rtype: WalIndex
+        """
+        times = []
+        xids = []
+        restore_points = []
+        for xid, info, rmid, data in self.records():
+            if not data:
+                continue
+            if rmid == RM_XACT_ID:
+                op = info & XLOG_XACT_OPMASK
+                if op in (XLOG_XACT_COMMIT, XLOG_XACT_ABORT,
+                          XLOG_XACT_COMMIT_COMPACT):
+                    if xid:
+                        xids.append(xid)
+                elif op in (XLOG_XACT_COMMIT_PREPARED,
+                            XLOG_XACT_ABORT_PREPARED):
+                    # The xid of the record is the one of the session
+                    # terminating the prepared transaction
+                    prepared_xid = self._prepared_xid(info, data)
+                    if prepared_xid:
+                        xids.append(prepared_xid)
+                    if self.magic < XLOG_PAGE_MAGIC_95:
+                        # The timestamp follows the prepared xid
+                        data = data[MAXIMUM_ALIGNOF:]
+                else:
+                    continue
+                if len(data) >= _timestamp.size:
+                    times.append(_to_epoch(_timestamp.unpack_from(data)[0]))
+            elif rmid == RM_XLOG_ID and info & 0xF0 == XLOG_RESTORE_POINT:
+                if len(data) < _timestamp.size + MAXFNAMELEN:
+                    continue
+                name = data[_timestamp.size:_timestamp.size + MAXFNAMELEN]
+                name = name.split(b'\0', 1)[0].decode('utf-8', 'replace')
+                restore_points.append(name)
+        return WalIndex(
+            min(times) if times else None,
+            max(times) if times else None,
+            min(xids) if xids else None,
+            max(xids) if xids else None,
+            tuple(restore_points))
+
+
+def read_wal_file(path, name=None, compression=None):
+    """
+    Validate a WAL segment, and build its WalIndex
+
+    :param str path: the path of the segment
+    :param str|None name: the name of the segment, if different from
+        the name of the file
+    :param str|None compression: the compression of the file
+    :rtype: WalIndex
+    :raise BadWalFile: if the content of the file is not valid
+    :raise UnsupportedWalFile: if the file cannot be decoded
+    """
+    if name is None:
+        name = path
+    with closing(open_wal_file(path, compression)) as wal_file:
+        try:
+            return WalReader(wal_file, name).index()
+        except (struct.error, EOFError, IOError, zlib.error) as e:
+            raise BadWalFile(str(e) or type(e).__name__)
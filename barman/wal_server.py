@@ -0,0 +1,639 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module implements the WAL server, a resident process serving the
+archived WAL files over a Unix or TCP socket, and its client.
+
+The WAL server keeps the configuration and the Server objects in memory,
+so a request doesn't pay the startup of a `barman get-wal` process.
+A connection can be used for many requests (keep-alive), and a client
+can send many requests before reading the responses (pipelining).
+
+The protocol is line oriented. Every request is a line of ASCII words:
+
+    GET <server> <wal_name> [<compression>]
+    PEEK <server> <wal_name> <size>
+
+The response is either a line with the error message:
+
+    ERROR <message>
+
+or an `OK` line followed by the content, in chunks. Every chunk is a
+line with its length in bytes followed by the data, and the content is
+terminated by an empty chunk:
+
+    OK
+    <length>
+    <data>
+    0
+
+The content of a GET is the WAL file, compressed with `compression`
+if requested. The content of a PEEK is the list of the archived WAL
+files following `wal_name`, one per line, with the name, the size and
+the compression (`None` if not compressed) of the archived file
+separated by tabs. The list is taken from the catalog of the server.
+"""
+
+import argparse
+import bz2
+import errno
+import io
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import threading
+import zlib
+from collections import namedtuple
+
+from barman import xlog
+from barman.exceptions import WalServerException
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+_logger = logging.getLogger(__name__)
+
+#: The compressions supported by the client
+COMPRESSIONS = ('gzip', 'bzip2')
+
+#: Maximum length of a request line
+MAX_REQUEST_LENGTH = 1024
+
+#: An archived WAL file returned by a PEEK request
+PeekedWal = namedtuple('PeekedWal', 'name size compression')
+
+
+def parse_address(address):
+    """
+    Parse the address of a WAL server, which is either the path of a
+    Unix socket or a HOST:PORT pair for a TCP socket
+
+    The host name is resolved, and an IPv6 address must be enclosed in
+    square brackets, like in `[::1]:5433`.
+
+    :param str address: the address
+    :return tuple[int,str|tuple]: the socket family and the
+        socket address
+    :raise socket.gaierror: if the host name can't be resolved
+    """
+    if os.sep in address:
+        return socket.AF_UNIX, address
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        raise WalServerException(
+            "invalid WAL server address '%s': expected a socket path "
+            "or HOST:PORT" % address)
+    family, _, _, _, socket_address = socket.getaddrinfo(
+        host.strip('[]') or 'localhost', int(port), 0,
+        socket.SOCK_STREAM)[0]
+    return family, socket_address
+
+
+def is_loopback(family, socket_address):
+    """
+    Check that a socket address is reachable only from the local host
+
+    :param int family: the socket family
+    :param str|tuple socket_address: the socket address
+    :rtype: bool
+    """
+    if family == socket.AF_UNIX:
+        return True
+    if family == socket.AF_INET:
+        return socket_address[0].startswith('127.')
+    return family == socket.AF_INET6 and socket_address[0] == '::1'
+
+
+def is_wal_name(name):
+    """
+    Check that a string is the name of a WAL file, without any path
+
+    :param str name: the string to check
+    :rtype: bool
+    """
+    return os.path.basename(name) == name and xlog.is_any_xlog_file(name)
+
+
+class _ChunkedWriter(object):
+    """
+    File object writing the content of a response in chunks
+
+    The OK line is written with the first chunk, so an error raised
+    before any content is produced can still be sent to the client.
+    """
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.started = False
+
+    def _start(self):
+        if not self.started:
+            self.wfile.write(b'OK\n')
+            self.started = True
+
+    def write(self, data):
+        if data:
+            self._start()
+            self.wfile.write(('%d\n' % len(data)).encode('ascii'))
+            self.wfile.write(data)
+
+    def close(self):
+        self._start()
+        self.wfile.write(b'0\n')
+
+
+class WalRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Serve the requests of a client connection, until it is closed
+    """
+
+    #: Seconds of inactivity before closing a connection
+    timeout = 600
+
+    #: The responses are buffered and flushed when complete
+    wbufsize = 65536
+
+    def handle(self):
+        client = self.client_address or 'local client'
+        _logger.debug("Connection from %s", client)
+        try:
+            self._serve(client)
+        except socket.error as e:
+            # Inactivity timeout, or connection closed by the client
+            _logger.debug("Connection from %s closed: %s", client, e)
+
+    def _serve(self, client):
+        """
+        Execute the requests of a client, until the connection is closed
+
+        :param client: the address of the client
+        """
+        while True:
+            line = self.rfile.readline(MAX_REQUEST_LENGTH)
+            if not line:
+                break
+            if not line.endswith(b'\n'):
+                self._send_error('request too long')
+                break
+            words = line.decode('ascii', 'replace').split()
+            writer = _ChunkedWriter(self.wfile)
+            try:
+                self.dispatch(client, words, writer)
+            except WalServerException as e:
+                self._send_error(str(e))
+            except Exception as e:
+                _logger.exception("Request '%s' from %s failed",
+                                  ' '.join(words), client)
+                if writer.started:
+                    # The response can't be completed
+                    break
+                self._send_error(str(e))
+            else:
+                writer.close()
+            self.wfile.flush()
+
+    def _send_error(self, message):
+        """
+        Send an error response
+
+        :param str message: the error message
+        """
+        self.wfile.write(('ERROR %s\n' % message.replace('\n', ' '))
+                         .encode('utf-8'))
+        self.wfile.flush()
+
+    def dispatch(self, client, words, writer):
+        """
+        Execute a request
+
+        :param client: the address of the client
+        :param list[str] words: the words of the request line
+        :param _ChunkedWriter writer: the file object receiving the content
+            of the response
+        """
+        if not words:
+            raise WalServerException('empty request')
+        command, args = words[0], words[1:]
+        if command == 'GET' and len(args) in (2, 3):
+            server, wal_name = self._get_server(args[0], args[1])
+            compression = args[2] if len(args) == 3 else None
+            if compression is not None and compression not in COMPRESSIONS:
+                raise WalServerException(
+                    "unsupported compression '%s'" % compression)
+            if not os.path.exists(server.get_wal_full_path(wal_name)):
+                raise WalServerException(
+                    "WAL file '%s' not found in server '%s'" %
+                    (wal_name, args[0]))
+            _logger.info("Sending WAL '%s' for server '%s' to %s",
+                         wal_name, args[0], client)
+            server.write_wal(wal_name, writer, compression)
+        elif command == 'PEEK' and len(args) == 3:
+            server, wal_name = self._get_server(args[0], args[1])
+            if not args[2].isdigit() or int(args[2]) < 1:
+                raise WalServerException("invalid peek size '%s'" % args[2])
+            wal_infos = server.peek_wal(wal_name, int(args[2]), cached=True)
+            for wal_info in wal_infos:
+                writer.write(('%s\t%s\t%s\n' % (
+                    wal_info.name, wal_info.size,
+                    wal_info.compression)).encode('ascii'))
+        else:
+            raise WalServerException(
+                "invalid request '%s'" % ' '.join(words))
+
+    def _get_server(self, server_name, wal_name):
+        """
+        Validate the arguments of a request
+
+        :param str server_name: the name of the server
+        :param str wal_name: the name of the WAL file
+        :return tuple[barman.server.Server,str]: the server and the
+            WAL name
+        """
+        server = self.server.servers.get(server_name)
+        if server is None:
+            raise WalServerException("unknown server '%s'" % server_name)
+        if not is_wal_name(wal_name):
+            raise WalServerException(
+                "'%s' is not a valid wal file name" % wal_name)
+        return server, wal_name
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn,
+                          socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _ThreadingTCP6Server(_ThreadingTCPServer):
+    address_family = socket.AF_INET6
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class WalServer(object):
+    """
+    Serve the WAL files of a set of servers until stopped, with a thread
+    for every client connection
+    """
+
+    def __init__(self, servers, address, allow_remote=False):
+        """
+        :param dict[str,barman.server.Server] servers: the servers whose
+            WAL files are served
+        :param str address: the path of a Unix socket, or HOST:PORT
+        :param bool allow_remote: accept to listen on a TCP address
+            reachable from other hosts. The WAL server doesn't
+            authenticate its clients, nor encrypt the WAL files.
+        """
+        self.servers = servers
+        self.address = address
+        self.allow_remote = allow_remote
+        self.family, self.socket_address = parse_address(address)
+        self._server = None
+
+    def bind(self):
+        """
+        Create the listening socket
+
+        A Unix socket left by a terminated WAL server is replaced.
+        A TCP address reachable from other hosts is refused, unless
+        `allow_remote` is set.
+        """
+        if not self.allow_remote and \
+                not is_loopback(self.family, self.socket_address):
+            raise WalServerException(
+                "'%s' is not a loopback address, and remote connections "
+                "are not allowed" % self.address)
+        if self.family == socket.AF_UNIX:
+            if os.path.exists(self.socket_address):
+                self._remove_stale_socket()
+            self._server = _ThreadingUnixServer(self.socket_address,
+                                                WalRequestHandler)
+        elif self.family == socket.AF_INET6:
+            self._server = _ThreadingTCP6Server(self.socket_address,
+                                                WalRequestHandler)
+        else:
+            self._server = _ThreadingTCPServer(self.socket_address,
+                                               WalRequestHandler)
+        self._server.servers = self.servers
+
+    def _remove_stale_socket(self):
+        """
+        Remove the Unix socket of a terminated WAL server
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket_address)
+        except socket.error as e:
+            if e.errno not in (errno.ECONNREFUSED, errno.ENOTSOCK):
+                raise
+            os.unlink(self.socket_address)
+        else:
+            raise WalServerException(
+                "another WAL server is listening on '%s'" %
+                self.socket_address)
+        finally:
+            sock.close()
+
+    def run(self):
+        """
+        Serve the requests until the process receives SIGTERM or SIGINT
+        """
+        if self._server is None:
+            self.bind()
+        previous_handler = signal.signal(signal.SIGTERM, self.stop)
+        try:
+            self._server.serve_forever(poll_interval=0.5)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+            self._server.server_close()
+            if self.family == socket.AF_UNIX:
+                os.unlink(self.socket_address)
+
+    def stop(self, *args):
+        """
+        Ask the WAL server to terminate. It can be used as a signal handler.
+        """
+        # shutdown() waits for the serving loop to terminate, so it can't
+        # be called from the thread running it
+        threading.Thread(target=self._server.shutdown).start()
+
+
+class _BZ2Decompressor(object):
+    """
+    A bz2 decompressor with the interface of a zlib decompressor
+    """
+
+    def __init__(self):
+        self._decompressor = bz2.BZ2Decompressor()
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+    def flush(self):
+        return b''
+
+
+class WalClient(object):
+    """
+    Client of a WAL server
+    """
+
+    def __init__(self, address, timeout=None):
+        """
+        :param str address: the path of a Unix socket, or HOST:PORT
+        :param float|None timeout: socket timeout in seconds
+        """
+        self.family, self.socket_address = parse_address(address)
+        self.timeout = timeout
+        self._socket = None
+        self._rfile = None
+
+    def connect(self):
+        """
+        Open the connection, if not already open
+        """
+        if self._socket is not None:
+            return
+        self._socket = socket.socket(self.family, socket.SOCK_STREAM)
+        self._socket.settimeout(self.timeout)
+        try:
+            self._socket.connect(self.socket_address)
+        except socket.error:
+            self.close()
+            raise
+        self._rfile = self._socket.makefile('rb')
+
+    def close(self):
+        """
+        Close the connection
+        """
+        if self._rfile is not None:
+            self._rfile.close()
+            self._rfile = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, *words):
+        self.connect()
+        self._socket.sendall(('%s\n' % ' '.join(words)).encode('ascii'))
+
+    def _read_response(self, destination):
+        """
+        Read a response, writing its content to a file object
+
+        :param destination: the file object receiving the content
+        :return str|None: the error message of an ERROR response
+        """
+        line = self._rfile.readline().decode('utf-8')
+        if line.startswith('ERROR '):
+            return line[6:].rstrip('\n')
+        if line != 'OK\n':
+            raise WalServerException('unexpected response: %r' % line)
+        while True:
+            length = self._rfile.readline()
+            if not length.strip().isdigit():
+                raise WalServerException('unexpected chunk: %r' % length)
+            length = int(length)
+            if not length:
+                return None
+            data = self._rfile.read(length)
+            if len(data) != length:
+                raise WalServerException('connection closed')
+            destination.write(data)
+
+    def peek(self, server_name, wal_name, size):
+        """
+        Get the archived WAL files following a WAL file, starting with
+        the WAL file itself
+
+        :param str server_name: the server name
+        :param str wal_name: the first WAL file
+        :param int size: the maximum number of WAL files
+        :rtype: list[PeekedWal]
+        """
+        self._send('PEEK', server_name, wal_name, str(size))
+        content = io.BytesIO()
+        error = self._read_response(content)
+        if error is not None:
+            raise WalServerException(error)
+        result = []
+        for line in content.getvalue().decode('ascii').splitlines():
+            name, size, compression = line.split('\t')
+            result.append(PeekedWal(
+                name, int(size),
+                compression if compression != 'None' else None))
+        return result
+
+    def get_wals(self, server_name, requests, compression=None):
+        """
+        Retrieve a list of WAL files, sending all the requests before
+        reading the responses
+
+        :param str server_name: the server name
+        :param list[tuple[str,file]] requests: the WAL names, with the
+            binary file objects receiving their content
+        :param str|None compression: the compression used for the
+            transfer. The content is decompressed by the client.
+        :return dict[str,str]: the error messages of the failed WAL files
+        """
+        for wal_name, _ in requests:
+            words = ['GET', server_name, wal_name]
+            if compression:
+                words.append(compression)
+            self._send(*words)
+        errors = {}
+        for wal_name, destination in requests:
+            if compression == 'gzip':
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif compression == 'bzip2':
+                decompressor = _BZ2Decompressor()
+            else:
+                decompressor = None
+            if decompressor is not None:
+                target = _DecompressingWriter(destination, decompressor)
+            else:
+                target = destination
+            error = self._read_response(target)
+            if error is not None:
+                errors[wal_name] = error
+            elif decompressor is not None:
+                destination.write(decompressor.flush())
+        return errors
+
+
+class _DecompressingWriter(object):
+    """
+    File object decompressing the data written to it
+    """
+
+    def __init__(self, destination, decompressor):
+        self.destination = destination
+        self.decompressor = decompressor
+
+    def write(self, data):
+        self.destination.write(self.decompressor.decompress(data))
+
+
+def get_wal(client, server_name, wal_name, wal_dest, compression=None,
+            prefetch=0, spool_dir=None):
+    """
+    Retrieve a WAL file from a WAL server, as a `restore_command` does
+
+    With `prefetch`, the following WAL files are retrieved in the same
+    round trip and kept in `spool_dir`, where the next executions find
+    them.
+
+    :param WalClient client: the client of the WAL server
+    :param str server_name: the server name
+    :param str wal_name: the WAL file to retrieve
+    :param str wal_dest: the destination path
+    :param str|None compression: the compression used for the transfer
+    :param int prefetch: the number of WAL files retrieved in advance
+    :param str|None spool_dir: the directory of the prefetched files
+    :return str|None: the error message, if failed
+    """
+    if spool_dir and os.path.exists(os.path.join(spool_dir, wal_name)):
+        # The spool directory can be on another file system
+        shutil.move(os.path.join(spool_dir, wal_name), wal_dest)
+        return None
+    names = [wal_name]
+    if prefetch and spool_dir:
+        names += [peeked.name for peeked in
+                  client.peek(server_name, wal_name, prefetch + 1)
+                  if peeked.name != wal_name and is_wal_name(peeked.name)]
+        if not os.path.isdir(spool_dir):
+            os.makedirs(spool_dir)
+    destinations = []
+    requests = []
+    try:
+        for name in names:
+            if name == wal_name:
+                path = wal_dest
+            else:
+                path = os.path.join(spool_dir, name)
+            # Files are renamed in place only when complete
+            tmp_path = '%s.%s.tmp' % (path, os.getpid())
+            destinations.append((name, path, tmp_path))
+            requests.append((name, open(tmp_path, 'wb')))
+        errors = client.get_wals(server_name, requests, compression)
+    finally:
+        for _, destination in requests:
+            destination.close()
+    for name, path, tmp_path in destinations:
+        if name in errors or not os.path.exists(tmp_path):
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        else:
+            os.rename(tmp_path, path)
+    return errors.get(wal_name)
+
+
+def client_main(args=None):
+    """
+    The entry point of the barman-wal-client command
+    """
+    parser = argparse.ArgumentParser(
+        description='Retrieve a WAL file from a Barman WAL server. '
+                    'It can be used as restore_command.')
+    parser.add_argument('address',
+                        help='the path of the Unix socket, or HOST:PORT, '
+                             'of the WAL server')
+    parser.add_argument('server_name', help='the server name in Barman')
+    parser.add_argument('wal_name', help='the WAL file to retrieve (%%f)')
+    parser.add_argument('wal_dest', help='the destination path (%%p)')
+    parser.add_argument('--gzip', '-z', dest='compression',
+                        action='store_const', const='gzip',
+                        help='transfer the WAL files compressed with gzip')
+    parser.add_argument('--bzip2', '-j', dest='compression',
+                        action='store_const', const='bzip2',
+                        help='transfer the WAL files compressed with bzip2')
+    parser.add_argument('--prefetch', '-p', type=int, default=0,
+                        help='number of WAL files retrieved in advance '
+                             '(default: 0)')
+    parser.add_argument('--spool-dir', default='/var/tmp/walrestore',
+                        help='directory of the WAL files retrieved in '
+                             'advance (default: /var/tmp/walrestore)')
+    parser.add_argument('--timeout', type=float, default=60,
+                        help='socket timeout in seconds (default: 60)')
+    args = parser.parse_args(args)
+
+    client = WalClient(args.address, timeout=args.timeout)
+    try:
+        error = get_wal(client, args.server_name, args.wal_name,
+                        args.wal_dest, compression=args.compression,
+                        prefetch=args.prefetch, spool_dir=args.spool_dir)
+    except (socket.error, IOError, OSError, WalServerException) as e:
+        error = str(e)
+    finally:
+        client.close()
+    if error is not None:
+        sys.stderr.write('ERROR: %s\n' % error)
+        return 1
+    return 0
@@ -23,6 +23,8 @@ files
 import collections
 import os
 import re
+import sys
+from itertools import repeat
 from tempfile import NamedTemporaryFile
 
 from barman.exceptions import BadHistoryFileContents, BadXlogSegmentName
@@ -211,6 +213,180 @@ def xlog_file_size(xlog_segment_size):
     return xlog_segment_size * xlog_segments_per_file(xlog_segment_size)
 
 
+def segments_per_xlog_file(xlog_segment_size=None, version=None):
+    """
+    The number of segments actually used in an XLOG file, which is the
+    base of the conversion between segment names and segment numbers.
+
+    If the XLOG segment size is unknown, every possible segment name is
+    considered valid, as if the size was the smallest possible (8 KiB).
+
+    :param int|None xlog_segment_size: the size of a XLOG segment
+    :param int|None version: optional postgres version as an integer
+        (e.g. 90301 for 9.3.1)
+    :rtype: int
+    """
+    if xlog_segment_size:
+        count = xlog_segments_per_file(xlog_segment_size) + 1
+    else:
+        count = 0x80000
+    # If version is less than 9.3 the last segment is skipped
+    if version is not None and version < 90300:
+        count -= 1
+    return count
+
+
+def segment_number(path, xlog_segment_size=None, version=None):
+    """
+    Retrieve the timeline and the segment number of a xlog segment
+
+    The segment number is the position of the segment in the sequence of
+    the segments of the timeline, so that the segments between two names
+    can be counted with a subtraction.
+
+    :param str path: the file name to decode
+    :param int|None xlog_segment_size: the size of a XLOG segment
+    :param int|None version: optional postgres version as an integer
+    :return: the timeline and the segment number
+    :rtype: tuple[int,int]
+    :raise: BadXlogSegmentName
+    """
+    tli, log, seg = decode_segment_name(path)
+    if log is None:
+        raise BadXlogSegmentName(os.path.basename(path))
+    per_file = segments_per_xlog_file(xlog_segment_size, version)
+    return tli, log * per_file + seg
+
+
+def segment_name(tli, number, xlog_segment_size=None, version=None):
+    """
+    Build the xlog segment name from a timeline and a segment number
+
+    :param int tli: timeline number
+    :param int number: segment number, as returned by segment_number()
+    :param int|None xlog_segment_size: the size of a XLOG segment
+    :param int|None version: optional postgres version as an integer
+    :return str: segment file name
+    """
+    log, seg = divmod(number,
+                      segments_per_xlog_file(xlog_segment_size, version))
+    return encode_segment_name(tli, log, seg)
+
+
+class SegmentRange(object):
+    """
+    A contiguous range of xlog segments of a timeline
+
+    The range is represented by segment numbers (see segment_number()),
+    so it can be counted, sliced and tested for membership without
+    generating the names of its segments. Names are built only when
+    the range is iterated or indexed.
+    """
+
+    def __init__(self, tli, start, stop, xlog_segment_size=None,
+                 version=None):
+        """
+        :param int tli: the timeline of the segments
+        :param int start: the number of the first segment
+        :param int stop: the number after the last segment
+        :param int|None xlog_segment_size: the size of a XLOG segment
+        :param int|None version: optional postgres version as an integer
+        """
+        self.tli = tli
+        self.start = start
+        self.stop = max(start, stop)
+        self.xlog_segment_size = xlog_segment_size
+        self.version = version
+        self._per_file = segments_per_xlog_file(xlog_segment_size, version)
+
+    @classmethod
+    def from_names(cls, begin, end, xlog_segment_size=None, version=None):
+        """
+        Build the range of segments between two names, both included
+
+        :param str begin: begin segment name
+        :param str end: end segment name
+        :param int|None xlog_segment_size: the size of a XLOG segment
+        :param int|None version: optional postgres version as an integer
+        :rtype: SegmentRange
+        :raise: BadXlogSegmentName
+        """
+        per_file = segments_per_xlog_file(xlog_segment_size, version)
+        tli, begin_log, begin_seg = decode_segment_name(begin)
+        end_tli, end_log, end_seg = decode_segment_name(end)
+        if begin_log is None or end_log is None:
+            raise BadXlogSegmentName(begin if begin_log is None else end)
+        # this class doesn't support timeline changes
+        assert tli == end_tli, (
+            "Begin segment (%s) and end segment (%s) "
+            "must have the same timeline part" % (begin, end))
+        # Names of segments that are never used, like the skipped last
+        # segment of a file before 9.3, are moved inside the range
+        start = begin_log * per_file + min(begin_seg, per_file)
+        stop = end_log * per_file + min(end_seg + 1, per_file)
+        return cls(tli, start, stop, xlog_segment_size, version)
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def __repr__(self):
+        return "%s(%r, %r, %r)" % (self.__class__.__name__,
+                                   self.tli, self.start, self.stop)
+
+    def __contains__(self, path):
+        """
+        Check if a segment name belongs to the range.
+        Names of other kinds of files are never contained.
+        """
+        if not is_wal_file(path):
+            return False
+        tli, log, seg = decode_segment_name(path)
+        if tli != self.tli or seg >= self._per_file:
+            return False
+        return self.start <= log * self._per_file + seg < self.stop
+
+    def __iter__(self):
+        log, seg = divmod(self.start, self._per_file)
+        for _ in repeat(None, len(self)):
+            yield encode_segment_name(self.tli, log, seg)
+            seg += 1
+            if seg == self._per_file:
+                seg = 0
+                log += 1
+
+    def __getitem__(self, item):
+        """
+        Return the name of a segment given its position in the range,
+        or a new range given a slice with step 1
+        """
+        if isinstance(item, slice):
+            start, stop, step = item.indices(len(self))
+            if step != 1:
+                raise ValueError("slice step must be 1")
+            return SegmentRange(self.tli, self.start + start,
+                                self.start + stop, self.xlog_segment_size,
+                                self.version)
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError("segment index out of range")
+        return segment_name(self.tli, self.start + item,
+                            self.xlog_segment_size, self.version)
+
+    def index(self, path):
+        """
+        Return the position of a segment name inside the range
+
+        :param str path: the segment name
+        :rtype: int
+        :raise ValueError: if the segment is not in the range
+        """
+        if path not in self:
+            raise ValueError("%s is not in range" % path)
+        return segment_number(path, self.xlog_segment_size,
+                              self.version)[1] - self.start
+
+
 def generate_segment_names(begin, end=None, version=None,
                            xlog_segment_size=None):
     """
@@ -234,45 +410,13 @@ def generate_segment_names(begin, end=None, version=None,
     :rtype: collections.Iterable[str]
     :raise: BadXlogSegmentName
     """
-    begin_tli, begin_log, begin_seg = decode_segment_name(begin)
-    end_tli, end_log, end_seg = None, None, None
     if end:
-        end_tli, end_log, end_seg = decode_segment_name(end)
-
-        # this method doesn't support timeline changes
-        assert begin_tli == end_tli, (
-            "Begin segment (%s) and end segment (%s) "
-            "must have the same timeline part" % (begin, end))
-
-    # If version is less than 9.3 the last segment must be skipped
-    skip_last_segment = version is not None and version < 90300
-
-    # This is the number of XLOG segments in an XLOG file. By XLOG file
-    # we don't mean an actual file on the filesystem, but the definition
-    # used in the PostgreSQL sources: a set of files containing the
-    # same file number.
-    if xlog_segment_size:
-        # The generator is operating is precise and correct mode:
-        # knowing exactly when a switch to the next file is required
-        xlog_seg_per_file = xlog_segments_per_file(xlog_segment_size)
-    else:
-        # The generator is operating only in precise mode: generating every
-        # possible XLOG file name.
-        xlog_seg_per_file = 0x7ffff
-
-    # Start from the first xlog and generate the segments sequentially
-    # If ``end`` has been provided, the while condition ensure the termination
-    # otherwise this generator will never stop
-    cur_log, cur_seg = begin_log, begin_seg
-    while end is None or \
-            cur_log < end_log or \
-            (cur_log == end_log and cur_seg <= end_seg):
-        yield encode_segment_name(begin_tli, cur_log, cur_seg)
-        cur_seg += 1
-        if cur_seg > xlog_seg_per_file or (
-                skip_last_segment and cur_seg == xlog_seg_per_file):
-            cur_seg = 0
-            cur_log += 1
+        return iter(SegmentRange.from_names(begin, end, xlog_segment_size,
+                                            version))
+    tli, start = segment_number(begin, xlog_segment_size, version)
+    # Without ``end``, the range is virtually infinite
+    return iter(SegmentRange(tli, start, sys.maxsize, xlog_segment_size,
+                             version))
 
 
 def hash_dir(path):
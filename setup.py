@@ -69,7 +69,7 @@ setup(
     author_email='info@2ndquadrant.com',
     url='http://www.pgbarman.org/',
     packages=['barman', ],
-    scripts=['bin/barman', ],
+    scripts=['bin/barman', 'bin/barman-wal-client'],
     data_files=[
         ('share/man/man1', ['doc/barman.1']),
         ('share/man/man5', ['doc/barman.5']),
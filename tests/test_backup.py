@@ -15,7 +15,9 @@
 # You should have received a copy of the GNU General Public License
 # along with Barman.  If not, see <http://www.gnu.org/licenses/>.
 
+import errno
 import os
+import shutil
 from datetime import datetime, timedelta
 
 import dateutil.parser
@@ -24,9 +26,12 @@ import mock
 import pytest
 from mock import Mock, patch
 
+import barman.backup
 import barman.utils
-from barman.exceptions import CompressionIncompatibility
-from barman.infofile import BackupInfo
+from barman.exceptions import (CompressionIncompatibility,
+                               UnknownBackupIdException)
+from barman.infofile import BackupInfo, WalFileInfo
+from barman.trash import Trash
 from testing_helpers import (build_backup_directories, build_backup_manager,
                              build_test_backup_info, caplog_reset)
 
@@ -98,6 +103,7 @@ class TestBackup(object):
         # BackupManager setup
         backup_manager = build_backup_manager()
         instance = mock_infofile.return_value
+        instance.backup_id = 'fake_backup_id'
         # Instruct the patched method to raise a general exception
         backup_manager.executor.start_backup = Mock(
             side_effect=Exception('abc'))
@@ -158,8 +164,8 @@ class TestBackup(object):
         (out, err) = capsys.readouterr()
         assert "unable to parse the target time parameter " in err
 
-    @patch('barman.backup.BackupManager.get_available_backups')
-    def test_delete_backup(self, mock_available_backups, tmpdir, caplog):
+    @patch('barman.backup.BackupManager.backup_cache_remove')
+    def test_delete_backup(self, mock_cache_remove, tmpdir, caplog):
         """
         Simple test for the deletion of a backup.
         We want to test the behaviour of the delete_backup method
@@ -209,7 +215,8 @@ class TestBackup(object):
             backup_id='fake_backup',
             server=backup_manager.server,
         )
-        mock_available_backups.return_value = {
+        # The catalog is not changed by the deletions
+        backup_manager._backup_cache = {
             "fake_backup": b_pre_info,
             "fake_backup_id": b_info,
         }
@@ -320,6 +327,186 @@ class TestBackup(object):
             assert os.path.exists(wal_history_file03.strpath)
             assert os.path.exists(wal_history_file04.strpath)
 
+    def test_delete_backups(self, tmpdir):
+        """
+        Test the deletion of a set of backups with a single
+        rewrite of the xlogdb
+        """
+        backup_manager = build_backup_manager(
+            name='TestServer',
+            global_conf={
+                'barman_home': tmpdir.strpath
+            })
+        backup_manager.server.config.minimum_redundancy = 2
+        backup_manager.server.config.backup_options = []
+        backups = []
+        for day, timeline in ((1, 1), (2, 1), (3, 2), (4, 1)):
+            b_info = build_test_backup_info(
+                backup_id='2017010%sT000000' % day,
+                server=backup_manager.server,
+                begin_wal='0000000%s000000000000000%s' % (timeline, 2 * day),
+                timeline=timeline)
+            build_backup_directories(b_info)
+            b_info.save()
+            backups.append(b_info)
+        xlog_db = tmpdir.join('xlog.db')
+        xlog_db.write(''.join(
+            '%s\t42\t43\tNone\n' % name for name in (
+                '000000010000000000000001',
+                '000000010000000000000004',
+                '000000010000000000000007',
+                '000000010000000000000009',
+                '000000020000000000000005',
+                '00000002.history')))
+        backup_manager.server.xlogdb.return_value.__enter__.return_value = (
+            xlog_db.open())
+
+        with patch.object(backup_manager, 'delete_wals') as delete_wals_mock:
+            with patch.object(backup_manager, 'remove_wal_before_backup',
+                              wraps=backup_manager.remove_wal_before_backup
+                              ) as remove_mock:
+                backup_manager.delete_backups(backups[:3])
+        # The third backup is kept for the minimum redundancy
+        assert sorted(backup_manager._backup_cache) == [
+            '20170103T000000', '20170104T000000']
+        assert not os.path.exists(backups[0].get_basebackup_directory())
+        assert not os.path.exists(backups[1].get_basebackup_directory())
+        assert os.path.exists(backups[2].get_basebackup_directory())
+        # The WAL files are removed once, up to the first remaining backup.
+        # The timeline of the other remaining backup is protected.
+        assert remove_mock.call_count == 1
+        remove_until, timelines_to_protect = remove_mock.call_args[0]
+        assert remove_until.backup_id == '20170103T000000'
+        assert timelines_to_protect == set([1])
+        assert [w.name for w in delete_wals_mock.call_args[0][0]] == [
+            '000000020000000000000005']
+
+        # Delete the first backup: the WAL files before the next one
+        # are removed, as its timeline is not protected anymore
+        backup_manager.server.xlogdb.return_value.__enter__.return_value = (
+            xlog_db.open())
+        backup_manager.server.config.minimum_redundancy = 0
+        with patch.object(backup_manager, 'delete_wals') as delete_wals_mock:
+            backup_manager.delete_backups([backups[2]])
+        assert [w.name for w in delete_wals_mock.call_args[0][0]] == [
+            '000000010000000000000001',
+            '000000010000000000000004',
+            '000000010000000000000007']
+        assert xlog_db.read() == (
+            '000000010000000000000009\t42\t43.0\tNone\n'
+            '00000002.history\t42\t43.0\tNone\n')
+
+    def test_delete_backups_trash(self, tmpdir):
+        """
+        Test the deletion of backups and WAL files with the trash
+        """
+        backup_manager = build_backup_manager(
+            name='TestServer',
+            global_conf={
+                'barman_home': tmpdir.strpath,
+                'deletion_mode': 'trash',
+            })
+        backup_manager.server.config.minimum_redundancy = 0
+        backup_manager.server.config.backup_options = []
+        backups = []
+        for day in (1, 2):
+            b_info = build_test_backup_info(
+                backup_id='2017010%sT000000' % day,
+                server=backup_manager.server,
+                begin_wal='00000001000000000000000%s' % (2 * day))
+            build_backup_directories(b_info)
+            b_info.save()
+            backups.append(b_info)
+        wals_dir = tmpdir.join('wals')
+        backup_manager.server.config.wals_directory = wals_dir.strpath
+        xlog_db = tmpdir.join('xlog.db')
+        xlog_db.write(''.join(
+            '%s\t42\t43\tNone\n' % name for name in (
+                '000000010000000000000001',
+                '000000010000000000000003',
+                '000000010000000000000004')))
+        for name in ('000000010000000000000001',
+                     '000000010000000000000003',
+                     '000000010000000000000004'):
+            wals_dir.join(name[:16], name).ensure()
+        backup_manager.server.xlogdb.return_value.__enter__.return_value = (
+            xlog_db.open())
+
+        backup_manager.delete_backup(backups[0])
+        # The backup and the WAL files are in the trash
+        assert sorted(backup_manager._backup_cache) == ['20170102T000000']
+        assert not os.path.exists(backups[0].get_basebackup_directory())
+        assert xlog_db.read() == '000000010000000000000004\t42\t43.0\tNone\n'
+        assert not wals_dir.join('0000000100000000',
+                                 '000000010000000000000003').check()
+        trash = backup_manager.trash
+        entries = trash.entries()
+        assert len(entries) == 2
+        assert entries[0].endswith('backup-20170101T000000')
+        assert sorted(os.listdir(entries[1])) == [
+            '000000010000000000000001', '000000010000000000000003']
+        assert trash.reclaim() > 0
+        assert trash.entries() == []
+
+        # The files are deleted immediately if the trash is not usable
+        with patch.object(Trash, 'put_directory',
+                          side_effect=OSError('cross-device link')):
+            backup_manager.delete_backup(backups[1])
+        assert not os.path.exists(backups[1].get_basebackup_directory())
+        assert trash.entries() == []
+
+    def test_delete_wals(self, tmpdir, capsys):
+        """
+        Test the removal of the obsolete WAL files outside the xlogdb lock
+        """
+        backup_manager = build_backup_manager(
+            name='TestServer',
+            global_conf={'barman_home': tmpdir.strpath})
+        backup_manager.WAL_DELETION_BATCH_SIZE = 2
+        wals_dir = tmpdir.join('wals')
+        backup_manager.server.config.wals_directory = wals_dir.strpath
+        names = ['0000000100000000000000%02X' % i for i in range(1, 8)]
+        for name in names:
+            wals_dir.join(name[:16], name).ensure()
+        wals_dir.join('0000000100000001', '000000010000000100000001').ensure()
+        xlog_db = tmpdir.join('xlog.db')
+        xlog_db.write(''.join(
+            '%s\t42\t43\tNone\n' % name
+            for name in names + ['000000010000000100000001']))
+        xlogdb = backup_manager.server.xlogdb.return_value
+        xlogdb.__enter__.return_value = xlog_db.open()
+
+        def delete_files(paths):
+            # The files are deleted after the release of the lock
+            assert xlogdb.__exit__.called
+            return real_delete_files(paths)
+
+        real_delete_files = barman.backup._delete_files
+        b_info = build_test_backup_info(
+            server=backup_manager.server,
+            begin_wal='000000010000000100000001')
+        with patch('barman.backup._delete_files',
+                   side_effect=delete_files) as delete_mock:
+            removed = backup_manager.remove_wal_before_backup(b_info)
+        assert removed == names
+        # Four batches, removed in parallel
+        assert delete_mock.call_count == 4
+        assert xlog_db.read() == '000000010000000100000001\t42\t43.0\tNone\n'
+        # The empty hash directory is removed too
+        assert not wals_dir.join('0000000100000000').check()
+        assert wals_dir.join('0000000100000001').check()
+
+        # A missing file is ignored, the other errors are reported
+        wal_infos = [WalFileInfo(name=name) for name in names[:2]]
+        with patch('os.unlink', side_effect=[
+                OSError(errno.ENOENT, 'No such file or directory'),
+                OSError(errno.EACCES, 'Permission denied')]):
+            backup_manager.delete_wals(wal_infos)
+        out, err = capsys.readouterr()
+        assert names[0] not in err
+        assert ('Ignoring deletion of WAL file %s for server TestServer'
+                % names[1]) in err
+
     def test_available_backups(self, tmpdir):
         """
         Test the get_available_backups that retrieves all the
@@ -387,6 +574,71 @@ class TestBackup(object):
         assert backup_manager._backup_cache[b_info.backup_id].to_dict() == \
             b_info.to_dict()
 
+    def test_backup_catalog_snapshot(self, tmpdir, monkeypatch):
+        """
+        Check the loading of the backups from the catalog snapshot
+        """
+        monkeypatch.setattr(barman.backup, 'CATALOG_SNAPSHOT_RACY_TIME', 0)
+        global_conf = {'barman_home': tmpdir.strpath}
+        backup_manager = build_backup_manager(name='TestServer',
+                                              global_conf=global_conf)
+        for backup_id in ('20170101T000000', '20170102T000000'):
+            build_test_backup_info(
+                backup_id=backup_id,
+                server=backup_manager.server).save()
+        backup_manager._load_backup_cache()
+        assert os.path.exists(backup_manager.catalog_snapshot_path)
+
+        # The backup.info files are not parsed again
+        backup_manager = build_backup_manager(name='TestServer',
+                                              global_conf=global_conf)
+        with patch.object(BackupInfo, 'load') as load_mock:
+            backup_manager._load_backup_cache()
+        assert not load_mock.called
+        backup = backup_manager.get_backup('20170102T000000')
+        assert backup.backup_id == '20170102T000000'
+        assert backup.filename == backup.get_filename()
+        assert backup.to_dict() == build_test_backup_info(
+            backup_id='20170102T000000',
+            server=backup_manager.server).to_dict()
+
+        # Only the changed files are parsed
+        backup.status = BackupInfo.FAILED
+        backup.save()
+        backup_manager = build_backup_manager(name='TestServer',
+                                              global_conf=global_conf)
+        with patch.object(BackupInfo, 'load', autospec=True,
+                          side_effect=BackupInfo.load) as load_mock:
+            backup_manager._load_backup_cache()
+        assert load_mock.call_count == 1
+        assert backup_manager.get_backup(
+            '20170102T000000').status == BackupInfo.FAILED
+
+        # Added and removed backups are detected
+        build_test_backup_info(backup_id='20170103T000000',
+                               server=backup_manager.server).save()
+        shutil.rmtree(os.path.dirname(backup.filename))
+        backup_manager = build_backup_manager(name='TestServer',
+                                              global_conf=global_conf)
+        backup_manager._load_backup_cache()
+        assert sorted(backup_manager._backup_cache) == [
+            '20170101T000000', '20170103T000000']
+
+        # Recently modified files are not trusted
+        monkeypatch.setattr(barman.backup, 'CATALOG_SNAPSHOT_RACY_TIME', 60)
+        os.unlink(backup_manager.catalog_snapshot_path)
+        backup_manager._load_backup_cache()
+        snapshot = backup_manager._read_catalog_snapshot()
+        assert snapshot['directory_mtime'] is None
+        assert snapshot['backups'] == {}
+
+        # An invalid snapshot is ignored
+        with open(backup_manager.catalog_snapshot_path, 'w') as f:
+            f.write('invalid')
+        backup_manager._load_backup_cache()
+        assert sorted(backup_manager._backup_cache) == [
+            '20170101T000000', '20170103T000000']
+
     def test_backup_cache_add(self, tmpdir):
         """
         Check the method responsible for the registration of a BackupInfo obj
@@ -451,6 +703,65 @@ class TestBackup(object):
         backup_manager.backup_cache_remove(b_info)
         assert b_info.backup_id not in backup_manager._backup_cache
 
+    def test_backup_catalog_order(self, tmpdir):
+        """
+        Check the lookups of the neighbours of a backup in the catalog
+        """
+        backup_manager = build_backup_manager(
+            name='TestServer',
+            global_conf={
+                'barman_home': tmpdir.strpath
+            })
+        statuses = [BackupInfo.DONE, BackupInfo.FAILED, BackupInfo.DONE,
+                    BackupInfo.STARTED, BackupInfo.DONE]
+        backups = []
+        # Save them in random order
+        for day in (3, 1, 5, 2, 4):
+            b_info = build_test_backup_info(
+                backup_id='2017010%sT000000' % day,
+                server=backup_manager.server,
+                status=statuses[day - 1])
+            b_info.save()
+        for day in range(1, 6):
+            backups.append(backup_manager.get_backup(
+                '2017010%sT000000' % day))
+
+        assert backup_manager.get_first_backup_id() == backups[0].backup_id
+        assert backup_manager.get_last_backup_id() == backups[4].backup_id
+        assert backup_manager.get_last_backup_id(
+            (BackupInfo.FAILED,)) == backups[1].backup_id
+        assert backup_manager.get_first_backup_id(
+            (BackupInfo.EMPTY,)) is None
+        assert backup_manager.get_previous_backup(
+            backups[2].backup_id) is backups[0]
+        assert backup_manager.get_previous_backup(
+            backups[2].backup_id, BackupInfo.STATUS_ALL) is backups[1]
+        assert backup_manager.get_previous_backup(
+            backups[0].backup_id) is None
+        assert backup_manager.get_next_backup(
+            backups[2].backup_id) is backups[4]
+        assert backup_manager.get_next_backup(
+            backups[4].backup_id) is None
+        with pytest.raises(UnknownBackupIdException):
+            backup_manager.get_next_backup('20170106T000000')
+
+        # The status of the backups is checked when looking for them
+        backups[3].status = BackupInfo.DONE
+        assert backup_manager.get_next_backup(
+            backups[2].backup_id) is backups[3]
+
+        # The catalog is kept ordered
+        backup_manager.backup_cache_remove(backups[4])
+        assert backup_manager.get_last_backup_id() == backups[3].backup_id
+        b_info = build_test_backup_info(
+            backup_id='20170102T120000',
+            server=backup_manager.server)
+        backup_manager.backup_cache_add(b_info)
+        assert backup_manager.get_next_backup(
+            backups[0].backup_id) is b_info
+        assert backup_manager.get_previous_backup(
+            backups[2].backup_id) is b_info
+
     def test_get_backup(self, tmpdir):
         """
         Check the get_backup method that uses the backups cache to retrieve
@@ -585,6 +896,46 @@ class TestBackup(object):
             False
         )
 
+    def test_deduplicate_backup(self, tmpdir, capsys):
+        """
+        Test the deduplication of a backup and the removal of the objects
+        when the backups are deleted
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.strpath,
+            'deduplication': 'on',
+        })
+        store_dir = tmpdir.join('main', 'objects')
+        assert backup_manager.config.deduplication_directory == \
+            store_dir.strpath
+        backups = []
+        for backup_id in ('20170101T000000', '20170102T000000'):
+            backup_info = build_test_backup_info(
+                backup_id=backup_id,
+                server=backup_manager.server,
+                tablespaces=[])
+            backup_info.save()
+            data_dir = backup_info.get_data_directory()
+            os.makedirs(data_dir)
+            with open(os.path.join(data_dir, 'PG_VERSION'), 'w') as f:
+                f.write('9.6')
+            backups.append(backup_info)
+        backup_manager._backup_cache = None
+
+        backup_manager.deduplicate_backup(backups[0])
+        backup_manager.deduplicate_backup(backups[1])
+        out, err = capsys.readouterr()
+        assert "Deduplication: 1 files (3 B) shared" in out
+        assert len(store_dir.listdir()) == 1
+        assert os.stat(os.path.join(backups[1].get_data_directory(),
+                                    'PG_VERSION')).st_nlink == 3
+
+        # The object is removed with the last backup using it
+        backup_manager.delete_backup_data(backups[0])
+        assert len(store_dir.listdir()[0].listdir()) == 1
+        backup_manager.delete_backup_data(backups[1])
+        assert store_dir.listdir()[0].listdir() == []
+
     def test_get_latest_archived_wals_info(self, tmpdir):
         """
         Test the get_latest_archived_wals_info method
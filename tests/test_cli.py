@@ -15,17 +15,34 @@
 # You should have received a copy of the GNU General Public License
 # along with Barman.  If not, see <http://www.gnu.org/licenses/>.
 
+import getpass
+import os
+import subprocess
+import sys
+import time
+
 import pytest
 from mock import Mock, patch
 
 import barman.config
-from barman.cli import (get_server, get_server_list, manage_server_command,
-                        recover)
+from barman import output
+from barman.cli import (for_each_server, get_server, get_server_list,
+                        manage_server_command, recover)
 from barman.infofile import BackupInfo
 from barman.server import Server
 from testing_helpers import build_config_dictionary, build_config_from_dicts
 
 
+def _slow_server_function(server, name):
+    """
+    Produce some output, the first servers being the slowest
+    """
+    time.sleep(server)
+    output.info("server %s", name)
+    if name == 'c':
+        output.error("error on %s", name)
+
+
 # noinspection PyMethodMayBeStatic
 class TestCli(object):
 
@@ -233,7 +250,66 @@ class TestCli(object):
         assert server_dict
         # Check for the presence of global errors
         assert global_error_list
-        assert len(global_error_list) == 6
+        assert len(global_error_list) == 7
+
+    def test_get_server_list_config_cache(self, monkeypatch, tmpdir,
+                                          capsys):
+        """
+        Test that the paths conflicts are checked again when all the
+        servers are requested, even with a valid configuration cache
+
+        :param monkeypatch monkeypatch: pytest patcher
+        """
+        conf_d = tmpdir.mkdir('conf.d')
+        config_file = tmpdir.join('barman.conf')
+        config_file.write(
+            '[barman]\n'
+            'barman_home = %s\n'
+            'barman_user = %s\n'
+            'configuration_files_directory = %s\n' % (
+                tmpdir.mkdir('home').strpath, getpass.getuser(),
+                conf_d.strpath))
+        wals_link = tmpdir.join('wals_link')
+        wals_link.mksymlinkto(tmpdir.mkdir('wals'))
+        conf_d.join('main.conf').write(
+            '[main]\n'
+            'backup_directory = %s\n'
+            'wals_directory = %s\n' % (tmpdir.join('main'), wals_link))
+        conf_d.join('other.conf').write(
+            '[other]\n'
+            'backup_directory = %s\n' % tmpdir.join('other'))
+        for path in (config_file, conf_d.join('main.conf'),
+                     conf_d.join('other.conf')):
+            path.setmtime(1500000000)
+
+        def load():
+            config = barman.config.Config(config_file.strpath)
+            config.load_configuration_files_directory()
+            monkeypatch.setattr(barman, '__config__', config)
+            return config
+
+        load()
+        assert sorted(get_server_list()) == ['main', 'other']
+
+        # The symbolic link now points to the directory of another server,
+        # which doesn't invalidate the cache
+        wals_link.remove()
+        wals_link.mksymlinkto(tmpdir.join('other'))
+
+        # A single server is taken from the cache
+        config = load()
+        args = Mock()
+        args.server_name = ['main']
+        assert list(get_server_list(args)) == ['main']
+        assert config._servers is None
+
+        # The conflict is found when all the servers are requested
+        load()
+        args.server_name = ['all']
+        with pytest.raises(SystemExit):
+            get_server_list(args)
+        out, err = capsys.readouterr()
+        assert 'Conflicting path: ' in err
 
     @patch('barman.cli.parse_backup_id')
     @patch('barman.cli.get_server')
@@ -336,3 +412,63 @@ class TestCli(object):
         with pytest.raises(SystemExit):
             recover(args)
         assert "" == err
+
+    @pytest.mark.parametrize('jobs', [1, 3])
+    def test_for_each_server(self, jobs, capsys):
+        """
+        Test the output of for_each_server is always in the same order
+        """
+        output.error_occurred = False
+        servers = {'a': 0.3, 'b': 0.2, 'c': 0.1, 'd': 0}
+        try:
+            for_each_server(_slow_server_function, servers, jobs)
+            out, err = capsys.readouterr()
+            assert out == "server a\nserver b\nserver c\nserver d\n"
+            assert err == "ERROR: error on c\n"
+            assert output.error_occurred
+        finally:
+            output.error_occurred = False
+
+    def test_get_wal_imports(self, tmpdir):
+        """
+        Test get-wal doesn't load the modules it doesn't need, to keep
+        its startup fast. The timing is measured by
+        scripts/startup-benchmark.
+        """
+        wal_name = '000000010000000000000001'
+        tmpdir.join('main', 'wals', wal_name[:16], wal_name).write(
+            'wal content', ensure=True)
+        config = tmpdir.join('barman.conf')
+        config.write('[barman]\n'
+                     'barman_home = %s\n'
+                     'barman_user = %s\n'
+                     '[main]\n'
+                     'conninfo = host=pg\n'
+                     'ssh_command = ssh pg\n'
+                     'archiver = on\n' % (tmpdir.strpath, getpass.getuser()))
+        script = (
+            'import sys\n'
+            'from barman.cli import main\n'
+            'sys.argv = ["barman", "-c", %r, "-q", "get-wal", "main", %r]\n'
+            'try:\n'
+            '    main()\n'
+            'finally:\n'
+            '    sys.stderr.write(" ".join(sorted(sys.modules)))\n'
+            % (config.strpath, wal_name))
+        path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        if 'PYTHONPATH' in os.environ:
+            path.append(os.environ['PYTHONPATH'])
+        process = subprocess.Popen(
+            [sys.executable, '-c', script],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(path)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        assert process.returncode == 0
+        assert out.decode() == 'wal content'
+        modules = err.decode().split()
+        assert 'barman.server' in modules
+        for module in ('psycopg2', 'barman.postgres', 'barman.wal_archiver',
+                       'barman.backup_executor', 'barman.recovery_executor',
+                       'barman.copy_controller', 'barman.diagnose',
+                       'barman.supervisor'):
+            assert module not in modules
@@ -358,6 +358,22 @@ class TestCommand(object):
         assert cmd.out == out
         assert cmd.err == err
 
+    def test_get_output_out_handler(self, popen, pipe_processor_loop):
+        command = 'command'
+        out = 'line1\nline2'
+        _mock_pipe(popen, pipe_processor_loop, 0, out, 'err')
+        handler = mock.Mock()
+
+        cmd = command_wrappers.Command(command)
+        result = cmd.get_output(out_handler=handler)
+
+        # The output is still collected, while passed to the handler
+        assert result == (out, 'err')
+        assert handler.mock_calls == [
+            mock.call('line1'),
+            mock.call('line2'),
+        ]
+
     def test_execute_invocation(self, popen, pipe_processor_loop,
                                 caplog):
         command = 'command'
@@ -389,6 +405,25 @@ class TestCommand(object):
         assert ('Command', INFO, out) in caplog.record_tuples
         assert ('Command', WARNING, err) in caplog.record_tuples
 
+    def test_execute_stdin_file(self, popen, pipe_processor_loop, tmpdir):
+        command = 'command'
+        stdin_file = tmpdir.join('input').ensure()
+
+        pipe = _mock_pipe(popen, pipe_processor_loop, 0, 'out', 'err')
+        pipe.stdin = None
+
+        cmd = command_wrappers.Command(command)
+        with open(stdin_file.strpath, 'rb') as stdin:
+            result = cmd.execute(stdin=stdin)
+
+            # The file is passed to the subprocess, not read
+            popen.assert_called_with(
+                [command], shell=False, env=None,
+                stdout=PIPE, stderr=PIPE, stdin=stdin,
+                preexec_fn=mock.ANY, close_fds=True
+            )
+        assert result == 0
+
     def test_execute_invocation_multiline(self, popen, pipe_processor_loop,
                                           caplog):
         command = 'command'
@@ -856,6 +891,59 @@ class TestRsyncPgdata(object):
         assert cmd.err == err
 
 
+@mock.patch('barman.command_wrappers.Command.pipe_processor_loop')
+@mock.patch('barman.command_wrappers.subprocess.Popen')
+class TestSshControlMaster(object):
+
+    def test_options(self, popen, pipe_processor_loop):
+        master = command_wrappers.SshControlMaster(
+            'ssh', ['postgres@pg'], control_path='/tmp/x/ssh')
+        assert master.enabled
+        assert master.options == [
+            'postgres@pg',
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=/tmp/x/ssh',
+            '-o', 'ControlPersist=60',
+        ]
+        assert master.command == (
+            "ssh 'postgres@pg' '-o' 'ControlMaster=auto' "
+            "'-o' 'ControlPath=/tmp/x/ssh' '-o' 'ControlPersist=60'")
+
+        # A connection sharing already set up by the user is left untouched
+        master = command_wrappers.SshControlMaster(
+            'ssh -o ControlPath=/other postgres@pg',
+            control_path='/tmp/x/ssh')
+        assert not master.enabled
+        assert master.options == []
+        assert master.command == 'ssh -o ControlPath=/other postgres@pg'
+
+        # Without a control path the sharing is disabled
+        master = command_wrappers.SshControlMaster('ssh', ['postgres@pg'])
+        assert not master.enabled
+        assert master.options == ['postgres@pg']
+
+    def test_close(self, popen, pipe_processor_loop, tmpdir):
+        control_path = tmpdir.join('ssh')
+        master = command_wrappers.SshControlMaster(
+            'ssh postgres@pg', control_path=control_path.strpath)
+
+        # No master connection has been opened, nothing to do
+        master.close()
+        assert not popen.called
+
+        control_path.write('')
+        _mock_pipe(popen, pipe_processor_loop)
+        master.close()
+        popen.assert_called_with(
+            "ssh postgres@pg '-o' 'ControlMaster=auto' "
+            "'-o' 'ControlPath=%s' '-o' 'ControlPersist=60' '-O' 'exit'" %
+            control_path.strpath,
+            shell=True, env=None,
+            stdout=PIPE, stderr=PIPE, stdin=PIPE,
+            preexec_fn=mock.ANY, close_fds=True
+        )
+
+
 class TestPgBaseBackup(object):
     """
     Simple class for testing of the PgBaseBackup obj
@@ -940,6 +1028,27 @@ class TestPgBaseBackup(object):
         assert pg_basebackup.err_handler
         assert pg_basebackup.out_handler
 
+    def test_init_compression(self):
+        """
+        Test that a compressed backup is taken in tar format
+        """
+        connection_mock = mock.MagicMock()
+        connection_mock.get_connection_string.return_value = 'test_connstring'
+        pg_basebackup = command_wrappers.PgBaseBackup(
+            command='/path/to/pg_basebackup',
+            connection=connection_mock,
+            version='9.4',
+            destination='/dest/dir',
+            compression='gzip')
+        assert pg_basebackup.args == [
+            "--dbname=test_connstring",
+            "-v",
+            "--no-password",
+            "--pgdata=/dest/dir",
+            "--format=tar",
+            "--gzip",
+        ]
+
     def test_pg_basebackup10_no_wals(self):
         """
         Test that --no-slot and --wal-method options are correctly passed
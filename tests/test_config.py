@@ -154,6 +154,8 @@ class TestConfig(object):
             'streaming_conninfo': 'host=web01 user=postgres port=5432',
             'streaming_wals_directory': '/some/barman/home/web/streaming',
             'errors_directory': '/some/barman/home/web/errors',
+            'deduplication_directory': '/some/barman/home/web/objects',
+            'trash_directory': '/some/barman/home/web/trash',
             'max_incoming_wals_queue': None,
         })
         assert web.__dict__ == expected
@@ -248,7 +250,7 @@ class TestConfig(object):
         # after _populate_servers() if there is a global paths error
         # servers_msg_list is created in configuration
         assert c.servers_msg_list
-        assert len(c.servers_msg_list) == 6
+        assert len(c.servers_msg_list) == 7
 
     def test_populate_servers_following_symlink(self, tmpdir):
         """
@@ -281,6 +283,79 @@ class TestConfig(object):
                 symlink += 1
         assert symlink == 1
 
+    def test_config_cache(self, tmpdir):
+        """
+        Test the cache of the configuration files
+        """
+        home = tmpdir.mkdir('home')
+        conf_d = tmpdir.mkdir('conf.d')
+        config_file = tmpdir.join('barman.conf')
+        config_file.write(
+            '[barman]\n'
+            'barman_home = %s\n'
+            'barman_user = barman\n'
+            'configuration_files_directory = %s\n' % (
+                home.strpath, conf_d.strpath))
+        conf_d.join('main.conf').write(
+            '[main]\n'
+            'description = Main\n'
+            'backup_directory = %(dir)s\n'
+            'wals_directory = %(dir)s\n' % {'dir': tmpdir.join('main')})
+        conf_d.join('other.conf').write('[other]\ndescription = Other\n')
+        # Files modified too recently are not cached
+        old = 1500000000
+        for path in (config_file, conf_d.join('main.conf'),
+                     conf_d.join('other.conf')):
+            path.setmtime(old)
+        cache_file = home.join(Config.CONFIG_CACHE_FILE)
+
+        def load():
+            config = Config(config_file.strpath)
+            config.load_configuration_files_directory()
+            return config
+
+        c = load()
+        assert sorted(c.server_names()) == ['main', 'other']
+        assert cache_file.check()
+        assert c.get_server('main').disabled
+
+        # The cache is used, building only the requested server
+        with patch('barman.config.ServerConfig') as server_mock:
+            c = load()
+            assert sorted(c.server_names()) == ['main', 'other']
+            server = c.get_server('main')
+            assert c.get_server('missing') is None
+        server_mock.assert_called_once_with(c, 'main')
+        assert server.disabled
+        assert len(server.msg_list.extend.call_args[0][0]) == 1
+        assert c._servers is None
+        c = load()
+        assert c.get_server('other').description == 'Other'
+
+        # A change in a file invalidates the cache
+        conf_d.join('other.conf').write('[other]\ndescription = Changed\n')
+        conf_d.join('other.conf').setmtime(old)
+        c = load()
+        assert c._cached_conflicts is None
+        assert c.get_server('other').description == 'Changed'
+        c = load()
+        assert c._cached_conflicts is not None
+        assert c.get_server('other').description == 'Changed'
+
+        # A recently modified file disables the cache
+        cache_file.remove()
+        conf_d.join('other.conf').setmtime()
+        c = load()
+        assert c.get_server('other').description == 'Changed'
+        assert not cache_file.check()
+
+        # A broken cache is ignored
+        conf_d.join('other.conf').setmtime(old)
+        cache_file.write('broken')
+        c = load()
+        assert c.get_server('other').description == 'Changed'
+        assert load()._cached_conflicts is not None
+
 
 # noinspection PyMethodMayBeStatic
 class TestCsvParsing(object):
@@ -15,18 +15,26 @@
 # You should have received a copy of the GNU General Public License
 # along with Barman.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
 import multiprocessing.dummy
 import os
-from datetime import datetime
+import tarfile
+from contextlib import closing
+from datetime import datetime, timedelta
 
 import dateutil.tz
 import mock
+import psycopg2
 import pytest
 from mock import patch
 
-from barman.copy_controller import (BUCKET_SIZE, RsyncCopyController,
-                                    _FileItem, _RsyncCopyItem)
-from barman.exceptions import CommandFailedException, RsyncListFilesFailure
+from barman.copy_controller import (BUCKET_SIZE, LocalCopyController,
+                                    PostgresCopyController,
+                                    RsyncCopyController, TarExtractController,
+                                    _FileItem, _read_server_file,
+                                    _RsyncCopyItem, _RsyncJob, clone_file)
+from barman.exceptions import (CommandFailedException, DataTransferFailure,
+                               RsyncListFilesFailure)
 from testing_helpers import (build_backup_manager, build_real_server,
                              build_test_backup_info)
 
@@ -192,6 +200,9 @@ class TestRsyncCopyController(object):
             optional=False)
         rcc.copy()
 
+        # All the rsync processes share the same ssh connection
+        control_path = tempdir.join('ssh').strpath
+
         # Check the order of calls to the Rsync mock
         assert rsync_mock.mock_calls == [
             mock.call(network_compression=False,
@@ -201,7 +212,10 @@ class TestRsyncCopyController(object):
                       ssh_options=['-c', '"arcfour"', '-p', '22',
                                    'postgres@pg01.nowhere', '-o',
                                    'BatchMode=yes', '-o',
-                                   'StrictHostKeyChecking=no'],
+                                   'StrictHostKeyChecking=no',
+                                   '-o', 'ControlMaster=auto',
+                                   '-o', 'ControlPath=%s' % control_path,
+                                   '-o', 'ControlPersist=60'],
                       exclude=None, exclude_and_protect=None, include=None,
                       retry_sleep=0, retry_times=0, retry_handler=mock.ANY),
             mock.call(network_compression=False,
@@ -211,7 +225,10 @@ class TestRsyncCopyController(object):
                       ssh_options=['-c', '"arcfour"', '-p', '22',
                                    'postgres@pg01.nowhere', '-o',
                                    'BatchMode=yes', '-o',
-                                   'StrictHostKeyChecking=no'],
+                                   'StrictHostKeyChecking=no',
+                                   '-o', 'ControlMaster=auto',
+                                   '-o', 'ControlPath=%s' % control_path,
+                                   '-o', 'ControlPersist=60'],
                       exclude=None, exclude_and_protect=None, include=None,
                       retry_sleep=0, retry_times=0, retry_handler=mock.ANY),
             mock.call(network_compression=False,
@@ -221,7 +238,10 @@ class TestRsyncCopyController(object):
                       ssh_options=['-c', '"arcfour"', '-p', '22',
                                    'postgres@pg01.nowhere', '-o',
                                    'BatchMode=yes', '-o',
-                                   'StrictHostKeyChecking=no'],
+                                   'StrictHostKeyChecking=no',
+                                   '-o', 'ControlMaster=auto',
+                                   '-o', 'ControlPath=%s' % control_path,
+                                   '-o', 'ControlPersist=60'],
                       exclude=[
                           '/pg_xlog/*',
                           '/pg_log/*',
@@ -239,7 +259,10 @@ class TestRsyncCopyController(object):
                       ssh_options=['-c', '"arcfour"', '-p', '22',
                                    'postgres@pg01.nowhere', '-o',
                                    'BatchMode=yes', '-o',
-                                   'StrictHostKeyChecking=no'],
+                                   'StrictHostKeyChecking=no',
+                                   '-o', 'ControlMaster=auto',
+                                   '-o', 'ControlPath=%s' % control_path,
+                                   '-o', 'ControlPersist=60'],
                       exclude=None, exclude_and_protect=None, include=None,
                       retry_sleep=0, retry_times=0, retry_handler=mock.ANY),
             mock.call()(
@@ -253,7 +276,10 @@ class TestRsyncCopyController(object):
                       ssh_options=['-c', '"arcfour"', '-p', '22',
                                    'postgres@pg01.nowhere', '-o',
                                    'BatchMode=yes', '-o',
-                                   'StrictHostKeyChecking=no'],
+                                   'StrictHostKeyChecking=no',
+                                   '-o', 'ControlMaster=auto',
+                                   '-o', 'ControlPath=%s' % control_path,
+                                   '-o', 'ControlPersist=60'],
                       exclude=None, exclude_and_protect=None, include=None,
                       retry_sleep=0, retry_times=0, retry_handler=mock.ANY),
             mock.call()(
@@ -289,27 +315,33 @@ class TestRsyncCopyController(object):
             mock.call(
                 mock.ANY, ':/fake/location/',
                 backup_info.get_data_directory(16387), checksum=False,
-                file_list=file_list_name('tbs1', 'safe')),
+                file_list=file_list_name('tbs1', 'safe'),
+                out_handler=mock.ANY),
             mock.call(
                 mock.ANY, ':/fake/location/',
                 backup_info.get_data_directory(16387), checksum=True,
-                file_list=file_list_name('tbs1', 'check')),
+                file_list=file_list_name('tbs1', 'check'),
+                out_handler=mock.ANY),
             mock.call(
                 mock.ANY, ':/another/location/',
                 backup_info.get_data_directory(16405), checksum=False,
-                file_list=file_list_name('tbs2', 'safe')),
+                file_list=file_list_name('tbs2', 'safe'),
+                out_handler=mock.ANY),
             mock.call(
                 mock.ANY, ':/another/location/',
                 backup_info.get_data_directory(16405), checksum=True,
-                file_list=file_list_name('tbs2', 'check')),
+                file_list=file_list_name('tbs2', 'check'),
+                out_handler=mock.ANY),
             mock.call(
                 mock.ANY, ':/pg/data/',
                 backup_info.get_data_directory(), checksum=False,
-                file_list=file_list_name('pgdata', 'safe')),
+                file_list=file_list_name('pgdata', 'safe'),
+                out_handler=mock.ANY),
             mock.call(
                 mock.ANY, ':/pg/data/',
                 backup_info.get_data_directory(), checksum=True,
-                file_list=file_list_name('pgdata', 'check')),
+                file_list=file_list_name('pgdata', 'check'),
+                out_handler=mock.ANY),
         ]
 
     def test_list_files(self):
@@ -588,6 +620,198 @@ class TestRsyncCopyController(object):
         assert item.safe_list[2].path == 'tmp/diff_size'
         assert item.safe_list[3].path == 'tmp/new'
 
+    @patch('barman.copy_controller.RsyncCopyController._rsync_factory')
+    @patch('barman.copy_controller.RsyncCopyController._list_files')
+    def test_analyze_directory_resume(self, list_files_mock,
+                                      rsync_factory_mock, tmpdir):
+        """
+        Files already present in the destination directory (i.e. a resumed
+        copy) take precedence over the ones in the reference directory
+        """
+        def file_item(path, size, hour):
+            return _FileItem('-rw-r--r--', size,
+                             datetime(year=2015, month=2, day=20,
+                                      hour=hour, minute=15, second=33,
+                                      tzinfo=dateutil.tz.tzlocal()),
+                             path)
+
+        ref_list = [file_item('changed', 100, 20),
+                    file_item('copied', 100, 10)]
+        dst_list = [file_item('changed', 200, 20),
+                    file_item('copied', 100, 21)]
+        src_list = [file_item('changed', 100, 20),
+                    file_item('copied', 100, 21)]
+        list_files_mock.side_effect = [ref_list, dst_list, src_list]
+
+        rcc = RsyncCopyController(
+            reuse_backup='link',
+            safe_horizon=datetime(
+                year=2015, month=2, day=20,
+                hour=19, minute=0, second=0,
+                tzinfo=dateutil.tz.tzlocal()))
+        rcc.temp_dir = tmpdir.mkdir('tmp').strpath
+        dst = tmpdir.mkdir('dst')
+        dst.ensure('copied')
+        item = _RsyncCopyItem(
+            label='pgdata',
+            src=':/pg/data/',
+            dst=dst.strpath,
+            reuse='/reuse/dir',
+            is_directory=True,
+            item_class=rcc.PGDATA_CLASS)
+
+        rcc._analyze_directory(item)
+
+        assert list_files_mock.mock_calls == [
+            mock.call(rsync_factory_mock.return_value, '/reuse/dir/'),
+            mock.call(rsync_factory_mock.return_value, dst.strpath + '/'),
+            mock.call(rsync_factory_mock.return_value, ':/pg/data/')]
+        # The destination copy of 'changed' differs from the source,
+        # while the one of 'copied' must be verified with checksums
+        assert [entry.path for entry in item.safe_list] == ['changed']
+        assert [entry.path for entry in item.check_list] == ['copied']
+
+    def test_plan(self):
+        """
+        Test the serialisable representation of the copy plan
+        """
+        rcc = RsyncCopyController()
+        rcc.add_directory('pgdata', ':/pg/data/', '/dst/data',
+                          item_class=rcc.PGDATA_CLASS)
+        rcc.add_file('pg_control', ':/pg/data/global/pg_control',
+                     '/dst/data/global/pg_control',
+                     item_class=rcc.PGCONTROL_CLASS)
+        date = datetime(year=2015, month=2, day=20,
+                        tzinfo=dateutil.tz.tzutc())
+        rcc.item_list[0].safe_list = [
+            _FileItem('-rw-r--r--', 100, date, 'base/1')]
+        rcc.item_list[0].check_list = []
+        job = mock.Mock(item_idx=0, id=0, checksum=False)
+        rcc.jobs_done = [job]
+
+        # Only what is needed to resume the copy is saved
+        assert rcc.plan() == {
+            'items': [
+                {'dst': '/dst/data', 'is_directory': True},
+                {'dst': '/dst/data/global/pg_control',
+                 'is_directory': False},
+            ],
+            'jobs_done': 1,
+        }
+
+    def test_progress_handler(self):
+        """
+        Test the parsing of the itemized rsync output
+        """
+        rcc = RsyncCopyController()
+        rcc.progress_queue = mock.Mock()
+        job = _RsyncJob(0, 'description', id=0, checksum=False, file_list=[
+            _FileItem('-rw-------', 100, 'date', 'base/1/1234'),
+            _FileItem('-rw-------', 200, 'date', 'base/1/5678'),
+            _FileItem('-rw-------', 300, 'date', 'base/1/9999'),
+            _FileItem('-rw-------', 400, 'date', 'PG_VERSION'),
+        ])
+        assert job.total_size == 1000
+        job.copy_start_time = datetime.now()
+
+        handler = rcc._progress_handler(job)
+        handler('cd+++++++++ base/1/')
+        handler('>f+++++++++ base/1/1234')
+        handler('.f          base/1/5678')
+        handler('>f.st...... base/1/9999')
+        handler('hf          PG_VERSION => base/1/1234')
+        handler('Number of files: 4')
+
+        assert job.processed_files == 4
+        assert job.processed_size == 1000
+        assert job.copied_files == 2
+        assert job.copied_size == 400
+        # The progress is reported at most once per interval
+        assert rcc.progress_queue.put.call_count == 1
+        assert rcc.progress_queue.put.call_args[0][0]['copied_files'] == 1
+
+    def test_parse_stats(self):
+        """
+        Test the parsing of the rsync transfer summary
+        """
+        output = (
+            '>f+++++++++ base/1/1234\n'
+            'Number of files: 3 (reg: 2, dir: 1)\n'
+            'Total transferred file size: 2000 bytes\n'
+            'Total bytes sent: 1,234\n'
+            'Total bytes received: 5678\n'
+            '\n'
+            'sent 1,234 bytes  received 5678 bytes  13824.00 bytes/sec\n')
+        assert RsyncCopyController._parse_stats(output) == 6912
+        assert RsyncCopyController._parse_stats(None) == 0
+
+    def test_progress(self, tmpdir):
+        """
+        Test the progress of the copy
+        """
+        rcc = RsyncCopyController(
+            progress_file=tmpdir.join('progress.json').strpath)
+        rcc.add_directory('tbs1', ':/tbs1/', '/dst/tbs1')
+        rcc.add_directory('pgdata', ':/pg/data/', '/dst/data')
+        rcc.add_file('pg_control', ':/pg/data/global/pg_control',
+                     '/dst/data/global/pg_control')
+        rcc.item_list[0].safe_list = [
+            _FileItem('-rw-------', 1000, 'date', 'file1')]
+        rcc.item_list[0].check_list = [
+            _FileItem('-rw-------', 1000, 'date', 'file2')]
+        rcc.item_list[1].safe_list = [
+            _FileItem('-rw-------', 2000, 'date', 'file3')]
+        rcc.item_list[1].check_list = []
+        now = datetime.now()
+        rcc.copy_start_time = now - timedelta(seconds=20)
+
+        # Nothing has been copied yet
+        progress = rcc.progress()
+        assert progress['total_files'] == 3
+        assert progress['total_size'] == 4000
+        assert progress['processed_size'] == 0
+        assert progress['throughput'] is None
+        assert progress['estimated_end_time'] is None
+
+        # A finished job and a running one
+        job = _RsyncJob(0, 'description', id=0, checksum=False,
+                        file_list=rcc.item_list[0].safe_list)
+        job.copy_start_time = now - timedelta(seconds=10)
+        job.copied_files = 1
+        job.copied_size = 1000
+        job.transferred_size = 1100
+        rcc.jobs_done = [job]
+        rcc.running_jobs = {
+            (1, 0, False): {
+                'pid': 1234,
+                'item_idx': 1,
+                'id': 0,
+                'checksum': False,
+                'copy_start_time': now - timedelta(seconds=5),
+                'processed_files': 0,
+                'processed_size': 1000,
+                'copied_files': 0,
+                'copied_size': 1000,
+                'transferred_size': 0,
+            }
+        }
+        progress = rcc.progress()
+        assert progress['processed_size'] == 2000
+        assert progress['copied_size'] == 2000
+        assert progress['transferred_size'] == 1100
+        assert [item['processed_size'] for item in progress['items']] == \
+            [1000, 1000, 0]
+        assert len(progress['workers']) == 1
+        assert progress['workers'][0]['item'] == 'pgdata'
+        # 2000 bytes in about 10 seconds
+        assert 150 < progress['throughput'] < 250
+        assert progress['estimated_end_time'] > now.isoformat()
+
+        # The progress is written as JSON
+        rcc._write_progress()
+        with open(rcc.progress_file) as f:
+            assert json.load(f)['total_size'] == 4000
+
     @patch('barman.copy_controller.RsyncCopyController._rsync_factory')
     @patch('barman.copy_controller.RsyncCopyController.'
            '_rsync_ignore_vanished_files')
@@ -705,6 +929,7 @@ class TestRsyncCopyController(object):
             mock.call(rsync_mock, ':/pg/data/',
                       backup_info.get_data_directory(),
                       '--files-from=/path/to/file.list',
+                      '--stats', '--no-human-readable',
                       '--checksum', check=True),
         ]
 
@@ -718,6 +943,7 @@ class TestRsyncCopyController(object):
             mock.call(rsync_mock, ':/pg/data/',
                       backup_info.get_data_directory(),
                       '--files-from=/path/to/file.list',
+                      '--stats', '--no-human-readable',
                       check=True),
         ]
 
@@ -833,7 +1059,8 @@ class TestRsyncCopyController(object):
             network_compression=config.network_compression,
             reuse_backup=None,
             safe_horizon=None,
-            workers=workers)
+            workers=workers,
+            progress_file=tmpdir.join('progress.json').strpath)
 
         backup_info = build_test_backup_info(
             server=server,
@@ -902,6 +1129,9 @@ class TestRsyncCopyController(object):
         # Do the fake run
         rcc.copy()
 
+        # The progress file is removed at the end of the copy
+        assert not tmpdir.join('progress.json').check()
+
         # Calculate statistics
         result = rcc.statistics()
 
@@ -920,5 +1150,305 @@ class TestRsyncCopyController(object):
             assert result['copy_time_per_item'][tbs] > 0
             assert result['serialized_copy_time_per_item'][tbs] > 0
 
+        for tbs in ('pgdata', 'tbs1', 'tbs2'):
+            assert result['throughput_per_item'][tbs] > 0
+        assert result['copied_size'] == 0
+        assert result['transferred_size'] == 0
+
         assert result.get('number_of_workers') == rcc.workers
         assert result.get('total_time') > 0
+
+
+def test_clone_file(tmpdir):
+    """
+    Test the copy of a single file
+    """
+    src = tmpdir.join('src')
+    src.write('x' * 100000)
+    src.chmod(0o600)
+    os.utime(src.strpath, (1000000000, 1000000000))
+    dst = tmpdir.join('dst')
+
+    method = clone_file(src.strpath, dst.strpath)
+
+    assert method in ('reflink', 'copy_file_range', 'copy')
+    assert dst.read() == src.read()
+    assert dst.stat().mode == src.stat().mode
+    assert dst.stat().mtime == 1000000000
+
+
+# noinspection PyMethodMayBeStatic
+class TestLocalCopyController(object):
+    """
+    This class tests the methods of the LocalCopyController object
+    """
+
+    def test_is_excluded(self):
+        """
+        Unit test for the _is_excluded method
+        """
+        patterns = ['/pg_xlog/*', '/postmaster.pid', 'pgsql_tmp*']
+        assert LocalCopyController._is_excluded('/pg_xlog/0001', patterns)
+        assert not LocalCopyController._is_excluded('/pg_xlog', patterns)
+        assert LocalCopyController._is_excluded('/postmaster.pid', patterns)
+        assert not LocalCopyController._is_excluded(
+            '/base/postmaster.pid', patterns)
+        assert LocalCopyController._is_excluded(
+            '/base/pgsql_tmp123', patterns)
+        assert not LocalCopyController._is_excluded('/base/1234', patterns)
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_copy(self, workers, tmpdir):
+        """
+        Test the copy of a directory with exclusions
+        """
+        src = tmpdir.mkdir('src')
+        src.join('PG_VERSION').write('9.6')
+        src.join('postmaster.pid').write('1234')
+        src.mkdir('base').mkdir('1').join('1234').write('data')
+        xlog_dir = src.mkdir('pg_xlog')
+        xlog_dir.join('000000010000000000000001').write('wal')
+        src.mkdir('pg_tblspc').join('16387').write('tbs')
+        dst = tmpdir.join('dst')
+
+        lcc = LocalCopyController(workers=workers)
+        lcc.add_directory(
+            label='pgdata',
+            src=src.strpath + '/',
+            dst=dst.strpath,
+            exclude=['/pg_xlog/*', '/postmaster.pid'],
+            exclude_and_protect=['/pg_tblspc/16387'],
+            item_class=lcc.PGDATA_CLASS)
+        lcc.copy()
+
+        assert dst.join('PG_VERSION').read() == '9.6'
+        assert dst.join('base', '1', '1234').read() == 'data'
+        assert not dst.join('postmaster.pid').check()
+        assert dst.join('pg_xlog').check(dir=1)
+        assert dst.join('pg_xlog').listdir() == []
+        assert dst.join('pg_tblspc').listdir() == []
+        assert lcc.copy_start_time <= lcc.copy_end_time
+
+
+class TestTarExtractController(object):
+    """
+    This class tests the methods of the TarExtractController object
+    """
+
+    @pytest.mark.parametrize('workers', [1, 2])
+    def test_copy(self, workers, tmpdir):
+        """
+        Test the local extraction of the archives with exclusions
+        """
+        src = tmpdir.mkdir('src')
+        src.join('PG_VERSION').write('9.6')
+        src.join('postmaster.pid').write('1234')
+        src.mkdir('base').mkdir('1').join('1234').write('data')
+        src.mkdir('pg_xlog').join('000000010000000000000001').write('wal')
+        src.mkdir('pg_tblspc').join('16387').mksymlinkto('/fake/location')
+        tbs = tmpdir.mkdir('tbs')
+        tbs.mkdir('PG_9.6_201608131').join('1').write('tbs')
+        with closing(tarfile.open(tmpdir.join('base.tar.gz').strpath,
+                                  'w:gz')) as tar:
+            for name in src.listdir():
+                tar.add(name.strpath, name.basename)
+        with closing(tarfile.open(tmpdir.join('16387.tar.gz').strpath,
+                                  'w:gz')) as tar:
+            tar.add(tbs.join('PG_9.6_201608131').strpath,
+                    'PG_9.6_201608131')
+        dst = tmpdir.mkdir('dst')
+        tbs_dst = tmpdir.mkdir('tbs_dst')
+
+        tec = TarExtractController(workers=workers)
+        tec.add_archive(
+            label='tbs1',
+            src=tmpdir.join('16387.tar.gz').strpath,
+            dst=tbs_dst.strpath,
+            item_class=tec.TABLESPACE_CLASS)
+        tec.add_archive(
+            label='pgdata',
+            src=tmpdir.join('base.tar.gz').strpath,
+            dst=dst.strpath,
+            exclude=['/pg_xlog/*', '/postmaster.pid', '/pg_tblspc/16387'],
+            item_class=tec.PGDATA_CLASS)
+        tec.copy()
+
+        assert dst.join('PG_VERSION').read() == '9.6'
+        assert dst.join('base', '1', '1234').read() == 'data'
+        assert not dst.join('postmaster.pid').check()
+        assert dst.join('pg_xlog').check(dir=1)
+        assert dst.join('pg_xlog').listdir() == []
+        assert dst.join('pg_tblspc').listdir() == []
+        assert tbs_dst.join('PG_9.6_201608131', '1').read() == 'tbs'
+        assert tec.copy_start_time <= tec.copy_end_time
+
+    @patch('barman.copy_controller.Command')
+    def test_copy_remote(self, command_mock, tmpdir):
+        """
+        Test the extraction of an archive on a remote host
+        """
+        archive = tmpdir.join('base.tar.gz').ensure()
+        tec = TarExtractController(path='/test/bin',
+                                   ssh_command='ssh postgres@pg')
+        tec.add_archive(label='pgdata', src=archive.strpath, dst='/pgdata',
+                        exclude=['/pg_xlog/*', 'pgsql_tmp*'])
+        tec.copy()
+
+        command_mock.assert_called_once_with(
+            'ssh postgres@pg', shell=True, path='/test/bin', check=True)
+        args, kwargs = command_mock.return_value.call_args
+        assert args == (
+            "tar '--extract' '--gzip' '--file=-' '--preserve-permissions' "
+            "'--directory=/pgdata' '--exclude=pgsql_tmp*' '--anchored' "
+            "'--exclude=pg_xlog/*'",)
+        assert kwargs['stdin'].name == archive.strpath
+
+        # A failure is reported to the caller
+        command_mock.return_value.side_effect = CommandFailedException(
+            dict(ret=2, out='', err='error'))
+        with pytest.raises(CommandFailedException):
+            tec.copy()
+
+
+class FakeServerCursor(object):
+    """
+    A cursor emulating the file access functions of PostgreSQL
+    on the local file system
+    """
+
+    def __init__(self):
+        self.result = None
+
+    def execute(self, query, params):
+        if 'pg_ls_dir' in query:
+            path = params['dir']
+            self.result = []
+            for name in sorted(os.listdir(path)):
+                st = os.stat(os.path.join(path, name))
+                self.result.append((name, st.st_size,
+                                    os.path.isdir(os.path.join(path, name)),
+                                    st.st_mtime))
+        elif 'pg_stat_file' in query:
+            if os.path.exists(params[0]):
+                st = os.stat(params[0])
+                self.result = [(st.st_size, st.st_mtime)]
+            else:
+                self.result = [(None, None)]
+        elif 'pg_read_binary_file' in query:
+            path, offset, length = params
+            if not os.path.exists(path):
+                self.result = [(None,)]
+            else:
+                with open(path, 'rb') as f:
+                    f.seek(offset)
+                    self.result = [(f.read(length),)]
+
+    def fetchone(self):
+        return self.result[0]
+
+    def fetchall(self):
+        return self.result
+
+
+class TestPostgresCopyController(object):
+    """
+    This class tests the methods of the PostgresCopyController object
+    """
+
+    @patch('barman.copy_controller.psycopg2')
+    def test_copy(self, psycopg2_mock, tmpdir):
+        """
+        Test the copy of a directory and of some files
+        """
+        psycopg2_mock.Error = psycopg2.Error
+        psycopg2_mock.connect.return_value.cursor.side_effect = \
+            FakeServerCursor
+        src = tmpdir.mkdir('src')
+        src.join('PG_VERSION').write('9.6')
+        src.join('postmaster.pid').write('1234')
+        src.mkdir('base').mkdir('1').join('1234').write('data')
+        src.mkdir('pg_xlog').join('000000010000000000000001').write('wal')
+        src.mkdir('pg_tblspc').mkdir('16387').join('PG_9.6').write('tbs')
+        src.mkdir('global').join('pg_control').write('control')
+        dst = tmpdir.join('dst')
+
+        pcc = PostgresCopyController('dbname=postgres')
+        pcc.add_directory(
+            label='pgdata',
+            src=src.strpath,
+            dst=dst.strpath,
+            exclude=['/pg_xlog/*', '/postmaster.pid', '/global/pg_control'],
+            exclude_and_protect=['pg_tblspc/16387'],
+            item_class=pcc.PGDATA_CLASS)
+        pcc.add_file(
+            label='pg_control',
+            src=src.join('global', 'pg_control').strpath,
+            dst=dst.join('global', 'pg_control').strpath,
+            item_class=pcc.PGCONTROL_CLASS)
+        pcc.add_file(
+            label='ident_file',
+            src=tmpdir.join('pg_ident.conf').strpath,
+            dst=dst.join('pg_ident.conf').strpath,
+            optional=True,
+            item_class=pcc.CONFIG_CLASS)
+        pcc.copy()
+
+        psycopg2_mock.connect.assert_called_with('dbname=postgres')
+        assert dst.join('PG_VERSION').read() == '9.6'
+        assert dst.join('base', '1', '1234').read() == 'data'
+        assert dst.join('global', 'pg_control').read() == 'control'
+        assert not dst.join('postmaster.pid').check()
+        assert dst.join('pg_xlog').listdir() == []
+        assert dst.join('pg_tblspc').listdir() == []
+        assert not dst.join('pg_ident.conf').check()
+        stats = pcc.statistics()
+        assert stats['copied_size'] == 14
+        assert stats['number_of_workers'] == 1
+
+        # A missing mandatory file is an error
+        pcc.add_file(
+            label='hba_file',
+            src=tmpdir.join('pg_hba.conf').strpath,
+            dst=dst.join('pg_hba.conf').strpath,
+            item_class=pcc.CONFIG_CLASS)
+        with pytest.raises(DataTransferFailure):
+            pcc.copy()
+
+    def test_read_server_file(self, tmpdir):
+        """
+        Test the chunked copy of a single file
+        """
+        src = tmpdir.join('src')
+        src.write('0123456789')
+        dst = tmpdir.join('dst')
+        with patch.object(PostgresCopyController, 'CHUNK_SIZE', 4):
+            cursor = mock.Mock(wraps=FakeServerCursor())
+            assert _read_server_file(cursor, src.strpath, dst.strpath) == 10
+            assert cursor.execute.call_count == 3
+            assert dst.read() == '0123456789'
+
+            # A file removed in the meantime is skipped
+            assert _read_server_file(
+                FakeServerCursor(), tmpdir.join('missing').strpath,
+                dst.strpath) == 0
+            assert not dst.check()
+
+    def test_make_jobs(self):
+        """
+        Test the split of the files in batches
+        """
+        pcc = PostgresCopyController('dbname=postgres', workers=2)
+        pcc.BATCH_FILES = 2
+        pcc.BATCH_SIZE = 100
+        jobs = pcc._make_jobs([
+            ('/a', '/dst/a', 10, 1),
+            ('/b', '/dst/b', 90, 2),
+            ('/c', '/dst/c', 20, 3),
+            ('/d', '/dst/d', 5, 4),
+            ('/e', '/dst/e', 1, 5),
+        ])
+        assert jobs == [
+            ('dbname=postgres', [('/b', '/dst/b', 2)]),
+            ('dbname=postgres', [('/c', '/dst/c', 3), ('/a', '/dst/a', 1)]),
+            ('dbname=postgres', [('/d', '/dst/d', 4), ('/e', '/dst/e', 5)]),
+        ]
@@ -0,0 +1,189 @@
+# Copyright (C) 2013-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+
+import mock
+
+from barman.dedup import ManifestEntry, ObjectStore
+
+MTIME = 1500000000
+
+
+def build_backup(tmpdir, backup_id, files):
+    """
+    Build a fake backup directory containing the given files
+
+    :param tmpdir: the base directory
+    :param str backup_id: the name of the backup directory
+    :param dict[str,str] files: a relative path -> content map
+    :return: the backup directory
+    """
+    backup_dir = tmpdir.join(backup_id)
+    backup_dir.ensure('backup.info').write('status=DONE')
+    for rel_path, content in files.items():
+        backup_dir.join(rel_path).write(content, ensure=True)
+        backup_dir.join(rel_path).setmtime(MTIME)
+    return backup_dir
+
+
+# noinspection PyMethodMayBeStatic
+class TestObjectStore(object):
+    """
+    Test the ObjectStore class
+    """
+
+    def test_object_path(self):
+        store = ObjectStore('/srv/objects')
+        assert store.object_path('abcdef') == '/srv/objects/ab/cdef'
+
+    def test_deduplicate(self, tmpdir):
+        """
+        Test the deduplication of two backups sharing some files
+        """
+        store = ObjectStore(tmpdir.join('objects').strpath)
+        backup1 = build_backup(tmpdir, 'backup1', {
+            'data/base/1/1234': 'template',
+            'data/base/2/1234': 'template',
+            'data/PG_VERSION': '9.6',
+            'data/empty': '',
+            '16387/PG_9.6/1/4567': 'tablespace',
+        })
+
+        shared = store.deduplicate(backup1.strpath)
+
+        # Only the duplicated file within the backup is shared
+        assert shared == (1, len('template'))
+        manifest = store.read_manifest(backup1.strpath)
+        assert sorted(manifest.keys()) == [
+            '16387/PG_9.6/1/4567',
+            'data/PG_VERSION',
+            'data/base/1/1234',
+            'data/base/2/1234',
+        ]
+        version_file = backup1.join('data/PG_VERSION')
+        key = store.file_digest(version_file.strpath)
+        assert manifest['data/PG_VERSION'] == ManifestEntry(
+            key, version_file.stat().mode & 0o7777, MTIME)
+        assert os.path.samefile(store.object_path(key),
+                                backup1.join('data/PG_VERSION').strpath)
+        assert os.path.samefile(backup1.join('data/base/1/1234').strpath,
+                                backup1.join('data/base/2/1234').strpath)
+        assert backup1.join('data/base/1/1234').read() == 'template'
+        # The metadata files are never deduplicated
+        assert backup1.join('backup.info').stat().nlink == 1
+        assert backup1.join('data/empty').stat().nlink == 1
+
+        # The second backup shares the unchanged files with the first one
+        backup2 = build_backup(tmpdir, 'backup2', {
+            'data/base/1/1234': 'template',
+            'data/PG_VERSION': '10',
+        })
+        # A file hard linked to the previous backup, as reuse_backup = link
+        backup2.ensure('16387/PG_9.6/1', dir=True)
+        os.link(backup1.join('16387/PG_9.6/1/4567').strpath,
+                backup2.join('16387/PG_9.6/1/4567').strpath)
+
+        with mock.patch.object(ObjectStore, 'file_digest',
+                               side_effect=ObjectStore.file_digest) \
+                as digest_mock:
+            shared = store.deduplicate(backup2.strpath, backup1.strpath)
+        assert shared == (2, len('template') + len('tablespace'))
+        # The linked file has not been hashed again
+        assert digest_mock.call_count == 2
+        assert os.path.samefile(backup1.join('data/base/1/1234').strpath,
+                                backup2.join('data/base/1/1234').strpath)
+        assert not os.path.samefile(backup1.join('data/PG_VERSION').strpath,
+                                    backup2.join('data/PG_VERSION').strpath)
+
+    def test_deduplicate_attributes(self, tmpdir):
+        """
+        Test that the files with the same content are shared even if they
+        have different permissions or modification time, as within the
+        backups of different servers, and that their attributes are saved
+        in the manifest
+        """
+        store = ObjectStore(tmpdir.join('objects').strpath)
+        backup1 = build_backup(tmpdir, 'backup1', {
+            'data/base/1/1234': 'template',
+            'data/PG_VERSION': '9.6',
+        })
+        backup1.join('data/PG_VERSION').chmod(0o644)
+        store.deduplicate(backup1.strpath)
+
+        # Same content, touched after the first backup
+        backup2 = build_backup(tmpdir, 'backup2', {
+            'data/base/16384/1234': 'template',
+            'data/PG_VERSION': '9.6',
+        })
+        backup2.join('data/base/16384/1234').setmtime(MTIME + 60)
+        backup2.join('data/PG_VERSION').chmod(0o600)
+
+        shared = store.deduplicate(backup2.strpath, backup1.strpath)
+        assert shared == (2, len('template') + len('9.6'))
+        assert os.path.samefile(backup1.join('data/base/1/1234').strpath,
+                                backup2.join('data/base/16384/1234').strpath)
+        assert os.path.samefile(backup1.join('data/PG_VERSION').strpath,
+                                backup2.join('data/PG_VERSION').strpath)
+        manifest = store.read_manifest(backup2.strpath)
+        assert manifest['data/base/16384/1234'].mtime == MTIME + 60
+        assert manifest['data/PG_VERSION'].mode == 0o600
+
+        # The objects keep the attributes of the first backup, so only
+        # the second one has files to fix after a copy
+        assert store.changed_attributes(backup1.strpath) == []
+        assert store.changed_attributes(backup2.strpath) == [
+            ('data/PG_VERSION', 0o600, MTIME),
+            ('data/base/16384/1234',
+             manifest['data/base/16384/1234'].mode, MTIME + 60),
+        ]
+
+    def test_release(self, tmpdir):
+        """
+        Test the removal of the objects no longer used by any backup
+        """
+        store = ObjectStore(tmpdir.join('objects').strpath)
+        backup1 = build_backup(tmpdir, 'backup1', {
+            'data/shared': 'shared',
+            'data/unique': 'unique',
+        })
+        backup2 = build_backup(tmpdir, 'backup2', {
+            'data/shared': 'shared',
+        })
+        store.deduplicate(backup1.strpath)
+        store.deduplicate(backup2.strpath)
+        shared_object = store.object_path(
+            store.read_manifest(backup1.strpath)['data/shared'].key)
+        unique_object = store.object_path(
+            store.read_manifest(backup1.strpath)['data/unique'].key)
+
+        # Delete the data of the first backup
+        backup1.join('data').remove()
+        assert store.release(backup1.strpath) == 1
+        assert not os.path.exists(unique_object)
+        assert os.path.exists(shared_object)
+
+        # Releasing twice is harmless
+        assert store.release(backup1.strpath) == 0
+
+        backup2.join('data').remove()
+        assert store.release(backup2.strpath) == 1
+        assert not os.path.exists(shared_object)
+
+        # A backup without manifest doesn't reference any object
+        assert store.release(tmpdir.mkdir('backup3').strpath) == 0
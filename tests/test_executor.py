@@ -16,15 +16,22 @@
 # along with Barman.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import errno
+import json
 import os
+import tarfile
+from contextlib import closing
 
 import mock
 import pytest
 from dateutil import tz
 from mock import Mock, patch
 
-from barman.backup_executor import PostgresBackupExecutor, RsyncBackupExecutor
+from barman.backup_executor import (ConcurrentBackupStrategy,
+                                    PostgresBackupExecutor,
+                                    RsyncBackupExecutor)
 from barman.config import BackupOptions
+from barman.copy_controller import _RsyncCopyItem
 from barman.exceptions import (CommandFailedException, DataTransferFailure,
                                FsOperationFailed, SshCommandException)
 from barman.infofile import BackupInfo, Tablespace
@@ -48,6 +55,17 @@ class TestRsyncBackupExecutor(object):
         server = build_mocked_server()
         backup_manager = Mock(server=server, config=server.config)
         assert RsyncBackupExecutor(backup_manager)
+        assert not server.config.disabled
+
+        # The backup_compression option disables the server
+        server = build_mocked_server(
+            global_conf={'backup_compression': 'gzip'})
+        backup_manager = Mock(server=server, config=server.config)
+        RsyncBackupExecutor(backup_manager)
+        assert server.config.disabled
+        assert server.config.msg_list == [
+            'backup_compression option is not supported by '
+            'rsync backup_method']
 
         # Test exception for the missing ssh_command
         with pytest.raises(SshCommandException):
@@ -148,7 +166,106 @@ class TestRsyncBackupExecutor(object):
         assert err == ''
         assert 'ssh: FAILED' in out
 
-    @patch("barman.backup.RsyncBackupExecutor.backup_copy")
+    @patch('barman.backup_executor.UnixRemoteCommand')
+    def test_shared_ssh_connection(self, command_mock):
+        """
+        Test that the remote commands share a single SSH connection
+        """
+        executor = build_backup_manager().executor
+        with executor.shared_ssh_connection() as ssh_master:
+            control_dir = os.path.dirname(ssh_master.control_path)
+            assert os.path.isdir(control_dir)
+            # Nested contexts reuse the same connection
+            with executor.shared_ssh_connection() as nested:
+                assert nested is ssh_master
+            assert executor.ssh_master is ssh_master
+            executor._remote_command()
+            command_mock.assert_called_once_with(
+                'ssh', ssh_master.options, path=executor.server.path)
+            assert 'ControlPath=%s' % ssh_master.control_path in \
+                ssh_master.options
+        assert executor.ssh_master is None
+        assert not os.path.exists(control_dir)
+
+        # The ssh checks use the shared connection
+        command_mock.reset_mock()
+        command_mock.return_value.get_last_output.return_value = ('', '')
+        executor.check(Mock())
+        ssh_options = command_mock.call_args[0][1]
+        assert any(option.startswith('ControlPath=')
+                   for option in ssh_options)
+
+        # The copy of the backup too
+        copy_masters = []
+        with patch.object(executor, 'backup_copy',
+                          side_effect=lambda backup_info: copy_masters.append(
+                              executor.ssh_master)):
+            executor.strategy = Mock()
+            executor.backup(Mock(begin_wal=None,
+                                 copy_stats={'copy_time': 1}))
+        assert copy_masters[0] is not None
+        assert executor.ssh_master is None
+
+    @patch('barman.backup_executor.output')
+    @patch('barman.backup_executor.UnixRemoteCommand')
+    def test_copy_progress(self, command_mock, output_mock, tmpdir):
+        """
+        Test the report of the progress of a running copy
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.strpath
+        })
+        executor = backup_manager.executor
+        command_mock.return_value.get_last_output.return_value = ('', '')
+        backup_info = build_test_backup_info(
+            backup_id='20170101T000000',
+            server=backup_manager.server,
+            status=BackupInfo.STARTED)
+        backup_info.save()
+        backup_manager._backup_cache = None
+
+        # No copy is running
+        assert executor.get_copy_progress() == (None, None)
+        executor.status()
+        assert not any(call[1][2] == 'copy_progress'
+                       for call in output_mock.result.mock_calls)
+
+        progress = {
+            'pid': os.getpid(),
+            'total_size': 4 * 1024 * 1024,
+            'processed_size': 1024 * 1024,
+            'throughput': 1024,
+            'estimated_end_time': '2017-01-01T01:00:00',
+        }
+        progress_file = os.path.join(backup_info.get_basebackup_directory(),
+                                     RsyncBackupExecutor.COPY_PROGRESS_FILE)
+        with open(progress_file, 'w') as f:
+            json.dump(progress, f)
+        copy_backup, copy_progress = executor.get_copy_progress()
+        assert copy_backup.backup_id == backup_info.backup_id
+        assert copy_progress == progress
+
+        executor.status()
+        output_mock.result.assert_called_with(
+            'status', 'main', 'copy_progress', 'Backup copy in progress',
+            '20170101T000000: 25.00% (1.0 MiB of 4.0 MiB), 1.0 KiB/s, '
+            'estimated end Sun Jan  1 01:00:00 2017')
+
+        check_strategy = mock.Mock()
+        executor.check(check_strategy)
+        check_strategy.init_check.assert_called_with('backup copy')
+        check_strategy.result.assert_called_with('main', True, hint=mock.ANY)
+
+        # The process which was copying the backup has been killed
+        with patch('os.kill') as kill_mock:
+            kill_mock.side_effect = OSError(errno.ESRCH, 'No such process')
+            executor.check(check_strategy)
+        check_strategy.result.assert_called_with(
+            'main', False,
+            hint='copy of backup 20170101T000000 interrupted '
+                 '(process %s is not running)' % os.getpid())
+
+    @patch("barman.backup_executor.RsyncBackupExecutor.backup_copy")
     @patch("barman.backup.BackupManager.get_previous_backup")
     @patch("barman.backup.BackupManager.remove_wal_before_backup")
     def test_backup(self, rwbb_mock, gpb_mock, backup_copy_mock,
@@ -269,7 +386,11 @@ class TestRsyncBackupExecutor(object):
                                    'postgres@pg01.nowhere', '-o',
                                    'BatchMode=yes', '-o',
                                    'StrictHostKeyChecking=no'],
-                      retry_sleep=30, retry_times=0, workers=1),
+                      ssh_master=None,
+                      retry_sleep=30, retry_times=0, workers=1,
+                      progress_file=os.path.join(
+                          backup_info.get_basebackup_directory(),
+                          RsyncBackupExecutor.COPY_PROGRESS_FILE)),
             mock.call().add_directory(
                 label='tbs1',
                 src=':/fake/location/',
@@ -313,6 +434,105 @@ class TestRsyncBackupExecutor(object):
             mock.call().statistics(),
         ]
 
+    @patch('barman.backup_executor.RsyncCopyController')
+    def test_backup_copy_save_plan(self, rsync_mock, tmpdir):
+        """
+        Test that the copy plan is saved when the copy fails
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.mkdir('home').strpath
+        })
+        backup_manager.server.postgres.server_major_version = '9.6'
+        backup_info = build_test_backup_info(
+            server=backup_manager.server,
+            pgdata="/pg/data",
+            tablespaces=[])
+        backup_info.save()
+        rsync_mock.return_value.item_list = []
+        rsync_mock.return_value.plan.return_value = {'items': [],
+                                                     'jobs_done': 0}
+        rsync_mock.return_value.copy.side_effect = CommandFailedException(
+            dict(ret=1, out='', err='error'))
+
+        with pytest.raises(DataTransferFailure):
+            backup_manager.executor.backup_copy(backup_info)
+
+        plan_file = os.path.join(backup_info.get_basebackup_directory(),
+                                 RsyncBackupExecutor.COPY_PLAN_FILE)
+        with open(plan_file) as f:
+            assert json.load(f) == {'items': [], 'jobs_done': 0,
+                                    'pgdata': '/pg/data'}
+
+    @patch('barman.backup_executor.RsyncCopyController')
+    def test_backup_copy_resume(self, rsync_mock, tmpdir):
+        """
+        Test the resume of the copy of a failed backup
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.mkdir('home').strpath
+        })
+        backup_manager.server.postgres.server_major_version = '9.6'
+        begin_time = datetime.datetime(2017, 1, 1, tzinfo=tz.tzlocal())
+        failed_backup = build_test_backup_info(
+            backup_id='20170101T000000',
+            server=backup_manager.server,
+            pgdata="/pg/data",
+            begin_time=begin_time,
+            status=BackupInfo.FAILED,
+            tablespaces=[])
+        failed_backup.save()
+        failed_data = failed_backup.get_data_directory()
+        os.makedirs(os.path.join(failed_data, 'base'))
+        open(os.path.join(failed_data, 'base', '1'), 'w').close()
+        # A file hard linked to a previous backup
+        open(tmpdir.join('linked').strpath, 'w').close()
+        os.link(tmpdir.join('linked').strpath,
+                os.path.join(failed_data, 'base', '2'))
+        plan_file = os.path.join(failed_backup.get_basebackup_directory(),
+                                 RsyncBackupExecutor.COPY_PLAN_FILE)
+        with open(plan_file, 'w') as f:
+            json.dump({'pgdata': '/pg/data',
+                       'items': [{'dst': failed_data,
+                                  'is_directory': True}],
+                       'jobs_done': 3}, f)
+        backup_info = build_test_backup_info(
+            backup_id='20170102T000000',
+            server=backup_manager.server,
+            pgdata="/pg/data",
+            status=BackupInfo.STARTED,
+            tablespaces=[])
+        backup_info.save()
+        backup_manager._backup_cache = None
+
+        controller = rsync_mock.return_value
+        controller.safe_horizon = None
+        controller.item_list = [
+            _RsyncCopyItem('pgdata', ':/pg/data/',
+                           backup_info.get_data_directory(),
+                           is_directory=True),
+        ]
+        backup_manager.executor.backup_copy(backup_info)
+
+        # The data has been moved inside the new backup
+        assert os.path.exists(os.path.join(
+            backup_info.get_data_directory(), 'base', '1'))
+        assert not os.path.exists(os.path.join(
+            backup_info.get_data_directory(), 'base', '2'))
+        assert tmpdir.join('linked').check()
+        assert not os.path.exists(failed_data)
+        assert not os.path.exists(plan_file)
+        assert controller.safe_horizon == begin_time
+
+        # A different PGDATA is not resumed
+        backup_info.pgdata = '/another/pgdata'
+        with open(plan_file, 'w') as f:
+            json.dump({'pgdata': '/pg/data', 'items': [],
+                       'jobs_done': 0}, f)
+        controller.safe_horizon = None
+        backup_manager.executor.backup_copy(backup_info)
+        assert os.path.exists(plan_file)
+        assert controller.safe_horizon is None
+
     @patch('barman.backup_executor.RsyncCopyController')
     def test_backup_copy_with_included_files(self, rsync_moc, tmpdir, capsys):
         backup_manager = build_backup_manager(global_conf={
@@ -673,6 +893,23 @@ class TestPostgresBackupExecutor(object):
         assert executor.strategy
         assert server.config.disabled
 
+        # A parallel copy uses the concurrent backup API
+        server = build_mocked_server(
+            global_conf={'backup_method': 'postgres',
+                         'postgres_backup_jobs': 4})
+        executor = PostgresBackupExecutor(server.backup_manager)
+        assert isinstance(executor.strategy, ConcurrentBackupStrategy)
+        assert executor.mode == 'postgres-concurrent'
+        assert not server.config.disabled
+
+        # Expect an error if a parallel copy is compressed
+        server = build_mocked_server(
+            global_conf={'backup_method': 'postgres',
+                         'postgres_backup_jobs': 4,
+                         'backup_compression': 'gzip'})
+        executor = PostgresBackupExecutor(server.backup_manager)
+        assert server.config.disabled
+
     @patch(
         "barman.backup_executor.PostgresBackupExecutor.backup_copy")
     @patch("barman.backup.BackupManager.get_previous_backup")
@@ -737,6 +974,189 @@ class TestPostgresBackupExecutor(object):
             pbc_mock.side_effect = CommandFailedException('test')
             backup_manager.executor.backup(backup_info)
 
+    @patch("barman.backup_executor.PostgresBackupExecutor.backup_copy")
+    def test_parallel_backup_stop_on_failure(self, pbc_mock, tmpdir):
+        """
+        Test that a parallel backup, started through the concurrent
+        backup API, is always stopped
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.strpath,
+            'backup_method': 'postgres',
+            'postgres_backup_jobs': 4,
+        })
+        executor = backup_manager.executor
+        executor.strategy = Mock()
+        backup_info = build_test_backup_info(
+            server=backup_manager.server,
+            begin_wal=None)
+
+        pbc_mock.side_effect = CommandFailedException('test')
+        with pytest.raises(CommandFailedException):
+            executor.backup(backup_info)
+        executor.strategy.start_backup.assert_called_once_with(backup_info)
+        executor.strategy.stop_backup.assert_called_once_with(backup_info)
+
+        # The backup is not stopped if it hasn't been started
+        executor.strategy.reset_mock()
+        executor.strategy.start_backup.side_effect = \
+            CommandFailedException('test')
+        with pytest.raises(CommandFailedException):
+            executor.backup(backup_info)
+        assert not executor.strategy.stop_backup.called
+
+    def test_backup_label_from_archive(self, tmpdir):
+        """
+        Test that the backup_label of a compressed backup is read from
+        the archive of the data directory
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.strpath,
+            'backup_method': 'postgres'
+        })
+        backup_info = build_test_backup_info(
+            backup_id='fake_backup_id',
+            server=backup_manager.server)
+        backup_info.compression = 'gzip'
+        content = tmpdir.mkdir('content')
+        label = ('START WAL LOCATION: 0/40000028 '
+                 '(file 000000010000000000000040)\n'
+                 'CHECKPOINT LOCATION: 0/40000028\n'
+                 'START TIME: 2017-10-26 14:38:00 CET\n')
+        content.join('backup_label').write(label)
+        content.join('PG_VERSION').write('9.6')
+        archive = backup_info.get_archive_file()
+        os.makedirs(os.path.dirname(archive))
+        with closing(tarfile.open(archive, 'w:gz')) as tar:
+            tar.add(content.join('backup_label').strpath, 'backup_label')
+            tar.add(content.join('PG_VERSION').strpath, 'PG_VERSION')
+
+        strategy = backup_manager.executor.strategy
+        strategy._backup_info_from_backup_label(backup_info)
+        assert backup_info.backup_label == label
+        assert backup_info.begin_wal == '000000010000000000000040'
+        assert backup_info.begin_xlog == '0/40000028'
+
+        # A missing backup_label is an error
+        with pytest.raises(ValueError):
+            strategy._read_archive_member(archive, 'missing')
+
+    @patch("barman.backup_executor.PostgresCopyController")
+    def test_parallel_backup_copy(self, controller_mock, tmpdir):
+        """
+        Test the copy of a backup through parallel connections
+
+        :param controller_mock: mock for the PostgresCopyController object
+        :param tmpdir: pytest temp directory
+        """
+        backup_manager = build_backup_manager(global_conf={
+            'barman_home': tmpdir.mkdir('home').strpath,
+            'backup_method': 'postgres',
+            'postgres_backup_jobs': 4,
+        })
+        postgres_mock = backup_manager.server.postgres
+        postgres_mock.server_major_version = '9.6'
+        postgres_mock.get_connection_string.return_value = 'dbname=postgres'
+        controller_mock.return_value.statistics.return_value = {
+            'copy_time': 10}
+        backup_info = build_test_backup_info(
+            server=backup_manager.server,
+            pgdata="/pg/data",
+            config_file="/etc/postgresql.conf",
+            hba_file="/pg/data/pg_hba.conf",
+            ident_file="/pg/data/pg_ident.conf")
+
+        backup_manager.executor.backup_copy(backup_info)
+
+        controller = controller_mock.return_value
+        controller_mock.assert_called_once_with(conninfo='dbname=postgres',
+                                                workers=4)
+        assert controller.add_directory.mock_calls == [
+            mock.call(
+                label='tbs1',
+                src='/fake/location',
+                dst=backup_info.get_data_directory(16387),
+                exclude=['/*'] + RsyncBackupExecutor.EXCLUDE_LIST,
+                include=['/PG_9.6_*'],
+                item_class=controller.TABLESPACE_CLASS),
+            mock.call(
+                label='tbs2',
+                src='/another/location',
+                dst=backup_info.get_data_directory(16405),
+                exclude=['/*'] + RsyncBackupExecutor.EXCLUDE_LIST,
+                include=['/PG_9.6_*'],
+                item_class=controller.TABLESPACE_CLASS),
+            mock.call(
+                label='pgdata',
+                src='/pg/data',
+                dst=backup_info.get_data_directory(),
+                exclude=(RsyncBackupExecutor.PGDATA_EXCLUDE_LIST +
+                         RsyncBackupExecutor.EXCLUDE_LIST),
+                exclude_and_protect=['pg_tblspc/16387', 'pg_tblspc/16405'],
+                item_class=controller.PGDATA_CLASS),
+        ]
+        assert controller.add_file.mock_calls == [
+            mock.call(
+                label='pg_control',
+                src='/pg/data/global/pg_control',
+                dst='%s/global/pg_control' %
+                    backup_info.get_data_directory(),
+                item_class=controller.PGCONTROL_CLASS),
+            mock.call(
+                label='config_file',
+                src='/etc/postgresql.conf',
+                dst=os.path.join(backup_info.get_data_directory(),
+                                 'postgresql.conf'),
+                optional=False,
+                item_class=controller.CONFIG_CLASS),
+        ]
+        controller.copy.assert_called_once_with()
+        assert backup_info.copy_stats == {'copy_time': 10}
+        assert os.path.isdir(backup_info.get_data_directory(16387))
+        # The PostgreSQL connection is still used by the backup
+        assert not backup_manager.server.close.called
+
+    @patch("barman.backup_executor.PostgresBackupExecutor.get_remote_status")
+    def test_check_parallel(self, remote_status_mock):
+        """
+        Test the checks of a parallel backup
+
+        :param remote_status_mock: mock for the get_remote_status method
+        """
+        remote_status_mock.return_value = {
+            'pg_basebackup_compatible': True,
+            'pg_basebackup_installed': True,
+            'pg_basebackup_path': '/fake/path',
+            'pg_basebackup_bwlimit': True,
+            'pg_basebackup_version': '9.6',
+            'pg_basebackup_tbls_mapping': True,
+        }
+        backup_manager = build_backup_manager(global_conf={
+            'backup_method': 'postgres',
+            'postgres_backup_jobs': 2,
+        })
+        postgres_mock = backup_manager.server.postgres
+        postgres_mock.server_txt_version = '9.6.3'
+        postgres_mock.server_version = 90603
+        postgres_mock.is_superuser = True
+        check_strat = CheckStrategy()
+        backup_manager.executor.check(check_strategy=check_strat)
+        assert check_strat.has_error is False
+
+        # A superuser is required
+        postgres_mock.is_superuser = False
+        check_strat = CheckStrategy()
+        backup_manager.executor.check(check_strategy=check_strat)
+        assert check_strat.has_error is True
+
+        # PostgreSQL 9.5 or higher is required
+        postgres_mock.is_superuser = True
+        postgres_mock.server_txt_version = '9.4.12'
+        postgres_mock.server_version = 90412
+        check_strat = CheckStrategy()
+        backup_manager.executor.check(check_strategy=check_strat)
+        assert check_strat.has_error is True
+
     @patch("barman.backup_executor.PostgresBackupExecutor.get_remote_status")
     def test_check(self, remote_status_mock):
         """
@@ -905,6 +1325,7 @@ class TestPostgresBackupExecutor(object):
                 tbs_mapping=mock.ANY,
                 bwlimit=None,
                 immediate=False,
+                compression=None,
                 retry_times=0,
                 retry_sleep=30,
                 retry_handler=mock.ANY,
@@ -938,6 +1359,7 @@ class TestPostgresBackupExecutor(object):
                 tbs_mapping=mock.ANY,
                 bwlimit=1,
                 immediate=True,
+                compression=None,
                 retry_times=0,
                 retry_sleep=30,
                 retry_handler=mock.ANY,
@@ -968,6 +1390,7 @@ class TestPostgresBackupExecutor(object):
                 tbs_mapping=mock.ANY,
                 bwlimit=1,
                 immediate=True,
+                compression=None,
                 retry_times=0,
                 retry_sleep=30,
                 retry_handler=mock.ANY,
@@ -996,12 +1419,39 @@ class TestPostgresBackupExecutor(object):
                 tbs_mapping=mock.ANY,
                 bwlimit=1,
                 immediate=True,
+                compression=None,
+                retry_times=0,
+                retry_sleep=30,
+                retry_handler=mock.ANY,
+                path=mock.ANY),
+            mock.call()(),
+        ]
+
+        # Check a compressed backup: the tablespaces are not mapped,
+        # as they are stored in their own archives
+        remote_mock.reset_mock()
+        pg_basebackup_mock.reset_mock()
+        backup_manager.config.backup_compression = 'gzip'
+        backup_manager.executor.backup_copy(backup_info)
+        assert backup_info.compression == 'gzip'
+        assert pg_basebackup_mock.mock_calls == [
+            mock.call(
+                connection=mock.ANY,
+                version='9.5',
+                app_name='barman_streaming_backup',
+                destination=backup_info.get_data_directory(),
+                command='/fake/path',
+                tbs_mapping={},
+                bwlimit=1,
+                immediate=True,
+                compression='gzip',
                 retry_times=0,
                 retry_sleep=30,
                 retry_handler=mock.ANY,
                 path=mock.ANY),
             mock.call()(),
         ]
+        backup_manager.config.backup_compression = None
 
         # Raise a test CommandFailedException and expect it to be wrapped
         # inside a DataTransferFailure exception
@@ -25,6 +25,7 @@ from dateutil.tz import tzlocal, tzoffset
 
 from barman.infofile import (BackupInfo, Field, FieldListFile, WalFileInfo,
                              load_datetime_tz)
+from barman.wal_reader import WalIndex
 from testing_helpers import build_backup_manager, build_mocked_server
 
 BASE_BACKUP_INFO = """backup_label=None
@@ -313,6 +314,24 @@ class TestWalFileInfo(object):
 
         assert list(wfile_info.items()) == list(info_file.items())
 
+    def test_xlogdb_line_index(self):
+        """
+        Test the WAL index is stored as the last field of a xlogdb line
+        """
+        wfile_info = WalFileInfo(
+            name='000000010000000000000002', size=42, time=43,
+            compression='gzip',
+            index=WalIndex(1500000000.5, 1500000010.25, 1000, 1010,
+                           ('before upgrade',)))
+        line = wfile_info.to_xlogdb_line()
+        assert line == (
+            '000000010000000000000002\t42\t43\tgzip\t'
+            '[1500000000.5,1500000010.25,1000,1010,["before upgrade"]]\n')
+
+        info_file = WalFileInfo.from_xlogdb_line(line)
+        assert info_file.index == wfile_info.index
+        assert list(wfile_info.items()) == list(info_file.items())
+
     def test_timezone_aware_parser(self):
         """
         Test the timezone_aware_parser method with different string
@@ -569,6 +569,41 @@ class TestOutputAPI(object):
         assert exit_mock.call_count == 1
         assert exit_mock.call_args[0] != 0
 
+    def test_recording(self):
+        # preparation
+        writer = self._mock_writer()
+
+        recorder = output.start_recording()
+        assert isinstance(recorder, output.RecordingOutputWriter)
+        output.info('message %s', 'one')
+        output.init('check', 'main', True)
+        output.result('check', 'main', 'ssh', False, None)
+        output.error('error %(msg)s', {'msg': 'two'})
+        calls = output.stop_recording()
+
+        # Nothing has been sent to the writer
+        assert output._writer == writer
+        assert writer.mock_calls == []
+        # Simulate the replay in another process
+        output.error_occurred = False
+        assert calls == [
+            ('info', ('message one',), {}),
+            ('init_check', ('main', True), {}),
+            ('result_check', ('main', 'ssh', False, None), {}),
+            ('error_occurred', (), {}),
+            ('error', ('error two',), {}),
+        ]
+
+        output.replay(calls)
+        assert writer.mock_calls == [
+            mock.call.info('message one'),
+            mock.call.init_check('main', True),
+            mock.call.result_check('main', 'ssh', False, None),
+            mock.call.error_occurred(),
+            mock.call.error('error two'),
+        ]
+        assert output.error_occurred is True
+
 
 # noinspection PyMethodMayBeStatic
 class TestConsoleWriter(object):
@@ -28,7 +28,7 @@ from barman.exceptions import (PostgresConnectionError,
                                PostgresInvalidReplicationSlot,
                                PostgresIsInRecovery, PostgresSuperuserRequired,
                                PostgresUnsupportedFeature)
-from barman.postgres import PostgreSQLConnection
+from barman.postgres import PostgreSQLConnection, ReplicationSlot
 from barman.xlog import DEFAULT_XLOG_SEG_SIZE
 from testing_helpers import build_real_server
 
@@ -785,70 +785,67 @@ class TestPostgres(object):
         assert server.postgres.current_xlog_file_name is None
 
     @patch('barman.postgres.psycopg2.connect')
-    @patch('barman.postgres.PostgreSQLConnection.is_in_recovery',
-           new_callable=PropertyMock)
-    @patch('barman.postgres.PostgreSQLConnection.is_superuser',
-           new_callable=PropertyMock)
-    @patch('barman.postgres.PostgreSQLConnection.server_txt_version',
-           new_callable=PropertyMock)
-    @patch('barman.postgres.PostgreSQLConnection.has_pgespresso',
-           new_callable=PropertyMock)
-    @patch('barman.postgres.PostgreSQLConnection.current_xlog_file_name',
-           new_callable=PropertyMock)
-    @patch('barman.postgres.PostgreSQLConnection.current_size',
-           new_callable=PropertyMock)
-    @patch('barman.postgres.PostgreSQLConnection.get_configuration_files')
-    @patch('barman.postgres.PostgreSQLConnection.get_setting')
-    @patch('barman.postgres.'
-           'PostgreSQLConnection.get_synchronous_standby_names')
-    def test_get_remote_status(self,
-                               get_synchronous_standby_names,
-                               get_setting_mock,
-                               get_configuration_files_mock,
-                               current_size_mock,
-                               current_xlog_file_mock,
-                               has_pgespresso_mock,
-                               server_txt_version_mock,
-                               is_superuser_mock,
-                               is_in_recovery_mock,
-                               conn_mock):
+    def test_get_remote_status(self, conn_mock):
         """
         simple test for the fetch_remote_status method
         """
         # Build a server
         server = build_real_server()
-        current_xlog_file_mock.return_value = 'DE/ADBEEF'
-        current_size_mock.return_value = 497354072
-        has_pgespresso_mock.return_value = True
-        server_txt_version_mock.return_value = '9.1.0'
-        is_in_recovery_mock.return_value = False
-        is_superuser_mock.return_value = True
-        get_configuration_files_mock.return_value = {'a': 'b'}
-        get_setting_mock.return_value = 'dummy_setting'
-        get_synchronous_standby_names.return_value = []
         conn_mock.return_value.server_version = 90100
+        cursor_mock = conn_mock.return_value.cursor.return_value
+        cursor_mock.fetchone.return_value = {
+            'version': 'PostgreSQL 9.1.0 on x86_64-pc-linux-gnu',
+            'is_superuser': True,
+            'is_in_recovery': False,
+            'current_xlog': '000000010000000000000001',
+            'data_directory': '/pgdata',
+            'wal_level': 'hot_standby',
+            'current_size': 497354072,
+            'pgespresso_installed': True,
+            'config_file': '/pgdata/postgresql.conf',
+            'hba_file': '/pgdata/pg_hba.conf',
+            'ident_file': None,
+            'included_files': ['/pgdata/include.conf'],
+            'synchronous_standby_names': '2 (a, b)',
+            'archive_mode': 'on',
+            'archive_command': 'rsync %p barman:/incoming/%f',
+        }
 
         result = server.postgres.fetch_remote_status()
 
         assert result == {
-            'a': 'b',
+            'archive_mode': 'on',
+            'archive_command': 'rsync %p barman:/incoming/%f',
+            'config_file': '/pgdata/postgresql.conf',
+            'hba_file': '/pgdata/pg_hba.conf',
+            'included_files': ['/pgdata/include.conf'],
             'is_superuser': True,
             'is_in_recovery': False,
-            'current_xlog': 'DE/ADBEEF',
-            'data_directory': 'dummy_setting',
+            'current_xlog': '000000010000000000000001',
+            'data_directory': '/pgdata',
             'pgespresso_installed': True,
             'server_txt_version': '9.1.0',
-            'wal_level': 'dummy_setting',
+            'wal_level': 'hot_standby',
             'current_size': 497354072,
             'replication_slot_support': False,
             'replication_slot': None,
-            'synchronous_standby_names': [],
+            'synchronous_standby_names': ['a', 'b'],
         }
-
-        # Test error management
+        # Everything has been retrieved with a single query
+        assert cursor_mock.execute.call_count == 2
+        assert cursor_mock.execute.call_args_list[0] == call(
+            'SET application_name TO barman')
+        query = cursor_mock.execute.call_args[0][0]
+        assert 'pg_current_xlog_location()' in query
+        assert 'pg_replication_slots' not in query
+        assert 'pg_stat_archiver' not in query
+
+        # Error management
         server.postgres.close()
         conn_mock.side_effect = psycopg2.DatabaseError
         assert server.postgres.fetch_remote_status() == {
+            'archive_mode': None,
+            'archive_command': None,
             'is_superuser': None,
             'is_in_recovery': None,
             'current_xlog': None,
@@ -860,18 +857,169 @@ class TestPostgres(object):
             'synchronous_standby_names': None,
         }
 
-        get_setting_mock.side_effect = psycopg2.ProgrammingError
-        assert server.postgres.fetch_remote_status() == {
-            'is_superuser': None,
-            'is_in_recovery': None,
-            'current_xlog': None,
+    @patch('barman.postgres.psycopg2.connect')
+    def test_get_remote_status_fallback(self, conn_mock):
+        """
+        Test that a failure of the single query doesn't affect the
+        properties which can be retrieved separately
+        """
+        server = build_real_server(main_conf={'slot_name': 'test'})
+        postgres = server.postgres
+        conn_mock.return_value.server_version = 90600
+        cursor_mock = conn_mock.return_value.cursor.return_value
+        cursor_mock.execute.side_effect = [None, psycopg2.ProgrammingError]
+        settings = {'archive_mode': 'on', 'wal_level': 'replica',
+                    'synchronous_standby_names': 'a, b'}
+        with patch.multiple(
+                PostgreSQLConnection,
+                server_txt_version=PropertyMock(return_value='9.6.3'),
+                is_superuser=PropertyMock(return_value=False),
+                current_size=PropertyMock(return_value=None),
+                is_in_recovery=PropertyMock(return_value=False),
+                current_xlog_file_name=PropertyMock(
+                    return_value='000000010000000000000001'),
+                has_pgespresso=PropertyMock(return_value=False)), \
+                patch.object(postgres, 'get_setting',
+                             side_effect=settings.get), \
+                patch.object(postgres, 'get_configuration_files',
+                             return_value={'config_file': '/pg.conf'}), \
+                patch.object(postgres, 'get_archiver_stats',
+                             return_value={'archived_count': 5}), \
+                patch.object(postgres, 'get_replication_slot',
+                             side_effect=psycopg2.ProgrammingError):
+            result = postgres.fetch_remote_status()
+
+        conn_mock.return_value.rollback.assert_called_once_with()
+        # Only the failing properties are None
+        assert result == {
+            'archive_mode': 'on',
+            'archive_command': None,
+            'archived_count': 5,
+            'config_file': '/pg.conf',
+            'is_superuser': False,
+            'is_in_recovery': False,
+            'current_xlog': '000000010000000000000001',
             'data_directory': None,
-            'pgespresso_installed': None,
-            'server_txt_version': None,
-            'replication_slot_support': None,
+            'pgespresso_installed': False,
+            'server_txt_version': '9.6.3',
+            'wal_level': 'replica',
+            'current_size': None,
+            'replication_slot_support': True,
             'replication_slot': None,
-            'synchronous_standby_names': None,
+            'synchronous_standby_names': ['a', 'b'],
+        }
+
+    @patch('barman.postgres.psycopg2.connect')
+    def test_get_remote_status_slot(self, conn_mock):
+        """
+        Test fetch_remote_status on PostgreSQL 10 with a replication slot
+        """
+        # Build a non superuser server with a replication slot
+        server = build_real_server(main_conf={'slot_name': 'test'})
+        conn_mock.return_value.server_version = 100000
+        cursor_mock = conn_mock.return_value.cursor.return_value
+        cursor_mock.fetchone.return_value = {
+            'version': 'PostgreSQL 10.1 on x86_64-pc-linux-gnu',
+            'is_superuser': False,
+            'is_in_recovery': True,
+            'current_xlog': None,
+            'data_directory': None,
+            'wal_level': 'replica',
+            'current_size': None,
+            'pgespresso_installed': False,
+            'config_file': None,
+            'hba_file': None,
+            'ident_file': None,
+            'included_files': [],
+            'synchronous_standby_names': '',
+            'slot_name': 'test',
+            'slot_active': True,
+            'slot_restart_lsn': '0/3000000',
+            'archive_mode': 'off',
+            'archive_command': '(disabled)',
+            'archived_count': 0,
+            'last_archived_wal': None,
+            'last_archived_time': None,
+            'failed_count': 0,
+            'last_failed_wal': None,
+            'last_failed_time': None,
+            'stats_reset': None,
+            'is_archiving': False,
+            'current_archived_wals_per_second': None,
+        }
+
+        result = server.postgres.fetch_remote_status()
+
+        assert result == {
+            'archive_mode': 'off',
+            'archive_command': '(disabled)',
+            'archived_count': 0,
+            'last_archived_wal': None,
+            'last_archived_time': None,
+            'failed_count': 0,
+            'last_failed_wal': None,
+            'last_failed_time': None,
+            'stats_reset': None,
+            'is_archiving': False,
+            'current_archived_wals_per_second': None,
+            'is_superuser': False,
+            'is_in_recovery': True,
+            'current_xlog': None,
+            'data_directory': None,
+            'pgespresso_installed': False,
+            'server_txt_version': '10.1',
+            'wal_level': 'replica',
+            'current_size': None,
+            'replication_slot_support': True,
+            'replication_slot': ReplicationSlot('test', True, '0/3000000'),
+            'synchronous_standby_names': [''],
         }
+        query, params = cursor_mock.execute.call_args[0]
+        assert 'pg_current_wal_lsn()' in query
+        assert 'pg_replication_slots' in query
+        assert "LIKE '%%.history'" in query
+        assert params == {'slot_name': 'test'}
+
+    @patch('barman.postgres.psycopg2.connect')
+    def test_fetch_volatile_remote_status(self, conn_mock):
+        """
+        Test the collection of the values of the status changing frequently
+        """
+        server = build_real_server(main_conf={'slot_name': 'test'})
+        conn_mock.return_value.server_version = 100000
+        cursor_mock = conn_mock.return_value.cursor.return_value
+        cursor_mock.fetchone.return_value = {
+            'is_in_recovery': False,
+            'current_xlog': '000000010000000000000003',
+            'current_size': 42,
+            'slot_name': 'test',
+            'slot_active': False,
+            'slot_restart_lsn': '0/3000000',
+            'archived_count': 1,
+            'last_archived_wal': '000000010000000000000002',
+        }
+
+        assert server.postgres.fetch_volatile_remote_status() == {
+            'is_in_recovery': False,
+            'current_xlog': '000000010000000000000003',
+            'current_size': 42,
+            'replication_slot': ReplicationSlot('test', False, '0/3000000'),
+            'archived_count': 1,
+            'last_archived_wal': '000000010000000000000002',
+        }
+        query, params = cursor_mock.execute.call_args[0]
+        assert 'pg_current_wal_lsn()' in query
+        assert 'pg_stat_archiver' in query
+        # The settings and the version are not collected again
+        assert 'version()' not in query
+        assert 'pg_settings' not in query
+        assert params == {'slot_name': 'test'}
+
+        # Error management
+        # The first query checks the connection
+        cursor_mock.execute.side_effect = [None, psycopg2.ProgrammingError]
+        assert server.postgres.fetch_volatile_remote_status() is None
+        conn_mock.return_value.rollback.assert_called_once_with()
 
     @patch('barman.postgres.PostgreSQLConnection.connect')
     @patch('barman.postgres.PostgreSQLConnection.is_in_recovery',
@@ -1291,9 +1439,11 @@ class TestPostgres(object):
         # Supported version 9.4
         cursor_mock.reset_mock()
         server_version_mock.return_value = 90400
+        cursor_mock.fetchone.return_value = ('test', True, '0/3000000')
         replication_slot = server.postgres.get_replication_slot(
             server.config.slot_name)
-        assert replication_slot is cursor_mock.fetchone.return_value
+        assert replication_slot == ReplicationSlot(
+            slot_name='test', active=True, restart_lsn='0/3000000')
         cursor_mock.execute.assert_called_once_with(
             "SELECT slot_name, "
             "active, "
@@ -1302,6 +1452,10 @@ class TestPostgres(object):
             "WHERE slot_type = 'physical' "
             "AND slot_name = '%s'" % server.config.slot_name)
 
+        # The replication slot does not exist
+        cursor_mock.fetchone.return_value = None
+        assert server.postgres.get_replication_slot('test') is None
+
         # Too old version (3.0)
         server_version_mock.return_value = 90300
         with pytest.raises(PostgresUnsupportedFeature):
@@ -17,7 +17,8 @@
 
 import os
 import shutil
-import time
+import tarfile
+from contextlib import closing
 
 import dateutil
 import mock
@@ -25,7 +26,7 @@ import pytest
 
 import testing_helpers
 from barman import xlog
-from barman.exceptions import CommandFailedException
+from barman.exceptions import CommandFailedException, DataTransferFailure
 from barman.infofile import WalFileInfo
 from barman.recovery_executor import Assertion, RecoveryExecutor
 
@@ -200,8 +201,8 @@ class TestRecoveryExecutor(object):
                                    None, False)
         target_datetime = dateutil.parser.parse(
             '2015-06-03 16:11:03.710380+02:00')
-        target_epoch = (time.mktime(target_datetime.timetuple()) +
-                        (target_datetime.microsecond / 1000000.))
+        # 2015-06-03 14:11:03.710380 UTC
+        target_epoch = 1433340663.71038
 
         assert recovery_info['target_datetime'] == target_datetime
         assert recovery_info['target_epoch'] == target_epoch
@@ -258,6 +259,8 @@ class TestRecoveryExecutor(object):
         """
         # Build basic folder/files structure
         dest = tmpdir.mkdir('destination')
+        # A non empty destination requires the rsync copy
+        dest.join('PG_VERSION').write('9.6')
         server = testing_helpers.build_real_server()
         backup_info = testing_helpers.build_test_backup_info(
             server=server,
@@ -302,6 +305,189 @@ class TestRecoveryExecutor(object):
             mock.call().copy(),
         ]
 
+    @mock.patch('barman.recovery_executor.RsyncCopyController')
+    @mock.patch('barman.recovery_executor.LocalCopyController')
+    def test_recover_backup_copy_local(self, local_controller_mock,
+                                       rsync_controller_mock, tmpdir):
+        """
+        Test the local copy of a backup into an empty destination
+        """
+        dest = tmpdir.mkdir('destination')
+        # Symbolic links don't make the destination non empty
+        dest.mkdir('pg_tblspc').join('16387').mksymlinkto('/fake/location')
+        server = testing_helpers.build_real_server()
+        backup_info = testing_helpers.build_test_backup_info(
+            server=server,
+            tablespaces=[('tbs1', 16387, '/fake/location')])
+        executor = RecoveryExecutor(server.backup_manager)
+        executor.config.parallel_jobs = 4
+
+        executor._backup_copy(
+            backup_info, dest.strpath, tablespaces=None)
+
+        assert not rsync_controller_mock.called
+        local_controller_mock.assert_called_once_with(workers=4)
+        controller = local_controller_mock.return_value
+        assert controller.add_directory.call_count == 2
+        controller.copy.assert_called_once_with()
+
+        # An error during the local copy is reported as a transfer failure
+        controller.copy.side_effect = OSError(28, 'No space left on device')
+        with pytest.raises(DataTransferFailure):
+            executor._backup_copy(
+                backup_info, dest.strpath, tablespaces=None)
+
+        # A remote recovery always uses rsync
+        local_controller_mock.reset_mock()
+        executor._backup_copy(
+            backup_info, dest.strpath, tablespaces=None,
+            remote_command='ssh pg@remote')
+        assert not local_controller_mock.called
+        assert rsync_controller_mock.called
+
+    def test_restore_file_attributes(self, tmpdir):
+        """
+        Test the restore of the attributes of the deduplicated files
+        """
+        backup_info = testing_helpers.build_test_backup_info(
+            tablespaces=[('tbs1', 16387, '/fake/location')])
+        backup_info.config.basebackups_directory = tmpdir.strpath
+        base_dir = tmpdir.mkdir(backup_info.backup_id)
+        for rel_path in ('data/PG_VERSION', '16387/PG_9.6/1/4567'):
+            base_dir.join(rel_path).write('content', ensure=True)
+            base_dir.join(rel_path).chmod(0o644)
+            base_dir.join(rel_path).setmtime(1500000000)
+        base_dir.join('deduplication.manifest').write(
+            'abc 600 1500000000.000000 data/PG_VERSION\n'
+            'def 644 1500000060.000000 16387/PG_9.6/1/4567\n'
+            'ghi 644 1500000000.000000 data/missing\n')
+        executor = RecoveryExecutor(backup_info.server.backup_manager)
+        cmd = mock.Mock()
+
+        executor._restore_file_attributes(
+            backup_info, '/pgdata', {'tbs1': '/tbs1'}, cmd)
+
+        cmd.set_file_attributes.assert_called_once_with([
+            ('/tbs1/PG_9.6/1/4567', 0o644, 1500000060),
+            ('/pgdata/PG_VERSION', 0o600, 1500000000),
+        ])
+
+        # Nothing to do for a compressed backup
+        cmd.reset_mock()
+        backup_info.compression = 'gzip'
+        executor._restore_file_attributes(
+            backup_info, '/pgdata', None, cmd)
+        assert not cmd.set_file_attributes.called
+
+    @mock.patch('barman.recovery_executor.RsyncCopyController')
+    @mock.patch('barman.recovery_executor.TarExtractController')
+    def test_recover_backup_extract(self, extract_controller_mock,
+                                    rsync_controller_mock, tmpdir):
+        """
+        Test the extraction of a compressed backup
+        """
+        server = testing_helpers.build_real_server()
+        backup_info = testing_helpers.build_test_backup_info(
+            server=server,
+            tablespaces=[('tbs1', 16387, '/fake/location')])
+        backup_info.compression = 'gzip'
+        executor = RecoveryExecutor(server.backup_manager)
+        executor.config.parallel_jobs = 4
+
+        executor._backup_copy(
+            backup_info, '/pgdata', tablespaces={'tbs1': '/tbs1'},
+            remote_command='ssh pg@remote')
+
+        assert not rsync_controller_mock.called
+        controller = extract_controller_mock.return_value
+        assert extract_controller_mock.mock_calls == [
+            mock.call(path=server.path, ssh_command='ssh pg@remote',
+                      workers=4),
+            mock.call().add_archive(
+                label='tbs1',
+                src=backup_info.get_data_directory() + '/16387.tar.gz',
+                dst='/tbs1',
+                item_class=controller.TABLESPACE_CLASS),
+            mock.call().add_archive(
+                label='pgdata',
+                src=backup_info.get_data_directory() + '/base.tar.gz',
+                dst='/pgdata',
+                exclude=[
+                    '/pg_log/*',
+                    '/pg_xlog/*',
+                    '/pg_wal/*',
+                    '/postmaster.pid',
+                    '/recovery.conf',
+                    '/tablespace_map',
+                    '/pg_tblspc/16387',
+                ],
+                item_class=controller.PGDATA_CLASS),
+            mock.call().copy(),
+        ]
+
+        # A tar failure is reported as a transfer failure
+        controller.copy.side_effect = CommandFailedException(
+            dict(ret=2, out='', err='error'))
+        with pytest.raises(DataTransferFailure):
+            executor._backup_copy(backup_info, '/pgdata')
+
+    def test_map_temporary_config_files_compressed(self, tmpdir):
+        """
+        Test the extraction of the configuration files from the archive
+        of a compressed backup, during a remote recovery
+        """
+        tempdir = tmpdir.mkdir('tempdir')
+        recovery_info = {
+            'configuration_files': ['postgresql.conf', 'postgresql.auto.conf'],
+            'tempdir': tempdir.strpath,
+            'temporary_configuration_files': [],
+            'results': {'changes': [], 'warnings': [], 'missing_files': []},
+        }
+        backup_info = testing_helpers.build_test_backup_info()
+        backup_info.compression = 'gzip'
+        backup_info.config.basebackups_directory = tmpdir.strpath
+        datadir = tmpdir.mkdir(backup_info.backup_id).mkdir('data')
+        content = tmpdir.mkdir('content')
+        content.join('postgresql.conf').write('archive_command = something')
+        content.mkdir('base').join('1').write('data')
+        with closing(tarfile.open(datadir.join('base.tar.gz').strpath,
+                                  'w:gz')) as tar:
+            for name in content.listdir():
+                tar.add(name.strpath, name.basename)
+
+        executor = RecoveryExecutor(testing_helpers.build_backup_manager())
+        executor._map_temporary_config_files(recovery_info,
+                                             backup_info, 'ssh@something')
+        assert tempdir.join('postgresql.conf').read() == \
+            'archive_command = something'
+        assert recovery_info['temporary_configuration_files'] == [
+            tempdir.join('postgresql.conf').strpath]
+        assert recovery_info['results']['missing_files'] == [
+            'postgresql.auto.conf', 'pg_hba.conf', 'pg_ident.conf']
+
+    def test_is_empty_destination(self, tmpdir):
+        """
+        Test the check of the destination of a local recovery
+        """
+        dest = tmpdir.mkdir('destination')
+        tbs = tmpdir.mkdir('tbs')
+        server = testing_helpers.build_real_server()
+        backup_info = testing_helpers.build_test_backup_info(
+            server=server,
+            tablespaces=[('tbs1', 16387, '/fake/location')])
+        executor = RecoveryExecutor(server.backup_manager)
+        relocation = {'tbs1': tbs.strpath}
+
+        dest.mkdir('base')
+        assert executor._is_empty_destination(
+            backup_info, dest.strpath, relocation)
+
+        tbs.mkdir('PG_9.6_201608131').join('file').write('')
+        assert not executor._is_empty_destination(
+            backup_info, dest.strpath, relocation)
+        # Without relocation the tablespace goes in a missing location
+        assert executor._is_empty_destination(backup_info, dest.strpath)
+
     @mock.patch('barman.backup.CompressionManager')
     @mock.patch('barman.recovery_executor.RsyncPgData')
     def test_recover_xlog(self, rsync_pg_mock, cm_mock, tmpdir):
@@ -493,6 +679,7 @@ class TestRecoveryExecutor(object):
             'safe_horizon': None,
             'is_pitr': False,
             'get_wal': False,
+            'ssh_master': None,
         }
         # test remote recovery
         rec_info = executor.recover(backup_info, dest.strpath, {}, None, None,
@@ -501,6 +688,12 @@ class TestRecoveryExecutor(object):
         del rec_info['cmd']
         del rec_info['rsync']
         sys_tempdir = rec_info['tempdir']
+        # the remote commands share the same ssh connection
+        ssh_master = rec_info.pop('ssh_master')
+        assert ssh_master.ssh_command == 'remote@command'
+        assert ssh_master.control_path == os.path.join(sys_tempdir, 'ssh')
+        remote_cmd_mock.assert_called_with(ssh_master.command,
+                                           path=server.path)
         assert rec_info == {
             'tempdir': sys_tempdir,
             'wal_dest': dest.join('pg_xlog').strpath,
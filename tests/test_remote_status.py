@@ -0,0 +1,309 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+from mock import PropertyMock, patch
+
+from barman.exceptions import PostgresConnectionError
+from barman.postgres import PostgreSQLConnection, ReplicationSlot
+from barman.remote_status import (VOLATILE_STATUS_TTL, RemoteStatusCache,
+                                  RemoteStatusMixin)
+from testing_helpers import build_real_server
+
+
+class FakeComponent(RemoteStatusMixin):
+    """
+    A component counting the calls to fetch_remote_status
+    """
+
+    def __init__(self, status):
+        super(FakeComponent, self).__init__()
+        self.status = status
+        self.calls = 0
+
+    def fetch_remote_status(self):
+        self.calls += 1
+        return dict(self.status)
+
+    def is_remote_status_cacheable(self, status):
+        return status.get('error') is None
+
+
+class FakeVolatileComponent(FakeComponent):
+    """
+    A component collecting its volatile values separately
+    """
+
+    REMOTE_STATUS_TTLS = {'current_xlog': VOLATILE_STATUS_TTL}
+
+    def __init__(self, status):
+        super(FakeVolatileComponent, self).__init__(status)
+        self.volatile_calls = 0
+
+    def fetch_volatile_remote_status(self):
+        self.volatile_calls += 1
+        return {'current_xlog': self.status['current_xlog']}
+
+
+class TestRemoteStatusCache(object):
+    """
+    Test the on-disk cache of the remote status
+    """
+
+    def test_get_set(self, tmpdir):
+        path = tmpdir.join('remote_status.cache').strpath
+        cache = RemoteStatusCache(path, 60)
+        assert cache.get('postgres') is None
+
+        status = {'replication_slot': ReplicationSlot('test', True, '0/1')}
+        cache.set('postgres', status)
+        cache.set('streaming', {'streaming': True})
+        # A new instance reads the content of the file
+        cache = RemoteStatusCache(path, 60)
+        assert cache.get('postgres') == status
+        assert cache.get('streaming') == {'streaming': True}
+
+        # Expired entries are ignored
+        with patch('time.time') as time_mock:
+            time_mock.return_value = 10 ** 10
+            assert cache.get('postgres') is None
+
+        # Invalidation
+        cache.invalidate('postgres')
+        assert cache.get('postgres') is None
+        assert cache.get('streaming') == {'streaming': True}
+        cache.invalidate()
+        assert not tmpdir.join('remote_status.cache').check()
+        assert cache.get('streaming') is None
+
+    @patch('barman.remote_status.time')
+    def test_ttls(self, time_mock, tmpdir):
+        time_mock.time.return_value = 1000
+        cache = RemoteStatusCache(
+            tmpdir.join('remote_status.cache').strpath, 60)
+        ttls = {'current_xlog': VOLATILE_STATUS_TTL, 'current_size': 0}
+        cache.set('postgres', {'current_xlog': '000000010000000000000002',
+                               'server_txt_version': '9.6'}, ttls)
+        time_mock.time.return_value = 1000 + VOLATILE_STATUS_TTL - 1
+        assert cache.get('postgres') is not None
+        # The volatile values expire, the stable ones are still valid
+        time_mock.time.return_value = 1000 + VOLATILE_STATUS_TTL
+        assert cache.get('postgres') is None
+        assert cache.get_values('postgres') == (
+            {'server_txt_version': '9.6'}, ['current_xlog'])
+        # Updating the volatile values keeps the expiration of the others
+        cache.update('postgres', {'current_xlog': '000000010000000000000003'},
+                     ttls)
+        assert cache.get('postgres') == {
+            'current_xlog': '000000010000000000000003',
+            'server_txt_version': '9.6'}
+        time_mock.time.return_value = 1061
+        assert cache.get_values('postgres') == (None, [])
+        cache.update('postgres', {'current_xlog': '000000010000000000000004'},
+                     ttls)
+        assert cache.get_values('postgres') == (None, [])
+
+        # A TTL longer than the default one is ignored
+        cache.set('postgres', {'server_txt_version': '9.6'},
+                  {'server_txt_version': 3600})
+        time_mock.time.return_value = 1122
+        assert cache.get('postgres') is None
+        # Values with a zero TTL are always expired
+        cache.set('postgres', {'current_size': 42}, ttls)
+        assert cache.get('postgres') is None
+        assert cache.get_values('postgres') == ({}, ['current_size'])
+
+        # When bypassed, the cache is updated but never read
+        cache.bypass = True
+        cache.set('streaming', {'streaming': True})
+        assert cache.get('streaming') is None
+        assert RemoteStatusCache(cache.path, 60).get('streaming') == {
+            'streaming': True}
+
+    def test_damaged_cache(self, tmpdir):
+        cache_file = tmpdir.join('remote_status.cache')
+        cache_file.write('garbage')
+        cache = RemoteStatusCache(cache_file.strpath, 60)
+        assert cache.get('postgres') is None
+        # A missing directory doesn't raise any error
+        cache = RemoteStatusCache(
+            tmpdir.join('missing', 'remote_status.cache').strpath, 60)
+        cache.set('postgres', {'streaming': True})
+        assert cache.get('postgres') is None
+
+    def test_mixin(self, tmpdir):
+        cache = RemoteStatusCache(
+            tmpdir.join('remote_status.cache').strpath, 60)
+        component = FakeComponent({'server_txt_version': '9.6'})
+        component.set_remote_status_cache(cache, 'postgres')
+        assert component.get_remote_status() == {'server_txt_version': '9.6'}
+
+        # Another process reads the status from the cache
+        other = FakeComponent({'server_txt_version': '10'})
+        other.set_remote_status_cache(cache, 'postgres')
+        assert other.get_remote_status() == {'server_txt_version': '9.6'}
+        assert other.calls == 0
+
+        # Explicit invalidation
+        other.reset_remote_status()
+        assert other.get_remote_status() == {'server_txt_version': '10'}
+        assert other.calls == 1
+
+        # Failures are not cached
+        cache.invalidate()
+        failed = FakeComponent({'error': 'connection refused'})
+        failed.set_remote_status_cache(cache, 'postgres')
+        failed.get_remote_status()
+        assert cache.get('postgres') is None
+
+    @patch('barman.remote_status.time')
+    def test_mixin_volatile(self, time_mock, tmpdir):
+        time_mock.time.return_value = 1000
+        cache = RemoteStatusCache(
+            tmpdir.join('remote_status.cache').strpath, 60)
+        component = FakeVolatileComponent({
+            'server_txt_version': '9.6',
+            'current_xlog': '000000010000000000000001'})
+        component.set_remote_status_cache(cache, 'postgres')
+        component.get_remote_status()
+        assert component.calls == 1
+
+        # The stable values survive the volatile ones,
+        # which are collected again
+        time_mock.time.return_value = 1000 + VOLATILE_STATUS_TTL + 1
+        other = FakeVolatileComponent({
+            'server_txt_version': '10',
+            'current_xlog': '000000010000000000000002'})
+        other.set_remote_status_cache(cache, 'postgres')
+        assert other.get_remote_status() == {
+            'server_txt_version': '9.6',
+            'current_xlog': '000000010000000000000002'}
+        assert (other.calls, other.volatile_calls) == (0, 1)
+        assert cache.get('postgres') == other.get_remote_status()
+
+        # Everything is collected again after the default TTL
+        time_mock.time.return_value = 1061
+        other.reset_remote_status()
+        assert other.get_remote_status()['server_txt_version'] == '10'
+        assert (other.calls, other.volatile_calls) == (1, 1)
+
+        # The components not supporting it collect the whole status
+        time_mock.time.return_value = 1061 + VOLATILE_STATUS_TTL + 1
+        component = FakeComponent({
+            'server_txt_version': '11',
+            'current_xlog': '000000010000000000000003'})
+        component.REMOTE_STATUS_TTLS = other.REMOTE_STATUS_TTLS
+        component.set_remote_status_cache(cache, 'postgres')
+        assert component.get_remote_status()['server_txt_version'] == '11'
+        assert component.calls == 1
+
+    def test_server(self, tmpdir):
+        server = build_real_server(main_conf={
+            'backup_directory': tmpdir.strpath,
+            'remote_status_cache_ttl': '30',
+            'streaming_archiver': 'on',
+            'slot_name': 'test',
+        })
+        cache = server.remote_status_cache
+        assert cache.path == tmpdir.join('remote_status.cache').strpath
+        assert cache.ttl == 30
+        assert server.postgres._remote_status_cache_key == 'postgres'
+        assert server.streaming._remote_status_cache_key == 'streaming'
+        assert [archiver._remote_status_cache_key
+                for archiver in server.archivers] == [
+            'archiver.FileWalArchiver', 'archiver.StreamingWalArchiver']
+
+        # Reset the whole cache
+        cache.set('postgres', {'server_txt_version': '9.6'})
+        with patch.object(server.postgres, 'fetch_remote_status') as fetch:
+            fetch.return_value = {'server_txt_version': '10'}
+            server.reset_remote_status()
+            assert server.postgres.get_remote_status() == {
+                'server_txt_version': '10'}
+
+        # The volatile values of PostgreSQL expire earlier
+        assert server.postgres.REMOTE_STATUS_TTLS['replication_slot'] == \
+            VOLATILE_STATUS_TTL
+
+        # The commands acting on the status don't read the cache
+        server.postgres.reset_remote_status()
+        cache.set('postgres', {
+            'replication_slot': ReplicationSlot('test', True, '0/1')})
+        with patch.object(server.postgres, 'fetch_remote_status') as fetch:
+            fetch.return_value = {
+                'replication_slot': ReplicationSlot('test', False, '0/1')}
+            server.bypass_remote_status_cache()
+            assert not server.postgres.get_remote_status()[
+                'replication_slot'].active
+            assert fetch.call_count == 1
+
+        # The cache is disabled by default
+        server = build_real_server()
+        assert server.remote_status_cache is None
+        assert server.postgres._remote_status_cache is None
+        server.bypass_remote_status_cache()
+
+    def test_components_cacheable(self, tmpdir):
+        server = build_real_server(main_conf={
+            'backup_directory': tmpdir.strpath,
+            'remote_status_cache_ttl': '30',
+            'streaming_archiver': 'on',
+        })
+        file_archiver, streaming_archiver = server.archivers
+        # PostgreSQL unreachable
+        assert not file_archiver.is_remote_status_cacheable(
+            {'archive_mode': None, 'archive_command': None})
+        assert file_archiver.is_remote_status_cacheable(
+            {'archive_mode': 'on', 'archive_command': None})
+        # Unknown PostgreSQL version
+        assert not streaming_archiver.is_remote_status_cacheable(
+            {'pg_receivexlog_installed': True,
+             'pg_receivexlog_compatible': None})
+        assert streaming_archiver.is_remote_status_cacheable(
+            {'pg_receivexlog_installed': False,
+             'pg_receivexlog_compatible': None})
+        assert streaming_archiver.is_remote_status_cacheable(
+            {'pg_receivexlog_installed': True,
+             'pg_receivexlog_compatible': False})
+
+        # The rsync executor doesn't cache a failure
+        executor = server.backup_manager.executor
+        with patch.object(PostgreSQLConnection, 'server_version',
+                          new_callable=PropertyMock) as version_mock:
+            version_mock.side_effect = PostgresConnectionError('refused')
+            assert executor.get_remote_status() == {}
+            assert server.remote_status_cache.get('executor') is None
+            executor.reset_remote_status()
+            version_mock.side_effect = None
+            version_mock.return_value = 90600
+            assert executor.get_remote_status() == {}
+            assert server.remote_status_cache.get('executor') == {}
+
+        server = build_real_server(main_conf={
+            'backup_directory': tmpdir.strpath,
+            'backup_method': 'postgres',
+            'remote_status_cache_ttl': '30',
+        })
+        executor = server.backup_manager.executor
+        assert not executor.is_remote_status_cacheable(
+            {'pg_basebackup_installed': True,
+             'pg_basebackup_compatible': None})
+        assert executor.is_remote_status_cacheable(
+            {'pg_basebackup_installed': False,
+             'pg_basebackup_compatible': None})
+        assert executor.is_remote_status_cacheable(
+            {'pg_basebackup_installed': True,
+             'pg_basebackup_compatible': True})
@@ -257,3 +257,78 @@ class TestRetentionPolicies(object):
         report = rp.first_backup()
 
         assert report == 'test_backup'
+
+    def test_report_cache(self):
+        """
+        Test that the report is computed once per catalog generation
+        """
+        server = build_mocked_server()
+        server.backup_manager.catalog_generation = 1
+        server.config.minimum_redundancy = 1
+        rp = RetentionPolicyFactory.create(
+            server,
+            'retention_policy',
+            'REDUNDANCY 1')
+        backups = {}
+        for backup_id in ('test_backup', 'test_backup2'):
+            backups[backup_id] = build_test_backup_info(
+                server=rp.server,
+                backup_id=backup_id,
+                end_time=datetime.now(tzlocal()))
+        server.get_available_backups.return_value = backups
+
+        assert rp.report() == {'test_backup': BackupInfo.OBSOLETE,
+                               'test_backup2': BackupInfo.VALID}
+        assert rp.backup_status('test_backup') == BackupInfo.OBSOLETE
+        assert rp.backup_status('test_backup2') == BackupInfo.VALID
+        assert rp.first_backup() == 'test_backup2'
+        assert server.get_available_backups.call_count == 1
+
+        # A change of the catalog invalidates the report
+        del backups['test_backup2']
+        server.backup_manager.catalog_generation = 2
+        assert rp.backup_status('test_backup') == BackupInfo.VALID
+        assert rp.first_backup() == 'test_backup'
+        assert server.get_available_backups.call_count == 2
+
+    def test_recovery_window_report_expiry(self):
+        """
+        Test that the report of a recovery window policy expires when
+        a backup leaves the recovery window
+        """
+        server = build_mocked_server()
+        server.backup_manager.catalog_generation = 1
+        server.config.minimum_redundancy = 0
+        rp = RetentionPolicyFactory.create(
+            server,
+            'retention_policy',
+            'RECOVERY WINDOW OF 1 DAYS')
+        now = datetime.now(tzlocal())
+        rp._now = lambda: now
+        server.get_available_backups.return_value = {
+            'test_backup': build_test_backup_info(
+                server=rp.server,
+                backup_id='test_backup',
+                end_time=now - timedelta(hours=40)),
+            'test_backup2': build_test_backup_info(
+                server=rp.server,
+                backup_id='test_backup2',
+                end_time=now - timedelta(hours=30)),
+            'test_backup3': build_test_backup_info(
+                server=rp.server,
+                backup_id='test_backup3',
+                end_time=now - timedelta(hours=20)),
+        }
+        assert rp.backup_status('test_backup') == BackupInfo.OBSOLETE
+        assert rp.backup_status('test_backup2') == BackupInfo.VALID
+
+        # Still valid three hours later
+        now += timedelta(hours=3)
+        assert rp.backup_status('test_backup2') == BackupInfo.VALID
+        assert server.get_available_backups.call_count == 1
+
+        # Recomputed when test_backup3 leaves the recovery window
+        now += timedelta(hours=2)
+        assert rp.backup_status('test_backup2') == BackupInfo.OBSOLETE
+        assert rp.backup_status('test_backup3') == BackupInfo.VALID
+        assert server.get_available_backups.call_count == 2
@@ -23,6 +23,7 @@ import pytest
 from mock import MagicMock, mock, patch
 from psycopg2.tz import FixedOffsetTimezone
 
+import barman
 from barman.exceptions import (LockFileBusy, LockFilePermissionDenied,
                                PostgresDuplicateReplicationSlot,
                                PostgresInvalidReplicationSlot,
@@ -30,11 +31,12 @@ from barman.exceptions import (LockFileBusy, LockFilePermissionDenied,
                                PostgresSuperuserRequired,
                                PostgresUnsupportedFeature)
 from barman.infofile import BackupInfo, WalFileInfo
-from barman.lockfile import (ServerBackupLock, ServerCronLock,
+from barman.lockfile import (ServerBackupLock, ServerCronLock, ServerTrashLock,
                              ServerWalArchiveLock, ServerWalReceiveLock)
 from barman.postgres import PostgreSQLConnection
 from barman.process import ProcessInfo
 from barman.server import CheckOutputStrategy, CheckStrategy, Server
+from barman.wal_reader import WalIndex
 from testing_helpers import (build_config_from_dicts, build_real_server,
                              build_test_backup_info)
 
@@ -95,6 +97,130 @@ class TestServer(object):
                "'slot_name' options to be properly configured" \
                in server.config.msg_list
 
+    def test_lazy_init(self, tmpdir):
+        """
+        Test a server building its components on first use
+        """
+        server = Server(build_config_from_dicts(
+            global_conf={'barman_home': tmpdir.strpath},
+            main_conf={'conninfo': '', 'ssh_command': ''},
+        ).get_server('main'), lazy=True)
+        # The components are not built, so their errors are not detected
+        assert not server.config.disabled
+        assert 'postgres' not in server.__dict__
+
+        # The WAL archive is usable without the components
+        wal_name = '000000010000000000000001'
+        tmpdir.join('main', 'wals', wal_name[:16], wal_name).write(
+            'wal content', ensure=True)
+        output_dir = tmpdir.mkdir('output')
+        server.get_wal(wal_name, output_directory=output_dir.strpath)
+        assert output_dir.join(wal_name).read() == 'wal content'
+        server.close()
+        assert 'postgres' not in server.__dict__
+
+        # All the components are built on first access
+        assert server.backup_manager.server is server
+        assert server.postgres is None
+        assert server.archivers
+        assert server.config.disabled
+        assert "PostgreSQL connection: Missing 'conninfo' parameter for " \
+               "server 'main'" in server.config.msg_list
+
+    @pytest.mark.parametrize('cached', [False, True])
+    def test_peek_wal(self, tmpdir, cached):
+        """
+        Test the list of the following WAL files, taken from the xlogdb
+        """
+        server = build_real_server(global_conf={
+            'barman_home': tmpdir.strpath,
+            'barman_lock_directory': tmpdir.strpath,
+        })
+        xlogdb = tmpdir.join('main', 'wals', 'xlog.db')
+        xlogdb.write('\n'.join([
+            '0000000100000000000000FE\t16\t2\tNone',
+            '0000000100000000000000FE.00000028.backup\t1\t2\tNone',
+            '0000000100000000000000FF\t16\t3\tgzip',
+            '000000010000000100000000\t16\t4\tNone',
+            '000000010000000100000001\t16\t5\tNone',
+            '000000010000000100000001\t16\t5\tNone',
+            '000000010000000100000001.partial\t16\t5\tNone',
+            # The third segment of the group is missing
+            '000000010000000100000003\t16\t6\tNone',
+            '00000002.history\t42\t7\tNone',
+            '000000020000000100000004\t16\t8\tNone',
+            '',
+        ]), ensure=True)
+
+        # The xlogdb is never locked
+        with patch.object(server, 'xlogdb') as xlogdb_mock:
+            wal_infos = server.peek_wal('0000000100000000000000FE', 10,
+                                        cached=cached)
+            assert [(w.name, w.compression) for w in wal_infos] == [
+                ('0000000100000000000000FE', None),
+                ('0000000100000000000000FF', 'gzip'),
+                ('000000010000000100000000', None),
+                ('000000010000000100000001', None),
+            ]
+            assert [w.name for w in server.peek_wal(
+                '0000000100000000000000FF', 2, cached=cached)] == [
+                '0000000100000000000000FF', '000000010000000100000000']
+            assert [w.name for w in server.peek_wal(
+                '000000010000000100000002', 10, cached=cached)] == []
+            assert [w.name for w in server.peek_wal(
+                '000000010000000100000003', 10, cached=cached)] == [
+                '000000010000000100000003']
+            assert [w.name for w in server.peek_wal(
+                '00000002.history', 10, cached=cached)] == [
+                '00000002.history']
+            assert server.peek_wal('00000003.history', 10,
+                                   cached=cached) == []
+        assert not xlogdb_mock.called
+
+        # A line still being appended is ignored
+        xlogdb.write('000000020000000100000005\t16\t9\tNone', mode='a')
+        assert [w.name for w in server.peek_wal(
+            '000000020000000100000004', 10, cached=cached)] == [
+            '000000020000000100000004']
+        xlogdb.write('\n', mode='a')
+        assert [w.name for w in server.peek_wal(
+            '000000020000000100000004', 10, cached=cached)] == [
+            '000000020000000100000004', '000000020000000100000005']
+
+        # An empty archive
+        xlogdb.remove()
+        assert server.peek_wal('000000020000000100000004', 10,
+                               cached=cached) == []
+
+    def test_peek_wal_unsorted(self, tmpdir):
+        """
+        Test the list of the following WAL files, taken from an xlogdb
+        not sorted by WAL name
+        """
+        server = build_real_server(global_conf={
+            'barman_home': tmpdir.strpath,
+            'barman_lock_directory': tmpdir.strpath,
+        })
+        xlogdb = tmpdir.join('main', 'wals', 'xlog.db')
+        xlogdb.write('\n'.join([
+            '000000010000000000000003\t16\t3\tNone',
+            '000000010000000000000004\t16\t4\tNone',
+            '000000010000000000000001\t16\t1\tNone',
+            '000000010000000000000002\t16\t2\tNone',
+            '',
+        ]), ensure=True)
+        wal_name = '000000010000000000000001'
+
+        # The binary search can't find the WAL file
+        assert server.peek_wal(wal_name, 10) == []
+
+        # The whole xlogdb is read if the WAL file is in the archive
+        tmpdir.join('main', 'wals', wal_name[:16], wal_name).write(
+            '', ensure=True)
+        assert [w.name for w in server.peek_wal(wal_name, 10)] == [
+            '000000010000000000000001', '000000010000000000000002',
+            '000000010000000000000003', '000000010000000000000004']
+
     def test_check_config_missing(self, tmpdir):
         """
         Verify the check method can be called on an empty configuration
@@ -248,6 +374,70 @@ class TestServer(object):
         # check for the presence of the .history file
         assert history_info.name in wals
 
+    def test_get_required_xlog_files(self, tmpdir):
+        """
+        Test the selection of the WAL files needed to reach a target
+        """
+        def wal(segment, index=None, time=43):
+            return WalFileInfo(name='0000000100000000000000%02X' % segment,
+                               size=42, time=time, compression=None,
+                               index=index).to_xlogdb_line()
+
+        wals_dir = tmpdir.mkdir("wals")
+        wals_dir.join("xlog.db").write(''.join([
+            wal(1), wal(2),
+            wal(3, time=150),
+            wal(4, time=250),
+            wal(5, WalIndex(300, 400, 10, 20, ())),
+            wal(6, WalIndex(400, 500, 15, 30, ('rp',))),
+            wal(7, WalIndex(500, 600, 31, 40, ())),
+            wal(8, WalIndex(600, 700, 41, 50, ())),
+        ]))
+        server = build_real_server(
+            global_conf={
+                "barman_lock_directory": tmpdir.mkdir('lock').strpath
+            },
+            main_conf={
+                "wals_directory": wals_dir.strpath
+            })
+        backup = build_test_backup_info(
+            begin_wal='000000010000000000000001',
+            end_wal='000000010000000000000002')
+
+        def required(**kwargs):
+            return [int(wal_info.name[-2:], 16) for wal_info in
+                    server.get_required_xlog_files(backup, **kwargs)]
+
+        # Without a target every file is required
+        assert required() == [1, 2, 3, 4, 5, 6, 7, 8]
+        # The file containing the target, and the following one
+        assert required(target_time=450) == [1, 2, 3, 4, 5, 6, 7]
+        assert required(target_name='rp') == [1, 2, 3, 4, 5, 6, 7]
+        # Without index, the modification time is used
+        assert required(target_time=120) == [1, 2, 3, 4]
+        # The last file that could contain the target xid, and the
+        # following one. Every file without index could contain it.
+        assert required(target_xid='12') == [1, 2, 3, 4, 5, 6]
+        assert required(target_xid='17') == [1, 2, 3, 4, 5, 6, 7]
+        assert required(target_xid='35') == [1, 2, 3, 4, 5, 6, 7, 8]
+        # Every target must be reached
+        assert required(target_time=550, target_name='rp') == \
+            [1, 2, 3, 4, 5, 6, 7, 8]
+        # A target which is never found
+        assert required(target_name='missing') == [1, 2, 3, 4, 5, 6, 7, 8]
+
+        # A prepared transaction, committed after other files whose
+        # range contains its xid
+        wals_dir.join("xlog.db").write(''.join([
+            wal(1), wal(2),
+            wal(3, WalIndex(300, 400, 10, 20, ())),
+            wal(4, WalIndex(400, 500, 21, 30, ())),
+            wal(5, WalIndex(500, 600, 15, 40, ())),
+            wal(6, WalIndex(600, 700, 41, 50, ())),
+            wal(7, WalIndex(700, 800, 51, 60, ())),
+        ]))
+        assert required(target_xid='15') == [1, 2, 3, 4, 5, 6]
+
     @patch('barman.server.Server.get_remote_status')
     def test_pg_stat_archiver_show(self, remote_mock, capsys):
         """
@@ -704,6 +894,44 @@ class TestServer(object):
                 assert ("Another STREAMING ARCHIVER process is running for "
                         "server %s" % server.config.name) in caplog.text
 
+    @patch('barman.server.BarmanSubProcess')
+    def test_reclaim_trash(self, subprocess_mock, tmpdir, capsys,
+                           monkeypatch):
+        """
+        Test the trash reclaimer and its start from cron
+        """
+        monkeypatch.setattr(barman, '__config__', MagicMock(
+            config_file='/etc/barman.conf'))
+        server = build_real_server({'barman_home': tmpdir.strpath})
+        # Nothing to do if the trash is empty
+        server.cron_reclaim_trash()
+        assert not subprocess_mock.called
+
+        trash = server.backup_manager.trash
+        trash_dir = tmpdir.join(server.config.name, 'trash')
+        trash_dir.join('20170101-1-wals', '000000010000000000000001').ensure()
+        server.cron_reclaim_trash()
+        subprocess_mock.assert_called_once_with(
+            subcommand='reclaim-trash', config='/etc/barman.conf',
+            args=[server.config.name])
+
+        # Another reclaimer is running
+        subprocess_mock.reset_mock()
+        with ServerTrashLock(tmpdir.strpath, server.config.name):
+            server.cron_reclaim_trash()
+            server.reclaim_trash()
+        assert not subprocess_mock.called
+        assert len(trash.entries()) == 1
+        out, err = capsys.readouterr()
+        assert ("Another reclaim-trash process is already running "
+                "on server %s" % server.config.name) in out
+
+        server.reclaim_trash()
+        assert trash.entries() == []
+        out, err = capsys.readouterr()
+        assert ("Removed 1 files from the trash of server %s"
+                % server.config.name) in out
+
     @patch('barman.server.ProcessManager')
     def test_kill(self, pm_mock, capsys):
 
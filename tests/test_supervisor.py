@@ -0,0 +1,198 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+import mock
+from mock import patch
+
+import barman
+from barman.exceptions import LockFileBusy
+from barman.supervisor import CronSupervisor
+from testing_helpers import (build_backup_directories, build_mocked_server,
+                             build_real_server, build_test_backup_info)
+
+
+def build_servers(*names, **conf):
+    """
+    Build a dictionary of mocked servers
+    """
+    servers = {}
+    for name in names:
+        server = build_mocked_server(name=name, main_conf=conf)
+        servers[name] = server
+    return servers
+
+
+class TestCronSupervisor(object):
+    """
+    This class tests the CronSupervisor object
+    """
+
+    def test_schedule(self):
+        """
+        Test that a server is not scheduled twice
+        """
+        servers = build_servers('main', 'test')
+        supervisor = CronSupervisor(servers)
+        pool = mock.Mock()
+        supervisor.running.add('main')
+        supervisor.schedule(pool)
+
+        pool.apply_async.assert_called_once_with(
+            supervisor.maintain, (servers['test'],))
+        assert supervisor.running == set(['main', 'test'])
+
+    @patch('barman.supervisor.ServerCronLock')
+    def test_maintain(self, lock_mock, capsys):
+        """
+        Test the maintenance of a server
+        """
+        servers = build_servers('main')
+        server = servers['main']
+        supervisor = CronSupervisor(servers)
+        supervisor.running.add('main')
+        supervisor.maintain(server)
+
+        lock_mock.assert_called_once_with(
+            server.config.barman_lock_directory, 'main')
+        server.backup_manager.reload_catalog.assert_called_once_with()
+        server.archive_wal.assert_called_once_with(verbose=False)
+        server.kill.assert_called_once_with('receive-wal',
+                                            fail_if_not_present=False)
+        server.backup_manager.cron_retention_policy.assert_called_once_with()
+        server.cron_reclaim_trash.assert_called_once_with()
+        server.close.assert_called_once_with()
+        assert supervisor.running == set()
+
+        # Another cron process is running
+        server.reset_mock()
+        lock_mock.return_value.__enter__.side_effect = LockFileBusy
+        supervisor.maintain(server)
+        assert not server.archive_wal.called
+        out, err = capsys.readouterr()
+        assert "Another cron process is already running" in out
+
+        # Failures are reported but don't stop the supervisor
+        lock_mock.return_value.__enter__.side_effect = None
+        server.archive_wal.side_effect = OSError('error')
+        supervisor.maintain(server)
+        out, err = capsys.readouterr()
+        assert "Maintenance of server main failed: error" in err
+        server.close.assert_called_with()
+
+    @patch('barman.supervisor.ServerCronLock')
+    def test_maintain_reload_catalog(self, lock_mock, tmpdir):
+        """
+        Test that the backups taken by other processes are seen by the
+        next maintenance of a server
+        """
+        server = build_real_server(global_conf={
+            'barman_home': tmpdir.strpath})
+        supervisor = CronSupervisor({'main': server})
+        seen = []
+
+        def retention_policy():
+            seen.append(sorted(
+                server.backup_manager.get_available_backups()))
+
+        with patch.multiple(server, archive_wal=mock.DEFAULT,
+                            kill=mock.DEFAULT,
+                            cron_reclaim_trash=mock.DEFAULT), \
+                patch.object(server.backup_manager, 'cron_retention_policy',
+                             side_effect=retention_policy):
+            supervisor.maintain(server)
+            generation = server.backup_manager.catalog_generation
+            # A backup taken by another process
+            backup_info = build_test_backup_info(
+                backup_id='20170101T000000', server=server)
+            build_backup_directories(backup_info)
+            backup_info.save()
+            supervisor.maintain(server)
+
+        assert seen == [[], ['20170101T000000']]
+        assert server.backup_manager.catalog_generation > generation
+
+    @patch('barman.supervisor.ServerWalReceiveLock')
+    @patch('barman.supervisor.BarmanSubProcess')
+    def test_supervise_receivers(self, subprocess_mock, lock_mock,
+                                 monkeypatch, capsys):
+        """
+        Test the restart of the receive-wal processes with backoff
+        """
+        monkeypatch.setattr(barman, '__config__', mock.Mock(
+            config_file='/etc/barman.conf'))
+        servers = build_servers('main', streaming_archiver='on')
+        servers.update(build_servers('test'))
+        supervisor = CronSupervisor(servers)
+        process = subprocess_mock.return_value.execute.return_value
+
+        # Only the streaming server gets a receive-wal process
+        supervisor.supervise_receivers(100)
+        subprocess_mock.assert_called_once_with(
+            subcommand='receive-wal', config='/etc/barman.conf',
+            args=['main'])
+        assert list(supervisor.receivers) == ['main']
+
+        # Nothing to do while the process is running
+        subprocess_mock.reset_mock()
+        process.poll.return_value = None
+        supervisor.supervise_receivers(101)
+        assert not subprocess_mock.called
+
+        # A failed process is restarted after a growing delay
+        process.poll.return_value = 1
+        supervisor.supervise_receivers(102)
+        assert not subprocess_mock.called
+        supervisor.supervise_receivers(103)
+        assert subprocess_mock.called
+        assert supervisor.receivers['main'].delay == 1
+        subprocess_mock.reset_mock()
+        supervisor.supervise_receivers(104)
+        assert supervisor.receivers['main'].delay == 2
+        assert not subprocess_mock.called
+        supervisor.supervise_receivers(106)
+        assert subprocess_mock.called
+        out, err = capsys.readouterr()
+        assert "receive-wal process for server main terminated " \
+            "with code 1, restarting in 2 seconds" in err
+
+        # The delay is reset after a long run
+        subprocess_mock.reset_mock()
+        supervisor.supervise_receivers(1000)
+        assert supervisor.receivers['main'].delay == 1
+
+        # A receive-wal started by someone else is left alone
+        subprocess_mock.reset_mock()
+        lock_mock.return_value.__enter__.side_effect = LockFileBusy
+        supervisor.supervise_receivers(2000)
+        assert not subprocess_mock.called
+        assert supervisor.receivers['main'].process is None
+
+    @patch('barman.supervisor.ThreadPool')
+    def test_run(self, pool_mock):
+        """
+        Test the main loop
+        """
+        servers = build_servers('main')
+        supervisor = CronSupervisor(servers, interval=60, workers=4)
+        supervisor.TICK = 0
+        with patch.object(supervisor, 'supervise_receivers') as sr_mock:
+            sr_mock.side_effect = lambda now: supervisor.stop()
+            supervisor.run()
+        pool_mock.assert_called_once_with(processes=4)
+        pool_mock.return_value.apply_async.assert_called_once_with(
+            supervisor.maintain, (servers['main'],))
+        pool_mock.return_value.join.assert_called_once_with()
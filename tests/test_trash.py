@@ -0,0 +1,132 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import os
+
+import pytest
+from mock import patch
+
+from barman.dedup import ObjectStore
+from barman.trash import Trash
+
+
+class TestTrash(object):
+    """
+    Test the trash area of a server
+    """
+
+    def test_put_directory(self, tmpdir):
+        backup_dir = tmpdir.join('base', '20170101T000000')
+        backup_dir.join('data', 'PG_VERSION').ensure()
+        trash = Trash(tmpdir.join('trash').strpath)
+
+        entry = trash.put_directory(backup_dir.strpath, 'backup-20170101')
+        assert not backup_dir.check()
+        assert os.path.exists(os.path.join(entry, 'data', 'PG_VERSION'))
+        assert trash.entries() == [entry]
+        assert entry.endswith('-backup-20170101')
+
+    def test_put_files(self, tmpdir):
+        wals = [tmpdir.join('wals', '0000000100000000', name).ensure()
+                for name in ('000000010000000000000001',
+                             '000000010000000000000002')]
+        trash = Trash(tmpdir.join('trash').strpath)
+
+        # A missing file is ignored
+        entry = trash.put_files(
+            [w.strpath for w in wals] + [tmpdir.join('missing').strpath],
+            'wals')
+        assert not wals[0].check()
+        assert sorted(os.listdir(entry)) == [
+            '000000010000000000000001', '000000010000000000000002']
+        assert trash.entries() == [entry]
+
+        # On failure, the files are restored
+        wals = [w.ensure() for w in wals]
+        rename = os.rename
+
+        def rename_mock(src, dst):
+            if src == wals[1].strpath:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            rename(src, dst)
+
+        with patch('os.rename', side_effect=rename_mock):
+            with pytest.raises(OSError):
+                trash.put_files([w.strpath for w in wals], 'wals')
+        assert wals[0].check()
+        assert wals[1].check()
+        assert trash.entries() == [entry]
+        assert len(os.listdir(trash.path)) == 1
+
+    def test_entries(self, tmpdir):
+        trash = Trash(tmpdir.join('trash').strpath)
+        assert trash.entries() == []
+        tmpdir.join('trash', '20170102-1-wals').ensure(dir=True)
+        tmpdir.join('trash', '20170101-1-wals').ensure(dir=True)
+        # An entry being created
+        tmpdir.join('trash', '.20170103-1-wals').ensure(dir=True)
+        assert trash.entries() == [
+            tmpdir.join('trash', '20170101-1-wals').strpath,
+            tmpdir.join('trash', '20170102-1-wals').strpath,
+        ]
+
+    @pytest.mark.parametrize('jobs', [1, 3])
+    def test_reclaim(self, jobs, tmpdir):
+        trash_dir = tmpdir.join('trash')
+        backup = trash_dir.join('20170101-1-backup-20170101T000000')
+        for i in range(250):
+            backup.join('data', 'base', str(i)).ensure()
+        backup.join('data', 'pg_tblspc').ensure(dir=True)
+        os.symlink(tmpdir.join('tbs').ensure(dir=True).strpath,
+                   backup.join('data', 'pg_tblspc', '16387').strpath)
+        wals = trash_dir.join('20170102-1-wals')
+        wals.join('000000010000000000000001').ensure()
+        trash = Trash(trash_dir.strpath)
+
+        assert trash.reclaim(jobs=jobs) == 252
+        assert trash.entries() == []
+        # Symbolic links are not followed
+        assert tmpdir.join('tbs').check(dir=True)
+
+    def test_reclaim_deduplicated(self, tmpdir):
+        store = ObjectStore(tmpdir.join('objects').strpath)
+        backup = tmpdir.join('base', '20170101T000000')
+        backup.join('data', 'PG_VERSION').write('9.6', ensure=True)
+        store.deduplicate(backup.strpath)
+        key = store.read_manifest(backup.strpath)['data/PG_VERSION'].key
+        trash = Trash(tmpdir.join('trash').strpath, store)
+        trash.put_directory(backup.strpath, 'backup-20170101T000000')
+        assert os.path.exists(store.object_path(key))
+
+        # The objects not used anymore are released
+        assert trash.reclaim() == 1
+        assert not os.path.exists(store.object_path(key))
+        assert trash.entries() == []
+
+    @patch('barman.trash.time')
+    def test_reclaim_rate(self, time_mock, tmpdir):
+        entry = tmpdir.join('trash', '20170101-1-backup')
+        for i in range(250):
+            entry.join(str(i)).ensure()
+        time_mock.time.return_value = 1000
+        trash = Trash(tmpdir.join('trash').strpath)
+
+        assert trash.reclaim(rate=50) == 250
+        # Three batches: the second one after two seconds, the third
+        # one after four seconds
+        assert [c[0][0] for c in time_mock.sleep.call_args_list] == [2, 4]
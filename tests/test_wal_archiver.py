@@ -15,14 +15,16 @@
 # You should have received a copy of the GNU General Public License
 # along with Barman.  If not, see <http://www.gnu.org/licenses/>.
 import os
+import threading
 
 import pytest
-from mock import ANY, MagicMock, patch
+from mock import ANY, MagicMock, patch, sentinel
 
 import barman.xlog
 from barman.compression import PyGZipCompressor, identify_compression
-from barman.exceptions import (ArchiverFailure, CommandFailedException,
-                               DuplicateWalFile, MatchingDuplicateWalFile)
+from barman.exceptions import (ArchiverFailure, BadWalFile,
+                               CommandFailedException, DuplicateWalFile,
+                               LockFileBusy, MatchingDuplicateWalFile)
 from barman.infofile import WalFileInfo
 from barman.process import ProcessInfo
 from barman.server import CheckOutputStrategy
@@ -49,19 +51,24 @@ class TestFileWalArchiver(object):
         backup_manager = build_backup_manager()
         # Set up mock responses
         postgres = backup_manager.server.postgres
-        postgres.get_setting.side_effect = ["value1", "value2"]
-        postgres.get_archiver_stats.return_value = {
-            'pg_stat_archiver': 'value3'
+        postgres.ARCHIVER_STATS_KEYS = ('archived_count',)
+        # The values are taken from the PostgreSQL status
+        postgres.get_remote_status.return_value = {
+            'archive_mode': 'value1',
+            'archive_command': 'value2',
+            'archived_count': 'value3',
+            'server_txt_version': '9.6.3',
         }
         # Instantiate a FileWalArchiver obj
         archiver = FileWalArchiver(backup_manager)
         result = {
             'archive_mode': 'value1',
             'archive_command': 'value2',
-            'pg_stat_archiver': 'value3',
+            'archived_count': 'value3',
         }
         # Compare results of the check method
         assert archiver.get_remote_status() == result
+        assert not postgres.get_setting.called
 
     @patch('barman.wal_archiver.FileWalArchiver.get_remote_status')
     def test_check(self, remote_mock, capsys):
@@ -190,6 +197,17 @@ class TestFileWalArchiver(object):
         archiver.archive(fxlogdb_mock)
         unlink_mock.assert_called_with(wal_info.orig_filename)
 
+        archive_wal_mock.side_effect = BadWalFile('segment too short')
+        archiver.archive(fxlogdb_mock)
+        out, err = capsys.readouterr()
+        assert ("\tError: %s is not a valid WAL file "
+                "(BadWalFile:segment too short). "
+                "File moved to errors directory." % wal_info.name) in out
+        move_mock.assert_called_with(
+            wal_info.orig_filename,
+            os.path.join(archiver.config.errors_directory,
+                         "%s.%s.corrupted" % (wal_info.name, 'test_time')))
+
         # Test batch errors
         caplog_reset(caplog)
         batch.errors = ['testfile_1', 'testfile_2']
@@ -405,6 +423,56 @@ class TestFileWalArchiver(object):
             wal_info.fullpath(backup_manager.server)
         )
 
+    @patch('barman.wal_archiver.read_wal_file')
+    def test_archive_wal_integrity_check(self, read_mock, tmpdir):
+        """
+        Test the validation and the indexing of the WAL files
+        """
+        backup_manager = build_backup_manager(
+            name='TestServer',
+            global_conf={
+                'barman_home': tmpdir.strpath,
+                'wal_integrity_check': 'on',
+            })
+        backup_manager.server.get_backup.return_value = None
+        archive_dir = tmpdir.join('main').join('wals')
+        xlog_db = archive_dir.join('xlog.db')
+        wal_file = tmpdir.join('main').join('incoming').join(
+            '000000010000000000000001')
+        wal_file.ensure()
+        xlog_db.ensure()
+        backup_manager.server.xlogdb.return_value.__enter__.return_value = (
+            xlog_db.open(mode='a'))
+        archiver = FileWalArchiver(backup_manager)
+
+        # An invalid WAL file is rejected
+        read_mock.side_effect = BadWalFile('segment too short')
+        wal_info = WalFileInfo.from_file(wal_file.strpath)
+        with pytest.raises(BadWalFile):
+            archiver.archive_wal(None, wal_info)
+        read_mock.assert_called_once_with(
+            wal_file.strpath, '000000010000000000000001', None)
+        assert os.path.exists(wal_file.strpath)
+
+        # Without wal_index, the index is not stored
+        read_mock.side_effect = None
+        read_mock.return_value = sentinel.index
+        archiver.archive_wal(None, wal_info)
+        assert wal_info.index is None
+        assert os.path.exists(wal_info.fullpath(backup_manager.server))
+
+        # Without wal_integrity_check, an invalid WAL file is archived
+        # without index
+        os.unlink(wal_info.fullpath(backup_manager.server))
+        wal_file.ensure()
+        archiver.config.wal_integrity_check = False
+        archiver.config.wal_index = True
+        read_mock.side_effect = BadWalFile('segment too short')
+        wal_info = WalFileInfo.from_file(wal_file.strpath)
+        archiver.archive_wal(None, wal_info)
+        assert wal_info.index is None
+        assert not os.path.exists(wal_file.strpath)
+
     # TODO: The following test should be splitted in two
     # the BackupManager part and the FileWalArchiver part
     def test_archive_wal_no_backup(self, tmpdir, capsys):
@@ -815,6 +883,79 @@ class TestStreamingWalArchiver(object):
                 CommandFailedException
             archiver.receive_wal()
 
+    @patch("barman.wal_archiver.StreamingWalArchiver.archive")
+    @patch("barman.wal_archiver.StreamingWalArchiver.get_remote_status")
+    @patch("barman.wal_archiver.PgReceiveXlog")
+    def test_receive_wal_inline(self, receivexlog_mock, remote_mock,
+                                archive_mock, tmpdir):
+        """
+        Test the inline archiving of the streamed WAL files
+        """
+        backup_manager = build_backup_manager(
+            global_conf={
+                'barman_lock_directory': tmpdir.strpath,
+            },
+            main_conf={
+                'backup_directory': tmpdir,
+                'streaming_archiver_inline': 'on',
+            },
+        )
+        backup_manager.server.streaming.get_remote_status.return_value = {
+            "streaming_supported": True
+        }
+        remote_mock.return_value = {
+            'pg_receivexlog_installed': True,
+            'pg_receivexlog_compatible': True,
+            'pg_receivexlog_synchronous': False,
+            'pg_receivexlog_path': 'fake/path',
+            'pg_receivexlog_supports_slots': True,
+            'pg_receivexlog_version': '9.4',
+        }
+        archiver = StreamingWalArchiver(backup_manager)
+        archiver.receive_wal()
+
+        receivexlog_mock.return_value.execute.assert_called_once_with()
+        # The background thread always makes a last pass
+        archive_mock.assert_called_with(verbose=False)
+
+        # The thread is stopped even if pg_receivexlog fails
+        archive_mock.reset_mock()
+        receivexlog_mock.return_value.execute.side_effect = \
+            CommandFailedException(dict(ret=1, out='', err='error'))
+        with pytest.raises(ArchiverFailure):
+            archiver.receive_wal()
+        archive_mock.assert_called_with(verbose=False)
+
+    @patch("barman.wal_archiver.StreamingWalArchiver.archive")
+    @patch("barman.wal_archiver.ServerWalArchiveLock")
+    def test_inline_archive(self, lock_mock, archive_mock, tmpdir):
+        """
+        Test the loop executed by the inline archiver thread
+        """
+        backup_manager = build_backup_manager(
+            main_conf={'backup_directory': tmpdir})
+        archiver = StreamingWalArchiver(backup_manager)
+        stop = threading.Event()
+        stop.set()
+
+        archiver._inline_archive(stop)
+        lock_mock.assert_called_once_with(
+            backup_manager.config.barman_lock_directory,
+            backup_manager.config.name)
+        archive_mock.assert_called_once_with(verbose=False)
+
+        # An archive-wal process is running
+        archive_mock.reset_mock()
+        lock_mock.return_value.__enter__.side_effect = LockFileBusy
+        archiver._inline_archive(stop)
+        assert not archive_mock.called
+
+        # Errors don't stop the thread
+        lock_mock.return_value.__enter__.side_effect = None
+        archive_mock.side_effect = OSError('error')
+        archiver._inline_archive(stop)
+        archive_mock.assert_called_once_with(verbose=False)
+
     @patch("barman.utils.which")
     @patch("barman.command_wrappers.Command")
     def test_when_streaming_connection_rejected(
@@ -0,0 +1,330 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+import bz2
+import gzip
+import io
+import struct
+from contextlib import closing
+
+import pytest
+
+from barman.exceptions import BadWalFile, UnsupportedWalFile
+from barman.wal_reader import (POSTGRES_EPOCH, RM_XACT_ID, RM_XLOG_ID,
+                               XACT_XINFO_HAS_DBINFO, XACT_XINFO_HAS_INVALS,
+                               XACT_XINFO_HAS_RELFILENODES,
+                               XACT_XINFO_HAS_SUBXACTS,
+                               XACT_XINFO_HAS_TWOPHASE, XLOG_RESTORE_POINT,
+                               XLOG_XACT_ABORT, XLOG_XACT_ABORT_PREPARED,
+                               XLOG_XACT_COMMIT, XLOG_XACT_COMMIT_PREPARED,
+                               XLOG_XACT_HAS_INFO, XLP_FIRST_IS_CONTRECORD,
+                               XLP_LONG_HEADER, WalIndex, WalReader,
+                               read_wal_file)
+from barman.xlog import encode_segment_name
+
+MAGIC_96 = 0xD093
+MAGIC_94 = 0xD07E
+SEGMENT = encode_segment_name(1, 0, 0x3000000 // (256 * 8))
+
+
+def align(data):
+    """
+    Pad data to a multiple of 8 bytes
+    """
+    return data + b'\0' * (-len(data) % 8)
+
+
+def timestamp(epoch):
+    """
+    Build a PostgreSQL timestamp from a Unix epoch
+    """
+    return struct.pack('<q', int((epoch - POSTGRES_EPOCH) * 1000000))
+
+
+def record_96(xid, rmid, info, data, block=False):
+    """
+    Build a 9.5+ WAL record, with an optional block reference
+    """
+    if block:
+        headers = b'\x00' + b'\0' * 19
+    else:
+        headers = struct.pack('<BB', 255, len(data))
+    tot_len = 24 + len(headers) + len(data)
+    return struct.pack('<IIQBB2xI', tot_len, xid, 0, info, rmid, 0) + \
+        headers + data
+
+
+def record_94(xid, rmid, info, data):
+    """
+    Build a 9.3/9.4 WAL record
+    """
+    tot_len = 32 + len(data)
+    return struct.pack('<IIIBB2xQI4x', tot_len, xid, len(data), info,
+                       rmid, 0, 0) + data
+
+
+def build_segment(records, magic=MAGIC_96, page_size=256, pages=8,
+                  pageaddr=0x3000000, prefix=b'', tli=1):
+    """
+    Lay out a list of records inside the pages of a WAL segment
+
+    :param list[bytes] records: the records
+    :param bytes prefix: the end of a record started in the previous
+        segment
+    :return: the segment. The records not fitting in it are truncated.
+    """
+    # The (start, end) position of every record inside the stream
+    bounds = [(-1, len(prefix))]
+    stream = align(prefix)
+    for record in records:
+        bounds.append((len(stream), len(stream) + len(record)))
+        stream += align(record)
+    segment = b''
+    pos = 0
+    for page in range(pages):
+        info = 0
+        rem_len = 0
+        for begin, end in bounds:
+            if begin < pos < end:
+                info |= XLP_FIRST_IS_CONTRECORD
+                rem_len = end - pos
+        if page == 0:
+            info |= XLP_LONG_HEADER
+            header = struct.pack('<HHIQI4xQII', magic, info, tli, pageaddr,
+                                 rem_len, 42, page_size * pages,
+                                 page_size)
+        elif pos < len(stream):
+            header = struct.pack('<HHIQI4x', magic, info, tli,
+                                 pageaddr + page * page_size, rem_len)
+        else:
+            # Never written page
+            segment += b'\0' * page_size
+            continue
+        size = page_size - len(header)
+        segment += header + stream[pos:pos + size].ljust(size, b'\0')
+        pos += size
+    return segment
+
+
+def reader(segment, name=None):
+    """
+    Build a WalReader on the content of a segment
+    """
+    return WalReader(io.BytesIO(segment), name)
+
+
+def commit(xid, epoch, op=XLOG_XACT_COMMIT, builder=record_96):
+    return builder(xid, RM_XACT_ID, op, timestamp(epoch) + b'\0' * 8)
+
+
+def prepared_96(prepared_xid, epoch, op=XLOG_XACT_COMMIT_PREPARED):
+    """
+    Build a 9.5+ COMMIT PREPARED or ABORT PREPARED record, with every
+    section preceding the prepared xid
+    """
+    if op == XLOG_XACT_COMMIT_PREPARED:
+        xinfo = (XACT_XINFO_HAS_DBINFO | XACT_XINFO_HAS_SUBXACTS |
+                 XACT_XINFO_HAS_RELFILENODES | XACT_XINFO_HAS_INVALS |
+                 XACT_XINFO_HAS_TWOPHASE)
+        sections = (struct.pack('<II', 16384, 1663) +
+                    struct.pack('<iII', 2, 5001, 5002) +
+                    struct.pack('<i', 1) + b'r' * 12 +
+                    struct.pack('<i', 1) + b'i' * 16)
+    else:
+        xinfo = (XACT_XINFO_HAS_SUBXACTS | XACT_XINFO_HAS_RELFILENODES |
+                 XACT_XINFO_HAS_TWOPHASE)
+        sections = (struct.pack('<iI', 1, 5001) +
+                    struct.pack('<i', 2) + b'r' * 24)
+    data = (timestamp(epoch) + struct.pack('<I', xinfo) + sections +
+            struct.pack('<I', prepared_xid))
+    # The session terminating the prepared transaction has no xid
+    return record_96(0, RM_XACT_ID, op | XLOG_XACT_HAS_INFO, data)
+
+
+def prepared_94(prepared_xid, epoch, op=XLOG_XACT_COMMIT_PREPARED):
+    """
+    Build a 9.3/9.4 COMMIT PREPARED or ABORT PREPARED record
+    """
+    data = struct.pack('<I4x', prepared_xid) + timestamp(epoch) + \
+        b'\0' * 8
+    return record_94(0, RM_XACT_ID, op, data)
+
+
+def restore_point(name, epoch, builder=record_96):
+    return builder(0, RM_XLOG_ID, XLOG_RESTORE_POINT,
+                   timestamp(epoch) + name.encode().ljust(64, b'\0'))
+
+
+class TestWalReader(object):
+    """
+    Test the decoding of the WAL files
+    """
+
+    def test_index(self):
+        segment = build_segment([
+            commit(1000, 1500000000.5),
+            record_96(1001, 10, 0, b'x' * 100, block=True),
+            commit(1002, 1500000010.25, op=XLOG_XACT_ABORT),
+            restore_point('before upgrade', 1500000011),
+            # Records crossing page boundaries
+            record_96(1003, 10, 0, b'y' * 300, block=True),
+            commit(999, 1500000012),
+        ], prefix=b'z' * 13)
+        index = reader(segment, SEGMENT).index()
+        assert index == WalIndex(1500000000.5, 1500000012, 999, 1002,
+                                 ('before upgrade',))
+
+    def test_index_94(self):
+        segment = build_segment([
+            commit(1000, 1500000000, builder=record_94),
+            record_94(1001, 10, 0, b'x' * 100),
+            restore_point('rp', 1500000011, builder=record_94),
+            commit(1002, 1500000010, builder=record_94),
+        ], magic=MAGIC_94)
+        index = reader(segment).index()
+        assert index == WalIndex(1500000000, 1500000010, 1000, 1002,
+                                 ('rp',))
+
+    def test_index_prepared(self):
+        segment = build_segment([
+            commit(1000, 1500000000),
+            prepared_96(900, 1500000005),
+            prepared_96(1100, 1500000010, op=XLOG_XACT_ABORT_PREPARED),
+        ], page_size=512)
+        index = reader(segment).index()
+        assert index == WalIndex(1500000000, 1500000010, 900, 1100, ())
+
+    def test_index_prepared_94(self):
+        segment = build_segment([
+            commit(1000, 1500000000, builder=record_94),
+            prepared_94(900, 1500000005),
+            prepared_94(1100, 1500000010, op=XLOG_XACT_ABORT_PREPARED),
+        ], magic=MAGIC_94)
+        index = reader(segment).index()
+        assert index == WalIndex(1500000000, 1500000010, 900, 1100, ())
+
+    def test_empty(self):
+        index = reader(build_segment([])).index()
+        assert index == WalIndex(None, None, None, None, ())
+
+    def test_continuation(self):
+        # A record started in the previous segment, covering a whole page
+        segment = build_segment([commit(1000, 1500000000)],
+                                prefix=b'z' * 300)
+        assert reader(segment).index().min_xid == 1000
+
+        # A record continuing in the next segment is ignored
+        segment = build_segment(
+            [commit(1000, 1500000000),
+             record_96(1001, 10, 0, b'x' * 200, block=True)],
+            page_size=128, pages=2)
+        assert reader(segment).index() == WalIndex(
+            1500000000, 1500000000, 1000, 1000, ())
+
+        # The continuation is missing
+        segment = bytearray(build_segment([
+            record_96(1001, 10, 0, b'x' * 300, block=True),
+            commit(1000, 1500000000)]))
+        segment[256:280] = struct.pack('<HHIQI4x', MAGIC_96, 0, 1,
+                                       0x3000100, 0)
+        with pytest.raises(BadWalFile) as e:
+            reader(bytes(segment)).index()
+        assert 'broken continuation record' in str(e.value)
+
+        # The WAL data ends in the middle of a record
+        segment = bytearray(build_segment([
+            record_96(1001, 10, 0, b'x' * 300, block=True),
+            commit(1000, 1500000000)]))
+        segment[256:512] = b'\0' * 256
+        with pytest.raises(BadWalFile) as e:
+            reader(bytes(segment)).index()
+        assert 'incomplete record' in str(e.value)
+
+    def test_recycled_page(self):
+        segment = bytearray(build_segment([commit(1000, 1500000000)]))
+        # A page from a recycled segment, with an old address
+        segment[256:280] = struct.pack('<HHIQI4x', MAGIC_96, 0, 1,
+                                       0x1000100, 0)
+        record = align(commit(2000, 1400000000))
+        segment[280:280 + len(record)] = record
+        index = reader(bytes(segment), SEGMENT).index()
+        assert index == WalIndex(1500000000, 1500000000, 1000, 1000, ())
+
+    def test_validation(self):
+        segment = build_segment(
+            [commit(1000, 1500000000),
+             record_96(1001, 10, 0, b'x' * 600, block=True)])
+
+        # Truncated segment
+        with pytest.raises(BadWalFile) as e:
+            reader(segment[:1024]).index()
+        assert 'segment size is 1024 bytes, expected 2048' in str(e.value)
+        with pytest.raises(BadWalFile):
+            reader(segment[:20]).index()
+
+        # Wrong segment name
+        with pytest.raises(BadWalFile) as e:
+            reader(segment, encode_segment_name(1, 0, 1)).index()
+        assert 'segment address 0/3000000 does not match' in str(e.value)
+
+        # Wrong timeline
+        with pytest.raises(BadWalFile) as e:
+            reader(build_segment([], tli=2), SEGMENT).index()
+        assert 'unexpected timeline 2' in str(e.value)
+        segment_tli = bytearray(segment)
+        segment_tli[4:8] = struct.pack('<I', 2)
+        with pytest.raises(BadWalFile) as e:
+            reader(bytes(segment_tli)).index()
+        assert 'unexpected timeline 1 in page at offset 100' in str(e.value)
+
+        # A hole in the WAL data
+        segment_hole = bytearray(segment)
+        segment_hole[256:280] = b'\0' * 24
+        with pytest.raises(BadWalFile) as e:
+            reader(bytes(segment_hole)).index()
+        assert 'missing WAL data before offset 200' in str(e.value)
+
+        # Unknown page magic
+        with pytest.raises(UnsupportedWalFile):
+            reader(build_segment([], magic=0xD000)).index()
+        with pytest.raises(BadWalFile):
+            reader(b'\0' * 2048).index()
+
+    @pytest.mark.parametrize(('compression', 'opener'), [
+        (None, open),
+        ('gzip', gzip.GzipFile),
+        ('pybzip2', bz2.BZ2File),
+    ])
+    def test_read_wal_file(self, compression, opener, tmpdir):
+        wal_file = tmpdir.join(SEGMENT)
+        with closing(opener(wal_file.strpath, 'wb')) as f:
+            f.write(build_segment([commit(1000, 1500000000)]))
+        index = read_wal_file(wal_file.strpath, compression=compression)
+        assert index.min_xid == 1000
+
+        with closing(opener(wal_file.strpath, 'wb')) as f:
+            f.write(b'\0' * 2048)
+        with pytest.raises(BadWalFile):
+            read_wal_file(wal_file.strpath, compression=compression)
+
+    def test_read_wal_file_errors(self, tmpdir):
+        wal_file = tmpdir.join(SEGMENT)
+        wal_file.write_binary(b'not compressed')
+        with pytest.raises(BadWalFile):
+            read_wal_file(wal_file.strpath, compression='gzip')
+        with pytest.raises(UnsupportedWalFile):
+            read_wal_file(wal_file.strpath, compression='custom')
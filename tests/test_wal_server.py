@@ -0,0 +1,188 @@
+# Copyright (C) 2011-2017 2ndQuadrant Limited
+#
+# This file is part of Barman.
+#
+# Barman is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Barman is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Barman.  If not, see <http://www.gnu.org/licenses/>.
+
+import gzip
+import io
+import socket
+import threading
+from contextlib import closing
+
+import pytest
+from mock import patch
+
+from barman.exceptions import WalServerException
+from barman.server import Server
+from barman.wal_server import (PeekedWal, WalClient, WalServer, get_wal,
+                               is_loopback, parse_address)
+from testing_helpers import build_config_from_dicts
+
+WALS = ['000000010000000000000001',
+        '000000010000000000000002',
+        '000000010000000000000003']
+
+
+@pytest.fixture
+def wal_server(tmpdir):
+    """
+    Run a WAL server for the 'main' server in a thread
+    """
+    server = Server(build_config_from_dicts(
+        global_conf={'barman_home': tmpdir.strpath},
+    ).get_server('main'), lazy=True)
+    wals_dir = tmpdir.join('main', 'wals', WALS[0][:16])
+    wals_dir.join(WALS[0]).write_binary(b'first wal', ensure=True)
+    with closing(gzip.GzipFile(wals_dir.join(WALS[1]).strpath, 'wb')) as f:
+        f.write(b'second wal' * 1000)
+    wals_dir.join(WALS[2]).write_binary(b'third wal')
+    # The WAL files listed by PEEK are taken from the xlogdb
+    tmpdir.join('main', 'wals', 'xlog.db').write(
+        '%s\t9\t1500000000\tNone\n'
+        '%s\t100\t1500000001\tgzip\n'
+        '%s\t9\t1500000002\tNone\n' % tuple(WALS))
+    wal_server = WalServer({'main': server},
+                           tmpdir.join('wal.sock').strpath)
+    wal_server.bind()
+    # Signals can't be handled outside the main thread
+    with patch('barman.wal_server.signal'):
+        thread = threading.Thread(target=wal_server.run)
+        thread.start()
+        yield wal_server
+        wal_server.stop()
+        thread.join()
+    assert not tmpdir.join('wal.sock').check()
+
+
+class TestWalServer(object):
+    """
+    Test the WAL server and its client
+    """
+
+    def test_parse_address(self):
+        assert parse_address('/tmp/wal.sock') == (socket.AF_UNIX,
+                                                  '/tmp/wal.sock')
+        assert parse_address('127.0.0.1:5433') == (socket.AF_INET,
+                                                   ('127.0.0.1', 5433))
+        family, socket_address = parse_address(':5433')
+        assert socket_address[1] == 5433
+        assert is_loopback(family, socket_address)
+        family, socket_address = parse_address('[::1]:5433')
+        assert family == socket.AF_INET6
+        assert socket_address[:2] == ('::1', 5433)
+        with pytest.raises(WalServerException):
+            parse_address('barman')
+
+    def test_remote_address(self):
+        # Remote connections must be explicitly allowed
+        wal_server = WalServer({}, '0.0.0.0:0')
+        with pytest.raises(WalServerException) as e:
+            wal_server.bind()
+        assert 'not a loopback address' in str(e.value)
+        assert wal_server._server is None
+        wal_server = WalServer({}, '0.0.0.0:0', allow_remote=True)
+        wal_server.bind()
+        wal_server._server.server_close()
+
+        wal_server = WalServer({}, '127.0.0.1:0')
+        wal_server.bind()
+        assert wal_server._server.server_address[0] == '127.0.0.1'
+        wal_server._server.server_close()
+
+    def test_requests(self, wal_server):
+        client = WalClient(wal_server.address, timeout=10)
+        # All the requests are sent before reading the responses
+        requests = [(name, io.BytesIO())
+                    for name in WALS[1:] + ['000000010000000000000009']]
+        errors = client.get_wals('main', requests)
+        assert requests[0][1].getvalue() == b'second wal' * 1000
+        assert requests[1][1].getvalue() == b'third wal'
+        assert errors == {
+            '000000010000000000000009':
+                "WAL file '000000010000000000000009' not found in "
+                "server 'main'"}
+
+        # The same connection is still usable
+        destination = io.BytesIO()
+        assert client.get_wals('main', [(WALS[0], destination)],
+                               compression='gzip') == {}
+        assert destination.getvalue() == b'first wal'
+        destination = io.BytesIO()
+        assert client.get_wals('main', [(WALS[1], destination)],
+                               compression='bzip2') == {}
+        assert destination.getvalue() == b'second wal' * 1000
+        assert client.peek('main', WALS[1], 5) == [
+            PeekedWal(WALS[1], 100, 'gzip'),
+            PeekedWal(WALS[2], 9, None)]
+
+        # Invalid requests
+        with pytest.raises(WalServerException) as e:
+            client.peek('other', WALS[0], 5)
+        assert "unknown server 'other'" in str(e.value)
+        errors = client.get_wals('main', [('../xlog.db', io.BytesIO())])
+        assert errors == {'../xlog.db':
+                          "'../xlog.db' is not a valid wal file name"}
+        errors = client.get_wals('main', [(WALS[0], io.BytesIO())],
+                                 compression='custom')
+        assert errors == {WALS[0]: "unsupported compression 'custom'"}
+        client._send('DELETE', 'main')
+        assert client._read_response(None) == \
+            "invalid request 'DELETE main'"
+        client.close()
+
+    def test_get_wal(self, wal_server, tmpdir):
+        client = WalClient(wal_server.address, timeout=10)
+        spool_dir = tmpdir.join('spool')
+        wal_dest = tmpdir.join('pg_wal', 'RECOVERYXLOG').ensure()
+
+        # The following WAL files are retrieved in advance
+        assert get_wal(client, 'main', WALS[0], wal_dest.strpath,
+                       compression='gzip', prefetch=5,
+                       spool_dir=spool_dir.strpath) is None
+        assert wal_dest.read_binary() == b'first wal'
+        assert sorted(spool_dir.listdir()) == [spool_dir.join(WALS[1]),
+                                               spool_dir.join(WALS[2])]
+
+        # and then taken from the spool directory
+        client.close()
+        with patch.object(client, 'get_wals') as get_wals_mock:
+            assert get_wal(client, 'main', WALS[2], wal_dest.strpath,
+                           spool_dir=spool_dir.strpath) is None
+        assert not get_wals_mock.called
+        assert wal_dest.read_binary() == b'third wal'
+        assert spool_dir.listdir() == [spool_dir.join(WALS[1])]
+
+        # A missing file
+        assert get_wal(client, 'main', '000000010000000000000009',
+                       wal_dest.strpath) == \
+            "WAL file '000000010000000000000009' not found in server 'main'"
+        assert wal_dest.read_binary() == b'third wal'
+        assert tmpdir.join('pg_wal').listdir() == [wal_dest]
+        client.close()
+
+    def test_stale_socket(self, wal_server, tmpdir):
+        # A running WAL server is not replaced
+        other = WalServer({}, wal_server.address)
+        with pytest.raises(WalServerException):
+            other.bind()
+
+        # The socket left by a terminated WAL server is replaced
+        sock_path = tmpdir.join('stale.sock').strpath
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(sock_path)
+        sock.close()
+        other = WalServer({}, sock_path)
+        other.bind()
+        other._server.server_close()
@@ -206,6 +206,72 @@ class Test(object):
                 '000000010000000200000001',
                 '000000010000000200000002')
 
+    def test_segment_number(self):
+        assert xlog.segments_per_xlog_file() == 0x80000
+        assert xlog.segments_per_xlog_file(version=90200) == 0x7ffff
+        assert xlog.segments_per_xlog_file(1 << 24) == 256
+        assert xlog.segments_per_xlog_file(1 << 24, 90200) == 255
+        assert xlog.segments_per_xlog_file(1 << 26) == 64
+
+        assert xlog.segment_number(
+            '/path/00000003000000020000000A', 1 << 24) == (3, 0x20A)
+        assert xlog.segment_number(
+            '00000003000000020000000A', 1 << 24, 90200) == (3, 0x1FE + 0xA)
+        assert xlog.segment_number(
+            '00000003000000020000000A') == (3, 0x10000A)
+        assert xlog.segment_name(3, 0x20A, 1 << 24) == \
+            '00000003000000020000000A'
+        assert xlog.segment_name(3, 0x1FE + 0xA, 1 << 24, 90200) == \
+            '00000003000000020000000A'
+        with pytest.raises(barman.exceptions.BadXlogSegmentName):
+            xlog.segment_number('00000001.history')
+        with pytest.raises(barman.exceptions.BadXlogSegmentName):
+            xlog.segment_number('00000001000000000000000X')
+
+    def test_segment_range(self):
+        segments = xlog.SegmentRange.from_names(
+            '0000000100000001000000FE', '000000010000000300000001',
+            1 << 24)
+        # The range is counted without generating the names
+        assert len(segments) == 260
+        assert len(xlog.SegmentRange.from_names(
+            '000000010000000000000000', '000000010000FFFF000000FF',
+            1 << 24)) == 1 << 24
+        assert segments[0] == '0000000100000001000000FE'
+        assert segments[2] == '000000010000000200000000'
+        assert segments[-1] == '000000010000000300000001'
+        with pytest.raises(IndexError):
+            segments[260]
+        assert list(segments[1:4]) == [
+            '0000000100000001000000FF',
+            '000000010000000200000000',
+            '000000010000000200000001']
+        assert len(segments[-2:]) == 2
+        assert len(segments[300:]) == 0
+        with pytest.raises(ValueError):
+            segments[::2]
+        assert list(segments)[-3:] == [
+            '0000000100000002000000FF',
+            '000000010000000300000000',
+            '000000010000000300000001']
+
+        # Membership checks the timeline and the boundaries
+        assert '000000010000000200000080' in segments
+        assert '/path/000000010000000200000080' in segments
+        assert '000000020000000200000080' not in segments
+        assert '0000000100000001000000FD' not in segments
+        assert '000000010000000300000002' not in segments
+        assert '000000010000000200000100' not in segments
+        assert '00000001.history' not in segments
+        assert '000000010000000200000080.partial' not in segments
+        assert segments.index('000000010000000200000080') == 0x82
+        with pytest.raises(ValueError):
+            segments.index('000000020000000200000080')
+
+        # An empty range
+        assert len(xlog.SegmentRange.from_names(
+            '000000010000000200000001', '000000010000000100000001')) == 0
+
     def test_hash_dir(self):
         assert xlog.hash_dir(
             '000000000000000200000001') == '0000000000000002'
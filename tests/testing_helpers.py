@@ -231,6 +231,7 @@ def build_config_dictionary(config_keys=None):
         'archiver': True,
         'archiver_batch_size': 0,
         'config': None,
+        'backup_compression': None,
         'backup_directory': '/some/barman/home/main',
         'backup_options': BackupOptions("",  "", ""),
         'bandwidth_limit': None,
@@ -243,6 +244,8 @@ def build_config_dictionary(config_keys=None):
         'check_timeout': 30,
         'custom_compression_filter': None,
         'custom_decompression_filter': None,
+        'deduplication': False,
+        'deduplication_directory': '/some/barman/home/main/objects',
         'description': ' Text with quotes ',
         'immediate_checkpoint': False,
         'incoming_wals_directory': '/some/barman/home/main/incoming',
@@ -278,9 +281,18 @@ def build_config_dictionary(config_keys=None):
         'msg_list': [],
         'path_prefix': None,
         'streaming_archiver': False,
+        'streaming_archiver_inline': False,
         'streaming_wals_directory': '/some/barman/home/main/streaming',
         'errors_directory': '/some/barman/home/main/errors',
         'parallel_jobs': 1,
+        'postgres_backup_jobs': 1,
+        'remote_status_cache_ttl': 0,
+        'wal_index': False,
+        'wal_integrity_check': False,
+        'deletion_mode': 'immediate',
+        'trash_directory': '/some/barman/home/main/trash',
+        'trash_reclaim_jobs': 1,
+        'trash_reclaim_rate': 0,
     }
     # Check for overriding keys
     if config_keys is not None: